@@ -0,0 +1,117 @@
+var clone = require('clone');
+
+var INDEXED = /([A-Za-z_]\w*)((?:@[A-Za-z_]\w*)+)/g;
+
+/**
+ * Expand the indexed families of a model (see expand_indices in
+ * src/Cmodel.py, the naming of the expanded names has to be the
+ * same): every element of populations, reactions, observations, data,
+ * inputs and sde.drift using names suffixed by @index (e.g. S@p) is
+ * repeated for every value of the indices it uses. Coupling matrices
+ * (model.couplings) are replaced by their values and the elements
+ * where they are 0 are dropped.
+ */
+exports.expand = function(model){
+
+  if(!model.indices || !model.indices.length){
+    return model;
+  }
+
+  var n = {}, width = {}, order = [], couplings = {};
+  model.indices.forEach(function(x){
+    n[x.name] = x.n;
+    width[x.name] = String(x.n - 1).length;
+    order.push(x.name);
+  });
+  (model.couplings || []).forEach(function(x){
+    couplings[x.name] = x.value;
+  });
+
+  function pad(v, w){
+    var s = String(v);
+    while(s.length < w){
+      s = '0' + s;
+    }
+    return s;
+  };
+
+  function used(x, found){
+    if(typeof x === 'string'){
+      var m;
+      INDEXED.lastIndex = 0;
+      while((m = INDEXED.exec(x)) !== null){
+        m[2].split('@').slice(1).forEach(function(i){
+          if(!(i in n)){
+            throw new Error('undefined index ' + i + ' in ' + x);
+          }
+          found[i] = true;
+        });
+      }
+    } else if(Array.isArray(x)){
+      x.forEach(function(v){used(v, found);});
+    } else if(x && typeof x === 'object'){
+      Object.keys(x).forEach(function(k){used(x[k], found);});
+    }
+    return found;
+  };
+
+  function subst(x, env){
+    if(typeof x === 'string'){
+      return x.replace(INDEXED, function(match, name, suffix){
+        var ind = suffix.split('@').slice(1);
+        if(name in couplings){
+          var value = couplings[name];
+          ind.forEach(function(i){value = value[env[i]];});
+          if(!value){
+            throw {zero: true};
+          }
+          return String(value);
+        }
+        return name + '__' + ind.map(function(i){return pad(env[i], width[i]);}).join('_');
+      });
+    } else if(Array.isArray(x)){
+      return x.map(function(v){return subst(v, env);});
+    } else if(x && typeof x === 'object'){
+      var res = {};
+      Object.keys(x).forEach(function(k){res[k] = subst(x[k], env);});
+      return res;
+    }
+    return x;
+  };
+
+  function expand(elements){
+    var res = [];
+    elements.forEach(function(x){
+      var found = used(x, {});
+      var ind = order.filter(function(i){return i in found;});
+
+      (function product(d, env){
+        if(d === ind.length){
+          try {
+            res.push(subst(x, env));
+          } catch(e){
+            if(!e.zero) throw e;
+          }
+          return;
+        }
+        for(var v = 0; v < n[ind[d]]; v++){
+          env[ind[d]] = v;
+          product(d+1, env);
+        }
+      })(0, {});
+    });
+    return res;
+  };
+
+  model = clone(model);
+  ['populations', 'reactions', 'observations', 'data', 'inputs'].forEach(function(k){
+    if(k in model){
+      model[k] = expand(model[k]);
+    }
+  });
+  if(model.sde && model.sde.drift){
+    model.sde.drift = expand(model.sde.drift);
+  }
+
+  return model;
+};
@@ -3,9 +3,89 @@ var fs = require('fs')
   , rimraf = require('rimraf')
   , path = require('path')
   , spawn = require('child_process').spawn
-  , inputs = require('../lib/inputs');
+  , inputs = require('../lib/inputs')
+  , indices = require('../lib/indices');
+
+/**
+ * log a summary of the profile written by Builder(profile=True)
+ * (see src/Builder.py Profile)
+ */
+function logProfile(pathModel, emitter){
+  try {
+    var profile = JSON.parse(fs.readFileSync(path.join(pathModel, '.profile.json')));
+  } catch(e) {
+    return emitter.emit('error', 'could not read the build profile: ' + e.message);
+  }
+
+  var ms = function(x){ return (1000*x).toFixed(1) + ' ms'; };
+
+  emitter.emit('log', 'Build profile (' + path.join(pathModel, '.profile.json') + '):');
+  emitter.emit('log', '  SymPy calls: ' + Object.keys(profile.symbolic).map(function(op){ return op + ' ' + profile.symbolic[op]; }).join(', '));
+
+  var stats = profile.stats;
+  var perTemplate = function(x){ return Object.keys(x.templates).filter(function(k){ return x.templates[k]; }).sort().map(function(k){ return k + ': ' + x.templates[k]; }).join(', '); };
+  emitter.emit('log', '  symbolic cache: ' + stats.symbolic_cache.hits + ' hits, ' + stats.symbolic_cache.disk_hits + ' disk hits, ' + stats.symbolic_cache.misses + ' misses');
+  emitter.emit('log', '  cse: ' + stats.cse.n_removed + ' operations removed (' + perTemplate(stats.cse) + ')');
+  emitter.emit('log', '  precompute: ' + stats.precompute.length + ' parameter only subexpressions (' + perTemplate(stats.precompute) + ')');
+  emitter.emit('log', '  time cache: ' + stats.time_cache.length + ' time only subexpressions (' + perTemplate(stats.time_cache) + ')');
+
+  emitter.emit('log', '  templates:');
+  Object.keys(profile.templates).sort(function(a, b){ return profile.templates[b] - profile.templates[a]; }).forEach(function(x){
+    emitter.emit('log', '    ' + x + ': ' + ms(profile.templates[x]));
+  });
+
+  emitter.emit('log', '  slowest methods:');
+  profile.methods.slice(0, 10).forEach(function(x){
+    emitter.emit('log', '    ' + x.name + ': ' + ms(x.time) + ' (' + x.calls + ' calls)');
+  });
+
+  emitter.emit('log', '  slowest expressions:');
+  profile.slowest.slice(0, 10).forEach(function(x){
+    var op = x.derivate ? ('d/d' + x.derivate + ' ') : (x.inverse ? ('solve for ' + x.inverse + ' ') : '');
+    emitter.emit('log', '    ' + ms(x.time) + ' ' + op + x.term + ' [' + x.templates.join(', ') + ']');
+  });
+};
+
+/**
+ * Without keepSources the sources are not left in pathModel/C but
+ * moved to pathModel/.C (with the manifest of the build, see
+ * src/Builder.py code()) so that the next install only re-renders and
+ * recompiles what changed: restore them.
+ */
+function restoreSources(pathModel, callback){
+  var pathSources = path.join(pathModel, 'C')
+    , pathKept = path.join(pathModel, '.C');
+
+  fs.exists(pathKept, function(kept){
+    if(!kept) return callback(null);
+
+    fs.exists(pathSources, function(exists){
+      if(exists){
+        rimraf(pathKept, callback);
+      } else {
+        fs.rename(pathKept, pathSources, callback);
+      }
+    });
+  });
+};
+
+/**
+ * move the sources out of the way (see restoreSources)
+ */
+function hideSources(pathModel, callback){
+  var pathKept = path.join(pathModel, '.C');
+
+  rimraf(pathKept, function(err){
+    if(err) return callback(err);
+    fs.rename(path.join(pathModel, 'C'), pathKept, callback);
+  });
+};
 
-module.exports = function(dpkgRoot, dpkg, pathModel, keepSources, emitter, callback){
+/**
+ * profile (optional, last for backward compatibility): write and log
+ * the build profile (.profile.json)
+ */
+module.exports = function(dpkgRoot, dpkg, pathModel, keepSources, emitter, callback, profile){
 
   function fail(err){
     if(err){
@@ -17,74 +97,70 @@ module.exports = function(dpkgRoot, dpkg, pathModel, keepSources, emitter, callb
   mkdirp(pathModel, function (err) {
     if(err) return fail(err);
 
-    //get data
-    inputs.resolve(dpkgRoot, dpkg, dpkg.data.concat(dpkg.inputs).filter(function(x){return ('require' in x) && ('fields' in x.require);}), function(err, rlinks){
+    restoreSources(pathModel, function(err){
       if(err) return fail(err);
 
-      fs.writeFile(path.join(pathModel, '.data.json'), JSON.stringify(rlinks), function(err){
+      //get data (of the expanded model, see lib/indices.js)
+      var xdpkg = indices.expand(dpkg);
+      inputs.resolve(dpkgRoot, xdpkg, xdpkg.data.concat(xdpkg.inputs).filter(function(x){return ('require' in x) && ('fields' in x.require);}), function(err, rlinks){
         if(err) return fail(err);
-        
-        var tplter = [
-          "import os",
-          "import sys",
-          "import json",
-          "class SsmError(Exception):",
-          "\tdef __init__(self, value):",
-          "\t\tself.value = value",
-          "\tdef __str__(self):",
-          "\t\treturn repr(self.value)",
-          "sys.path.append('" + path.resolve(__dirname, '..', 'src') + "')",
-          "from Builder import Builder",
-          "path_model_coded = '" + pathModel + "'",
-          "dpkg = json.load(open('" + path.join(dpkgRoot, 'ssm.json') + "'))",
-          "try:",
-          "\tb = Builder(path_model_coded, '"+ dpkgRoot + "', dpkg)",
-          "\tb.prepare()",
-          "\tb.code()",
-          "\tb.write_data()",
-          "except SsmError as err:",
-          "\tsys.exit(1)"//,
-        ].join('\n');
-
-        var templater = spawn('python', ['-c', tplter]);
-        templater.stdout.setEncoding('utf8');
-        templater.stderr.setEncoding('utf8');
-        templater.stdout.on('data', function(data){
-          emitter.emit('logEol', data);
-        });
-        templater.stderr.on('data', function(data){
-          emitter.emit('errorEol', data);
-        });
-
-        templater.on('exit', function (code) {
-
-          // console.log('CODE', code);
-
-          if(code === 0) {
-            var make = spawn('make', ['install'], {cwd: path.join(pathModel, 'C', 'templates')});
-            make.stdout.setEncoding('utf8');
-            make.stderr.setEncoding('utf8');
-            make.stdout.on('data', function(data){
-              emitter.emit('logEol', data);
-            });
-            make.stderr.on('data', function(data){
-              emitter.emit('errorEol', data);
-            });
 
-            make.on('exit', function (code) {
-              if(keepSources){
-
-                if(code === 0){
-                  emitter.emit('success','model has been created in ' + pathModel);
-                  callback(null);
-                } else {
-                  callback(new Error('could not build the model ('+ code +').'));
-                }
+        fs.writeFile(path.join(pathModel, '.data.json'), JSON.stringify(rlinks), function(err){
+          if(err) return fail(err);
+        
+          var tplter = [
+            "import os",
+            "import sys",
+            "import json",
+            "class SsmError(Exception):",
+            "\tdef __init__(self, value):",
+            "\t\tself.value = value",
+            "\tdef __str__(self):",
+            "\t\treturn repr(self.value)",
+            "sys.path.append('" + path.resolve(__dirname, '..', 'src') + "')",
+            "from Builder import Builder",
+            "path_model_coded = '" + pathModel + "'",
+            "dpkg = json.load(open('" + path.join(dpkgRoot, 'ssm.json') + "'))",
+            "try:",
+            "\tb = Builder(path_model_coded, '"+ dpkgRoot + "', dpkg, profile=" + (profile ? "True" : "False") + ")",
+            "\tb.prepare()",
+            "\tb.code()",
+            "\tb.write_data()",
+            "except SsmError as err:",
+            "\tsys.exit(1)"//,
+          ].join('\n');
+
+          var templater = spawn('python', ['-c', tplter]);
+          templater.stdout.setEncoding('utf8');
+          templater.stderr.setEncoding('utf8');
+          templater.stdout.on('data', function(data){
+            emitter.emit('logEol', data);
+          });
+          templater.stderr.on('data', function(data){
+            emitter.emit('errorEol', data);
+          });
+
+          templater.on('exit', function (code) {
+
+            // console.log('CODE', code);
+
+            if(code === 0) {
+              if(profile){
+                logProfile(pathModel, emitter);
+              }
 
-              } else {
+              var make = spawn('make', ['install'], {cwd: path.join(pathModel, 'C', 'templates')});
+              make.stdout.setEncoding('utf8');
+              make.stderr.setEncoding('utf8');
+              make.stdout.on('data', function(data){
+                emitter.emit('logEol', data);
+              });
+              make.stderr.on('data', function(data){
+                emitter.emit('errorEol', data);
+              });
 
-                rimraf(path.join(pathModel, 'C'), function(err){
-                  if(err) emitter.emit('error', err.message);
+              make.on('exit', function (code) {
+                if(keepSources){
 
                   if(code === 0){
                     emitter.emit('success','model has been created in ' + pathModel);
@@ -93,14 +169,28 @@ module.exports = function(dpkgRoot, dpkg, pathModel, keepSources, emitter, callb
                     callback(new Error('could not build the model ('+ code +').'));
                   }
 
-                });
+                } else {
+
+                  hideSources(pathModel, function(err){
+                    if(err) emitter.emit('error', err.message);
 
-              }
+                    if(code === 0){
+                      emitter.emit('success','model has been created in ' + pathModel);
+                      callback(null);
+                    } else {
+                      callback(new Error('could not build the model ('+ code +').'));
+                    }
+
+                  });
+
+                }
               
-            });
-          } else {
-            callback(new Error('could not template the model ('+ code +').'));
-          }
+              });
+            } else {
+              callback(new Error('could not template the model ('+ code +').'));
+            }
+
+          });
 
         });
 
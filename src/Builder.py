@@ -21,38 +21,213 @@ import os.path
 import tarfile
 import shutil
 import json
-
-from Ccoder import Ccoder
+import copy
+import hashlib
+import inspect
+import time
+import multiprocessing
+
+from Cmodel import cached_sym_ccode, SYMBOLIC_OPS
+from Ccoder import Ccoder, ROLL_UNIT
 from Data import Data
 
-from jinja2 import Environment, FileSystemLoader
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def uses(x, name):
+    """True if one of the strings of x (nested dicts, lists and
+    tuples of strings) contains name (e.g. '_pre[')"""
+
+    if isinstance(x, dict):
+        return any(uses(y, name) for y in x.values())
+    elif isinstance(x, (list, tuple)):
+        return any(uses(y, name) for y in x)
+    return isinstance(x, basestring) and name in x
+
+def _cached_sym_ccode(args):
+    """pool worker for Builder.code (has to be picklable). Returns
+    (ccode, status, SymPy calls, time)"""
+
+    key, cache_dir = args
+    counts = dict.fromkeys(SYMBOLIC_OPS, 0)
+    t = time.time()
+    Cterm, status = cached_sym_ccode(key, cache_dir, None, counts)
+
+    return (Cterm, status, counts, time.time() - t)
+
+
+class Profile:
+    """
+    profile of a build (see Builder(profile=True)): wall time and
+    calls of every Ccoder method, SymPy calls (see SYMBOLIC_OPS)
+    made on behalf of each of them and the slowest symbolic
+    expressions with the templates whose generation requested them.
+    """
+
+    def __init__(self, n_slowest=20):
+        self.n_slowest = n_slowest
+        self.methods = {}
+        self.stack = []
+        self.template = None
+        self.templates = {}
+        self.expressions = {}
+        self.recorders = []
+        self.recorded = {}
+
+    def method(self, name):
+        if name not in self.methods:
+            self.methods[name] = dict(dict.fromkeys(SYMBOLIC_OPS, 0), calls=0, time=0.0)
+        return self.methods[name]
+
+    def wrap(self, name, f):
+        """f counted and timed as the Ccoder method name (time
+        includes the nested Ccoder methods, SymPy calls are
+        attributed to the innermost one, see computed)"""
+
+        def wrapped(*args, **kwargs):
+            m = self.method(name)
+            m['calls'] += 1
+            self.stack.append(name)
+            t = time.time()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                m['time'] += time.time() - t
+                self.stack.pop()
+
+        return wrapped
+
+    def record(self, name, f):
+        """f() remembering the expressions it requests so that a
+        memoized result used by other templates can be attributed
+        to them as well (see replay)"""
+
+        keys = set()
+        self.recorders.append(keys)
+        try:
+            return f()
+        finally:
+            self.recorders.pop()
+            self.recorded[name] = keys
+
+    def replay(self, name):
+        for key in self.recorded.get(name, []):
+            self.request(key)
+
+    def request(self, key):
+        x = self.expressions.setdefault(key, {'time': 0.0, 'method': None, 'templates': set()})
+        if self.template:
+            x['templates'].add(self.template)
+        for keys in self.recorders:
+            keys.add(key)
+
+    def computed(self, key, counts, elapsed, method=None):
+        ##attributed to the innermost generator rather than to the
+        ##make_C_term plumbing every generator goes through
+        if method is None:
+            method = next((x for x in reversed(self.stack) if x not in ('make_C_term', 'sym_ccode')), 'make_C_term')
+        m = self.method(method)
+        for op in SYMBOLIC_OPS:
+            m[op] += counts[op]
+
+        x = self.expressions.setdefault(key, {'time': 0.0, 'method': None, 'templates': set()})
+        x['time'] += elapsed
+        x['method'] = method
+
+    def report(self):
+        methods = [dict(v, name=k) for k, v in self.methods.items()]
+        methods.sort(key=lambda x: x['time'], reverse=True)
+
+        slowest = sorted(self.expressions.items(), key=lambda x: x[1]['time'], reverse=True)[:self.n_slowest]
+
+        return {
+            'templates': self.templates,
+            'methods': methods,
+            'symbolic': dict((op, sum(x[op] for x in methods)) for op in SYMBOLIC_OPS),
+            'slowest': [{
+                'term': safe.replace('ssm___', ''),
+                'derivate': derivate,
+                'inverse': inverse,
+                'time': x['time'],
+                'method': x['method'],
+                'templates': sorted(x['templates'])
+            } for (safe, derivate, inverse), x in slowest if x['time'] > 0]
+        }
 
 class Builder(Data, Ccoder):
     """build a model"""
 
     def __init__(self, path_rendered, dpkgRoot, dpkg,  **kwargs):
+        ##on disk symbolic cache shared across builds (cache_dir=None to disable)
+        kwargs.setdefault('cache_dir', os.environ.get('SSM_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.ssm', 'cache')))
+
         Ccoder.__init__(self, dpkgRoot, dpkg, **kwargs)
         Data.__init__(self, path_rendered, dpkgRoot, dpkg,  **kwargs)
 
+        ##opt-in profiling (see Profile): code() writes the report in .profile.json
+        if kwargs.get('profile', False):
+            self.profile = Profile()
+            for name, f in inspect.getmembers(Ccoder, inspect.ismethod):
+                if not name.startswith('_'):
+                    setattr(self, name, self.profile.wrap(name, getattr(self, name)))
+
         self.path_rendered = os.path.abspath(unicode(path_rendered, 'utf8'))
-        self.env = Environment(loader=FileSystemLoader(os.path.join(self.path_rendered, 'C', 'templates')))
+
+        ##templates whose generated functions go through common subexpression elimination (see Ccoder.cse)
+        ##(not by default for models with indices: the temporaries would prevent the equations to be rolled into loops)
+        self.cse_templates = set(kwargs.get('cse', [] if self.indices else ['ode_sde', 'step_ekf', 'Q', 'jac', 'Ht']))
+        self.cse_stats = {}
+
+        ##templates whose generated functions use the parameter only subexpressions computed once per parameter set (see Ccoder.precompute)
+        self.precompute_templates = set(kwargs.get('precompute', ['ode_sde', 'psr', 'observed', 'Q', 'Ht', 'jac', 'step_ekf']))
+        self.precompute_stats = {}
+
+        ##stepping functions whose time only caches are computed once per time point and shared by the particles (see Ccoder.time_cache, fixed time grid only: sde and euler psr)
+        self.time_cache_templates = set(kwargs.get('time_cache', ['ode_sde', 'psr']))
+        self.time_cache_stats = {}
+
+        bcc = None
+        if self.cache_dir:
+            path_bcc = os.path.join(self.cache_dir, 'jinja')
+            if not os.path.exists(path_bcc):
+                os.makedirs(path_bcc)
+            bcc = FileSystemBytecodeCache(path_bcc)
+
+        self.env = Environment(loader=FileSystemLoader(os.path.join(self.path_rendered, 'C', 'templates')), bytecode_cache=bcc)
         self.env.filters.update({
-            'is_prior': lambda x: ('require' in x) and ('fields' not in x['require']) and ('data' in x) and ('distribution' in x['data'])
+            'is_prior': lambda x: ('require' in x) and ('fields' not in x['require']) and ('data' in x) and ('distribution' in x['data']),
+            'roll': self.roll,
+            'soa': self.soa,
+            'uses': uses
         })
+        self.env.globals['roll_unit'] = ROLL_UNIT
 
-    def prepare(self, path_templates=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'C', 'templates'), replace=True):
+    def prepare(self, path_templates=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'C', 'templates'), replace=False):
         """
-        copy templates to path_rendered
+        copy templates to path_rendered.
+
+        Unless replace is True, previous builds are kept and only the
+        files whose content changed are copied so that make can skip
+        the objects that are up to date.
         """
 
-        ##this function is called only when a new user has created or edited a model whose name is unique (primary key) so it is the only one able to recreate a model...
         if replace:
             if os.path.exists(self.path_rendered):
                 shutil.rmtree(self.path_rendered)
 
         #copy templates to uploads/rendered/user_name/model_id
-        if not os.path.exists(self.path_rendered):
-            shutil.copytree(path_templates, os.path.join(self.path_rendered, 'C', 'templates'))
+        path_dest = os.path.join(self.path_rendered, 'C', 'templates')
+        if not os.path.exists(path_dest):
+            os.makedirs(path_dest)
+
+        for x in os.listdir(path_templates):
+            src = os.path.join(path_templates, x)
+            dest = os.path.join(path_dest, x)
+            if os.path.isfile(src) and not (os.path.exists(dest) and read_file(src) == read_file(dest)):
+                shutil.copy(src, dest)
 
     def archive(self, replace=True):
         """make a tarball"""
@@ -66,59 +241,369 @@ class Builder(Data, Ccoder):
                 shutil.rmtree(self.path_rendered)
 
     def render(self, prefix, data):
+        """render <prefix>_template.c into <prefix>.c. The file is
+        only written if its content changed (keep mtime for make)"""
+
+        path_tpl = os.path.join(self.path_rendered, 'C', 'templates', prefix + '_template.c')
+        path_c = os.path.join(self.path_rendered, 'C', 'templates', prefix + '.c')
 
         template = self.env.get_template(prefix + '_template.c')
-        with open(os.path.join(self.path_rendered, 'C', 'templates', prefix + ".c"), "w") as f:
-            f.write(template.render(data))
-            os.remove(os.path.join(self.path_rendered, 'C', 'templates', prefix + '_template.c'))
+        code = template.render(data).encode('utf8')
 
-    def code(self):
-        """generate C code for MIF, Simplex, pMCMC, Kalman, simulation, ..."""
+        if not (os.path.exists(path_c) and read_file(path_c) == code):
+            with open(path_c, "w") as f:
+                f.write(code)
 
-        is_diff = True if len(self.par_diff) > 0 else False
+        os.remove(path_tpl)
 
-        orders = self.orders()
+    def template_hash(self, prefix, sections):
+        """
+        hash of everything a rendered template depends on: the
+        template itself (and ordered.tpl), the code generator and the
+        sections of the parsed model it is generated from
+        """
 
-        ##methods whose results are use multiple times
-        step_ode_sde = self.step_ode_sde()
-        jac = self.jac(step_ode_sde['sf'])
-
-        self.render('ode_sde', {'is_diff': is_diff, 'step':step_ode_sde, 'orders': orders})
-
-        parameters = self.parameters()
-        parameters['orders'] = orders
-        self.render('transform', parameters)
-        self.render('input', parameters)
-
-        observed = self.observed()
-        observed['orders'] = orders
-        observed['h_grads'] = self.h_grads()
-        self.render('observed', observed)
-
-        self.render('iterator', {'iterators':self.iterators()})
-
-        psr = {
-            'orders': orders,
-            'alloc': self.alloc_psr(),
-            'is_diff': is_diff,
-            'white_noise': self.white_noise,
-            'step': self.step_psr(),
-            'step_inc': self.step_psr_inc(),
-            'psr_multinomial': self.step_psr_multinomial()
+        path_templates = os.path.join(self.path_rendered, 'C', 'templates')
+        path_src = os.path.dirname(os.path.abspath(__file__))
+
+        h = hashlib.sha1()
+        for x in [os.path.join(path_templates, prefix + '_template.c'), os.path.join(path_templates, 'ordered.tpl')] + [os.path.join(path_src, y) for y in ['Cmodel.py', 'Ccoder.py', 'Builder.py']]:
+            h.update(read_file(x))
+
+        model = {
+            'orders': self.orders(),
+            'par': [self.par_sv, self.par_inc, self.remainder, self.par_diff, self.par_noise, self.par_proc, self.par_obs, self.par_forced, self.par_disp, self.par_other],
+            'map_prior_name2name': self.map_prior_name2name,
+            'cse': prefix in self.cse_templates,
+            'precompute': sorted(self.precompute_templates),
+            'time_cache': sorted(self.time_cache_templates)
         }
-        self.render('psr', psr)
 
-        self.render('diff', {'diff': self.compute_diff(), 'orders': orders})
+        for x in sections:
+            if x == 'proc':
+                model[x] = [self.proc_model, self.white_noise, self.par_inc_def]
+            elif x == 'obs':
+                model[x] = self.obs_model
+            elif x == 'sde':
+                model[x] = self.model.get('sde', {})
+            elif x == 'inputs':
+                model[x] = [self.model['inputs'], self.model['populations']]
 
-        self.render('Q', {'Q': self.eval_Q(), 'is_diff': is_diff, 'orders': orders})
+        h.update(json.dumps(model, sort_keys=True))
 
-        self.render('Ht', {'Ht': self.Ht(), 'is_diff': is_diff, 'orders': orders})
+        return h.hexdigest()
 
-        self.render('jac', {'jac': jac, 'is_diff': is_diff, 'orders': orders})
+    def templates(self):
+        """
+        list of (prefix, model sections (see template_hash), function
+        returning the data to render prefix_template.c with)
+        """
 
-        self.render('step_ekf', {'is_diff': is_diff, 'step': step_ode_sde, 'orders': orders})
+        is_diff = True if len(self.par_diff) > 0 else False
+
+        orders = self.orders()
+
+        ##methods whose results are use multiple times
+        memo = {}
+        def get(name, f):
+            if name not in memo:
+                memo[name] = f() if self.profile is None else self.profile.record(name, f)
+            elif self.profile is not None:
+                self.profile.replay(name)
+            return memo[name]
+
+        step_ode_sde = lambda: get('step_ode_sde', self.step_ode_sde)
+        jac = lambda: get('jac', lambda: self.jac(step_ode_sde()['sf']))
+
+        ##the stepping functions share their _pre (and _tt) with precompute, the other templates have their own block of _pre
+        pre_block = lambda prefix: 'step' if prefix in ('ode_sde', 'psr') else prefix
+
+        def hoist(prefix, terms):
+            if prefix not in self.precompute_templates:
+                return list(terms)
+
+            res = self.precompute(terms, pre_block(prefix))
+            self.precompute_stats[prefix] = self.precompute_stats.get(prefix, 0) + res['n_hoisted']
+            return res['terms']
+
+        def time_cached(prefix, x):
+            ##the time cache only pays off on the time grid shared by the particles (sde, euler psr): the
+            ##steps specific to a particle (ode, psr leaps) use the caches computed inline
+            x['inline'] = {'caches': x['caches'], 'sf': x['sf']}
+            if prefix in self.time_cache_templates:
+                res = self.time_cache_step(x['caches'], x['sf'])
+                x['caches'] = res['caches']
+                x['sf'] = res['sf']
+                self.time_cache_stats[prefix] = res['n_hoisted']
+
+        def precomputed(prefix, f):
+            ##time_cache can move every _pre of a function into _tt: look for what is actually used
+            def data():
+                self.precompute_stats[prefix] = 0
+                self.time_cache_stats[prefix] = 0
+                if pre_block(prefix) == prefix:
+                    self.pre_blocks[prefix] = ([], {})
+                x = f()
+                x['tt'] = uses(x, '_tt[')
+                if pre_block(prefix) == prefix:
+                    x['pre_block'] = prefix
+                    x['pre_terms'] = self.pre_blocks[prefix][0]
+                return x
+            return data
+
+        def step(prefix, funcs):
+            x = step_ode_sde()
+            if prefix not in self.cse_templates and prefix not in self.precompute_templates and prefix not in self.time_cache_templates:
+                return x
+
+            x = copy.deepcopy(x)
+            x['caches'] = hoist(prefix, x['caches'])
+            x['sf'] = hoist(prefix, x['sf'])
+            time_cached(prefix, x)
+            for k in funcs:
+                eqs = x['func'][k]['proc']['system'] + x['func'][k]['obs']
+                for eq, term in zip(eqs, hoist(prefix, [eq['eq'] for eq in eqs])):
+                    eq['eq'] = term
+
+            if prefix not in self.cse_templates:
+                return x
+
+            self.cse_stats[prefix] = 0
+            for k in funcs:
+                eqs = x['func'][k]['proc']['system'] + x['func'][k]['obs']
+                res = self.cse([eq['eq'] for eq in eqs])
+                for eq, term in zip(eqs, res['terms']):
+                    eq['eq'] = term
+                x['func'][k]['cse'] = res['cse']
+                self.cse_stats[prefix] += res['n_removed']
+
+            return x
+
+        def ode_sde():
+            x = dict(step('ode_sde', step_ode_sde()['func'].keys()))
+
+            ##scratch space of the batched stepping functions: one block per noise, diffusion, _sf, _r, _cse and state
+            n_states = len(self.par_sv) + len(self.par_inc) + len(self.par_diff)
+            x['batch_width'] = max(len(f['proc']['noises']) + len(self.par_diff) + len(x['sf']) + len(x['caches']) + len(f.get('cse', [])) + n_states for k, f in x['func'].items() if k != 'ode')
+
+            return x
+
+        def Q():
+            x = self.eval_Q()
+            for tpl in x.values():
+                tpl['sf'] = hoist('Q', tpl['sf'])
+                terms = tpl['Q_proc'] + tpl['Q_inc'] + tpl['Q_sde']
+                for t, term in zip(terms, hoist('Q', [t['term'] for t in terms])):
+                    t['term'] = term
+                tpl['pre'] = any('_pre[' in x for x in tpl['sf'] + [t['term'] for t in terms])
+
+            if 'Q' in self.cse_templates:
+                self.cse_stats['Q'] = 0
+                for tpl in x.values():
+                    terms = tpl['Q_proc'] + tpl['Q_inc']
+                    res = self.cse([t['term'] for t in terms])
+                    for t, term in zip(terms, res['terms']):
+                        t['term'] = term
+                    tpl['cse'] = res['cse']
+                    self.cse_stats['Q'] += res['n_removed']
+
+            return x
+
+        def jac_cse():
+            x = jac()
+            if 'jac' in self.precompute_templates:
+                x = copy.deepcopy(x)
+                x['caches'] = hoist('jac', x['caches'])
+                x['sf'] = hoist('jac', x['sf'])
+
+            if 'jac' in self.cse_templates:
+                x = copy.deepcopy(x)
+                res = self.cse(x['caches'])
+                x['caches'] = res['terms']
+                x['cse'] = res['cse']
+                self.cse_stats['jac'] = res['n_removed']
+
+            return x
+
+        def Ht():
+            x = self.Ht()
+            rows = x['Ht_sv'] + x['Ht_inc'] + x['Ht_diff']
+            terms = iter(hoist('Ht', [t for row in rows for t in row]))
+            for row in rows:
+                row[:] = [terms.next() for t in row]
+
+            if 'Ht' in self.cse_templates:
+                res = self.cse([t for row in rows for t in row])
+                terms = iter(res['terms'])
+                for row in rows:
+                    row[:] = [terms.next() for t in row]
+                x['cse'] = res['cse']
+                self.cse_stats['Ht'] = res['n_removed']
+
+            return x
+
+        def parameters():
+            x = get('parameters', self.parameters)
+            x['orders'] = orders
+            return x
+
+        def observed():
+            x = self.observed()
+            x['orders'] = orders
+            x['h_grads'] = self.h_grads()
+
+            ##observed has one function per observation (and per term): flag the ones using _pre
+            for obs in x['observed']:
+                keys = [k for k in ['mean', 'sd', 'p', 'n'] if k in obs]
+                for k, term in zip(keys, hoist('observed', [obs[k] for k in keys])):
+                    obs[k] = term
+                obs['pre'] = any('_pre[' in obs[k] for k in keys)
+                obs['pre_mean'] = '_pre[' in obs['mean']
+
+            for h in x['h_grads']['h_grads'].values():
+                for grad, term in zip(h['grads'], hoist('observed', [grad['Cterm'] for grad in h['grads']])):
+                    grad['Cterm'] = term
+                h['pre'] = any('_pre[' in grad['Cterm'] for grad in h['grads'])
+
+            return x
+
+        def psr():
+            step = self.step_psr()
+            step['caches'] = hoist('psr', step['caches'])
+            step['sf'] = hoist('psr', step['sf'])
+            time_cached('psr', step)
+
+            ##variance of the gamma white noises
+            var = hoist('psr', ['pow(gsl_vector_get(par,ORDER_{0}),2)'.format(x['sd']) for x in self.white_noise])
+
+            return {
+                'orders': orders,
+                'alloc': self.alloc_psr(),
+                'is_diff': is_diff,
+                'white_noise': [dict(x, var=v) for x, v in zip(self.white_noise, var)],
+                'step': step,
+                'step_inc': self.step_psr_inc(),
+                'psr_multinomial': self.step_psr_multinomial()
+            }
+
+        ##precompute has to be rendered last (once the stepping functions using its _pre and _tt are generated)
+        return [
+            ('ode_sde', ['proc', 'sde'], precomputed('ode_sde', lambda: {'is_diff': is_diff, 'step': ode_sde(), 'orders': orders})),
+            ('transform', ['inputs', 'sde'], parameters),
+            ('input', ['inputs', 'sde'], parameters),
+            ('observed', ['obs', 'proc'], precomputed('observed', observed)),
+            ('iterator', [], lambda: {'iterators': self.iterators()}),
+            ('psr', ['proc'], precomputed('psr', psr)),
+            ('nrm', ['proc', 'sde'], lambda: dict(self.step_nrm(), is_diff=is_diff, orders=orders)),
+            ('diff', ['sde'], lambda: {'diff': self.compute_diff(), 'orders': orders}),
+            ('Q', ['proc', 'sde'], precomputed('Q', lambda: {'Q': Q(), 'is_diff': is_diff, 'orders': orders})),
+            ('Ht', ['proc', 'obs'], precomputed('Ht', lambda: {'Ht': Ht(), 'is_diff': is_diff, 'orders': orders})),
+            ('jac', ['proc', 'obs', 'sde'], precomputed('jac', lambda: {'jac': jac_cse(), 'is_diff': is_diff, 'orders': orders})),
+            ('step_ekf', ['proc', 'sde'], precomputed('step_ekf', lambda: {'is_diff': is_diff, 'step': step('step_ekf', ['ode']), 'orders': orders})),
+            ('check_IC', ['inputs', 'sde'], parameters),
+            ('precompute', ['proc', 'sde'], lambda: {'pre_block': 'step', 'pre_terms': self.pre_blocks.get('step', ([], {}))[0], 'time_terms': self.time_terms, 'orders': orders})
+        ]
+
+    def code(self, jobs=1):
+        """generate C code for MIF, Simplex, pMCMC, Kalman, simulation, ...
+
+        Only the templates whose inputs (see template_hash) changed
+        since the last build are generated and rendered.
+
+        With jobs > 1, the generators are first run without computing
+        anything symbolic to collect every term that make_C_term has
+        to sympify, differentiate or solve. Those terms are then
+        computed by a pool of jobs processes, so that the generators
+        and the rendering only hit the in-process cache. The output
+        is identical to the one of the serial path.
+        """
 
-        self.render('check_IC', parameters)
+        path_manifest = os.path.join(self.path_rendered, 'C', 'templates', '.build.json')
+        try:
+            manifest = json.load(open(path_manifest))
+        except (IOError, ValueError):
+            manifest = {}
+
+        todo = []
+        hashes = []
+        for prefix, sections, data in self.templates():
+            h = self.template_hash(prefix, sections)
+            hashes.append((prefix, h))
+            if not (manifest.get(prefix) == h and os.path.exists(os.path.join(self.path_rendered, 'C', 'templates', prefix + '.c'))):
+                todo.append((prefix, h))
+
+        ##the _pre (block step) and _tt indexes are shared by precompute and the stepping functions: they are generated together
+        shared = set(['ode_sde', 'psr', 'precompute'])
+        if shared & set(x[0] for x in todo):
+            todo = [x for x in hashes if x in todo or x[0] in shared]
+
+        todo_prefix = [x[0] for x in todo]
+        for prefix, h in hashes:
+            if prefix not in todo_prefix:
+                os.remove(os.path.join(self.path_rendered, 'C', 'templates', prefix + '_template.c'))
+
+        ##collection pass: only the generators run (cse, precompute and time cache are skipped, see Ccoder.hoist)
+        if jobs > 1 and todo:
+            self.pending = []
+            for prefix, sections, data in self.templates():
+                if prefix in todo_prefix:
+                    if self.profile is not None:
+                        self.profile.template = prefix
+                    data()
+            pending = self.pending
+            self.pending = None
+
+            keys = []
+            seen = set()
+            for key in pending:
+                if key not in seen and key not in self._ccoded:
+                    seen.add(key)
+                    keys.append(key)
+
+            if keys:
+                pool = multiprocessing.Pool(jobs)
+                try:
+                    res = pool.map(_cached_sym_ccode, [(key, self.cache_dir) for key in keys], max(1, len(keys) // (4*jobs)))
+                finally:
+                    pool.close()
+                    pool.join()
+
+                for key, (Cterm, status, counts, elapsed) in zip(keys, res):
+                    self._ccoded[key] = Cterm
+                    self.cache_stats[status] += 1
+                    if self.profile is not None:
+                        self.profile.computed(key, counts, elapsed, 'code (jobs={0})'.format(jobs))
+
+        self.pre_blocks = {}
+        self.precompute_stats = {}
+        self.time_terms = []
+        self._time_terms = {}
+        self.time_cache_stats = {}
+
+        for prefix, sections, data in self.templates():
+            if prefix in todo_prefix:
+                if self.profile is not None:
+                    self.profile.template = prefix
+                    t = time.time()
+                self.render(prefix, data())
+                manifest[prefix] = todo[todo_prefix.index(prefix)][1]
+                if self.profile is not None:
+                    self.profile.templates[prefix] = time.time() - t
+
+        with open(path_manifest, 'w') as f:
+            json.dump(manifest, f)
+
+        ##statistics of the build: only reported with profile (.profile.json), the build itself is silent
+        if self.profile is not None:
+            self.profile.template = None
+            stats = {
+                'symbolic_cache': self.cache_stats,
+                'cse': {'n_removed': sum(self.cse_stats.values()), 'templates': self.cse_stats},
+                'precompute': {'length': sum(len(x[0]) for x in self.pre_blocks.values()), 'templates': self.precompute_stats},
+                'time_cache': {'length': len(self.time_terms), 'templates': self.time_cache_stats}
+            }
+            with open(os.path.join(self.path_rendered, '.profile.json'), 'w') as f:
+                json.dump(dict(self.profile.report(), jobs=jobs, stats=stats), f, indent=2)
 
     def write_data(self):
 
@@ -218,6 +218,7 @@ int ssm_theta_copy(ssm_theta_t *dest, ssm_theta_t *src)
 
 int ssm_par_copy(ssm_par_t *dest, ssm_par_t *src)
 {
+    ssm_par_changed();
     return gsl_vector_memcpy(dest, src);
 }
 
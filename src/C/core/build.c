@@ -177,6 +177,7 @@ ssm_nav_t *ssm_nav_new(json_t *jparameters, ssm_options_t *opts)
     nav->implementation = opts->implementation;
     nav->noises_off = opts->noises_off;
     nav->print = opts->print;
+    nav->psr_step = ssm_str_to_psr_step(opts->psr_step);
 
     nav->parameters = _ssm_parameters_new(&nav->parameters_length);
     nav->states = _ssm_states_new(&nav->states_length, nav->parameters);
@@ -767,15 +768,33 @@ ssm_calc_t *ssm_calc_new(json_t *jdata, ssm_nav_t *nav, ssm_data_t *data, ssm_fi
 
     if (nav->implementation == SSM_ODE || nav->implementation == SSM_EKF){
 
-        calc->T = gsl_odeiv2_step_rkf45;
-        calc->control = gsl_odeiv2_control_y_new(opts->eps_abs, opts->eps_rel);
-        calc->step = gsl_odeiv2_step_alloc(calc->T, dim);
-        calc->evolve = gsl_odeiv2_evolve_alloc(dim);
+        calc->T = ssm_str_to_ode_step(opts->integrator);
+        if (ssm_ode_step_is_implicit(calc->T) && nav->implementation == SSM_EKF) {
+            //the jacobian of the system integrated by the EKF (including the covariance) is not generated
+            ssm_print_warning("implicit ODE integrators are only available for the ode implementation. rkf45 will be used instead.");
+            calc->T = gsl_odeiv2_step_rkf45;
+        }
+
         (calc->sys).function =  (nav->implementation == SSM_ODE) ? &ssm_step_ode: &ssm_step_ekf;
-        (calc->sys).jacobian = NULL;
+        (calc->sys).jacobian = (ssm_ode_step_is_implicit(calc->T)) ? &ssm_jac_ode : NULL;
         (calc->sys).dimension= dim;
         (calc->sys).params= calc;
 
+        //the driver is only used to own (and link) control, step and evolve: the integration is done by ssm_f_prediction_ode()
+        calc->driver = gsl_odeiv2_driver_alloc_y_new(&(calc->sys), calc->T, opts->dt, opts->eps_abs, opts->eps_rel);
+        calc->control = calc->driver->c;
+        calc->step = calc->driver->s;
+        calc->evolve = calc->driver->e;
+
+        if ((calc->sys).jacobian) {
+            //the sparse jacobian set by ssm_eval_jac()
+            calc->_Ft_nnz = 0;
+            calc->_Ft_i = ssm_i1_new(dim*dim);
+            calc->_Ft_j = ssm_i1_new(dim*dim);
+            calc->_Ft_x = ssm_d1_new(dim*dim);
+            calc->_f_dfdt = ssm_d1_new(2*dim);
+        }
+
         if(nav->implementation == SSM_EKF){
 
             int can_run;
@@ -817,6 +836,10 @@ ssm_calc_t *ssm_calc_new(json_t *jdata, ssm_nav_t *nav, ssm_data_t *data, ssm_fi
             calc->_Q = gsl_matrix_calloc(n_s, n_s);
             calc->_FtCt = gsl_matrix_calloc(n_s, n_s);
             calc->_Ft = gsl_matrix_calloc(n_s, n_s);
+            calc->_Ft_nnz = 0;
+            calc->_Ft_i = ssm_i1_new(n_s*n_s);
+            calc->_Ft_j = ssm_i1_new(n_s*n_s);
+            calc->_Ft_x = ssm_d1_new(n_s*n_s);
             calc->_eval = gsl_vector_calloc(n_s);
             calc->_evec = gsl_matrix_calloc(n_s, n_s);
             calc->_w_eigen_vv = gsl_eigen_symmv_alloc(n_s);
@@ -826,6 +849,8 @@ ssm_calc_t *ssm_calc_new(json_t *jdata, ssm_nav_t *nav, ssm_data_t *data, ssm_fi
         calc->y_pred = ssm_d1_new(dim);
     } else if (nav->implementation == SSM_PSR){
         ssm_psr_new(calc);
+    } else if (nav->implementation == SSM_NRM){
+        ssm_nrm_new(calc);
     }
 
     /**************************/
@@ -842,6 +867,34 @@ ssm_calc_t *ssm_calc_new(json_t *jdata, ssm_nav_t *nav, ssm_data_t *data, ssm_fi
     calc->_par = NULL;
     calc->_nav = nav;
 
+    /*********************************/
+    /* parameter only subexpressions */
+    /*********************************/
+
+    calc->pre_length = ssm_precompute_length(calc->pre_offset);
+    calc->pre = calc->pre_length ? ssm_d1_new(calc->pre_length) : NULL;
+    calc->pre_par = NULL;
+    calc->pre_generation = 0;
+
+    calc->tt = ssm_tcache_new(ssm_time_terms_length());
+
+    /***************************/
+    /* observation log density */
+    /***************************/
+
+    calc->accuracy = ssm_str_to_accuracy(opts->accuracy);
+    calc->log_fact = ssm_log_fact_new();
+
+    /*****************************************/
+    /* batched prediction and log likelihood */
+    /*****************************************/
+
+    if (opts->flag_batch && nav->implementation != SSM_EKF) {
+        calc->batch = ssm_batch_new(GSL_MIN(fitness->J, SSM_BATCH_SIZE), nav);
+    } else {
+        calc->batch = NULL;
+    }
+
     /**************/
     /* covariates */
     /**************/
@@ -849,6 +902,8 @@ ssm_calc_t *ssm_calc_new(json_t *jdata, ssm_nav_t *nav, ssm_data_t *data, ssm_fi
     json_t *jcovariates = json_object_get(jdata, "covariates");
     calc->covariates_length = json_array_size(jcovariates);
 
+    calc->cov = ssm_tcache_new(calc->covariates_length);
+
     if(calc->covariates_length){
 
         calc->acc = malloc(calc->covariates_length * sizeof(gsl_interp_accel *));
@@ -975,9 +1030,14 @@ void ssm_calc_free(ssm_calc_t *calc, ssm_nav_t *nav)
 
     if (nav->implementation == SSM_ODE  || nav->implementation == SSM_EKF){
 
-        gsl_odeiv2_step_free(calc->step);
-        gsl_odeiv2_evolve_free(calc->evolve);
-        gsl_odeiv2_control_free(calc->control);
+        gsl_odeiv2_driver_free(calc->driver);
+
+        if ((calc->sys).jacobian) {
+            free(calc->_Ft_i);
+            free(calc->_Ft_j);
+            free(calc->_Ft_x);
+            free(calc->_f_dfdt);
+        }
 
         if(nav->implementation == SSM_EKF){
             gsl_vector_free(calc->_pred_error);
@@ -991,6 +1051,9 @@ void ssm_calc_free(ssm_calc_t *calc, ssm_nav_t *nav)
             gsl_matrix_free(calc->_Q);
             gsl_matrix_free(calc->_FtCt);
             gsl_matrix_free(calc->_Ft);
+            free(calc->_Ft_i);
+            free(calc->_Ft_j);
+            free(calc->_Ft_x);
             gsl_vector_free(calc->_eval);
             gsl_matrix_free(calc->_evec);
             gsl_eigen_symmv_free(calc->_w_eigen_vv);
@@ -1000,11 +1063,22 @@ void ssm_calc_free(ssm_calc_t *calc, ssm_nav_t *nav)
         free(calc->y_pred);
     } else if (nav->implementation == SSM_PSR){
         ssm_psr_free(calc);
+    } else if (nav->implementation == SSM_NRM){
+        ssm_nrm_free(calc);
     }
 
     free(calc->to_be_sorted);
     free(calc->index_sorted);
 
+    free(calc->pre);
+    ssm_tcache_free(calc->tt);
+
+    free(calc->log_fact);
+
+    if(calc->batch){
+        ssm_batch_free(calc->batch);
+    }
+
     if(calc->covariates_length){
         int k;
         for(k=0; k< calc->covariates_length; k++) {
@@ -1020,6 +1094,8 @@ void ssm_calc_free(ssm_calc_t *calc, ssm_nav_t *nav)
         free(calc->acc);
     }
 
+    ssm_tcache_free(calc->cov);
+
     free(calc);
 }
 
@@ -1070,6 +1146,10 @@ ssm_options_t *ssm_options_new(void)
     opts->root = ssm_c1_new(SSM_STR_BUFFSIZE);
     opts->next = ssm_c1_new(SSM_STR_BUFFSIZE);
     opts->interpolator = ssm_c1_new(SSM_STR_BUFFSIZE);
+    opts->accuracy = ssm_c1_new(SSM_STR_BUFFSIZE);
+    opts->resampling = ssm_c1_new(SSM_STR_BUFFSIZE);
+    opts->psr_step = ssm_c1_new(SSM_STR_BUFFSIZE);
+    opts->integrator = ssm_c1_new(SSM_STR_BUFFSIZE);
     opts->start = ssm_c1_new(SSM_STR_BUFFSIZE);
     opts->end = ssm_c1_new(SSM_STR_BUFFSIZE);
     opts->server = ssm_c1_new(SSM_STR_BUFFSIZE);
@@ -1092,9 +1172,14 @@ ssm_options_t *ssm_options_new(void)
     strncpy(opts->next, "", SSM_STR_BUFFSIZE);
     opts->n_thread = 1;
     opts->like_min = 1.0e-17;
+    opts->ess_threshold = 1.0;
     opts->J = 1;
     opts->n_obs = -1;
     strncpy(opts->interpolator, "linear", SSM_STR_BUFFSIZE);
+    strncpy(opts->accuracy, "fast", SSM_STR_BUFFSIZE);
+    strncpy(opts->resampling, "systematic", SSM_STR_BUFFSIZE);
+    strncpy(opts->psr_step, "euler", SSM_STR_BUFFSIZE);
+    strncpy(opts->integrator, "rkf45", SSM_STR_BUFFSIZE);
     opts->n_obs = -1;
     opts->n_iter = 10;
     opts->a = 0.98;
@@ -1115,6 +1200,8 @@ ssm_options_t *ssm_options_new(void)
     strncpy(opts->end, "", SSM_STR_BUFFSIZE);
     strncpy(opts->server, "127.0.0.1", SSM_STR_BUFFSIZE);
     opts->flag_no_filter = 0;
+    opts->flag_batch = 0;
+    opts->flag_tree = 0;
 
     return opts;
 }
@@ -1126,6 +1213,10 @@ void ssm_options_free(ssm_options_t *opts)
     free(opts->root);
     free(opts->next);
     free(opts->interpolator);
+    free(opts->accuracy);
+    free(opts->resampling);
+    free(opts->psr_step);
+    free(opts->integrator);
     free(opts->start);
     free(opts->end);
     free(opts->server);
@@ -1154,7 +1245,30 @@ ssm_fitness_t *ssm_fitness_new(ssm_data_t *data, ssm_options_t *opts)
     fitness->log_like = 0.0;
 
     fitness->weights = ssm_d1_new(fitness->J);
+    fitness->weights_prev = ssm_d1_new(fitness->J);
+    ssm_fitness_reset_weights(fitness);
+    fitness->ess_threshold = opts->ess_threshold;
     fitness->select = ssm_u2_new(fitness->data_length, fitness->J);
+    fitness->_first = ssm_i1_new(fitness->J);
+
+    //one chunk of particles per thread (as in ssm_worker_inproc())
+    fitness->resampling = ssm_str_to_resampling(opts->resampling);
+    fitness->chunks_length = ssm_sanitize_n_threads(opts->n_thread, fitness);
+    fitness->J_chunk = fitness->J / fitness->chunks_length;
+    fitness->_cum_weights = ssm_d1_new(fitness->J);
+    fitness->_cum_counts = ssm_d1_new(fitness->J);
+    fitness->_chunk_weights = ssm_d1_new(fitness->chunks_length);
+    fitness->_chunk_counts = ssm_d1_new(fitness->chunks_length);
+    fitness->_ran = 0.0;
+
+    fitness->flag_collapse = 0;
+    fitness->rep = ssm_i1_new(fitness->J);
+    fitness->_rep_tmp = ssm_i1_new(fitness->J);
+    fitness->_rep_map = ssm_i1_new(fitness->J);
+    for(i=0; i<fitness->J; i++){
+        fitness->rep[i] = i;
+        fitness->_rep_map[i] = -1;
+    }
 
     fitness->cum_status = malloc(fitness->J * sizeof (ssm_err_code_t));
     if(fitness->cum_status == NULL) {
@@ -1166,6 +1280,7 @@ ssm_fitness_t *ssm_fitness_new(ssm_data_t *data, ssm_options_t *opts)
     }
 
     fitness->n_all_fail = 0;
+    fitness->dt_warm = 1.0/ ((double) round(1.0/opts->dt)); //as ssm_X_t.dt0
 
     fitness->log_like_prev = 0.0;
     fitness->log_prior = 0.0;
@@ -1195,7 +1310,16 @@ ssm_fitness_t *ssm_fitness_new(ssm_data_t *data, ssm_options_t *opts)
 void ssm_fitness_free(ssm_fitness_t *fitness)
 {
     free(fitness->weights);
+    free(fitness->weights_prev);
     ssm_u2_free(fitness->select, fitness->data_length);
+    free(fitness->_first);
+    free(fitness->_cum_weights);
+    free(fitness->_cum_counts);
+    free(fitness->_chunk_weights);
+    free(fitness->_chunk_counts);
+    free(fitness->rep);
+    free(fitness->_rep_tmp);
+    free(fitness->_rep_map);
 
     free(fitness->cum_status);
 
@@ -1203,6 +1327,68 @@ void ssm_fitness_free(ssm_fitness_t *fitness)
 }
 
 
+ssm_tcache_t *ssm_tcache_new(int width)
+{
+    ssm_tcache_t *tcache = malloc(sizeof (ssm_tcache_t));
+    if (tcache == NULL) {
+        ssm_print_err("Allocation impossible for ssm_tcache_t");
+        exit(EXIT_FAILURE);
+    }
+
+    tcache->width = width;
+    tcache->length = 0;
+    tcache->size = 0;
+    tcache->last = 0;
+    tcache->t = NULL;
+    tcache->values = NULL;
+
+    return tcache;
+}
+
+
+void ssm_tcache_free(ssm_tcache_t *tcache)
+{
+    free(tcache->t);
+    free(tcache->values);
+    free(tcache);
+}
+
+
+/**
+ * number of values per particle of the scratch space used by the
+ * batched functions of the generated code
+ */
+int ssm_batch_width(void)
+{
+    return GSL_MAX(ssm_ode_sde_batch_width(), GSL_MAX(ssm_psr_batch_width(), ssm_diff_batch_width()));
+}
+
+ssm_batch_t *ssm_batch_new(int size, ssm_nav_t *nav)
+{
+    ssm_batch_t *b = malloc(sizeof (ssm_batch_t));
+    if (b == NULL) {
+        ssm_print_err("Allocation impossible for ssm_batch_t");
+        exit(EXIT_FAILURE);
+    }
+
+    b->size = size;
+    b->length = nav->states_sv_inc->length + nav->states_diff->length;
+    b->J = 0;
+    b->dt = 0.0;
+    b->X = ssm_d1_new(b->length * size);
+    b->work = ssm_d1_new(GSL_MAX(ssm_batch_width(), 1) * size);
+
+    return b;
+}
+
+void ssm_batch_free(ssm_batch_t *b)
+{
+    free(b->X);
+    free(b->work);
+    free(b);
+}
+
+
 int _ssm_dim_X(ssm_nav_t *nav)
 {
     int dim = nav->states_sv_inc->length + nav->states_diff->length;
@@ -1322,6 +1508,33 @@ void ssm_D_J_X_free(ssm_X_t ***X, ssm_data_t *data, ssm_fitness_t *fitness)
     free(X);
 }
 
+/**
+ * all the rows point to the same particles (the paths are stored in
+ * a ssm_tree_t). Only X[0] has to be kept up to date to free it.
+ */
+ssm_X_t ***ssm_D_J_X_shared_new(ssm_data_t *data, ssm_fitness_t *fitness, ssm_nav_t *nav, ssm_options_t *opts)
+{
+    int i;
+    ssm_X_t ***X = malloc((data->length+1) * sizeof (ssm_X_t **));
+    if (X==NULL) {
+        ssm_print_err("Allocation impossible for ssm_X_t **");
+        exit(EXIT_FAILURE);
+    }
+
+    X[0] = ssm_J_X_new(fitness, nav, opts);
+    for(i=1; i<data->length+1; i++){
+        X[i] = X[0];
+    }
+
+    return X;
+}
+
+void ssm_D_J_X_shared_free(ssm_X_t ***X, ssm_fitness_t *fitness)
+{
+    ssm_J_X_free(X[0], fitness);
+    free(X);
+}
+
 
 ssm_hat_t *ssm_hat_new(ssm_nav_t *nav)
 {
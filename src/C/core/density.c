@@ -0,0 +1,179 @@
+/**************************************************************************
+ *    This file is part of ssm.
+ *
+ *    ssm is free software: you can redistribute it and/or modify it
+ *    under the terms of the GNU General Public License as published
+ *    by the Free Software Foundation, either version 3 of the
+ *    License, or (at your option) any later version.
+ *
+ *    ssm is distributed in the hope that it will be useful, but
+ *    WITHOUT ANY WARRANTY; without even the implied warranty of
+ *    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ *    GNU General Public License for more details.
+ *
+ *    You should have received a copy of the GNU General Public
+ *    License along with ssm.  If not, see
+ *    <http://www.gnu.org/licenses/>.
+ *************************************************************************/
+
+#include "ssm.h"
+
+#define SSM_LOG_DENSITY_TINY 1e-280 /**< smallest probability computed in linear space (the denormals lose precision) */
+
+/**
+ * Log densities of the observation processes (see the observed
+ * template). calc->accuracy selects the implementation:
+ *
+ * - SSM_ACC_EXACT: GSL special functions (reference)
+ * - SSM_ACC_FAST: tabulated log factorials (Stirling series above
+ *   the table) and erfc differences for the discretized normal
+ *   (agree with SSM_ACC_EXACT to ~1e-12 on the log scale)
+ * - SSM_ACC_APPROX: as SSM_ACC_FAST but the discretized normal is
+ *   approximated by the (tilted) density at y when sd >=
+ *   SSM_APPROX_SD_MIN (absolute error on the log scale < 1e-4 for y
+ *   within 6 sd of the mean and < 2e-3 within 40 sd)
+ */
+
+
+/**
+ * table of log(n!) for n < SSM_LOG_FACT_LENGTH
+ */
+double *ssm_log_fact_new(void)
+{
+    int n;
+    double *log_fact = ssm_d1_new(SSM_LOG_FACT_LENGTH);
+
+    log_fact[0] = 0.0;
+    for(n=1; n<SSM_LOG_FACT_LENGTH; n++){
+        log_fact[n] = log_fact[n-1] + log((double) n);
+    }
+
+    return log_fact;
+}
+
+
+/**
+ * Stirling series of log(Gamma(x)), accurate to machine precision
+ * for x > SSM_LOG_FACT_LENGTH
+ */
+static double ssm_log_gamma_stirling(double x)
+{
+    double ix = 1.0/x;
+    double ix2 = ix*ix;
+    return (x - 0.5)*log(x) - x + 0.5*log(2*M_PI) + ix*(1.0/12.0 - ix2*(1.0/360.0 - ix2/1260.0));
+}
+
+
+/**
+ * log(n!) for the integer n >= 0
+ */
+double ssm_log_fact(double n, ssm_calc_t *calc)
+{
+    if (calc->accuracy == SSM_ACC_EXACT) {
+        return gsl_sf_lngamma(n + 1.0);
+    } else if (n < SSM_LOG_FACT_LENGTH) {
+        return calc->log_fact[(int) n];
+    } else {
+        return ssm_log_gamma_stirling(n + 1.0);
+    }
+}
+
+
+/**
+ * log of the upper tail gaussian_Q(z) for z large (asymptotic
+ * expansion of the Mills ratio, relative error < 1e-12 for z > 35),
+ * used when gaussian_Q is too small to be represented accurately
+ * (below SSM_LOG_DENSITY_TINY)
+ */
+static double ssm_log_ugaussian_Q_tail(double z)
+{
+    double iz2 = 1.0/(z*z);
+    return -0.5*z*z - log(z) - 0.5*log(2*M_PI) + log1p(iz2*(-1.0 + iz2*(3.0 + iz2*(-15.0 + iz2*105.0))));
+}
+
+/**
+ * log(Q(a) - Q(b)) for 0 <= a < b where Q is the upper tail of the
+ * standard normal distribution
+ */
+static double ssm_log_ugaussian_Q_diff(double a, double b, ssm_accuracy_t accuracy)
+{
+    double like;
+    if (accuracy == SSM_ACC_EXACT) {
+        like = gsl_cdf_ugaussian_Q(a) - gsl_cdf_ugaussian_Q(b);
+    } else {
+        like = 0.5*(erfc(a*M_SQRT1_2) - erfc(b*M_SQRT1_2));
+    }
+
+    if (like > SSM_LOG_DENSITY_TINY) {
+        return log(like);
+    } else { //Q(a)-Q(b) = Q(a) (1 - Q(b)/Q(a))
+        double log_Qa = ssm_log_ugaussian_Q_tail(a);
+        return log_Qa + log1p(-exp(ssm_log_ugaussian_Q_tail(b) - log_Qa));
+    }
+}
+
+/**
+ * log of the probability of the count y under a normal distribution
+ * of mean mu and standard deviation sd discretized on [y-0.5, y+0.5]
+ * ([-inf, 0.5] for y=0). The interval is always taken in the tail
+ * closest to 0 so that the difference of the 2 cdf does not cancel
+ * and, when it (nearly) underflows, it is computed in log space from the
+ * asymptotic expansion of the tails.
+ */
+double ssm_log_dnorm_discretized(double y, double mu, double sd, ssm_calc_t *calc)
+{
+    double lower = (y - 0.5 - mu)/sd;
+    double upper = (y + 0.5 - mu)/sd;
+    double like;
+
+    if (y > 0.0) {
+        if (calc->accuracy == SSM_ACC_APPROX && sd >= SSM_APPROX_SD_MIN) {
+            //density at y times the integral over the interval of its exponential tilt (sinh(u)/u) and curvature
+            double z = (y - mu)/sd;
+            double u = fabs(z)/(2*sd);
+            double log_tilt = (u < 1e-8) ? 0.0 : ((u > 20.0) ? u - log(2*u) : log(sinh(u)/u));
+            return -0.5*z*z - log(sd) - 0.5*log(2*M_PI) + log_tilt - 1.0/(24*sd*sd);
+        } else if (lower > 0.0) {
+            return ssm_log_ugaussian_Q_diff(lower, upper, calc->accuracy);
+        } else if (upper < 0.0) {
+            return ssm_log_ugaussian_Q_diff(-upper, -lower, calc->accuracy);
+        } else if (calc->accuracy == SSM_ACC_EXACT) {
+            return log(gsl_cdf_ugaussian_P(upper) - gsl_cdf_ugaussian_P(lower));
+        } else {
+            return log(0.5*(erf(upper*M_SQRT1_2) - erf(lower*M_SQRT1_2)));
+        }
+    }
+
+    like = (calc->accuracy == SSM_ACC_EXACT) ? gsl_cdf_ugaussian_P(upper) : 0.5*erfc(-upper*M_SQRT1_2);
+    return (like > SSM_LOG_DENSITY_TINY) ? log(like) : ssm_log_ugaussian_Q_tail(-upper);
+}
+
+
+/**
+ * log of the Poisson probability of the count y for a mean mu
+ */
+double ssm_log_dpois(double y, double mu, ssm_calc_t *calc)
+{
+    if (mu == 0.0) {
+        return (y == 0.0) ? 0.0 : GSL_NEGINF;
+    }
+    return y*log(mu) - mu - ssm_log_fact(y, calc);
+}
+
+
+/**
+ * log of the binomial probability of y successes out of n trials of
+ * probability p (n is truncated to an integer)
+ */
+double ssm_log_dbinom(double y, double p, double n, ssm_calc_t *calc)
+{
+    n = floor(n);
+    if (y < 0.0 || y > n) {
+        return GSL_NEGINF;
+    } else if (p == 0.0 || p == 1.0) {
+        return (y == n*p) ? 0.0 : GSL_NEGINF;
+    }
+
+    double log_choose = (calc->accuracy == SSM_ACC_EXACT) ? gsl_sf_lnchoose((unsigned int) n, (unsigned int) y) : ssm_log_fact(n, calc) - ssm_log_fact(y, calc) - ssm_log_fact(n - y, calc);
+    return log_choose + y*log(p) + (n - y)*log1p(-p);
+}
@@ -20,9 +20,11 @@
 
 
 /**
- *  checks for numerical issues.  Also, ensures a uniform likelihood
- *  scale by making sure that everything below fitness->log_like_min
- *  is fitness->log_like_min*row->ts_nonan_length.
+ *  checks for numerical issues (NaN or +inf log likelihood are set
+ *  to fitness->log_like_min*row->ts_nonan_length). Small likelihoods
+ *  are not clamped: ssm_weight() normalizes the weights in log space
+ *  and itself discards the particles below
+ *  fitness->log_like_min*row->ts_nonan_length.
  */
  double ssm_sanitize_log_likelihood(double log_like, ssm_row_t *row, ssm_fitness_t *fitness, ssm_nav_t *nav)
  {
@@ -33,7 +35,7 @@
         }
         return fitness->log_like_min * row->ts_nonan_length;
     } else {
-        return GSL_MAX(fitness->log_like_min * row->ts_nonan_length, log_like);
+        return log_like;
     }
 }
 
@@ -45,13 +47,42 @@ double ssm_log_likelihood(ssm_row_t *row, ssm_X_t *X, ssm_par_t *par, ssm_calc_t
     double t = row->time;
 
     for(i=0; i< row->ts_nonan_length; i++){
-        loglike += log(row->observed[i]->f_likelihood(row->values[i], X, par, calc, t));
+        loglike += row->observed[i]->f_log_likelihood(row->values[i], X, par, calc, t);
     }
 
     return ssm_sanitize_log_likelihood(loglike, row, fitness, nav);
 }
 
 
+/**
+ * Log likelihood of the particles J_X[j0:j1] stored in
+ * log_like[j0:j1]. The particles are processed by blocks of
+ * calc->batch (see ssm_batch_gather()) so that the observation
+ * densities are evaluated for all the particles of a block at once.
+ */
+void ssm_log_likelihood_batch(ssm_row_t *row, ssm_X_t **J_X, int j0, int j1, ssm_par_t *par, ssm_calc_t *calc, ssm_nav_t *nav, ssm_fitness_t *fitness, double *log_like)
+{
+    int i, j, jb;
+    double t = row->time;
+    ssm_batch_t *b = calc->batch;
+
+    for(jb=j0; jb<j1; jb+=b->size){
+        double *res = log_like + jb;
+        ssm_batch_gather(b, J_X, jb, GSL_MIN(jb + b->size, j1));
+
+        for(j=0; j<b->J; j++){
+            res[j] = 0.0;
+        }
+        for(i=0; i< row->ts_nonan_length; i++){
+            row->observed[i]->f_log_likelihood_batch(row->values[i], b, par, calc, t, res);
+        }
+        for(j=0; j<b->J; j++){
+            res[j] = ssm_sanitize_log_likelihood(res[j], row, fitness, nav);
+        }
+    }
+}
+
+
 double ssm_sum_square(ssm_row_t *row, ssm_X_t *X, ssm_par_t *par, ssm_calc_t *calc, ssm_nav_t *nav, ssm_fitness_t *fitness)
 {
     int i;
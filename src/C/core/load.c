@@ -76,6 +76,9 @@ void ssm_input2par(ssm_par_t *par, ssm_input_t *input, ssm_calc_t *calc, ssm_nav
     for(i=0; i< it->length; i++){
         gsl_vector_set(par, it->p[i]->offset, it->p[i]->f_user2par(gsl_vector_get(input, it->p[i]->offset), input, calc));
     }
+
+    ssm_par_changed();
+    ssm_precompute(par, calc);
 }
 
 
@@ -89,7 +92,7 @@ void ssm_par2X(ssm_X_t *X, ssm_par_t *par, ssm_calc_t *calc, ssm_nav_t *nav)
 
     for(i=0; i<sv->length; i++){
 	X->proj[ sv->p[i]->offset ] = sv->p[i]->f(gsl_vector_get(par, sv->p[i]->ic->offset));
-	if(nav->implementation == SSM_PSR){
+	if(nav->implementation == SSM_PSR || nav->implementation == SSM_NRM){
 	    X->proj[ sv->p[i]->offset ] = round(X->proj[ sv->p[i]->offset ]);
 	} 
     }
@@ -148,7 +151,7 @@ void ssm_mcmc_results2X(ssm_X_t *X, json_t *jprediction_j, ssm_calc_t *calc, ssm
 	    ssm_print_err(str);
 	    exit(EXIT_FAILURE);
 	}
-	if(nav->implementation == SSM_PSR){
+	if(nav->implementation == SSM_PSR || nav->implementation == SSM_NRM){
 	    X->proj[ sv->p[i]->offset ] = round(X->proj[ sv->p[i]->offset ]);
 	}
     }
@@ -0,0 +1,181 @@
+/**************************************************************************
+ *    This file is part of ssm.
+ *
+ *    ssm is free software: you can redistribute it and/or modify it
+ *    under the terms of the GNU General Public License as published
+ *    by the Free Software Foundation, either version 3 of the
+ *    License, or (at your option) any later version.
+ *
+ *    ssm is distributed in the hope that it will be useful, but
+ *    WITHOUT ANY WARRANTY; without even the implied warranty of
+ *    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ *    GNU General Public License for more details.
+ *
+ *    You should have received a copy of the GNU General Public
+ *    License along with ssm.  If not, see
+ *    <http://www.gnu.org/licenses/>.
+ *************************************************************************/
+
+#include "ssm.h"
+
+/**
+ * Next reaction method (Gibson and Bruck, 2000): exact event driven
+ * simulation of the reactions of the psr implementation (nrm
+ * implementation).
+ *
+ * Every reaction has an absolute putative firing time kept in an
+ * indexed priority queue. After a reaction, only the propensities of
+ * the reactions depending on the state variables it changed (reaction
+ * dependency graph generated by Ccoder.step_nrm) are updated and
+ * their putative times rescaled so that a single random number is
+ * drawn per event. The propensities with a white noise or depending on
+ * the time (covariates, time terms) or on the diffusions are updated
+ * (the white noises redrawn by ssm_psr_white_noises() and the
+ * diffusions integrated) every dt0.
+ */
+
+
+static void ssm_nrm_swap(ssm_nrm_t *nrm, int i, int j)
+{
+    int ki = nrm->heap[i];
+    int kj = nrm->heap[j];
+
+    nrm->heap[i] = kj;
+    nrm->pos[kj] = i;
+    nrm->heap[j] = ki;
+    nrm->pos[ki] = j;
+}
+
+static void ssm_nrm_up(ssm_nrm_t *nrm, int i)
+{
+    int parent;
+
+    while(i > 0){
+        parent = (i-1)/2;
+        if(nrm->T[nrm->heap[parent]] <= nrm->T[nrm->heap[i]]){
+            break;
+        }
+        ssm_nrm_swap(nrm, i, parent);
+        i = parent;
+    }
+}
+
+static void ssm_nrm_down(ssm_nrm_t *nrm, int i)
+{
+    int child;
+
+    while((child = 2*i+1) < nrm->length){
+        if(child+1 < nrm->length && nrm->T[nrm->heap[child+1]] < nrm->T[nrm->heap[child]]){
+            child++;
+        }
+        if(nrm->T[nrm->heap[i]] <= nrm->T[nrm->heap[child]]){
+            break;
+        }
+        ssm_nrm_swap(nrm, i, child);
+        i = child;
+    }
+}
+
+
+/**
+ * Set the propensity of the reaction k to a at time t and move k in
+ * the queue. The putative time of a reaction that did not fire is
+ * rescaled by a_old/a, a new one is drawn otherwise.
+ */
+static void ssm_nrm_set(ssm_nrm_t *nrm, int k, double a, double t, int fired, gsl_rng *randgsl)
+{
+    if(a <= 0.0){
+        nrm->T[k] = GSL_POSINF;
+    } else if(fired || nrm->a[k] <= 0.0){
+        nrm->T[k] = t + gsl_ran_exponential(randgsl, 1.0/a);
+    } else {
+        nrm->T[k] = t + (nrm->a[k]/a) * (nrm->T[k] - t);
+    }
+    nrm->a[k] = a;
+
+    ssm_nrm_up(nrm, nrm->pos[k]);
+    ssm_nrm_down(nrm, nrm->pos[k]);
+}
+
+
+/**
+ * Propensities and putative times of every reaction of p_X at time t
+ * (heapified queue)
+ */
+static void ssm_nrm_init(ssm_X_t *p_X, double t, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc)
+{
+    int k;
+    double a;
+    ssm_nrm_t *nrm = calc->nrm;
+
+    for(k=0; k<nrm->length; k++){
+        a = ssm_nrm_propensity(k, p_X, t, par, nav, calc);
+        nrm->a[k] = a;
+        nrm->T[k] = (a > 0.0) ? t + gsl_ran_exponential(calc->randgsl, 1.0/a) : GSL_POSINF;
+        nrm->heap[k] = k;
+        nrm->pos[k] = k;
+    }
+
+    for(k=nrm->length/2 - 1; k>=0; k--){
+        ssm_nrm_down(nrm, k);
+    }
+}
+
+
+static ssm_err_code_t ssm_f_prediction_nrm_is_diff(ssm_X_t *p_X, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc, int is_diff)
+{
+    int i, k;
+    ssm_nrm_t *nrm = calc->nrm;
+    double t = t0;
+    double dt = p_X->dt;
+    double h = (nrm->refresh_length || is_diff) ? p_X->dt0 : t1 - t0; //time grid of the refreshments
+    double t_grid = GSL_MIN(t0 + h, t1);
+    double t_diff = t0; //last time the diffusions were integrated
+
+    ssm_psr_white_noises(t_grid - t0, par, nav, calc);
+    ssm_nrm_init(p_X, t, par, nav, calc);
+
+    while (t < t1) {
+        k = nrm->heap[0];
+
+        if (nrm->T[k] < t_grid) {
+            t = nrm->T[k];
+            ssm_psr_fire(p_X, k, nav);
+
+            for(i=nrm->dep_start[k]; i<nrm->dep_start[k+1]; i++){
+                ssm_nrm_set(nrm, nrm->dep[i], ssm_nrm_propensity(nrm->dep[i], p_X, t, par, nav, calc), t, nrm->dep[i] == k, calc->randgsl);
+            }
+
+        } else {
+            if (is_diff) {
+                p_X->dt = t_grid - t_diff;
+                ssm_compute_diff(p_X, par, nav, calc);
+                t_diff = t_grid;
+            }
+            t = t_grid;
+            t_grid = GSL_MIN(t + h, t1);
+
+            if (t < t1) {
+                ssm_psr_white_noises(t_grid - t, par, nav, calc);
+                for(i=0; i<nrm->refresh_length; i++){
+                    k = nrm->refresh[i];
+                    ssm_nrm_set(nrm, k, ssm_nrm_propensity(k, p_X, t, par, nav, calc), t, 0, calc->randgsl);
+                }
+            }
+        }
+    }
+
+    p_X->dt = dt;
+
+    return ssm_check_no_neg_sv_or_remainder(p_X, par, nav, calc, t1);
+}
+
+ssm_err_code_t ssm_f_prediction_nrm(ssm_X_t *p_X, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc)
+{
+    return ssm_f_prediction_nrm_is_diff(p_X, t0, t1, par, nav, calc, 1);
+}
+
+ssm_err_code_t ssm_f_prediction_nrm_no_diff(ssm_X_t *p_X, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc)
+{
+    return ssm_f_prediction_nrm_is_diff(p_X, t0, t1, par, nav, calc, 0);
+}
@@ -52,6 +52,7 @@ void ssm_options_load(ssm_options_t *opts, ssm_algo_t algo, int argc, char *argv
         {"Z", 'Z', "eps_rel_integ",  "relative error for adaptive step-size control", required_argument,  SSM_WORKER | SSM_SMC | SSM_KALMAN | SSM_KMCMC | SSM_PMCMC | SSM_KSIMPLEX | SSM_SIMPLEX | SSM_MIF | SSM_SIMUL },
         {"G", 'G', "freeze_forcing", "freeze covariates to their value at specified ISO 8601 date", required_argument, SSM_WORKER |  SSM_SMC | SSM_KALMAN | SSM_KMCMC | SSM_PMCMC | SSM_KSIMPLEX | SSM_SIMPLEX | SSM_MIF | SSM_SIMUL },
         {"K", 'K', "like_min",       "if applicable, particles with likelihood smaller than like_min are considered lost. Otherwise, lower bound on likelihood", required_argument,  SSM_WORKER | SSM_SMC | SSM_KALMAN | SSM_KMCMC | SSM_PMCMC | SSM_KSIMPLEX | SSM_SIMPLEX | SSM_MIF },
+        {"u", 'u', "ess_threshold",  "resample only when the effective sample size is below ess_threshold * J (weights are carried over otherwise, 1.0: always resample)", required_argument,  SSM_SMC | SSM_PMCMC },
         {"U", 'U', "eps_max",        "maximum value allowed for epislon", required_argument,  SSM_KMCMC | SSM_PMCMC },
         {"S", 'S', "alpha",          "smoothing factor of exponential smoothing used to compute smoothed acceptance rate (low values increase degree of smoothing)", required_argument,  SSM_KMCMC | SSM_PMCMC },
         {"H", 'H', "heat",           "re-heating accross MIF iterations (scales standard deviation of proposals)", required_argument,  SSM_MIF },
@@ -59,6 +60,10 @@ void ssm_options_load(ssm_options_t *opts, ssm_algo_t algo, int argc, char *argv
         {"F", 'F', "freq",           "For simulations outside the data range, print the outputs (and reset incidences to 0 if any) every specified days", required_argument,  SSM_WORKER | SSM_SIMUL },
         {"V", 'V', "size",           "simplex size used as stopping criteria", required_argument,  SSM_KSIMPLEX | SSM_SIMPLEX },
         {"Q", 'Q', "interpolator",   "gsl interpolator for covariates", required_argument,  SSM_WORKER | SSM_SMC | SSM_KALMAN | SSM_KMCMC | SSM_PMCMC | SSM_KSIMPLEX | SSM_SIMPLEX | SSM_MIF | SSM_SIMUL },
+        {"i", 'i', "integrator",     "ODE integrator: rkf45 (default), rkck or rk8pd (explicit), rk4imp, bsimp or msbdf (implicit, for stiff models, use the jacobian, ode implementation only)", required_argument,  SSM_WORKER | SSM_SMC | SSM_KALMAN | SSM_KMCMC | SSM_PMCMC | SSM_KSIMPLEX | SSM_SIMPLEX | SSM_MIF | SSM_SIMUL },
+        {"y", 'y', "accuracy",       "accuracy of the observation log densities: exact (gsl), fast (default) or approx", required_argument,  SSM_WORKER | SSM_SMC | SSM_KALMAN | SSM_KMCMC | SSM_PMCMC | SSM_KSIMPLEX | SSM_SIMPLEX | SSM_MIF },
+        {"q", 'q', "resampling",     "resampling scheme: systematic (default), stratified or residual", required_argument,  SSM_SMC | SSM_PMCMC },
+        {"m", 'm', "psr_step",       "stepping of the psr implementation: euler (default, fixed dt) or tau (adaptive tau-leaping, exact steps near extinction)", required_argument,  SSM_WORKER | SSM_SMC | SSM_PMCMC | SSM_MIF | SSM_SIMUL },
         {"R", 'R', "server",         "domain name or IP address of the particule server (e.g 127.0.0.1)", required_argument,  SSM_WORKER },
 
         {"h", 'h', "help",           "print the usage on stdout", no_argument,  SSM_WORKER | SSM_SMC | SSM_KALMAN | SSM_KMCMC | SSM_PMCMC | SSM_KSIMPLEX | SSM_SIMPLEX | SSM_MIF | SSM_SIMUL },
@@ -76,6 +81,8 @@ void ssm_options_load(ssm_options_t *opts, ssm_algo_t algo, int argc, char *argv
         {"s", 's', "smooth",         "tune epsilon with the value of the acceptance rate obtained with exponential smoothing", no_argument,  SSM_KMCMC | SSM_PMCMC },
         {"a", 'a', "acc",            "print the acceptance rate", no_argument,  SSM_KMCMC | SSM_PMCMC },
         {"z", 'z', "tcp",            "dispatch particles across machines", no_argument,  SSM_SIMUL | SSM_SMC | SSM_PMCMC | SSM_MIF },
+        {"k", 'k', "batch",          "predict (sde and psr only) and weight the particles by blocks with the batched functions", no_argument,  SSM_SMC | SSM_PMCMC },
+        {"o", 'o', "tree",           "store the particle paths in an ancestral tree keeping only the surviving lineages (trajectories are sampled at the thinning points)", no_argument,  SSM_PMCMC },
         {"b", 'b', "ic_only",        "only fit the initial condition using fixed lag smoothing", no_argument,  SSM_MIF },
         {"l", 'l', "least_squares",  "minimize the sum of squared errors instead of maximizing the likelihood", no_argument,  SSM_SIMPLEX },
         {"g", 'g', "seed_time",      "seed the random number generator with the current time", no_argument,  SSM_WORKER | SSM_SMC | SSM_KALMAN | SSM_KMCMC | SSM_PMCMC | SSM_KSIMPLEX | SSM_SIMPLEX | SSM_MIF | SSM_SIMUL }
@@ -210,6 +217,10 @@ void ssm_options_load(ssm_options_t *opts, ssm_algo_t algo, int argc, char *argv
             opts->like_min = atof(optarg);
             break;
 
+        case 'u': //ess_threshold
+            opts->ess_threshold = atof(optarg);
+            break;
+
         case 'U': //eps_max
             opts->eps_max = atof(optarg);
             break;
@@ -238,6 +249,22 @@ void ssm_options_load(ssm_options_t *opts, ssm_algo_t algo, int argc, char *argv
             strncpy(opts->interpolator, optarg, SSM_STR_BUFFSIZE);
             break;
 
+        case 'y': //accuracy
+            strncpy(opts->accuracy, optarg, SSM_STR_BUFFSIZE);
+            break;
+
+        case 'i': //integrator
+            strncpy(opts->integrator, optarg, SSM_STR_BUFFSIZE);
+            break;
+
+        case 'q': //resampling
+            strncpy(opts->resampling, optarg, SSM_STR_BUFFSIZE);
+            break;
+
+        case 'm': //psr_step
+            strncpy(opts->psr_step, optarg, SSM_STR_BUFFSIZE);
+            break;
+
         case 'R': //server
             strncpy(opts->server, optarg, SSM_STR_BUFFSIZE);
             break;
@@ -298,6 +325,14 @@ void ssm_options_load(ssm_options_t *opts, ssm_algo_t algo, int argc, char *argv
             opts->flag_tcp = 1;
             break;
 
+        case 'k': //batch
+            opts->flag_batch = 1;
+            break;
+
+        case 'o': //tree
+            opts->flag_tree = 1;
+            break;
+
         case 'b': //ic_only
             opts->flag_ic_only = 1;
             break;
@@ -379,6 +414,8 @@ void ssm_options_set_implementation(ssm_options_t *opts, ssm_algo_t algo, int ar
 		opts->implementation = SSM_SDE;
 	    } else if (!strcmp(argv[0], "psr")) {
 		opts->implementation = SSM_PSR;
+	    } else if (!strcmp(argv[0], "nrm")) {
+		opts->implementation = SSM_NRM;
 	    } else {
 		ssm_print_err("invalid implementation");
 		exit(EXIT_FAILURE);
@@ -117,6 +117,214 @@ ssm_err_code_t ssm_check_no_neg_sv_or_remainder(ssm_X_t *p_X, ssm_par_t *par, ss
 }
 
 
+/**
+ * Row of tcache for time t: the values cached at t, or a new row
+ * that the caller has to fill (*is_new is then set to 1).
+ *
+ * The time points are kept in increasing order and searched from
+ * the last hit (then by bisection) so that the particles stepping
+ * through the same time points one after the other all hit the
+ * cache. A time point that can't be appended (smaller than the last
+ * cached one, or cache full) resets it.
+ */
+double *ssm_tcache_get(ssm_tcache_t *tcache, double t, int *is_new)
+{
+    int k = tcache->last;
+    int n = tcache->width;
+
+    *is_new = 0;
+
+    if (k < tcache->length && tcache->t[k] == t) {
+        return &tcache->values[k*n];
+    } else if (k+1 < tcache->length && tcache->t[k+1] == t) {
+        tcache->last = k+1;
+        return &tcache->values[(k+1)*n];
+    }
+
+    if (tcache->length && t >= tcache->t[0] && t <= tcache->t[tcache->length-1]) {
+        int lo = 0, hi = tcache->length-1;
+        while (lo < hi) {
+            int mid = (lo + hi) / 2;
+            if (tcache->t[mid] < t) {
+                lo = mid + 1;
+            } else {
+                hi = mid;
+            }
+        }
+        if (tcache->t[lo] == t) {
+            tcache->last = lo;
+            return &tcache->values[lo*n];
+        }
+    }
+
+    if (tcache->length && (t < tcache->t[tcache->length-1] || tcache->length == SSM_TCACHE_MAX)) {
+        tcache->length = 0;
+    }
+
+    if (tcache->length == tcache->size) {
+        int size = tcache->size ? GSL_MIN(2*tcache->size, SSM_TCACHE_MAX) : 64;
+        double *times = realloc(tcache->t, size * sizeof (double));
+        double *values = realloc(tcache->values, size * GSL_MAX(n, 1) * sizeof (double));
+        if (times == NULL || values == NULL) {
+            ssm_print_err("Reallocation impossible");
+            exit(EXIT_FAILURE);
+        }
+        tcache->t = times;
+        tcache->values = values;
+        tcache->size = size;
+    }
+
+    k = tcache->length++;
+    tcache->t[k] = t;
+    tcache->last = k;
+    *is_new = 1;
+
+    return &tcache->values[k*n];
+}
+
+
+/**
+ * Covariates interpolated at time t (indexed by their ORDER_), used
+ * by the generated code instead of calling gsl_spline_eval for every
+ * occurrence of a covariate.
+ *
+ * Covariates do not depend on the particles so the interpolated
+ * values are cached per time point (see ssm_tcache_get()): all the
+ * particles handled by calc share them.
+ */
+const double *ssm_covariates(ssm_calc_t *calc, double t)
+{
+    int i, is_new;
+    double *cov = ssm_tcache_get(calc->cov, t, &is_new);
+
+    if (is_new) {
+        for (i=0; i<calc->covariates_length; i++) {
+            cov[i] = gsl_spline_eval(calc->spline[i], t, calc->acc[i]);
+        }
+    }
+
+    return cov;
+}
+
+
+/**
+ * one block of parameter only subexpressions per generated file (see
+ * ordered.tpl), in the order of ssm_pre_block_t: the indexes of a file
+ * don't depend on the terms of the others so that a file is only
+ * regenerated when its own terms change
+ */
+static int (*ssm_pre_length[SSM_PRE_BLOCKS])(void) = {
+    &ssm_pre_length_step, &ssm_pre_length_observed, &ssm_pre_length_Q, &ssm_pre_length_Ht, &ssm_pre_length_jac, &ssm_pre_length_step_ekf
+};
+
+static void (*ssm_pre_eval[SSM_PRE_BLOCKS])(ssm_par_t *par, double *_pre) = {
+    &ssm_pre_eval_step, &ssm_pre_eval_observed, &ssm_pre_eval_Q, &ssm_pre_eval_Ht, &ssm_pre_eval_jac, &ssm_pre_eval_step_ekf
+};
+
+
+/**
+ * number of parameter only subexpressions of the generated code.
+ * offset[block] is set to the index of the first term of each block.
+ */
+int ssm_precompute_length(int offset[])
+{
+    int b;
+    int n = 0;
+
+    for(b=0; b<SSM_PRE_BLOCKS; b++){
+        offset[b] = n;
+        n += (*ssm_pre_length[b])();
+    }
+
+    return n;
+}
+
+
+/**
+ * generation of the parameters, bumped by ssm_par_changed() each time
+ * the content of a ssm_par_t is modified (see ssm_precomputed())
+ */
+static unsigned long ssm_par_generation = 1;
+
+/**
+ * to be called after the content of a ssm_par_t is modified in place
+ * (ssm_input2par(), ssm_par_copy()): the parameter only
+ * subexpressions computed for a previous content are no longer used.
+ */
+void ssm_par_changed(void)
+{
+    ssm_par_generation++;
+}
+
+
+/**
+ * compute the parameter only subexpressions of the generated code
+ * (_pre) for par (see ssm_precomputed())
+ */
+void ssm_precompute(ssm_par_t *par, ssm_calc_t *calc)
+{
+    int b;
+
+    if(calc->pre_length){
+        for(b=0; b<SSM_PRE_BLOCKS; b++){
+            (*ssm_pre_eval[b])(par, calc->pre + calc->pre_offset[b]);
+        }
+    }
+
+    calc->pre_par = par;
+    calc->pre_generation = ssm_par_generation;
+
+    //the time only terms depend on the parameters
+    calc->tt->length = 0;
+}
+
+
+/**
+ * Parameter only subexpressions of the block of the generated code
+ * for par (_pre, see ssm_precompute()).
+ *
+ * ssm_input2par() computes them for the parameters it returns but
+ * calc can be used with other parameters (e.g. one parameter set per
+ * particle for MIF): they are recomputed when par is not the
+ * parameter set they were computed for or when a parameter set was
+ * modified since (see ssm_par_changed()). Only the pointer and the
+ * generation are compared, not the content.
+ */
+const double *ssm_precomputed(ssm_par_t *par, ssm_calc_t *calc, ssm_pre_block_t block)
+{
+    if (par != calc->pre_par || calc->pre_generation != ssm_par_generation) {
+        ssm_precompute(par, calc);
+    }
+
+    return calc->pre + calc->pre_offset[block];
+}
+
+
+/**
+ * Terms of the generated code that only depend on time (and
+ * parameters, covariates) at time t (_tt, see
+ * ssm_eval_time_terms()).
+ *
+ * All the particles share the parameters and step through the same
+ * time points: the terms are computed once per time point (per calc,
+ * that is per thread, see ssm_tcache_get()) and the per particle
+ * stepping functions only read them. They are recomputed when par
+ * changes (ssm_precompute() resets calc->tt).
+ */
+const double *ssm_time_terms(ssm_par_t *par, ssm_calc_t *calc, double t)
+{
+    int is_new;
+    const double *_pre = ssm_precomputed(par, calc, SSM_PRE_STEP);
+    double *tt = ssm_tcache_get(calc->tt, t, &is_new);
+
+    if (is_new) {
+        ssm_eval_time_terms(t, par, calc, _pre, tt);
+    }
+
+    return tt;
+}
+
+
 ssm_f_pred_t ssm_get_f_pred(ssm_nav_t *nav)
 {
     ssm_implementations_t implementation = nav->implementation;
@@ -147,11 +355,16 @@ ssm_f_pred_t ssm_get_f_pred(ssm_nav_t *nav)
 
     } else if (implementation == SSM_PSR){
         //no_white_noise is handled within the step funciton
-        if(noises_off & SSM_NO_DIFF){
+        if(nav->psr_step == SSM_PSR_TAU){
+            return (noises_off & SSM_NO_DIFF) ? &ssm_f_prediction_psr_tau_no_diff : &ssm_f_prediction_psr_tau;
+        } else if(noises_off & SSM_NO_DIFF){
             return &ssm_f_prediction_psr_no_diff;
         } else {
             return &ssm_f_prediction_psr;
         }
+
+    } else if (implementation == SSM_NRM){
+        return (noises_off & SSM_NO_DIFF) ? &ssm_f_prediction_nrm_no_diff : &ssm_f_prediction_nrm;
     }
 
     return NULL;
@@ -165,10 +378,18 @@ ssm_err_code_t ssm_f_prediction_ode(ssm_X_t *p_X, double t0, double t1, ssm_par_
     calc->_par = par; //pass the ref to par so that it is available wihtin the function to integrate
 
     double *y = p_X->proj;
-    gsl_odeiv2_evolve_reset (calc->evolve);
-    gsl_odeiv2_step_reset (calc->step);
+    double t_last = t; //start of the last step
+    double h_free = *h; //step size proposed by the controller before being truncated to land on t1
+
+    //the implicit and multistep steppers keep a state belonging to the last particle integrated by this thread, the explicit ones are stateless
+    if((calc->sys).jacobian){
+        gsl_odeiv2_evolve_reset (calc->evolve);
+        gsl_odeiv2_step_reset (calc->step);
+    }
 
     while (t < t1) {
+        t_last = t;
+        h_free = *h;
         int status = gsl_odeiv2_evolve_apply (calc->evolve, calc->control, calc->step, &(calc->sys), &t, t1, h, y);
         if (status != GSL_SUCCESS) {
             if (nav->print & SSM_PRINT_WARNING) {
@@ -177,11 +398,72 @@ ssm_err_code_t ssm_f_prediction_ode(ssm_X_t *p_X, double t0, double t1, ssm_par_
             return SSM_ERR_PRED;
         }
     }
+
+    //the last step was truncated to land on t1 (data point or output point of -F): warm start the next interval with the step size the controller had reached and not with the one adapted from the truncated step
+    if(h_free > t1 - t_last){
+        *h = GSL_MAX(*h, h_free);
+    }
+
     return ssm_check_no_neg_sv_or_remainder(p_X, par, nav, calc, t1);
 }
 
 
 
+/**
+ * Integration step size to start the next run with: the one
+ * reached by the adaptive ODE solver over the first data interval
+ * by the first particle that did not fail (ssm_X_t.dt0 if they
+ * all failed). Has to be called before resampling.
+ */
+double ssm_dt_warm(ssm_X_t **J_X, ssm_fitness_t *fitness)
+{
+    int j;
+    for(j=0; j<fitness->J; j++){
+        if(fitness->cum_status[j] == SSM_SUCCESS && fitness->weights[j] > GSL_NEGINF){
+            return J_X[j]->dt;
+        }
+    }
+
+    return J_X[0]->dt0;
+}
+
+
+/**
+ * Jacobian of the ODE system (gsl_odeiv2_system) used by the
+ * implicit steppers: dfdy[i*dim+j] is the derivative of the equation
+ * i against the state j (dense version of the sparse jacobian
+ * generated in ssm_eval_jac()). The time derivative dfdt (through the
+ * covariates and the time dependent terms) is a forward difference of
+ * ssm_step_ode().
+ */
+int ssm_jac_ode(double t, const double X[], double *dfdy, double dfdt[], void *params)
+{
+    int i, k;
+    ssm_calc_t *calc = (ssm_calc_t *) params;
+    int dim = (calc->sys).dimension;
+    double *f = calc->_f_dfdt;
+    double *f_dt = calc->_f_dfdt + dim;
+    double dt = SSM_JAC_DT * GSL_MAX(1.0, fabs(t));
+
+    ssm_eval_jac(X, t, calc->_par, calc->_nav, calc);
+
+    for(i=0; i<dim*dim; i++){
+        dfdy[i] = 0.0;
+    }
+    for(k=0; k<calc->_Ft_nnz; k++){
+        dfdy[calc->_Ft_i[k]*dim + calc->_Ft_j[k]] = calc->_Ft_x[k];
+    }
+
+    ssm_step_ode(t, X, f, params);
+    ssm_step_ode(t + dt, X, f_dt, params);
+    for(i=0; i<dim; i++){
+        dfdt[i] = (f_dt[i] - f[i])/dt;
+    }
+
+    return GSL_SUCCESS;
+}
+
+
 ssm_err_code_t ssm_f_prediction_sde_no_dem_sto_no_white_noise(ssm_X_t *p_X, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc)
 {
     double t = t0;
@@ -293,3 +575,233 @@ ssm_err_code_t ssm_f_prediction_psr_no_diff(ssm_X_t *p_X, double t0, double t1,
     }
     return ssm_check_no_neg_sv_or_remainder(p_X, par, nav, calc, t1);
 }
+
+
+/**
+ * Adaptive tau-leaping: each leap is a ssm_step_psr_leap() step as
+ * long as ssm_psr_tau() allows (relative change of the state
+ * variables of at most SSM_TAU_EPS). When the leap gets shorter than
+ * SSM_TAU_EXACT mean waiting times between two reactions (small
+ * populations, near extinction) the reactions are fired one by one
+ * (direct method), the rates being re-evaluated at least every
+ * p_X->dt0.
+ *
+ * When some propensities have a white noise or depend on the time,
+ * the covariates or the diffusions (calc->_a_grid) the steps don't
+ * cross the points of the dt0 time grid where the white noises are
+ * redrawn (see ssm_psr_white_noises()): the propensities are never
+ * used more than dt0 after they were evaluated.
+ */
+static ssm_err_code_t ssm_f_prediction_psr_tau_is_diff(ssm_X_t *p_X, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc, int is_diff)
+{
+    int k;
+    double t = t0;
+    double dt = p_X->dt;
+    double t_grid = t0; //end of the current step of the time grid
+    double a0, tau, h, u;
+
+    while (t < t1) {
+        if (t >= t_grid) {
+            t_grid = (calc->_a_grid) ? GSL_MIN(t + p_X->dt0, t1) : t1;
+            ssm_psr_white_noises(t_grid - t, par, nav, calc);
+        }
+
+        a0 = ssm_psr_propensities(p_X, t, par, nav, calc);
+        tau = ssm_psr_tau(p_X, SSM_TAU_EPS, calc);
+
+        if (a0 > 0.0 && tau >= SSM_TAU_EXACT/a0) {
+            p_X->dt = GSL_MIN(tau, t_grid - t);
+            ssm_step_psr_leap(p_X, t, par, nav, calc);
+        } else {
+            //no reaction before h: the rates are re-evaluated (memoryless) after dt0 at most
+            h = (a0 > 0.0) ? gsl_ran_exponential(calc->randgsl, 1.0/a0) : GSL_POSINF;
+            p_X->dt = GSL_MIN(GSL_MIN(h, p_X->dt0), t_grid - t);
+
+            if (p_X->dt == h) {
+                u = gsl_rng_uniform(calc->randgsl) * a0;
+                for(k=0; k<calc->_a_length-1 && u >= calc->_a[k]; k++){
+                    u -= calc->_a[k];
+                }
+                ssm_psr_fire(p_X, k, nav);
+            }
+        }
+
+        if (is_diff) {
+            ssm_compute_diff(p_X, par, nav, calc);
+        }
+        t = (p_X->dt == t_grid - t) ? t_grid : t + p_X->dt;
+    }
+
+    p_X->dt = dt;
+
+    return ssm_check_no_neg_sv_or_remainder(p_X, par, nav, calc, t1);
+}
+
+ssm_err_code_t ssm_f_prediction_psr_tau(ssm_X_t *p_X, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc)
+{
+    return ssm_f_prediction_psr_tau_is_diff(p_X, t0, t1, par, nav, calc, 1);
+}
+
+ssm_err_code_t ssm_f_prediction_psr_tau_no_diff(ssm_X_t *p_X, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc)
+{
+    return ssm_f_prediction_psr_tau_is_diff(p_X, t0, t1, par, nav, calc, 0);
+}
+
+
+/**
+ * Copy the states of the particles J_X[j0:j1] in the block b (see
+ * ssm_batch_t). The particles of a block share the same integration
+ * time step (sde and psr use a fixed one)
+ */
+void ssm_batch_gather(ssm_batch_t *b, ssm_X_t **J_X, int j0, int j1)
+{
+    int j, k;
+    int J = j1 - j0;
+
+    b->J = J;
+    b->dt = J_X[j0]->dt;
+
+    for(k=0; k<b->length; k++){
+        double *x = b->X + k*J;
+        for(j=0; j<J; j++){
+            x[j] = J_X[j0+j]->proj[k];
+        }
+    }
+}
+
+/**
+ * Copy back the states of the block b in the particles J_X[j0:j0+b->J]
+ */
+void ssm_batch_scatter(ssm_batch_t *b, ssm_X_t **J_X, int j0)
+{
+    int j, k;
+    int J = b->J;
+
+    for(k=0; k<b->length; k++){
+        const double *x = b->X + k*J;
+        for(j=0; j<J; j++){
+            J_X[j0+j]->proj[k] = x[j];
+        }
+    }
+}
+
+
+/**
+ * NULL if the particles have to be predicted one by one (ODE, EKF,
+ * adaptive psr steps, nrm or batched prediction not requested (calc->batch
+ * is NULL))
+ */
+ssm_f_pred_batch_t ssm_get_f_pred_batch(ssm_nav_t *nav, ssm_calc_t *calc)
+{
+    ssm_implementations_t implementation = nav->implementation;
+    ssm_noises_off_t noises_off= nav->noises_off;
+
+    if (calc->batch == NULL) {
+        return NULL;
+
+    } else if (implementation == SSM_SDE){
+
+        if (noises_off == (SSM_NO_DEM_STO | SSM_NO_WHITE_NOISE | SSM_NO_DIFF) ) {
+            return NULL;
+        } else if (noises_off == (SSM_NO_DEM_STO | SSM_NO_WHITE_NOISE) ) {
+            return &ssm_f_prediction_batch_sde_no_dem_sto_no_white_noise;
+        } else if (noises_off == (SSM_NO_DEM_STO | SSM_NO_DIFF) ) {
+            return &ssm_f_prediction_batch_sde_no_dem_sto_no_diff;
+        } else if (noises_off == (SSM_NO_WHITE_NOISE | SSM_NO_DIFF) ) {
+            return &ssm_f_prediction_batch_sde_no_white_noise_no_diff;
+        } else if (noises_off == SSM_NO_DEM_STO ) {
+            return &ssm_f_prediction_batch_sde_no_dem_sto;
+        } else if (noises_off == SSM_NO_WHITE_NOISE ) {
+            return &ssm_f_prediction_batch_sde_no_white_noise;
+        } else if (noises_off == SSM_NO_DIFF ) {
+            return &ssm_f_prediction_batch_sde_no_diff;
+        } else {
+            return &ssm_f_prediction_batch_sde_full;
+        }
+
+    } else if (implementation == SSM_PSR && nav->psr_step == SSM_PSR_EULER){
+        if(noises_off & SSM_NO_DIFF){
+            return &ssm_f_prediction_batch_psr_no_diff;
+        } else {
+            return &ssm_f_prediction_batch_psr;
+        }
+    }
+
+    return NULL;
+}
+
+
+/**
+ * Predict the particles J_X[j0:j1] by blocks of at most
+ * calc->batch->size particles with the batched stepping function
+ * f_step (and ssm_compute_diff_batch() if is_diff)
+ */
+static void ssm_f_prediction_batch(void (*f_step) (ssm_batch_t *, double, ssm_par_t *, ssm_nav_t *, ssm_calc_t *), int is_diff, ssm_X_t **J_X, int j0, int j1, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc, ssm_err_code_t *cum_status)
+{
+    int j, k;
+    double t;
+    ssm_batch_t *b = calc->batch;
+
+    for(k=j0; k<j1; k+=b->size){
+        ssm_batch_gather(b, J_X, k, GSL_MIN(k + b->size, j1));
+
+        t = t0;
+        while (t < t1) {
+            (*f_step)(b, t, par, nav, calc);
+            if(is_diff){
+                ssm_compute_diff_batch(b, par, nav, calc);
+            }
+            t += b->dt;
+        }
+
+        ssm_batch_scatter(b, J_X, k);
+        for(j=k; j<k+b->J; j++){
+            cum_status[j] |= ssm_check_no_neg_sv_or_remainder(J_X[j], par, nav, calc, t1);
+        }
+    }
+}
+
+void ssm_f_prediction_batch_sde_no_dem_sto_no_white_noise(ssm_X_t **J_X, int j0, int j1, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc, ssm_err_code_t *cum_status)
+{
+    ssm_f_prediction_batch(&ssm_step_sde_no_dem_sto_no_white_noise_batch, 1, J_X, j0, j1, t0, t1, par, nav, calc, cum_status);
+}
+
+void ssm_f_prediction_batch_sde_no_dem_sto_no_diff(ssm_X_t **J_X, int j0, int j1, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc, ssm_err_code_t *cum_status)
+{
+    ssm_f_prediction_batch(&ssm_step_sde_no_dem_sto_batch, 0, J_X, j0, j1, t0, t1, par, nav, calc, cum_status);
+}
+
+void ssm_f_prediction_batch_sde_no_white_noise_no_diff(ssm_X_t **J_X, int j0, int j1, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc, ssm_err_code_t *cum_status)
+{
+    ssm_f_prediction_batch(&ssm_step_sde_no_white_noise_batch, 0, J_X, j0, j1, t0, t1, par, nav, calc, cum_status);
+}
+
+void ssm_f_prediction_batch_sde_no_dem_sto(ssm_X_t **J_X, int j0, int j1, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc, ssm_err_code_t *cum_status)
+{
+    ssm_f_prediction_batch(&ssm_step_sde_no_dem_sto_batch, 1, J_X, j0, j1, t0, t1, par, nav, calc, cum_status);
+}
+
+void ssm_f_prediction_batch_sde_no_white_noise(ssm_X_t **J_X, int j0, int j1, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc, ssm_err_code_t *cum_status)
+{
+    ssm_f_prediction_batch(&ssm_step_sde_no_white_noise_batch, 1, J_X, j0, j1, t0, t1, par, nav, calc, cum_status);
+}
+
+void ssm_f_prediction_batch_sde_no_diff(ssm_X_t **J_X, int j0, int j1, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc, ssm_err_code_t *cum_status)
+{
+    ssm_f_prediction_batch(&ssm_step_sde_full_batch, 0, J_X, j0, j1, t0, t1, par, nav, calc, cum_status);
+}
+
+void ssm_f_prediction_batch_sde_full(ssm_X_t **J_X, int j0, int j1, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc, ssm_err_code_t *cum_status)
+{
+    ssm_f_prediction_batch(&ssm_step_sde_full_batch, 1, J_X, j0, j1, t0, t1, par, nav, calc, cum_status);
+}
+
+void ssm_f_prediction_batch_psr(ssm_X_t **J_X, int j0, int j1, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc, ssm_err_code_t *cum_status)
+{
+    ssm_f_prediction_batch(&ssm_step_psr_batch, 1, J_X, j0, j1, t0, t1, par, nav, calc, cum_status);
+}
+
+void ssm_f_prediction_batch_psr_no_diff(ssm_X_t **J_X, int j0, int j1, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc, ssm_err_code_t *cum_status)
+{
+    ssm_f_prediction_batch(&ssm_step_psr_batch, 0, J_X, j0, j1, t0, t1, par, nav, calc, cum_status);
+}
@@ -20,8 +20,14 @@
 
 /**
  * Computes the weight of the particles.
- * Note that p_fitness->weights already contains the likelihood
- * @return the sucess status (sucess if some particles have a likelihood > LIKE_MIN)
+ * Note that p_fitness->weights already contains the log likelihood
+ * (GSL_NEGINF for the particles whose prediction failed). The
+ * likelihoods are multiplied by the weights carried over from the
+ * previous observation (fitness->weights_prev, see
+ * ssm_adaptive_sampling()). The normalization is done with the
+ * log-sum-exp trick so that the weights and fitness->log_like_n do
+ * not underflow when all the likelihoods are small.
+ * @return the sucess status (sucess if some particles have a log likelihood > LOG_LIKE_MIN)
  */
 int ssm_weight(ssm_fitness_t *fitness, ssm_row_t *row, ssm_nav_t *nav, int n)
 {
@@ -29,6 +35,8 @@ int ssm_weight(ssm_fitness_t *fitness, ssm_row_t *row, ssm_nav_t *nav, int n)
 
     int j;
 
+    double log_like_lost = fitness->log_like_min * row->ts_nonan_length;
+    double log_like_max = GSL_NEGINF;
     double like_tot_n = 0.0;
     int nfailure_n = 0;
     int success = 1;
@@ -36,11 +44,19 @@ int ssm_weight(ssm_fitness_t *fitness, ssm_row_t *row, ssm_nav_t *nav, int n)
     fitness->ess_n = 0.0;
 
     for(j=0; j < fitness->J ; j++) {
-        /*compute first part of weights (non divided by sum likelihood)*/      
-        if (fitness->weights[j] <= pow(fitness->like_min, row->ts_nonan_length)) {
-            fitness->weights[j] = 0.0;
+        if (fitness->weights[j] <= log_like_lost || fitness->weights_prev[j] == 0.0) {
             nfailure_n += 1;
+        } else if (fitness->weights[j] > log_like_max) {
+            log_like_max = fitness->weights[j];
+        }
+    }
+
+    for(j=0; j < fitness->J ; j++) {
+        /*compute first part of weights (non divided by sum likelihood, scaled by the max likelihood)*/
+        if (fitness->weights[j] <= log_like_lost || fitness->weights_prev[j] == 0.0) {
+            fitness->weights[j] = 0.0;
         } else {
+            fitness->weights[j] = fitness->weights_prev[j] * exp(fitness->weights[j] - log_like_max);
             like_tot_n += fitness->weights[j]; //note that like_tot_n contains only like of part having a like>like_min
             fitness->ess_n += fitness->weights[j]*fitness->weights[j]; //first part of ess computation (sum of square)
         }
@@ -54,11 +70,11 @@ int ssm_weight(ssm_fitness_t *fitness, ssm_row_t *row, ssm_nav_t *nav, int n)
             sprintf(str,"nfailure = %d, at n=%d we keep all particles and assign equal weights", nfailure_n, n);
             ssm_print_warning(str);
         }
-        fitness->log_like_n = fitness->log_like_min * row->ts_nonan_length;
+        fitness->log_like_n = log_like_lost;
 
-        double invJ=1.0/ ((double) fitness->J);
+        ssm_fitness_reset_weights(fitness);
         for(j=0 ; j < fitness->J ; j++) {
-            fitness->weights[j]= invJ;
+            fitness->weights[j]= fitness->weights_prev[j];
             fitness->select[n][j]= j;
         }
         fitness->ess_n = 0.0;
@@ -68,7 +84,7 @@ int ssm_weight(ssm_fitness_t *fitness, ssm_row_t *row, ssm_nav_t *nav, int n)
             fitness->weights[j] /= like_tot_n;
         }
 
-        fitness->log_like_n = log(like_tot_n / ((double) fitness->J));
+        fitness->log_like_n = log_like_max + log(like_tot_n); //weights_prev sum to 1
         fitness->ess_n = (like_tot_n*like_tot_n)/fitness->ess_n;
     }
 
@@ -107,18 +123,298 @@ void ssm_systematic_sampling(ssm_fitness_t *fitness, ssm_calc_t *calc, int n)
 }
 
 
-void ssm_resample_X(ssm_fitness_t *fitness, ssm_X_t ***J_p_X, ssm_X_t ***J_p_X_tmp, int n)
+/**
+ * Resampling in chunks of particles (one per thread, see
+ * ssm_worker_inproc()) so that every stage but the scan of the chunk
+ * totals (ssm_cumsum_chunks()) can be run in parallel:
+ *
+ * 1. ssm_cumsum_chunk(): prefix sums of the weights within each chunk
+ * 2. ssm_cumsum_chunks(): prefix sums of the chunk totals
+ * 3. ssm_sampling_chunk(): ancestor of each particle of a chunk
+ *
+ * The prefix sum of the weights up to j is fitness->_cum_weights[j]
+ * plus the total of the previous chunks. The ancestor of the particle
+ * j is the first i such that this sum is > u_j, where u_j is:
+ *
+ * - SSM_RESAMPLING_SYSTEMATIC: (j + U)/J, U ~ U(0, 1) shared by all the particles
+ * - SSM_RESAMPLING_STRATIFIED: (j + U_j)/J, one U_j ~ U(0, 1) per particle
+ * - SSM_RESAMPLING_RESIDUAL: particle i gets floor(J*w_i) offspring and
+ *   the R remaining ones are drawn by systematic sampling on the
+ *   residual weights J*w_i - floor(J*w_i)
+ */
+
+
+/**
+ * first and last (excluded) particles of a chunk
+ */
+static void ssm_chunk_range(ssm_fitness_t *fitness, int chunk, int *j0, int *j1)
+{
+    *j0 = chunk * fitness->J_chunk;
+    *j1 = (chunk+1 == fitness->chunks_length) ? fitness->J : (chunk+1) * fitness->J_chunk;
+}
+
+/**
+ * prefix sum up to j (included) from the prefix sums within the
+ * chunks (cum) and of the chunk totals (chunk_cum)
+ */
+static double ssm_cum_at(ssm_fitness_t *fitness, double *cum, double *chunk_cum, int j)
+{
+    int chunk = GSL_MIN(j / fitness->J_chunk, fitness->chunks_length-1);
+    return (chunk) ? cum[j] + chunk_cum[chunk-1] : cum[j];
+}
+
+/**
+ * first j such that the prefix sum up to j is > u (J-1 if none).
+ * If i is >= 0, u is larger than for the previous call which returned
+ * i and the search is done linearly from i.
+ */
+static int ssm_cum_search(ssm_fitness_t *fitness, double *cum, double *chunk_cum, double u, int i)
+{
+    int lo, hi, mid;
+
+    if (i >= 0) {
+        while (i < fitness->J-1 && ssm_cum_at(fitness, cum, chunk_cum, i) <= u) {
+            i++;
+        }
+        return i;
+    }
+
+    lo = 0;
+    hi = fitness->J-1;
+    while (lo < hi) {
+        mid = (lo + hi)/2;
+        if (ssm_cum_at(fitness, cum, chunk_cum, mid) > u) {
+            hi = mid;
+        } else {
+            lo = mid+1;
+        }
+    }
+
+    return lo;
+}
+
+
+/**
+ * prefix sums of the (normalized) weights within the chunk
+ */
+void ssm_cumsum_chunk(ssm_fitness_t *fitness, int chunk)
+{
+    int j, j0, j1;
+    double cum = 0.0;
+    double cum_counts = 0.0;
+    double Jw, count;
+
+    ssm_chunk_range(fitness, chunk, &j0, &j1);
+
+    for(j=j0; j<j1; j++) {
+        if (fitness->resampling == SSM_RESAMPLING_RESIDUAL) {
+            Jw = fitness->J * fitness->weights[j];
+            count = floor(Jw);
+            cum_counts += count;
+            fitness->_cum_counts[j] = cum_counts;
+            cum += Jw - count;
+        } else {
+            cum += fitness->weights[j];
+        }
+        fitness->_cum_weights[j] = cum;
+    }
+
+    fitness->_chunk_weights[chunk] = cum;
+    fitness->_chunk_counts[chunk] = cum_counts;
+}
+
+
+/**
+ * prefix sums of the chunk totals and draw of the uniform random
+ * number shared by all the chunks
+ */
+void ssm_cumsum_chunks(ssm_fitness_t *fitness, ssm_calc_t *calc)
+{
+    int c;
+
+    for(c=1; c<fitness->chunks_length; c++) {
+        fitness->_chunk_weights[c] += fitness->_chunk_weights[c-1];
+        fitness->_chunk_counts[c] += fitness->_chunk_counts[c-1];
+    }
+
+    if (fitness->resampling != SSM_RESAMPLING_STRATIFIED) {
+        fitness->_ran = gsl_ran_flat(calc->randgsl, 0.0, 1.0);
+    }
+}
+
+
+/**
+ * ancestors (fitness->select[n]) of the particles j0 to j1 (excluded)
+ */
+void ssm_sampling_chunk(ssm_fitness_t *fitness, ssm_calc_t *calc, int n, int j0, int j1)
 {
+    unsigned int *select = fitness->select[n];
+    double total = fitness->_chunk_weights[fitness->chunks_length-1];
+    int n_det = 0; //number of offspring set deterministically
+    int i = -1;
     int j;
+    double u;
+
+    if (fitness->resampling == SSM_RESAMPLING_RESIDUAL) {
+        n_det = (int) fitness->_chunk_counts[fitness->chunks_length-1];
+        for(j=j0; j<GSL_MIN(j1, n_det); j++) {
+            i = ssm_cum_search(fitness, fitness->_cum_counts, fitness->_chunk_counts, (double) j, i);
+            select[j] = i;
+        }
+        i = -1;
+    }
+
+    for(j=GSL_MAX(j0, n_det); j<j1; j++) {
+        u = (fitness->resampling == SSM_RESAMPLING_STRATIFIED) ? gsl_ran_flat(calc->randgsl, 0.0, 1.0) : fitness->_ran;
+        u = (j - n_det + u) * total / (fitness->J - n_det);
+        i = ssm_cum_search(fitness, fitness->_cum_weights, fitness->_chunk_weights, u, i);
+        select[j] = i;
+    }
+}
+
+
+/**
+ * Resampling (fitness->resampling scheme): sets fitness->select[n]
+ */
+void ssm_sampling(ssm_fitness_t *fitness, ssm_calc_t *calc, int n)
+{
+    int c;
+
+    for(c=0; c<fitness->chunks_length; c++) {
+        ssm_cumsum_chunk(fitness, c);
+    }
+    ssm_cumsum_chunks(fitness, calc);
+    ssm_sampling_chunk(fitness, calc, n, 0, fitness->J);
+}
+
+
+/**
+ * @return 1 if the effective sample size is below
+ * fitness->ess_threshold * J (always if fitness->ess_threshold >= 1.0)
+ */
+int ssm_need_resampling(ssm_fitness_t *fitness)
+{
+    return (fitness->ess_threshold >= 1.0 || fitness->ess_n < fitness->ess_threshold * fitness->J);
+}
+
+
+/**
+ * Adaptive resampling: the particles are resampled (see
+ * ssm_sampling()) only when the effective sample size is below
+ * fitness->ess_threshold * J. Otherwise select[n] is the identity
+ * (so that ssm_resample_X() does nothing) and the weights are
+ * carried over to the next observation.
+ * @return 1 if the particles were resampled
+ */
+int ssm_adaptive_sampling(ssm_fitness_t *fitness, ssm_calc_t *calc, int n)
+{
+    int j;
+
+    if (ssm_need_resampling(fitness)) {
+        ssm_sampling(fitness, calc, n);
+        ssm_fitness_reset_weights(fitness);
+        return 1;
+    }
+
+    for(j=0; j < fitness->J; j++) {
+        fitness->select[n][j] = j;
+        fitness->weights_prev[j] = fitness->weights[j];
+    }
+
+    return 0;
+}
+
+
+/**
+ * Uniform weights (1/J) for the next observation
+ */
+void ssm_fitness_reset_weights(ssm_fitness_t *fitness)
+{
+    int j;
+    double invJ = 1.0/ ((double) fitness->J);
+
+    for(j=0; j < fitness->J; j++) {
+        fitness->weights_prev[j] = invJ;
+    }
+}
+
+
+/**
+ * X_resampled[j] = X[select[j]]. The particles are permuted by
+ * ancestor index: the first offspring of a particle takes its state
+ * by a swap of pointers (ssm_resample_X_swap()) and only the other
+ * offspring are copied (ssm_resample_X_copy(), into the buffers of
+ * *J_p_X_tmp). Nothing is done if select is the identity.
+ */
+void ssm_resample_X(ssm_fitness_t *fitness, ssm_X_t ***J_p_X, ssm_X_t ***J_p_X_tmp, int n)
+{
+    if(ssm_resample_X_swap(fitness, J_p_X, J_p_X_tmp, n)) {
+        ssm_resample_X_copy(fitness, *J_p_X, n, 0, fitness->J);
+    }
+}
+
+/**
+ * Serial part of ssm_resample_X(): moves the ancestors to the
+ * position of their first offspring and swaps *J_p_X and *J_p_X_tmp.
+ * @return 0 if select is the identity (nothing is done)
+ */
+int ssm_resample_X_swap(ssm_fitness_t *fitness, ssm_X_t ***J_p_X, ssm_X_t ***J_p_X_tmp, int n)
+{
+    int j, a;
 
     unsigned int *select = fitness->select[n];
+    int *first = fitness->_first;
+    ssm_X_t **X = *J_p_X;
+    ssm_X_t **X_tmp = *J_p_X_tmp;
+    ssm_X_t *swap;
+
+    for(j=0; j<fitness->J && select[j] == j; j++);
+    if(j == fitness->J) {
+        return 0;
+    }
+
+    if(fitness->flag_collapse) {
+        ssm_collapse_resample(fitness, select);
+    }
 
-    for(j=0;j<fitness->J;j++) {
-        (*J_p_X_tmp)[j]->dt = (*J_p_X)[select[j]]->dt;
-        memcpy((*J_p_X_tmp)[j]->proj, (*J_p_X)[select[j]]->proj, (*J_p_X)[select[j]]->length * sizeof(double));
+    for(j=0; j<fitness->J; j++) {
+        first[j] = -1;
+    }
+
+    for(j=0; j<fitness->J; j++) {
+        a = select[j];
+        if(first[a] == -1) {
+            first[a] = j;
+            swap = X_tmp[j];
+            X_tmp[j] = X[a];
+            X[a] = swap;
+        }
     }
 
     ssm_swap_X(J_p_X, J_p_X_tmp);
+
+    return 1;
+}
+
+/**
+ * Parallel part of ssm_resample_X(): copies the state of the first
+ * offspring into the other offspring j0 to j1 (excluded) of the
+ * resampled particles J_X (the first offspring are never written so
+ * the chunks can be copied concurrently)
+ */
+void ssm_resample_X_copy(ssm_fitness_t *fitness, ssm_X_t **J_X, int n, int j0, int j1)
+{
+    int j, f;
+
+    unsigned int *select = fitness->select[n];
+
+    for(j=j0; j<j1; j++) {
+        f = fitness->_first[select[j]];
+        if(f != j) {
+            J_X[j]->dt = J_X[f]->dt;
+            memcpy(J_X[j]->proj, J_X[f]->proj, J_X[f]->length * sizeof(double));
+        }
+    }
 }
 
 /**
@@ -131,3 +427,82 @@ void ssm_swap_X(ssm_X_t ***X, ssm_X_t ***tmp_X)
     *tmp_X=*X;
     *X=tmp;
 }
+
+
+/**
+ * Collapse of the identical particles: when the dynamics are
+ * deterministic (f_pred is ssm_f_prediction_ode()) the particles
+ * resampled from the same ancestor stay identical, so only one of
+ * them (fitness->rep[j] == j) is predicted and weighted and the others
+ * are copied from it afterwards (ssm_expand_X()). The groups of
+ * identical particles do not span several chunks so that the chunks
+ * can still be predicted concurrently. The batched log likelihood
+ * (-k) is turned off when the particles are collapsed: the
+ * representatives are weighted one by one.
+ *
+ * ssm_fitness_collapse() has to be called when all the particles are
+ * copies of the same state (initial conditions).
+ */
+void ssm_fitness_collapse(ssm_fitness_t *fitness, ssm_f_pred_t f_pred)
+{
+    int j;
+
+    fitness->flag_collapse = (f_pred == &ssm_f_prediction_ode);
+
+    for(j=0; j<fitness->J; j++) {
+        fitness->rep[j] = (fitness->flag_collapse) ? GSL_MIN(j / fitness->J_chunk, fitness->chunks_length-1) * fitness->J_chunk : j;
+    }
+}
+
+
+/**
+ * groups of identical particles after resampling (select): the
+ * particles of a chunk whose ancestors are in the same group are
+ * copies of the first of them
+ */
+void ssm_collapse_resample(ssm_fitness_t *fitness, unsigned int *select)
+{
+    int c, j, j0, j1, r;
+    int *map = fitness->_rep_map;
+    int *tmp;
+
+    for(c=0; c<fitness->chunks_length; c++) {
+        ssm_chunk_range(fitness, c, &j0, &j1);
+
+        for(j=j0; j<j1; j++) {
+            r = fitness->rep[select[j]];
+            if(map[r] == -1) {
+                map[r] = j;
+            }
+            fitness->_rep_tmp[j] = map[r];
+        }
+
+        for(j=j0; j<j1; j++) {
+            map[fitness->rep[select[j]]] = -1;
+        }
+    }
+
+    tmp = fitness->rep;
+    fitness->rep = fitness->_rep_tmp;
+    fitness->_rep_tmp = tmp;
+}
+
+
+/**
+ * copy the predicted state, the weight and the status of
+ * fitness->rep[j] into the particles j0 to j1 (excluded) that were
+ * not predicted
+ */
+void ssm_expand_X(ssm_fitness_t *fitness, ssm_X_t **J_X, int j0, int j1)
+{
+    int j, r;
+
+    for(j=j0; j<j1; j++) {
+        r = fitness->rep[j];
+        if(r != j) {
+            ssm_X_copy(J_X[j], J_X[r]);
+            fitness->weights[j] = fitness->weights[r];
+            fitness->cum_status[j] = fitness->cum_status[r];
+        }
+    }
+}
@@ -58,7 +58,7 @@
 #include <pthread.h>
 
 typedef enum {SSM_SMC = 1 << 0, SSM_MIF = 1 << 1, SSM_PMCMC = 1 << 2, SSM_KMCMC = 1 << 3, SSM_KALMAN = 1 << 4, SSM_KSIMPLEX = 1 << 5, SSM_SIMUL = 1 << 6, SSM_SIMPLEX = 1 << 7, SSM_WORKER = 1 << 8 } ssm_algo_t;
-typedef enum {SSM_ODE, SSM_SDE, SSM_PSR, SSM_EKF} ssm_implementations_t;
+typedef enum {SSM_ODE, SSM_SDE, SSM_PSR, SSM_EKF, SSM_NRM} ssm_implementations_t;
 typedef enum {SSM_NO_DEM_STO = 1 << 0, SSM_NO_WHITE_NOISE = 1 << 1, SSM_NO_DIFF = 1 << 2 } ssm_noises_off_t; //several noises can be turned off
 
 typedef enum {SSM_PRINT_TRACE = 1 << 0, SSM_PRINT_X = 1 << 1, SSM_PRINT_HAT = 1 << 2, SSM_PRINT_DIAG = 1 << 3, SSM_PRINT_LOG = 1 << 4, SSM_PRINT_WARNING = 1 << 5 } ssm_print_t;
@@ -67,8 +67,23 @@ typedef enum {SSM_SUCCESS = 1 << 0 , SSM_ERR_LIKE= 1 << 1, SSM_ERR_REM_SV = 1 <<
 
 typedef enum {SSM_WORKER_J_PAR = 1 << 0, SSM_WORKER_D_X = 1 << 1, SSM_WORKER_FITNESS = 1 << 2 } ssm_worker_opt_t;
 
+typedef enum {SSM_ACC_EXACT, SSM_ACC_FAST, SSM_ACC_APPROX} ssm_accuracy_t; //accuracy of the observation log densities (see density.c)
+
+typedef enum {SSM_RESAMPLING_SYSTEMATIC, SSM_RESAMPLING_STRATIFIED, SSM_RESAMPLING_RESIDUAL} ssm_resampling_t;
+typedef enum {SSM_PSR_EULER, SSM_PSR_TAU} ssm_psr_step_t;
+typedef enum {SSM_PRE_STEP, SSM_PRE_OBSERVED, SSM_PRE_Q, SSM_PRE_HT, SSM_PRE_JAC, SSM_PRE_STEP_EKF, SSM_PRE_BLOCKS} ssm_pre_block_t; //blocks of parameter only subexpressions, one per generated file (step: ode_sde, psr and precompute, see ssm_precompute())
+
+typedef enum {SSM_TASK_PREDICT, SSM_TASK_CUMSUM, SSM_TASK_SAMPLING, SSM_TASK_RESAMPLE_X} ssm_worker_task_t; //tasks run by the inproc workers on their chunk of particles (see workers.c)
+
 #define SSM_BUFFER_SIZE (10 * 1024)  /**< 1000 KB buffer size */
 #define SSM_STR_BUFFSIZE 255 /**< buffer for log and error strings */
+#define SSM_TCACHE_MAX 65536 /**< maximum number of time points of a ssm_tcache_t (see ssm_tcache_get()) */
+#define SSM_BATCH_SIZE 256 /**< maximum number of particles of a ssm_batch_t */
+#define SSM_LOG_FACT_LENGTH 1024 /**< number of tabulated log factorials (see ssm_log_fact()) */
+#define SSM_APPROX_SD_MIN 5.0 /**< smallest standard deviation for which the discretized normal is approximated (SSM_ACC_APPROX) */
+#define SSM_JAC_DT 1e-7 /**< relative time step of the forward difference used for the time derivative of the ODE (see ssm_jac_ode()) */
+#define SSM_TAU_EPS 0.03 /**< bound on the relative change of the state variables during a leap (see ssm_psr_tau()) */
+#define SSM_TAU_EXACT 10.0 /**< leaps shorter than this number of mean waiting times between two reactions are replaced by exact steps (see ssm_f_prediction_psr_tau()) */
 
 
 #define SSM_WEB_APP 0 /**< webApp */
@@ -102,6 +117,58 @@ typedef gsl_matrix ssm_var_t;
 
 typedef struct _nav ssm_nav_t;
 
+/**
+ * Values computed at the time points already requested, shared by
+ * all the particles stepping through the same time points (see
+ * ssm_tcache_get())
+ */
+typedef struct
+{
+    int width;       /**< number of values per time point */
+    int length;      /**< number of cached time points */
+    int size;        /**< number of time points allocated */
+    int last;        /**< index of the last time point looked up */
+    double *t;       /**< [self.size] cached time points (increasing) */
+    double *values;  /**< [self.size * self.width] values at each cached time point */
+} ssm_tcache_t;
+
+/**
+ * Block of particles stored as a structure of arrays for the batched
+ * stepping functions of the generated code (see
+ * ssm_f_prediction_batch()): state k of particle j is X[k*J+j] so
+ * that every state of the particles of the block is contiguous
+ */
+typedef struct
+{
+    int size;        /**< maximum number of particles */
+    int length;      /**< number of states per particle (nav->states_sv_inc->length + nav->states_diff->length) */
+    int J;           /**< number of particles currently in the block */
+    double dt;       /**< integration time step (shared by the particles of the block) */
+    double *X;       /**< [self.length * self.size] states */
+    double *work;    /**< [ssm_batch_width() * self.size] scratch space of the batched functions */
+} ssm_batch_t;
+
+/**
+ * Next reaction method (exact simulation, see
+ * ssm_f_prediction_nrm()): propensities and absolute putative firing
+ * times of the reactions kept in an indexed priority queue (binary
+ * min heap on T) and reaction dependency graph (generated, see
+ * ssm_nrm_new())
+ */
+typedef struct
+{
+    int length;          /**< number of reactions */
+    int *dep_start;      /**< [this.length+1] */
+    int *dep;            /**< [this.dep_start[this.length]] the propensities to update after the reaction k are the ones of dep[dep_start[k]:dep_start[k+1]] */
+    int refresh_length;
+    int *refresh;        /**< [this.refresh_length] reactions whose propensities depend on the time, the covariates or the diffusions (updated every dt0) */
+
+    double *a;           /**< [this.length] propensities */
+    double *T;           /**< [this.length] absolute putative firing times */
+    int *heap;           /**< [this.length] reactions ordered as a binary min heap on T */
+    int *pos;            /**< [this.length] position of every reaction in heap */
+} ssm_nrm_t;
+
 /**
  * Everything needed to perform computations (possibly in parallel)
  * and store transiant states in a thread-safe way
@@ -121,16 +188,22 @@ typedef struct ssm_calc_t /*[N_THREADS] : for parallel computing we need N_THREA
     /* Euler multinomial */
     double **prob;      /**< [N_PAR_SV][number of output from the compartment]*/
     unsigned int **inc; /**< [N_PAR_SV][number of destinations] increments vector */
+    double *_a;         /**< [this._a_length] propensities of the reactions (see ssm_psr_propensities()) */
+    int _a_length;      /**< number of reactions */
+    int _a_grid;        /**< 1 if propensities have a white noise or depend on the time, the covariates or the diffusions: they are re-evaluated on the dt0 time grid */
+    double *_wn;        /**< white noises of the propensities on the current step of the dt0 time grid (see ssm_psr_white_noises()) */
 
     /* Gillespie */
-    //  double **reaction; /*reaction matrix*/
+    ssm_nrm_t *nrm;     /**< next reaction method (see ssm_f_prediction_nrm()) */
 
     /* ODE*/
     const gsl_odeiv2_step_type *T;
+    gsl_odeiv2_driver *driver;   /**< owns control, step and evolve (the driver is required by the msbdf stepper) */
     gsl_odeiv2_control *control;
     gsl_odeiv2_step *step;
     gsl_odeiv2_evolve *evolve;
     gsl_odeiv2_system sys;
+    double *_f_dfdt;             /**< [2*sys.dimension] derivatives at t and t+dt for the time derivative of the jacobian (see ssm_jac_ode()) */
     double *yerr;
 
     /* SDE */
@@ -150,7 +223,11 @@ typedef struct ssm_calc_t /*[N_THREADS] : for parallel computing we need N_THREA
     gsl_matrix *_Tmp_N_TS_N_SV; /**< [nav->observed_length][nav->states_sv_inc->length + nav->states_diff->length] */
     gsl_matrix *_Q;             /**< [nav->states_sv_inc->length + nav->states_diff->length][nav->states_sv_inc->length + nav->states_diff->length] */
     gsl_matrix *_FtCt;          /**< [nav->states_sv_inc->length + nav->states_diff->length][nav->states_sv_inc->length + nav->states_diff->length] */
-    gsl_matrix *_Ft;            /**< [nav->states_sv_inc->length + nav->states_diff->length][nav->states_sv_inc->length + nav->states_diff->length] */
+    gsl_matrix *_Ft;            /**< [nav->states_sv_inc->length + nav->states_diff->length][nav->states_sv_inc->length + nav->states_diff->length] (only used as a temporary matrix) */
+    int _Ft_nnz;                /**< number of non zero terms of the jacobian matrix Ft (set by ssm_eval_jac()) */
+    int *_Ft_i;                 /**< [(nav->states_sv_inc->length + nav->states_diff->length)^2] row of the non zero terms of Ft */
+    int *_Ft_j;                 /**< [(nav->states_sv_inc->length + nav->states_diff->length)^2] column of the non zero terms of Ft */
+    double *_Ft_x;              /**< [(nav->states_sv_inc->length + nav->states_diff->length)^2] value of the non zero terms of Ft */
     gsl_vector *_eval;      /**< [nav->states_sv_inc->length + nav->states_diff->length] */
     gsl_matrix *_evec;      /**< [nav->states_sv_inc->length + nav->states_diff->length][nav->states_sv_inc->length + nav->states_diff->length] */
     gsl_eigen_symmv_workspace *_w_eigen_vv;  /**< workspace to compute eigen values and eigen vector for symmetric matrix */
@@ -165,6 +242,22 @@ typedef struct ssm_calc_t /*[N_THREADS] : for parallel computing we need N_THREA
     gsl_interp_accel **acc;  /**< [self.covariates_length] an array of pointer to gsl_interp_accel */
     gsl_spline **spline;     /**< [self.covariates_length] an array of pointer to gsl_spline */
 
+    ssm_tcache_t *cov;       /**< covariates interpolated at the time points already requested (see ssm_covariates()) */
+
+    //parameter only subexpressions of the generated code (see ssm_precomputed())
+    int pre_length;          /**< number of precomputed terms */
+    int pre_offset[SSM_PRE_BLOCKS]; /**< index in pre of the first term of each block */
+    double *pre;             /**< [self.pre_length] precomputed terms */
+    const ssm_par_t *pre_par; /**< parameters pre was computed for (NULL if not computed yet) */
+    unsigned long pre_generation; /**< generation of the parameters when pre was computed (see ssm_par_changed()) */
+
+    ssm_tcache_t *tt;        /**< time only terms of the generated code at the time points already requested (see ssm_time_terms()) */
+
+    ssm_accuracy_t accuracy; /**< accuracy of the observation log densities */
+    double *log_fact;        /**< [SSM_LOG_FACT_LENGTH] log(n!) (see ssm_log_fact()) */
+
+    ssm_batch_t *batch;      /**< block of particles for the batched prediction and log likelihood (NULL unless opts->flag_batch, see ssm_get_f_pred_batch() and ssm_log_likelihood_batch()) */
+
     /* references */
     ssm_par_t *_par; /**< Reference to the parameter is the natural
                         scale (this.par) used to pass it to
@@ -297,10 +390,14 @@ typedef struct
     int offset; /**< order of the observed variable in nav.observed */
 
     double (*f_likelihood) (double y, ssm_X_t *X, ssm_par_t *par, ssm_calc_t *calc, double t);
+    double (*f_log_likelihood) (double y, ssm_X_t *X, ssm_par_t *par, ssm_calc_t *calc, double t);
     double (*f_obs_mean)             (ssm_X_t *X, ssm_par_t *par, ssm_calc_t *calc, double t);
     double (*f_obs_var)              (ssm_X_t *X, ssm_par_t *par, ssm_calc_t *calc, double t);
     double (*f_obs_ran)              (ssm_X_t *X, ssm_par_t *par, ssm_calc_t *calc, double t);
     double (*f_var_pred)             (ssm_X_t *X, ssm_par_t *par, ssm_calc_t *calc, ssm_nav_t *nav, double t);
+
+    //batched versions (one value per particle of the block in res)
+    void (*f_log_likelihood_batch)   (double y, ssm_batch_t *b, ssm_par_t *par, ssm_calc_t *calc, double t, double *res); /**< adds the log likelihood of y to res */
 } ssm_observed_t;
 
 
@@ -311,6 +408,7 @@ struct _nav
 {
     ssm_implementations_t implementation;
     ssm_noises_off_t noises_off;
+    ssm_psr_step_t psr_step;
     ssm_print_t print;
 
 
@@ -362,12 +460,30 @@ typedef struct
     double log_like_n ;         /**< log likelihood for the best parameter at n*/
     double log_like;            /**< log likelihood for the best parameter*/
 
-    double *weights;            /**< [this.J] the weights */
+    double *weights;            /**< [this.J] the weights (the log likelihoods before ssm_weight()) */
+    double *weights_prev;       /**< [this.J] normalized weights carried over from the last observation when the particles were not resampled (1/J otherwise) */
+    double ess_threshold;       /**< the particles are resampled when ess_n < ess_threshold * J (always if >= 1.0, see ssm_adaptive_sampling()) */
     unsigned int **select;      /**< [this.data_length][this.J] select is a vector with the indexes of the resampled particles. Note that we keep this.n_data values to keep genealogies */
+    int *_first;                /**< [this.J] position of the first offspring of each particle (used by ssm_resample_X()) */
+
+    ssm_resampling_t resampling; /**< resampling scheme (see ssm_sampling()) */
+    int chunks_length;          /**< number of chunks of particles (one per thread) */
+    int J_chunk;                /**< number of particles per chunk (the last chunk also takes the remainder) */
+    double *_cum_weights;       /**< [this.J] prefix sums of the weights within each chunk (of the residual weights for SSM_RESAMPLING_RESIDUAL) */
+    double *_cum_counts;        /**< [this.J] prefix sums of the deterministic number of offspring floor(J*weight) within each chunk (SSM_RESAMPLING_RESIDUAL) */
+    double *_chunk_weights;     /**< [this.chunks_length] prefix sums of the totals of the chunks of this._cum_weights */
+    double *_chunk_counts;      /**< [this.chunks_length] prefix sums of the totals of the chunks of this._cum_counts */
+    double _ran;                /**< uniform random number shared by all the chunks (systematic and residual resampling) */
+
+    int flag_collapse;          /**< deterministic dynamics: identical particles are predicted once (see ssm_fitness_collapse()) */
+    int *rep;                   /**< [this.J] index of the particle (within the same chunk) that j is a copy of (j if it has to be predicted) */
+    int *_rep_tmp;              /**< [this.J] */
+    int *_rep_map;              /**< [this.J] (-1 between the calls of ssm_collapse_resample()) */
 
     ssm_err_code_t *cum_status;   /**< [this.J] cumulated f_prediction status */
 
     int n_all_fail;             /**< number of times when every particles had like < LIKE_MIN within one iteration */
+    double dt_warm;             /**< integration step size learnt by the adaptive ODE solver over the first data interval of the last run (warm start of the next one, see ssm_dt_warm()) */
 
     /* for bayesian methods */
     double log_like_prev;
@@ -431,6 +547,13 @@ typedef struct
  */
 typedef ssm_err_code_t (*ssm_f_pred_t) (ssm_X_t *, double, double, ssm_par_t *, ssm_nav_t *, ssm_calc_t *);
 
+/**
+ * batched prediction function: predicts the particles J_X[j0:j1]
+ * (sharing the same parameters) and cumulates their status in
+ * cum_status[j0:j1]
+ */
+typedef void (*ssm_f_pred_batch_t) (ssm_X_t **, int, int, double, double, ssm_par_t *, ssm_nav_t *, ssm_calc_t *, ssm_err_code_t *);
+
 
 /**
  * options
@@ -455,9 +578,14 @@ typedef struct
     char *next;              /**< write the outputed parameters in a file prefixed by the argument */
     int n_thread;            /**< number of threads */
     double like_min;         /**< particles with likelihood smaller that like_min are considered lost */
+    double ess_threshold;    /**< resample only when the effective sample size is below ess_threshold * J */
     int J;                   /**< number of particles */
     int n_obs;               /**< number of observations to be fitted (for tempering) */
     char *interpolator;      /**< gsl interpolator for metadata */
+    char *accuracy;          /**< accuracy of the observation log densities (exact, fast or approx) */
+    char *resampling;        /**< resampling scheme (systematic, stratified or residual) */
+    char *psr_step;          /**< stepping of the psr implementation (euler or tau) */
+    char *integrator;        /**< gsl_odeiv2 stepper of the ODE (rkf45, rkck, rk8pd, rk4imp, bsimp or msbdf) */
     int n_iter;              /**< number of iterations */
     double a;                /**< cooling factor (scales standard deviation) */
     double b;                /**< re-heating (inflation) (scales standard deviation of the proposal) */
@@ -477,6 +605,8 @@ typedef struct
     char *end;               /**< ISO 8601 date when the simulation ends*/
     char *server;            /**< domain name or IP address of the particule server (e.g 127.0.0.1) */
     int flag_no_filter;      /**< do not filter */
+    int flag_batch;          /**< predict and weight the particles by blocks with the batched functions (see ssm_f_prediction_batch() and ssm_log_likelihood_batch()) */
+    int flag_tree;           /**< store the particle paths in an ancestral tree (see ssm_tree_t) */
 } ssm_options_t;
 
 
@@ -512,6 +642,33 @@ typedef struct
 } ssm_adapt_t;
 
 
+/**
+ * ancestral tree of the particle paths: only the lineages of the
+ * current particles (the leaves) are stored (see tree.c)
+ */
+typedef struct
+{
+    int J;              /**< number of particles (leaves) */
+    int length;         /**< maximum number of generations after the roots (data->length) */
+    int size;           /**< number of allocated nodes */
+    int n_free;         /**< number of free nodes */
+
+    ssm_X_t **X;        /**< [this.size] state of the nodes */
+    int *parent;        /**< [this.size] parent of the nodes (-1 for the roots) */
+    int *ref;           /**< [this.size] number of children (+1 for the leaves), the node is released at 0 */
+    int *row;           /**< [this.size] index of the data row of the nodes (-1 for the roots) */
+    int *stack;         /**< [this.size] stack of the free nodes (only the first this.n_free are valid) */
+
+    int *leaves;        /**< [this.J] nodes of the current particles */
+    int *leaves_tmp;    /**< [this.J] */
+    double *weights;    /**< [this.J] normalized weights of the leaves */
+    int *path;          /**< [this.length+1] nodes of the last sampled path */
+
+    ssm_nav_t *nav;     /**< reference (used to allocate new nodes) */
+    ssm_options_t *opts; /**< reference (used to allocate new nodes) */
+} ssm_tree_t;
+
+
 
 typedef struct
 {
@@ -526,6 +683,7 @@ typedef struct
     ssm_nav_t *nav;
     ssm_fitness_t *fitness;
     ssm_f_pred_t f_pred;
+    ssm_f_pred_batch_t f_pred_batch; /**< NULL if the particles have to be predicted one by one */
 } ssm_params_worker_inproc_t;
 
 
@@ -619,6 +777,11 @@ ssm_options_t *ssm_options_new(void);
 void ssm_options_free(ssm_options_t *opts);
 ssm_fitness_t *ssm_fitness_new(ssm_data_t *data, ssm_options_t *opts);
 void ssm_fitness_free(ssm_fitness_t *fitness);
+ssm_tcache_t *ssm_tcache_new(int width);
+void ssm_tcache_free(ssm_tcache_t *tcache);
+int ssm_batch_width(void);
+ssm_batch_t *ssm_batch_new(int size, ssm_nav_t *nav);
+void ssm_batch_free(ssm_batch_t *b);
 int _ssm_dim_X(ssm_nav_t *nav);
 ssm_X_t *ssm_X_new(ssm_nav_t *nav, ssm_options_t *opts);
 void ssm_X_free(ssm_X_t *X);
@@ -628,6 +791,8 @@ ssm_X_t **ssm_D_X_new(ssm_data_t *data, ssm_nav_t *nav, ssm_options_t *opts);
 void ssm_D_X_free(ssm_X_t **X, ssm_data_t *data);
 ssm_X_t ***ssm_D_J_X_new(ssm_data_t *data, ssm_fitness_t *fitness, ssm_nav_t *nav, ssm_options_t *opts);
 void ssm_D_J_X_free(ssm_X_t ***X, ssm_data_t *data, ssm_fitness_t *fitness);
+ssm_X_t ***ssm_D_J_X_shared_new(ssm_data_t *data, ssm_fitness_t *fitness, ssm_nav_t *nav, ssm_options_t *opts);
+void ssm_D_J_X_shared_free(ssm_X_t ***X, ssm_fitness_t *fitness);
 ssm_hat_t *ssm_hat_new(ssm_nav_t *nav);
 void ssm_hat_free(ssm_hat_t *hat);
 ssm_hat_t **ssm_D_hat_new(ssm_data_t *data, ssm_nav_t *nav);
@@ -654,12 +819,20 @@ void ssm_options_set_implementation(ssm_options_t *opts, ssm_algo_t algo, int ar
 /* fitness.c */
 double ssm_sanitize_log_likelihood(double log_like, ssm_row_t *row, ssm_fitness_t *fitness, ssm_nav_t *nav);
 double ssm_log_likelihood(ssm_row_t *row, ssm_X_t *X, ssm_par_t *par, ssm_calc_t *calc, ssm_nav_t *nav, ssm_fitness_t *fitness);
+void ssm_log_likelihood_batch(ssm_row_t *row, ssm_X_t **J_X, int j0, int j1, ssm_par_t *par, ssm_calc_t *calc, ssm_nav_t *nav, ssm_fitness_t *fitness, double *log_like);
 double ssm_sum_square(ssm_row_t *row, ssm_X_t *X, ssm_par_t *par, ssm_calc_t *calc, ssm_nav_t *nav, ssm_fitness_t *fitness);
 void ssm_aic(ssm_fitness_t *fitness, ssm_nav_t *nav, double log_like);
 void ssm_dic_init(ssm_fitness_t *fitness, double log_like, double log_prior);
 void ssm_dic_update(ssm_fitness_t *fitness, double log_like, double log_prior);
 void ssm_dic_end(ssm_fitness_t *fitness, ssm_nav_t *nav, int m);
 
+/* density.c */
+double *ssm_log_fact_new(void);
+double ssm_log_fact(double n, ssm_calc_t *calc);
+double ssm_log_dnorm_discretized(double y, double mu, double sd, ssm_calc_t *calc);
+double ssm_log_dpois(double y, double mu, ssm_calc_t *calc);
+double ssm_log_dbinom(double y, double p, double n, ssm_calc_t *calc);
+
 /* mvn.c */
 int ssm_rmvnorm(const gsl_rng *r, const int n, const gsl_vector *mean, const gsl_matrix *var, double sd_fac, gsl_vector *result);
 double ssm_dmvnorm(const int n, const gsl_vector *x, const gsl_vector *mean, const gsl_matrix *var, double sd_fac);
@@ -671,8 +844,17 @@ void ssm_X_reset_inc(ssm_X_t *X, ssm_row_t *row, ssm_nav_t *nav);
 void ssm_ran_multinomial (const gsl_rng * r, const size_t K, unsigned int N, const double p[], unsigned int n[]);
 double ssm_correct_rate(double rate, double dt);
 ssm_err_code_t ssm_check_no_neg_sv_or_remainder(ssm_X_t *p_X, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc, double t);
+double *ssm_tcache_get(ssm_tcache_t *tcache, double t, int *is_new);
+const double *ssm_covariates(ssm_calc_t *calc, double t);
+int ssm_precompute_length(int offset[]);
+void ssm_par_changed(void);
+void ssm_precompute(ssm_par_t *par, ssm_calc_t *calc);
+const double *ssm_precomputed(ssm_par_t *par, ssm_calc_t *calc, ssm_pre_block_t block);
+const double *ssm_time_terms(ssm_par_t *par, ssm_calc_t *calc, double t);
 ssm_f_pred_t ssm_get_f_pred(ssm_nav_t *nav);
 ssm_err_code_t ssm_f_prediction_ode                           (ssm_X_t *p_X, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc);
+int ssm_jac_ode(double t, const double X[], double *dfdy, double dfdt[], void *params);
+double ssm_dt_warm(ssm_X_t **J_X, ssm_fitness_t *fitness);
 ssm_err_code_t ssm_f_prediction_sde_no_dem_sto_no_white_noise (ssm_X_t *p_X, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc);
 ssm_err_code_t ssm_f_prediction_sde_no_dem_sto_no_diff        (ssm_X_t *p_X, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc);
 ssm_err_code_t ssm_f_prediction_sde_no_white_noise_no_diff    (ssm_X_t *p_X, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc);
@@ -682,12 +864,38 @@ ssm_err_code_t ssm_f_prediction_sde_no_diff                   (ssm_X_t *p_X, dou
 ssm_err_code_t ssm_f_prediction_sde_full                      (ssm_X_t *p_X, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc);
 ssm_err_code_t ssm_f_prediction_psr                           (ssm_X_t *p_X, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc);
 ssm_err_code_t ssm_f_prediction_psr_no_diff                   (ssm_X_t *p_X, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc);
+ssm_err_code_t ssm_f_prediction_psr_tau                       (ssm_X_t *p_X, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc);
+ssm_err_code_t ssm_f_prediction_psr_tau_no_diff               (ssm_X_t *p_X, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc);
+void ssm_batch_gather(ssm_batch_t *b, ssm_X_t **J_X, int j0, int j1);
+void ssm_batch_scatter(ssm_batch_t *b, ssm_X_t **J_X, int j0);
+ssm_f_pred_batch_t ssm_get_f_pred_batch(ssm_nav_t *nav, ssm_calc_t *calc);
+void ssm_f_prediction_batch_sde_no_dem_sto_no_white_noise (ssm_X_t **J_X, int j0, int j1, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc, ssm_err_code_t *cum_status);
+void ssm_f_prediction_batch_sde_no_dem_sto_no_diff        (ssm_X_t **J_X, int j0, int j1, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc, ssm_err_code_t *cum_status);
+void ssm_f_prediction_batch_sde_no_white_noise_no_diff    (ssm_X_t **J_X, int j0, int j1, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc, ssm_err_code_t *cum_status);
+void ssm_f_prediction_batch_sde_no_dem_sto                (ssm_X_t **J_X, int j0, int j1, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc, ssm_err_code_t *cum_status);
+void ssm_f_prediction_batch_sde_no_white_noise            (ssm_X_t **J_X, int j0, int j1, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc, ssm_err_code_t *cum_status);
+void ssm_f_prediction_batch_sde_no_diff                   (ssm_X_t **J_X, int j0, int j1, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc, ssm_err_code_t *cum_status);
+void ssm_f_prediction_batch_sde_full                      (ssm_X_t **J_X, int j0, int j1, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc, ssm_err_code_t *cum_status);
+void ssm_f_prediction_batch_psr                           (ssm_X_t **J_X, int j0, int j1, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc, ssm_err_code_t *cum_status);
+void ssm_f_prediction_batch_psr_no_diff                   (ssm_X_t **J_X, int j0, int j1, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc, ssm_err_code_t *cum_status);
 
 /* smc.c */
 int ssm_weight(ssm_fitness_t *fitness, ssm_row_t *row, ssm_nav_t *nav, int n);
 void ssm_systematic_sampling(ssm_fitness_t *fitness, ssm_calc_t *calc, int n);
+void ssm_cumsum_chunk(ssm_fitness_t *fitness, int chunk);
+void ssm_cumsum_chunks(ssm_fitness_t *fitness, ssm_calc_t *calc);
+void ssm_sampling_chunk(ssm_fitness_t *fitness, ssm_calc_t *calc, int n, int j0, int j1);
+void ssm_sampling(ssm_fitness_t *fitness, ssm_calc_t *calc, int n);
+int ssm_need_resampling(ssm_fitness_t *fitness);
+int ssm_adaptive_sampling(ssm_fitness_t *fitness, ssm_calc_t *calc, int n);
+void ssm_fitness_reset_weights(ssm_fitness_t *fitness);
+int ssm_resample_X_swap(ssm_fitness_t *fitness, ssm_X_t ***J_p_X, ssm_X_t ***J_p_X_tmp, int n);
+void ssm_resample_X_copy(ssm_fitness_t *fitness, ssm_X_t **J_X, int n, int j0, int j1);
 void ssm_resample_X(ssm_fitness_t *fitness, ssm_X_t ***J_p_X, ssm_X_t ***J_p_X_tmp, int n);
 void ssm_swap_X(ssm_X_t ***X, ssm_X_t ***tmp_X);
+void ssm_fitness_collapse(ssm_fitness_t *fitness, ssm_f_pred_t f_pred);
+void ssm_collapse_resample(ssm_fitness_t *fitness, unsigned int *select);
+void ssm_expand_X(ssm_fitness_t *fitness, ssm_X_t **J_X, int j0, int j1);
 
 /* transform.c */
 double ssm_f_id(double x);
@@ -715,6 +923,11 @@ double ssm_f_2prior_id(double x, ssm_hat_t *hat, ssm_par_t *par, ssm_calc_t *cal
 int ssm_in_par(ssm_it_parameters_t *it, const char *name);
 int ssm_in_jarray(json_t *array, const char *name);
 const gsl_interp_type *ssm_str_to_interp_type(const char *optarg);
+const gsl_odeiv2_step_type *ssm_str_to_ode_step(const char *optarg);
+int ssm_ode_step_is_implicit(const gsl_odeiv2_step_type *T);
+ssm_accuracy_t ssm_str_to_accuracy(const char *optarg);
+ssm_resampling_t ssm_str_to_resampling(const char *optarg);
+ssm_psr_step_t ssm_str_to_psr_step(const char *optarg);
 int ssm_sanitize_n_threads(int n_threads, ssm_fitness_t *fitness);
 
 /* print.c */
@@ -742,6 +955,19 @@ void ssm_ci95(double *hat_95, ssm_calc_t *calc, ssm_fitness_t *fitness);
 void ssm_hat_eval(ssm_hat_t *hat, ssm_X_t **J_X, ssm_par_t **J_par, ssm_nav_t *nav, ssm_calc_t *calc, ssm_fitness_t *fitness, const double t, int is_J_par);
 
 
+/* tree.c */
+ssm_tree_t *ssm_tree_new(ssm_fitness_t *fitness, ssm_nav_t *nav, ssm_options_t *opts);
+void ssm_tree_free(ssm_tree_t *tree);
+void ssm_tree_init(ssm_tree_t *tree, ssm_X_t **J_X);
+void ssm_tree_insert(ssm_tree_t *tree, ssm_X_t **J_X, unsigned int *select, int n);
+void ssm_tree_set_weights(ssm_tree_t *tree, double *weights);
+int ssm_tree_sample_path(ssm_tree_t *tree, ssm_calc_t *calc);
+void ssm_tree_print_traj(FILE *stream, ssm_tree_t *tree, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc, ssm_data_t *data, const int index);
+
+/* nrm.c */
+ssm_err_code_t ssm_f_prediction_nrm                           (ssm_X_t *p_X, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc);
+ssm_err_code_t ssm_f_prediction_nrm_no_diff                   (ssm_X_t *p_X, double t0, double t1, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc);
+
 /* bayes.c */
 ssm_err_code_t ssm_log_prob_proposal(double *log_proposal, ssm_theta_t *proposed, ssm_theta_t *theta, ssm_var_t *var, double sd_fac, ssm_nav_t *nav, int is_mvn);
 ssm_err_code_t ssm_log_prob_prior(double *log_prior, ssm_theta_t *theta, ssm_nav_t *nav, ssm_fitness_t *fitness);
@@ -761,6 +987,8 @@ double ssm_simplex(ssm_theta_t *theta, ssm_var_t *var, void *params, double (*f_
 void *ssm_worker_inproc(void *params);
 ssm_workers_t *ssm_workers_start(ssm_X_t ***D_J_X, ssm_par_t **J_par, ssm_data_t *data, ssm_calc_t **calc, ssm_fitness_t *fitness, ssm_f_pred_t f_pred, ssm_nav_t *nav, ssm_options_t *opts, ssm_worker_opt_t wopts);
 void ssm_workers_stop(ssm_workers_t *workers);
+int ssm_workers_sampling(ssm_workers_t *workers, ssm_calc_t **calc, ssm_fitness_t *fitness, int n);
+void ssm_workers_resample_X(ssm_workers_t *workers, ssm_fitness_t *fitness, ssm_X_t ***J_p_X, ssm_X_t ***J_p_X_tmp, int n);
 
 /* special functions */
 double heaviside(double x);
@@ -777,6 +1005,8 @@ ssm_err_code_t _ssm_check_and_correct_Ct(ssm_X_t *X, ssm_calc_t *calc, ssm_nav_t
 ssm_err_code_t ssm_kalman_gain_computation(ssm_row_t *row, double t, ssm_X_t *X, ssm_par_t *par, ssm_calc_t *calc, ssm_nav_t *nav);
 ssm_err_code_t ssm_kalman_update(ssm_fitness_t *fitness, ssm_X_t *X, ssm_row_t *row, double t, ssm_par_t *par, ssm_calc_t *calc, ssm_nav_t *nav);
 double ssm_diff_derivative(double jac_tpl, const double X[], ssm_state_t *state);
+void ssm_jac_set(ssm_calc_t *calc, int i, int j, double x);
+void ssm_jac_mul(ssm_calc_t *calc, const gsl_matrix *B, gsl_matrix *C);
 void ssm_kalman_reset_Ct(ssm_X_t *X, ssm_nav_t *nav);
 
 /******************************/
@@ -786,7 +1016,7 @@ void ssm_kalman_reset_Ct(ssm_X_t *X, ssm_nav_t *nav);
 /* mif/mif_util.c */
 double ssm_mif_cooling(ssm_options_t *opts, int m);
 void ssm_mif_scale_var(ssm_var_t *var, ssm_data_t *data, ssm_nav_t *nav);
-void ssm_mif_patch_like_prior(double *like, ssm_fitness_t *fitness, ssm_theta_t **J_theta, ssm_data_t *data, ssm_nav_t *nav, const int n, const int lag);
+void ssm_mif_patch_like_prior(double *log_like, ssm_fitness_t *fitness, ssm_theta_t **J_theta, ssm_data_t *data, ssm_nav_t *nav, const int n, const int lag);
 void ssm_mif_mean_var_theta_theoretical(double *theta_bart, double *theta_Vt, ssm_theta_t **J_theta, ssm_var_t *var, ssm_fitness_t *fitness, ssm_nav_t *nav, double var_fac);
 void ssm_mif_resample_and_mutate_theta(ssm_fitness_t *fitness, ssm_theta_t **J_theta, ssm_theta_t **J_theta_tmp, ssm_var_t *var, ssm_calc_t **calc, ssm_nav_t *nav, double sd_fac, int n);
 void ssm_mif_fixed_lag_smoothing(ssm_theta_t *mle, ssm_theta_t **J_theta, ssm_fitness_t *fitness, ssm_nav_t *nav);
@@ -837,6 +1067,8 @@ ssm_observed_t **_ssm_observed_new(int *observed_length);
 
 /* diff_template.c */
 void ssm_compute_diff(ssm_X_t *p_X, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc);
+void ssm_compute_diff_batch(ssm_batch_t *b, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc);
+int ssm_diff_batch_width(void);
 
 /* ode_sde_template.c */
 int ssm_step_ode(double t, const double X[], double f[], void *params);
@@ -844,11 +1076,46 @@ void ssm_step_sde_no_dem_sto(ssm_X_t *p_X, double t, ssm_par_t *par, ssm_nav_t *
 void ssm_step_sde_no_white_noise(ssm_X_t *p_X, double t, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc);
 void ssm_step_sde_full(ssm_X_t *p_X, double t, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc);
 void ssm_step_sde_no_dem_sto_no_white_noise(ssm_X_t *p_X, double t, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc);
+void ssm_step_sde_no_dem_sto_batch(ssm_batch_t *b, double t, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc);
+void ssm_step_sde_no_white_noise_batch(ssm_batch_t *b, double t, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc);
+void ssm_step_sde_full_batch(ssm_batch_t *b, double t, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc);
+void ssm_step_sde_no_dem_sto_no_white_noise_batch(ssm_batch_t *b, double t, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc);
+int ssm_ode_sde_batch_width(void);
 
 /* psr_template.c */
 void ssm_psr_new(ssm_calc_t *calc);
 void ssm_psr_free(ssm_calc_t *calc);
 void ssm_step_psr(ssm_X_t *p_X, double t, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc);
+void ssm_step_psr_leap(ssm_X_t *p_X, double t, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc);
+void ssm_step_psr_batch(ssm_batch_t *b, double t, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc);
+int ssm_psr_batch_width(void);
+void ssm_psr_white_noises(double dt, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc);
+double ssm_psr_propensities(ssm_X_t *p_X, double t, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc);
+double ssm_psr_tau(ssm_X_t *p_X, double eps, ssm_calc_t *calc);
+void ssm_psr_fire(ssm_X_t *p_X, int k, ssm_nav_t *nav);
+
+/* nrm_template.c */
+void ssm_nrm_new(ssm_calc_t *calc);
+void ssm_nrm_free(ssm_calc_t *calc);
+double ssm_nrm_propensity(int k, ssm_X_t *p_X, double t, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc);
+
+/* ordered.tpl: one block of parameter only subexpressions per generated file using them */
+int ssm_pre_length_step(void);
+void ssm_pre_eval_step(ssm_par_t *par, double *_pre);
+int ssm_pre_length_observed(void);
+void ssm_pre_eval_observed(ssm_par_t *par, double *_pre);
+int ssm_pre_length_Q(void);
+void ssm_pre_eval_Q(ssm_par_t *par, double *_pre);
+int ssm_pre_length_Ht(void);
+void ssm_pre_eval_Ht(ssm_par_t *par, double *_pre);
+int ssm_pre_length_jac(void);
+void ssm_pre_eval_jac(ssm_par_t *par, double *_pre);
+int ssm_pre_length_step_ekf(void);
+void ssm_pre_eval_step_ekf(ssm_par_t *par, double *_pre);
+
+/* precompute_template.c */
+int ssm_time_terms_length(void);
+void ssm_eval_time_terms(double t, ssm_par_t *par, ssm_calc_t *calc, const double *_pre, double *_tt);
 
 /* jac_template */
 void ssm_eval_jac(const double X[], double t, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc);
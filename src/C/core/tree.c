@@ -0,0 +1,257 @@
+/**************************************************************************
+ *    This file is part of ssm.
+ *
+ *    ssm is free software: you can redistribute it and/or modify it
+ *    under the terms of the GNU General Public License as published
+ *    by the Free Software Foundation, either version 3 of the
+ *    License, or (at your option) any later version.
+ *
+ *    ssm is distributed in the hope that it will be useful, but
+ *    WITHOUT ANY WARRANTY; without even the implied warranty of
+ *    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+ *    GNU General Public License for more details.
+ *
+ *    You should have received a copy of the GNU General Public
+ *    License along with ssm.  If not, see
+ *    <http://www.gnu.org/licenses/>.
+ *************************************************************************/
+
+#include "ssm.h"
+
+/**
+ * Ancestral tree of the particle paths (pMCMC trajectory sampling).
+ *
+ * Instead of keeping data->length+1 generations of J particles and
+ * the ancestor indexes (fitness->select), each generation is appended
+ * to a tree whose leaves are the current particles. A node is
+ * released as soon as it is neither a leaf nor the ancestor of a
+ * leaf so that only the surviving lineages are stored (on the order
+ * of J + J log(J) nodes after coalescence). Paths are sampled from
+ * the tree only when they have to be printed.
+ */
+
+
+static void ssm_tree_grow(ssm_tree_t *tree)
+{
+    int i;
+    int size = 2*tree->size;
+
+    tree->X = realloc(tree->X, size * sizeof (ssm_X_t *));
+    tree->parent = realloc(tree->parent, size * sizeof (int));
+    tree->ref = realloc(tree->ref, size * sizeof (int));
+    tree->row = realloc(tree->row, size * sizeof (int));
+    tree->stack = realloc(tree->stack, size * sizeof (int));
+
+    if (tree->X==NULL || tree->parent==NULL || tree->ref==NULL || tree->row==NULL || tree->stack==NULL) {
+        ssm_print_err("Allocation impossible for ssm_tree_t");
+        exit(EXIT_FAILURE);
+    }
+
+    for(i=tree->size; i<size; i++){
+        tree->X[i] = ssm_X_new(tree->nav, tree->opts);
+        tree->stack[tree->n_free++] = i;
+    }
+
+    tree->size = size;
+}
+
+
+/**
+ * index of a free node (the tree is grown if needed)
+ */
+static int ssm_tree_pop(ssm_tree_t *tree)
+{
+    if(!tree->n_free){
+        ssm_tree_grow(tree);
+    }
+
+    return tree->stack[--tree->n_free];
+}
+
+
+/**
+ * drop a reference to node and release it (and its ancestors that
+ * have no other descendants) when none is left
+ */
+static void ssm_tree_release(ssm_tree_t *tree, int node)
+{
+    while(node >= 0 && !(--tree->ref[node])){
+        tree->stack[tree->n_free++] = node;
+        node = tree->parent[node];
+    }
+}
+
+
+ssm_tree_t *ssm_tree_new(ssm_fitness_t *fitness, ssm_nav_t *nav, ssm_options_t *opts)
+{
+    int i;
+
+    ssm_tree_t *tree = malloc(sizeof (ssm_tree_t));
+    if (tree==NULL) {
+        ssm_print_err("Allocation impossible for ssm_tree_t");
+        exit(EXIT_FAILURE);
+    }
+
+    tree->J = fitness->J;
+    tree->length = fitness->data_length;
+    tree->nav = nav;
+    tree->opts = opts;
+
+    tree->size = 2*fitness->J;
+    tree->n_free = tree->size;
+    tree->X = malloc(tree->size * sizeof (ssm_X_t *));
+    tree->parent = ssm_i1_new(tree->size);
+    tree->ref = ssm_i1_new(tree->size);
+    tree->row = ssm_i1_new(tree->size);
+    tree->stack = ssm_i1_new(tree->size);
+    if (tree->X==NULL) {
+        ssm_print_err("Allocation impossible for ssm_tree_t");
+        exit(EXIT_FAILURE);
+    }
+    for(i=0; i<tree->size; i++){
+        tree->X[i] = ssm_X_new(nav, opts);
+        tree->stack[i] = tree->size - 1 - i;
+    }
+
+    tree->leaves = ssm_i1_new(tree->J);
+    tree->leaves_tmp = ssm_i1_new(tree->J);
+    tree->weights = ssm_d1_new(tree->J);
+    tree->path = ssm_i1_new(tree->length+1);
+
+    return tree;
+}
+
+
+void ssm_tree_free(ssm_tree_t *tree)
+{
+    int i;
+
+    for(i=0; i<tree->size; i++){
+        ssm_X_free(tree->X[i]);
+    }
+    free(tree->X);
+    free(tree->parent);
+    free(tree->ref);
+    free(tree->row);
+    free(tree->stack);
+
+    free(tree->leaves);
+    free(tree->leaves_tmp);
+    free(tree->weights);
+    free(tree->path);
+
+    free(tree);
+}
+
+
+/**
+ * release all the nodes and start a new tree whose roots are the
+ * initial conditions J_X
+ */
+void ssm_tree_init(ssm_tree_t *tree, ssm_X_t **J_X)
+{
+    int i, j, node;
+
+    tree->n_free = tree->size;
+    for(i=0; i<tree->size; i++){
+        tree->stack[i] = tree->size - 1 - i;
+    }
+
+    for(j=0; j<tree->J; j++){
+        node = ssm_tree_pop(tree);
+        ssm_X_copy(tree->X[node], J_X[j]);
+        tree->parent[node] = -1;
+        tree->ref[node] = 1;
+        tree->row[node] = -1;
+        tree->leaves[j] = node;
+        tree->weights[j] = 1.0/tree->J;
+    }
+}
+
+
+/**
+ * append the particles J_X predicted up to the data row n: the parent
+ * of J_X[j] is the leaf select[j] (the leaf j if select is NULL,
+ * i.e. when the particles were not resampled)
+ */
+void ssm_tree_insert(ssm_tree_t *tree, ssm_X_t **J_X, unsigned int *select, int n)
+{
+    int j, node, parent;
+    int *tmp;
+
+    for(j=0; j<tree->J; j++){
+        node = ssm_tree_pop(tree);
+        parent = tree->leaves[ (select) ? select[j] : j ];
+        ssm_X_copy(tree->X[node], J_X[j]);
+        tree->parent[node] = parent;
+        tree->ref[parent]++;
+        tree->ref[node] = 1;
+        tree->row[node] = n;
+        tree->leaves_tmp[j] = node;
+    }
+
+    for(j=0; j<tree->J; j++){
+        ssm_tree_release(tree, tree->leaves[j]);
+    }
+
+    tmp = tree->leaves;
+    tree->leaves = tree->leaves_tmp;
+    tree->leaves_tmp = tmp;
+}
+
+
+/**
+ * store the (normalized) weights of the leaves used to sample a path
+ */
+void ssm_tree_set_weights(ssm_tree_t *tree, double *weights)
+{
+    memcpy(tree->weights, weights, tree->J * sizeof (double));
+}
+
+
+/**
+ * sample a leaf according to tree->weights and store its ancestors
+ * (the root excluded) in tree->path, from the oldest to the
+ * leaf. Return the length of the path.
+ */
+int ssm_tree_sample_path(ssm_tree_t *tree, ssm_calc_t *calc)
+{
+    int j_sel, node, length, k;
+
+    double ran = gsl_ran_flat(calc->randgsl, 0.0, 1.0);
+    double cum_weights = tree->weights[0];
+
+    j_sel = 0;
+    while (cum_weights < ran && j_sel < (tree->J-1)) {
+        cum_weights += tree->weights[++j_sel];
+    }
+
+    length = 0;
+    for(node = tree->leaves[j_sel]; tree->parent[node] >= 0; node = tree->parent[node]){
+        tree->path[length++] = node;
+    }
+
+    //reverse
+    for(k=0; k<length/2; k++){
+        node = tree->path[k];
+        tree->path[k] = tree->path[length-1-k];
+        tree->path[length-1-k] = node;
+    }
+
+    return length;
+}
+
+
+/**
+ * sample a path and print it (see ssm_print_X())
+ */
+void ssm_tree_print_traj(FILE *stream, ssm_tree_t *tree, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc, ssm_data_t *data, const int index)
+{
+    int k, node;
+    int length = ssm_tree_sample_path(tree, calc);
+
+    for(k=0; k<length; k++){
+        node = tree->path[k];
+        ssm_print_X(stream, tree->X[node], par, nav, calc, data->rows[tree->row[node]], index);
+    }
+}
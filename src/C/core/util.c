@@ -77,6 +77,78 @@ const gsl_interp_type *ssm_str_to_interp_type(const char *optarg)
 }
 
 
+const gsl_odeiv2_step_type *ssm_str_to_ode_step(const char *optarg)
+{
+    if (strcmp(optarg, "rkf45") == 0) {
+        return gsl_odeiv2_step_rkf45;
+    } else if (strcmp(optarg, "rkck") == 0){
+        return gsl_odeiv2_step_rkck;
+    } else if (strcmp(optarg, "rk8pd") == 0){
+        return gsl_odeiv2_step_rk8pd;
+    } else if (strcmp(optarg, "rk4imp") == 0){
+        return gsl_odeiv2_step_rk4imp;
+    } else if (strcmp(optarg, "bsimp") == 0){
+        return gsl_odeiv2_step_bsimp;
+    } else if (strcmp(optarg, "msbdf") == 0){
+        return gsl_odeiv2_step_msbdf;
+    }
+
+    ssm_print_warning("Unknown ODE integrator. rkf45 will be used instead.");
+    return gsl_odeiv2_step_rkf45;
+}
+
+/**
+ * implicit steppers require the jacobian of the system
+ */
+int ssm_ode_step_is_implicit(const gsl_odeiv2_step_type *T)
+{
+    return (T == gsl_odeiv2_step_rk4imp || T == gsl_odeiv2_step_bsimp || T == gsl_odeiv2_step_msbdf);
+}
+
+
+ssm_accuracy_t ssm_str_to_accuracy(const char *optarg)
+{
+    if (strcmp(optarg, "exact") == 0) {
+        return SSM_ACC_EXACT;
+    } else if (strcmp(optarg, "fast") == 0){
+        return SSM_ACC_FAST;
+    } else if (strcmp(optarg, "approx") == 0){
+        return SSM_ACC_APPROX;
+    }
+
+    ssm_print_warning("Unknown accuracy for the observation densities. fast will be used instead.");
+    return SSM_ACC_FAST;
+}
+
+
+ssm_resampling_t ssm_str_to_resampling(const char *optarg)
+{
+    if (strcmp(optarg, "systematic") == 0) {
+        return SSM_RESAMPLING_SYSTEMATIC;
+    } else if (strcmp(optarg, "stratified") == 0){
+        return SSM_RESAMPLING_STRATIFIED;
+    } else if (strcmp(optarg, "residual") == 0){
+        return SSM_RESAMPLING_RESIDUAL;
+    }
+
+    ssm_print_warning("Unknown resampling scheme. systematic will be used instead.");
+    return SSM_RESAMPLING_SYSTEMATIC;
+}
+
+
+ssm_psr_step_t ssm_str_to_psr_step(const char *optarg)
+{
+    if (strcmp(optarg, "euler") == 0) {
+        return SSM_PSR_EULER;
+    } else if (strcmp(optarg, "tau") == 0){
+        return SSM_PSR_TAU;
+    }
+
+    ssm_print_warning("Unknown psr stepping. euler will be used instead.");
+    return SSM_PSR_EULER;
+}
+
+
 
 /**
  * make sure that n_threads <= J and return safe n_threads
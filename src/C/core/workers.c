@@ -34,6 +34,7 @@ void *ssm_worker_inproc(void *params)
     ssm_nav_t *nav = p->nav;
     ssm_fitness_t *fitness = p->fitness;
     ssm_f_pred_t f_pred = p->f_pred;
+    ssm_f_pred_batch_t f_pred_batch = p->f_pred_batch;
 
     // Socket to server controller
     void *controller = zmq_socket (context, ZMQ_SUB);
@@ -61,6 +62,9 @@ void *ssm_worker_inproc(void *params)
 
     int j, n, t0, t1;
     int the_id;
+    ssm_worker_task_t task;
+    int more;
+    size_t more_size = sizeof (int);
 
     int _zero = 0;
     int *j_par = (SSM_WORKER_J_PAR & wopts) ? &j: &_zero;
@@ -74,6 +78,13 @@ void *ssm_worker_inproc(void *params)
             zmq_recv(receiver, &the_id, sizeof (int), 0);
             zmq_recv(receiver, &n, sizeof (int), 0);	    
 
+            //optional task (prediction by default)
+            task = SSM_TASK_PREDICT;
+            zmq_getsockopt(receiver, ZMQ_RCVMORE, &more, &more_size);
+            if(more){
+                zmq_recv(receiver, &task, sizeof (ssm_worker_task_t), 0);
+            }
+
 	    np1 = n + 1;
             t0 = (n) ? data->rows[n-1]->time: 0;
             t1 = data->rows[n]->time;
@@ -81,17 +92,58 @@ void *ssm_worker_inproc(void *params)
             int J_start = the_id * J_chunk;
             int J_end = (the_id+1 == calc[the_id]->threads_length) ? fitness->J : (the_id+1)*J_chunk;
 
+            if(task != SSM_TASK_PREDICT){
+                //resampling stages (see ssm_workers_sampling() and ssm_workers_resample_X())
+                if(task == SSM_TASK_CUMSUM){
+                    ssm_cumsum_chunk(fitness, the_id);
+                } else if(task == SSM_TASK_SAMPLING){
+                    ssm_sampling_chunk(fitness, calc[the_id], n, J_start, J_end);
+                } else if(task == SSM_TASK_RESAMPLE_X){
+                    ssm_resample_X_copy(fitness, D_J_X[*n_X], n, J_start, J_end);
+                }
+                zmq_send(sender, &id, sizeof (int), 0);
+                continue;
+            }
+
+            if(f_pred_batch){
+                //the chunk of particles is predicted by blocks
+                for(j=J_start; j<J_end; j++ ){
+                    ssm_X_reset_inc(D_J_X[*n_X][j], data->rows[n], nav);
+                }
+                (*f_pred_batch)(D_J_X[*n_X], J_start, J_end, t0, t1, J_par[0], nav, calc[the_id], fitness->cum_status);
+            }
+
+            //the log likelihood of the chunk is computed by blocks (one parameter for all the particles, no collapsed particles)
+            int flag_batch_like = (calc[the_id]->batch != NULL) && !fitness->flag_collapse && !(SSM_WORKER_J_PAR & wopts) && (SSM_WORKER_FITNESS & wopts) && data->rows[n]->ts_nonan_length;
+            if(flag_batch_like){
+                ssm_log_likelihood_batch(data->rows[n], D_J_X[*n_X], J_start, J_end, J_par[0], calc[the_id], nav, fitness, fitness->weights);
+            }
+
             for(j=J_start; j<J_end; j++ ){
 
-                ssm_X_reset_inc(D_J_X[*n_X][j], data->rows[n], nav);
-		fitness->cum_status[j] |= (*f_pred)(D_J_X[*n_X][j], t0, t1, J_par[*j_par], nav, calc[the_id]);
-		
+                if(fitness->flag_collapse && fitness->rep[j] != j){
+                    continue; //copy of rep[j] (see ssm_expand_X())
+                }
+
+                if(!f_pred_batch){
+                    ssm_X_reset_inc(D_J_X[*n_X][j], data->rows[n], nav);
+                    fitness->cum_status[j] |= (*f_pred)(D_J_X[*n_X][j], t0, t1, J_par[*j_par], nav, calc[the_id]);
+                }
+
                 if((SSM_WORKER_FITNESS & wopts) && data->rows[n]->ts_nonan_length) {
-                    fitness->weights[j] = (fitness->cum_status[j] == SSM_SUCCESS) ?  exp(ssm_log_likelihood(data->rows[n], D_J_X[*n_X][j], J_par[*j_par], calc[the_id], nav, fitness)) : 0.0;
+                    if(fitness->cum_status[j] != SSM_SUCCESS){
+                        fitness->weights[j] = GSL_NEGINF;
+                    } else if(!flag_batch_like){
+                        fitness->weights[j] = ssm_log_likelihood(data->rows[n], D_J_X[*n_X][j], J_par[*j_par], calc[the_id], nav, fitness);
+                    }
                     fitness->cum_status[j] = SSM_SUCCESS;
                 }
             }
 
+            if(fitness->flag_collapse){
+                ssm_expand_X(fitness, D_J_X[*n_X], J_start, J_end);
+            }
+
             //send back id of the batch of particles now integrated
             zmq_send(sender, &id, sizeof (int), 0);
         }
@@ -196,6 +248,7 @@ ssm_workers_t *ssm_workers_start(ssm_X_t ***D_J_X, ssm_par_t **J_par, ssm_data_t
 	    w->params[i].nav = nav;
 	    w->params[i].fitness = fitness;
 	    w->params[i].f_pred = f_pred;
+	    w->params[i].f_pred_batch = (wopts & SSM_WORKER_J_PAR) ? NULL : ssm_get_f_pred_batch(nav, calc[i]); //one parameter per particle can't be batched
 
 	    pthread_create(&(w->workers[i]), NULL, ssm_worker_inproc, (void*) &(w->params[i]));
 	}
@@ -233,3 +286,61 @@ void ssm_workers_stop(ssm_workers_t *workers)
 
     free(workers);
 }
+
+
+/**
+ * run task on all the chunks of particles and wait for the inproc
+ * workers to complete
+ */
+static void ssm_workers_run(ssm_workers_t *workers, int n, ssm_worker_task_t task)
+{
+    int i, id;
+
+    for (i=0; i<workers->inproc_length; i++) {
+        zmq_send(workers->sender, &i, sizeof (int), ZMQ_SNDMORE);
+        zmq_send(workers->sender, &n, sizeof (int), ZMQ_SNDMORE);
+        zmq_send(workers->sender, &task, sizeof (ssm_worker_task_t), 0);
+    }
+
+    for (i=0; i<workers->inproc_length; i++) {
+        zmq_recv(workers->receiver, &id, sizeof (int), 0);
+    }
+}
+
+
+/**
+ * ssm_adaptive_sampling() with the prefix sums of the weights and the
+ * sampling of the ancestors done by the inproc workers on their chunk
+ * of particles (serial if there is only one thread or the particles
+ * are dispatched across machines)
+ * @return 1 if the particles were resampled
+ */
+int ssm_workers_sampling(ssm_workers_t *workers, ssm_calc_t **calc, ssm_fitness_t *fitness, int n)
+{
+    if(workers->flag_tcp || workers->inproc_length == 1 || !ssm_need_resampling(fitness)){
+        return ssm_adaptive_sampling(fitness, calc[0], n);
+    }
+
+    ssm_workers_run(workers, n, SSM_TASK_CUMSUM);
+    ssm_cumsum_chunks(fitness, calc[0]);
+    ssm_workers_run(workers, n, SSM_TASK_SAMPLING);
+    ssm_fitness_reset_weights(fitness);
+
+    return 1;
+}
+
+
+/**
+ * ssm_resample_X() with the copies of the states done by the inproc
+ * workers on their chunk of particles. *J_p_X must be the particles
+ * of the workers (D_J_X[n+1] with SSM_WORKER_D_X, D_J_X[0]
+ * otherwise).
+ */
+void ssm_workers_resample_X(ssm_workers_t *workers, ssm_fitness_t *fitness, ssm_X_t ***J_p_X, ssm_X_t ***J_p_X_tmp, int n)
+{
+    if(workers->flag_tcp || workers->inproc_length == 1){
+        ssm_resample_X(fitness, J_p_X, J_p_X_tmp, n);
+    } else if(ssm_resample_X_swap(fitness, J_p_X, J_p_X_tmp, n)){
+        ssm_workers_run(workers, n, SSM_TASK_RESAMPLE_X);
+    }
+}
@@ -240,8 +240,8 @@ ssm_err_code_t ssm_kalman_update(ssm_fitness_t *fitness, ssm_X_t *X, ssm_row_t *
     // positivity of state variables and remainder could have been lost when updating X_sv
     cum_status |= ssm_check_no_neg_sv_or_remainder(X, par, nav, calc, t);
 
-    // log_like   
-    fitness->log_like += ssm_sanitize_log_likelihood(log(ssm_dmvnorm(row->ts_nonan_length, &pred_error.vector, &zero.vector, &St.matrix, 1.0)), row, fitness, nav);
+    // log_like (floored at log_like_min per observation: there are no weights to discard the underflows)
+    fitness->log_like += GSL_MAX(fitness->log_like_min * row->ts_nonan_length, ssm_sanitize_log_likelihood(log(ssm_dmvnorm(row->ts_nonan_length, &pred_error.vector, &zero.vector, &St.matrix, 1.0)), row, fitness, nav));
     return cum_status;
 }
 
@@ -273,6 +273,40 @@ double ssm_diff_derivative(double jac_tpl, const double X[], ssm_state_t *state)
 }
 
 
+/**
+ * Append the non zero term x = Ft[i][j] to the jacobian matrix Ft
+ * stored in coordinate format in calc (calc->_Ft_i, calc->_Ft_j,
+ * calc->_Ft_x). Used by ssm_eval_jac() that only sets the
+ * structurally non zero terms of Ft
+ */
+void ssm_jac_set(ssm_calc_t *calc, int i, int j, double x)
+{
+    calc->_Ft_i[calc->_Ft_nnz] = i;
+    calc->_Ft_j[calc->_Ft_nnz] = j;
+    calc->_Ft_x[calc->_Ft_nnz] = x;
+    calc->_Ft_nnz++;
+}
+
+
+/**
+ * C = Ft * B where Ft is the sparse jacobian matrix set by
+ * ssm_eval_jac() and B and C are dense: every non zero term Ft[i][j]
+ * adds Ft[i][j] * B[j][.] to C[i][.] so that the cost is
+ * proportional to the number of non zero terms of Ft.
+ */
+void ssm_jac_mul(ssm_calc_t *calc, const gsl_matrix *B, gsl_matrix *C)
+{
+    int k;
+    gsl_matrix_set_zero(C);
+
+    for(k=0; k<calc->_Ft_nnz; k++){
+        gsl_vector_const_view Bj = gsl_matrix_const_row(B, calc->_Ft_j[k]);
+        gsl_vector_view Ci = gsl_matrix_row(C, calc->_Ft_i[k]);
+        gsl_blas_daxpy(calc->_Ft_x[k], &Bj.vector, &Ci.vector);
+    }
+}
+
+
 void ssm_kalman_reset_Ct(ssm_X_t *X, ssm_nav_t *nav)
 {
     int dim = nav->states_sv_inc->length + nav->states_diff->length;
@@ -152,7 +152,7 @@ int main(int argc, char *argv[])
 		    fitness->cum_status[j] |= (*f_pred)(J_X[j], t0, t1, J_par[j], nav, calc[0]);
 
 		    if(data->rows[n]->ts_nonan_length) {
-			fitness->weights[j] = (fitness->cum_status[j] == SSM_SUCCESS) ?  exp(ssm_log_likelihood(data->rows[n], J_X[j], J_par[j], calc[0], nav, fitness)) : 0.0;
+			fitness->weights[j] = (fitness->cum_status[j] == SSM_SUCCESS) ?  ssm_log_likelihood(data->rows[n], J_X[j], J_par[j], calc[0], nav, fitness) : GSL_NEGINF;
 			fitness->cum_status[j] = SSM_SUCCESS;
 		    }
 		}
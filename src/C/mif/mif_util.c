@@ -69,9 +69,10 @@ void ssm_mif_scale_var(ssm_var_t *var, ssm_data_t *data, ssm_nav_t *nav)
 
 
 /**
- * Multiply the loglikelihood of particle j by prod_i prior(theta_i)^(1/n_obs)
+ * Multiply the likelihood of particle j by prod_i prior(theta_i)^(1/n_obs)
+ * (log_like contains the log likelihoods, see ssm_weight())
  */
-void ssm_mif_patch_like_prior(double *like, ssm_fitness_t *fitness, ssm_theta_t **J_theta, ssm_data_t *data, ssm_nav_t *nav, const int n, const int lag)
+void ssm_mif_patch_like_prior(double *log_like, ssm_fitness_t *fitness, ssm_theta_t **J_theta, ssm_data_t *data, ssm_nav_t *nav, const int n, const int lag)
 {
     int i, j;
 
@@ -80,19 +81,17 @@ void ssm_mif_patch_like_prior(double *like, ssm_fitness_t *fitness, ssm_theta_t
 
     ssm_parameter_t *p;
     double log_like_prior_i;
-    double log_like;
     double inv_n_obs = 1.0/ ((double) data->n_obs);
     double inv_lag = 1.0/ ((double) lag);
 
     for(j=0; j<fitness->J; j++) {
-        if(like[j]){
-            log_like = log(like[j]);
+        if(log_like[j] != GSL_NEGINF){
 
             // likelihood is multiplied by prior(theta_j)^(1/n_obs) for parameters fitted with MIF (as opposed to fixed lag smoothing)
             for(i=0; i<mif->length; i++) {
                 p = mif->p[i];
                 log_like_prior_i = log(p->f_prior( p->f_inv(gsl_vector_get(J_theta[j], p->offset_theta)) ));
-                log_like += inv_n_obs * log_like_prior_i;
+                log_like[j] += inv_n_obs * log_like_prior_i;
             }
 
             // likelihood is multiplied by prior(theta_j)^(1/lag) for parameters fitted with fixed lag smoothing
@@ -100,15 +99,13 @@ void ssm_mif_patch_like_prior(double *like, ssm_fitness_t *fitness, ssm_theta_t
                 for(i=0; i<fls->length; i++) {
                     p = fls->p[i];
                     log_like_prior_i = log(p->f_prior( p->f_inv(gsl_vector_get(J_theta[j], p->offset_theta)) ));
-                    log_like += inv_lag * log_like_prior_i;
+                    log_like[j] += inv_lag * log_like_prior_i;
                 }
             }
 
-            //check for numerical issues and convert back to likelihood
-            if( (isnan(log_like) == 1) || (isinf(log_like) == 1) || (log_like > 1.0) ) {
-                like[j] = 0.0;
-            } else {
-                like[j] = exp(log_like);
+            //check for numerical issues
+            if( (isnan(log_like[j]) == 1) || (isinf(log_like[j]) == 1) || (log_like[j] > 1.0) ) {
+                log_like[j] = GSL_NEGINF;
             }
         }
     }
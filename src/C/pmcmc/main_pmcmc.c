@@ -18,7 +18,7 @@
 
 #include "ssm.h"
 
- static ssm_err_code_t run_smc(ssm_err_code_t (*f_pred) (ssm_X_t *, double, double, ssm_par_t *, ssm_nav_t *, ssm_calc_t *), ssm_X_t ***D_J_X, ssm_X_t ***D_J_X_tmp, ssm_par_t *par, ssm_calc_t **calc, ssm_data_t *data, ssm_fitness_t *fitness, ssm_nav_t *nav, ssm_workers_t *workers)
+ static ssm_err_code_t run_smc(ssm_err_code_t (*f_pred) (ssm_X_t *, double, double, ssm_par_t *, ssm_nav_t *, ssm_calc_t *), ssm_f_pred_batch_t f_pred_batch, ssm_X_t ***D_J_X, ssm_X_t ***D_J_X_tmp, ssm_par_t *par, ssm_calc_t **calc, ssm_data_t *data, ssm_fitness_t *fitness, ssm_nav_t *nav, ssm_workers_t *workers, ssm_tree_t *tree)
  {
   int i, j, n, np1, id, the_j;
   double t0, t1;
@@ -26,17 +26,26 @@
   fitness->log_like = 0.0;
   fitness->log_prior = 0.0;
   fitness->n_all_fail = 0;
+  ssm_fitness_reset_weights(fitness);
+  ssm_fitness_collapse(fitness, f_pred); //all the particles are copies of D_J_X[0][0]
 
   for(j=0; j<fitness->J; j++){
    fitness->cum_status[j] = SSM_SUCCESS;
  }
 
+ if(tree){
+  ssm_tree_init(tree, D_J_X[0]);
+}
+
  for(n=0; n<data->n_obs; n++) {
   np1 = n+1;
   t0 = (n) ? data->rows[n-1]->time: 0;
   t1 = data->rows[n]->time;
 
-  if(!workers->flag_tcp){
+  if(tree){ //the rows share the same particles, predicted in place
+   D_J_X[np1] = D_J_X[n];
+   D_J_X_tmp[np1] = D_J_X_tmp[n];
+ } else if(!workers->flag_tcp){
    for(j=0; j<fitness->J; j++){
     ssm_X_copy(D_J_X[np1][j], D_J_X[n][j]);
   }
@@ -74,23 +83,64 @@ for (j=0; j<fitness->J; j++) {
   }
 } else {
 
+ if(f_pred_batch){
+  for(j=0;j<fitness->J;j++) {
+    ssm_X_reset_inc(D_J_X[np1][j], data->rows[n], nav);
+  }
+  (*f_pred_batch)(D_J_X[np1], 0, fitness->J, t0, t1, par, nav, calc[0], fitness->cum_status);
+}
+
+ //no batching with collapsed particles (ode, never batch predicted): only the representatives are weighted, one by one
+ int flag_batch_like = calc[0]->batch && !fitness->flag_collapse && data->rows[n]->ts_nonan_length;
+ if(flag_batch_like){
+  ssm_log_likelihood_batch(data->rows[n], D_J_X[np1], 0, fitness->J, par, calc[0], nav, fitness, fitness->weights);
+}
+
  for(j=0;j<fitness->J;j++) {
-  ssm_X_reset_inc(D_J_X[np1][j], data->rows[n], nav);
-  fitness->cum_status[j] |= (*f_pred)(D_J_X[np1][j], t0, t1, par, nav, calc[0]);
+  if(fitness->flag_collapse && fitness->rep[j] != j){
+    continue; //copy of rep[j] (see ssm_expand_X())
+  }
+  if(!f_pred_batch){
+    ssm_X_reset_inc(D_J_X[np1][j], data->rows[n], nav);
+    fitness->cum_status[j] |= (*f_pred)(D_J_X[np1][j], t0, t1, par, nav, calc[0]);
+  }
   if(data->rows[n]->ts_nonan_length) {
-    fitness->weights[j] = (fitness->cum_status[j] == SSM_SUCCESS) ?  exp(ssm_log_likelihood(data->rows[n], D_J_X[np1][j], par, calc[0], nav, fitness)) : 0.0;
+    if(fitness->cum_status[j] != SSM_SUCCESS){
+      fitness->weights[j] = GSL_NEGINF;
+    } else if(!flag_batch_like){
+      fitness->weights[j] = ssm_log_likelihood(data->rows[n], D_J_X[np1][j], par, calc[0], nav, fitness);
+    }
     fitness->cum_status[j] = SSM_SUCCESS;
   }
 }
+
+ if(fitness->flag_collapse){
+  ssm_expand_X(fitness, D_J_X[np1], 0, fitness->J);
+}
+}
+
+if(n == 0){
+  fitness->dt_warm = ssm_dt_warm(D_J_X[np1], fitness);
 }
 
 if(data->rows[n]->ts_nonan_length) {
   if(ssm_weight(fitness, data->rows[n], nav, n)) {
-    ssm_systematic_sampling(fitness, calc[0], n);
+    ssm_workers_sampling(workers, calc, fitness, n);
   }
-  ssm_resample_X(fitness, &D_J_X[np1], &D_J_X_tmp[np1], n);
+  ssm_workers_resample_X(workers, fitness, &D_J_X[np1], &D_J_X_tmp[np1], n);
+}
+
+if(tree){
+  ssm_tree_insert(tree, D_J_X[np1], (data->rows[n]->ts_nonan_length) ? fitness->select[n] : NULL, n);
 }
 }
+
+if(tree){
+  D_J_X[0] = D_J_X[data->n_obs];
+  D_J_X_tmp[0] = D_J_X_tmp[data->n_obs];
+  ssm_tree_set_weights(tree, fitness->weights_prev);
+}
+
 return ( (data->n_obs != 0) && (fitness->n_all_fail == data->n_obs) ) ? SSM_ERR_PRED: SSM_SUCCESS;
 }
 
@@ -108,10 +158,15 @@ int main(int argc, char *argv[])
   ssm_data_t *data = ssm_data_new(jdata, nav, opts);
   ssm_fitness_t *fitness = ssm_fitness_new(data, opts);
   ssm_calc_t **calc = ssm_N_calc_new(jdata, nav, data, fitness, opts);
-  ssm_X_t ***D_J_X = ssm_D_J_X_new(data, fitness, nav, opts);
-  ssm_X_t ***D_J_X_tmp = ssm_D_J_X_new(data, fitness, nav, opts);
-    ssm_X_t **D_X = ssm_D_X_new(data, nav, opts); //to store sampled trajectories
-    ssm_X_t **D_X_prev = ssm_D_X_new(data, nav, opts);
+  //with --tree the paths are stored in an ancestral tree (for the proposed and the last accepted theta) and the rows of D_J_X share the same particles
+  int flag_tree = opts->flag_tree && (opts->print & SSM_PRINT_X);
+  ssm_X_t ***D_J_X = (flag_tree) ? ssm_D_J_X_shared_new(data, fitness, nav, opts) : ssm_D_J_X_new(data, fitness, nav, opts);
+  ssm_X_t ***D_J_X_tmp = (flag_tree) ? ssm_D_J_X_shared_new(data, fitness, nav, opts) : ssm_D_J_X_new(data, fitness, nav, opts);
+    ssm_X_t **D_X = (flag_tree) ? NULL : ssm_D_X_new(data, nav, opts); //to store sampled trajectories
+    ssm_X_t **D_X_prev = (flag_tree) ? NULL : ssm_D_X_new(data, nav, opts);
+    ssm_tree_t *tree = (flag_tree) ? ssm_tree_new(fitness, nav, opts) : NULL;
+    ssm_tree_t *tree_prev = (flag_tree) ? ssm_tree_new(fitness, nav, opts) : NULL;
+    ssm_tree_t *tree_swap;
 
     json_decref(jdata);
 
@@ -130,6 +185,7 @@ int main(int argc, char *argv[])
     int thin_traj = (int) ( (double) n_iter / (double) n_traj); //the thinning interval
 
     ssm_f_pred_t f_pred = ssm_get_f_pred(nav);
+    ssm_f_pred_batch_t f_pred_batch = ssm_get_f_pred_batch(nav, calc[0]);
 
     ssm_workers_t *workers = ssm_workers_start(D_J_X, &par_proposed, data, calc, fitness, f_pred, nav, opts, SSM_WORKER_D_X | SSM_WORKER_FITNESS);
 
@@ -185,7 +241,7 @@ int main(int argc, char *argv[])
       ssm_X_copy(D_J_X[0][j], D_J_X[0][0]);
     }
 
-    ssm_err_code_t success = run_smc(f_pred, D_J_X, D_J_X_tmp, par_proposed, calc, data, fitness, nav, workers);
+    ssm_err_code_t success = run_smc(f_pred, f_pred_batch, D_J_X, D_J_X_tmp, par_proposed, calc, data, fitness, nav, workers, tree);
     success |= ssm_log_prob_prior(&fitness->log_prior, proposed, nav, fitness);
 
     if(success != SSM_SUCCESS){
@@ -197,7 +253,12 @@ int main(int argc, char *argv[])
     fitness->log_like_prev = fitness->log_like;
     fitness->log_prior_prev = fitness->log_prior;
 
-    if ( ( nav->print & SSM_PRINT_X ) && data->n_obs ) {
+    if (flag_tree) {
+      tree_swap = tree_prev; tree_prev = tree; tree = tree_swap;
+      if (data->n_obs) {
+        ssm_tree_print_traj(nav->X, tree_prev, par, nav, calc[0], data, m);
+      }
+    } else if ( ( nav->print & SSM_PRINT_X ) && data->n_obs ) {
     
         ssm_sample_traj(D_X, D_J_X, calc[0], data, fitness);
 
@@ -249,12 +310,12 @@ int main(int argc, char *argv[])
 
     if(success == SSM_SUCCESS){
       ssm_par2X(D_J_X[0][0], par_proposed, calc[0], nav);
-      D_J_X[0][0]->dt = D_J_X[0][0]->dt0;
+      D_J_X[0][0]->dt = fitness->dt_warm; //warm start from the previous iteration
       for(j=1; j<fitness->J; j++){
         ssm_X_copy(D_J_X[0][j], D_J_X[0][0]);
       }
 
-      success |= run_smc(f_pred, D_J_X, D_J_X_tmp, par_proposed, calc, data, fitness, nav, workers);
+      success |= run_smc(f_pred, f_pred_batch, D_J_X, D_J_X_tmp, par_proposed, calc, data, fitness, nav, workers, tree);
       success |= ssm_metropolis_hastings(fitness, &ratio, proposed, theta, var, sd_fac, nav, calc[0], 1);
     }
 
@@ -264,7 +325,9 @@ int main(int argc, char *argv[])
           ssm_theta_copy(theta, proposed);
           ssm_par_copy(par, par_proposed);
 
-          if ( (nav->print & SSM_PRINT_X) && data->n_obs ) {
+          if (flag_tree) {
+            tree_swap = tree_prev; tree_prev = tree; tree = tree_swap;
+          } else if ( (nav->print & SSM_PRINT_X) && data->n_obs ) {
             ssm_sample_traj(D_X, D_J_X, calc[0], data, fitness);
             for(n=0; n<data->n_obs; n++){
               ssm_X_copy(D_X_prev[n+1], D_X[n+1]);
@@ -275,7 +338,9 @@ int main(int argc, char *argv[])
         ssm_adapt_ar(adapt, (success == SSM_SUCCESS) ? 1: 0, m); //compute acceptance rate
         ssm_adapt_var(adapt, theta, m);  //compute empirical variance
 
-        if ( (nav->print & SSM_PRINT_X) && ( (m % thin_traj) == 0) ) {
+        if ( flag_tree && data->n_obs && ( (m % thin_traj) == 0) ) {
+          ssm_tree_print_traj(nav->X, tree_prev, par, nav, calc[0], data, m);
+        } else if ( (nav->print & SSM_PRINT_X) && ( (m % thin_traj) == 0) ) {
           for(n=0; n<data->n_obs; n++){
             ssm_print_X(nav->X, D_X_prev[n+1], par, nav, calc[0], data->rows[n], m);
           }
@@ -312,10 +377,17 @@ int main(int argc, char *argv[])
 
      ssm_workers_stop(workers);
 
-     ssm_D_J_X_free(D_J_X, data, fitness);
-     ssm_D_J_X_free(D_J_X_tmp, data, fitness);
-     ssm_D_X_free(D_X, data);
-     ssm_D_X_free(D_X_prev, data);
+     if (flag_tree) {
+       ssm_D_J_X_shared_free(D_J_X, fitness);
+       ssm_D_J_X_shared_free(D_J_X_tmp, fitness);
+       ssm_tree_free(tree);
+       ssm_tree_free(tree_prev);
+     } else {
+       ssm_D_J_X_free(D_J_X, data, fitness);
+       ssm_D_J_X_free(D_J_X_tmp, data, fitness);
+       ssm_D_X_free(D_X, data);
+       ssm_D_X_free(D_X_prev, data);
+     }
 
      ssm_N_calc_free(calc, nav);
 
@@ -56,8 +56,10 @@ int main(int argc, char *argv[])
     }
 
     ssm_f_pred_t f_pred = ssm_get_f_pred(nav);
+    ssm_f_pred_batch_t f_pred_batch = ssm_get_f_pred_batch(nav, calc[0]);
 
     ssm_workers_t *workers = ssm_workers_start(&J_X, &par, data, calc, fitness, f_pred, nav, opts, SSM_WORKER_FITNESS);
+    ssm_fitness_collapse(fitness, f_pred); //all the particles are copies of J_X[0]
 
     for(n=0; n<data->n_obs; n++) {
         t0 = (n) ? data->rows[n-1]->time: 0;
@@ -97,20 +99,46 @@ int main(int argc, char *argv[])
             }
 
         } else {
+            if(f_pred_batch){
+                for(j=0;j<fitness->J;j++) {
+                    ssm_X_reset_inc(J_X[j], data->rows[n], nav);
+                }
+                (*f_pred_batch)(J_X, 0, fitness->J, t0, t1, par, nav, calc[0], fitness->cum_status);
+            }
+
+            //no batching with collapsed particles (ode, never batch predicted): only the representatives are weighted, one by one
+            int flag_batch_like = calc[0]->batch && !fitness->flag_collapse && data->rows[n]->ts_nonan_length;
+            if(flag_batch_like){
+                ssm_log_likelihood_batch(data->rows[n], J_X, 0, fitness->J, par, calc[0], nav, fitness, fitness->weights);
+            }
+
 	    for(j=0;j<fitness->J;j++) {
-                ssm_X_reset_inc(J_X[j], data->rows[n], nav);
-                fitness->cum_status[j] |= (*f_pred)(J_X[j], t0, t1, par, nav, calc[0]);
+                if(fitness->flag_collapse && fitness->rep[j] != j){
+                    continue; //copy of rep[j] (see ssm_expand_X())
+                }
+                if(!f_pred_batch){
+                    ssm_X_reset_inc(J_X[j], data->rows[n], nav);
+                    fitness->cum_status[j] |= (*f_pred)(J_X[j], t0, t1, par, nav, calc[0]);
+                }
 		if(data->rows[n]->ts_nonan_length) {
-                    fitness->weights[j] = (fitness->cum_status[j] == SSM_SUCCESS) ?  exp(ssm_log_likelihood(data->rows[n], J_X[j], par, calc[0], nav, fitness)) : 0.0;
+                    if(fitness->cum_status[j] != SSM_SUCCESS){
+                        fitness->weights[j] = GSL_NEGINF;
+                    } else if(!flag_batch_like){
+                        fitness->weights[j] = ssm_log_likelihood(data->rows[n], J_X[j], par, calc[0], nav, fitness);
+                    }
 		    fitness->cum_status[j] = SSM_SUCCESS;
                 }
             }
 
+            if(fitness->flag_collapse){
+                ssm_expand_X(fitness, J_X, 0, fitness->J);
+            }
+
         }
 
         if(!flag_no_filter && data->rows[n]->ts_nonan_length) {
             if(ssm_weight(fitness, data->rows[n], nav, n)) {
-		ssm_systematic_sampling(fitness, calc[0], n);
+		ssm_workers_sampling(workers, calc, fitness, n);
             }
 
             if (nav->print & SSM_PRINT_HAT) {
@@ -120,7 +148,7 @@ int main(int argc, char *argv[])
             if (nav->print & SSM_PRINT_DIAG) {
                 ssm_print_pred_res(nav->diag, J_X, par, nav, calc[0], data, data->rows[n], fitness);
             }
-	    ssm_resample_X(fitness, &J_X, &J_X_tmp, n);
+	    ssm_workers_resample_X(workers, fitness, &J_X, &J_X_tmp, n);
 
         } else if (nav->print & SSM_PRINT_HAT) { //we do not filter or all data ara NaN (no info).
             ssm_hat_eval(hat, J_X, &par, nav, calc[0], NULL, t1, 0);
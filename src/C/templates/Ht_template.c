@@ -7,7 +7,9 @@ void ssm_eval_Ht(ssm_X_t *p_X, ssm_row_t *row, double t, ssm_par_t *par, ssm_nav
 
     double *X = p_X->proj;
     int i, j;
-    gsl_matrix *Ht = calc->_Ht;
+    gsl_matrix *Ht = calc->_Ht;{% if Ht|uses('_cov[') %}
+    const double *_cov = ssm_covariates(calc, t);{% endif %}{% if Ht|uses('_pre[') %}
+    const double *_pre = ssm_precomputed(par, calc, SSM_PRE_HT);{% endif %}
     int m = nav->states_sv->length + nav->states_inc->length + nav->states_diff->length;
 
     ssm_it_states_t *states_inc = nav->states_inc;
@@ -37,6 +39,10 @@ void ssm_eval_Ht(ssm_X_t *p_X, ssm_row_t *row, double t, ssm_par_t *par, ssm_nav
     }
     {% endif %}
 
+    /* common subexpressions */
+    {% for x in Ht.cse %}
+    const double {{ x.name }} = {{ x.term }};{% endfor %}
+
     // Derivatives of observed means against state variables
     {% for Ht_i in Ht.Ht_sv %}
     {% set outer_loop = loop %}
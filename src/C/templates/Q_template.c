@@ -10,7 +10,9 @@ void ssm_eval_Q_{{ noises_off }}(const double X[], double t, ssm_par_t *par, ssm
 {
     int i, j;
     double term;
-    gsl_matrix *Q = calc->_Q;
+    gsl_matrix *Q = calc->_Q;{% if tpl|uses('_cov[') %}
+    const double *_cov = ssm_covariates(calc, t);{% endif %}{% if tpl.pre %}
+    const double *_pre = ssm_precomputed(par, calc, SSM_PRE_Q);{% endif %}
 
     {% if tpl.Q_inc %}
     ssm_it_states_t *states_inc = nav->states_inc;
@@ -56,17 +58,21 @@ void ssm_eval_Q_{{ noises_off }}(const double X[], double t, ssm_par_t *par, ssm
 
     /* caches */
     {% if tpl.sf %}
-    {% for sf in tpl.sf %}
-    _sf[{{ loop.index0 }}] = {{ sf }};{% endfor %}
+    {% filter roll(true) %}{% for sf in tpl.sf %}
+    _sf[{{ loop.index0 }}] = {{ sf }};{{ roll_unit }}{% endfor %}{% endfilter %}
     {% endif %}
 
 
+    /* common subexpressions (of Q_proc and Q_inc) */
+    {% for x in tpl.cse %}
+    const double {{ x.name }} = {{ x.term }};{% endfor %}
+
     /*
       Q_proc contains only term involving state variables.
     */
     {% if tpl.Q_proc %}
 
-    {% for x in tpl.Q_proc %}
+    {% filter roll(true) %}{% for x in tpl.Q_proc %}
     i = {{ x.i }};
     j = {{ x.j }};
     term = {{ x.term|safe }};
@@ -77,7 +83,7 @@ void ssm_eval_Q_{{ noises_off }}(const double X[], double t, ssm_par_t *par, ssm
     gsl_matrix_set(Q, j, i, term);
     {% endif %}
 
-    {% endfor %}
+    {{ roll_unit }}{% endfor %}{% endfilter %}
 
     {% endif %}
 
@@ -87,7 +93,7 @@ void ssm_eval_Q_{{ noises_off }}(const double X[], double t, ssm_par_t *par, ssm
     */
     {% if tpl.Q_inc %}
 
-    {% for x in tpl.Q_inc %}
+    {% filter roll(true) %}{% for x in tpl.Q_inc %}
 
     {% if x.i.is_inc %}
     i = states_inc->p[{{ x.i.ind }}]->offset;
@@ -109,7 +115,7 @@ void ssm_eval_Q_{{ noises_off }}(const double X[], double t, ssm_par_t *par, ssm
     gsl_matrix_set(Q, j, i, term);
     {% endif %}
 
-    {% endfor %}
+    {{ roll_unit }}{% endfor %}{% endfilter %}
 
     {% endif %}
 
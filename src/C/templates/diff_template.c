@@ -25,6 +25,42 @@ void ssm_compute_diff(ssm_X_t *p_X, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *
     {% endif %}
 }
 
+/**
+ * batched version of ssm_compute_diff() (see ssm_batch_t)
+ */
+void ssm_compute_diff_batch(ssm_batch_t *b, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc)
+{
+    {% if diff.terms|length %}
+
+    int i, j;
+    int J = b->J;
+    int n_browns = {{ diff.n_browns}};
+    ssm_it_states_t *it = nav->states_diff;
+
+    double *restrict Xb = b->X;
+    double sqrt_dt = sqrt(b->dt);
+
+    double *restrict _wb = b->work;
+    for(j=0; j<J; j++){
+        for(i=0; i<n_browns; i++){
+            _wb[i*J+j] = gsl_ran_ugaussian(calc->randgsl);
+        }
+    }
+
+    {% filter soa %}{% for eq in diff.terms %}
+    for(j=0; j<J; j++) X[it->p[{{ loop.index0 }}]->offset] += sqrt_dt*({{ eq }});{% endfor %}{% endfilter %}
+
+    {% endif %}
+}
+
+/**
+ * size of the scratch space (in number of particles, see ssm_batch_t) used by ssm_compute_diff_batch()
+ */
+int ssm_diff_batch_width(void)
+{
+    return {{ diff.n_browns if diff.terms|length else 0 }};
+}
+
 
 {% endblock %}
 
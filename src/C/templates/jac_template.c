@@ -6,11 +6,12 @@ void ssm_eval_jac(const double X[], double t, ssm_par_t *par, ssm_nav_t *nav, ss
 {
 
     int i;
-    gsl_matrix *Ft = calc->_Ft;
 
     ssm_it_states_t *states_diff = nav->states_diff;
     ssm_it_states_t *states_inc = nav->states_inc;
-    ssm_it_states_t *states_sv = nav->states_sv;
+    ssm_it_states_t *states_sv = nav->states_sv;{% if jac|uses('_cov[') %}
+    const double *_cov = ssm_covariates(calc, t);{% endif %}{% if jac|uses('_pre[') %}
+    const double *_pre = ssm_precomputed(par, calc, SSM_PRE_JAC);{% endif %}
 
     {% if is_diff  %}
     int is_diff = ! (nav->noises_off & SSM_NO_DIFF);
@@ -20,8 +21,7 @@ void ssm_eval_jac(const double X[], double t, ssm_par_t *par, ssm_nav_t *nav, ss
     double diffed[states_diff->length];
     {% endif %}
 
-    //some terms are always 0: derivative of the ODE (excluding the observed variable) against the observed variable, derivative of the dynamic of the observed variable against the observed variables, derivative of the drift eq.
-    gsl_matrix_set_zero(Ft);
+    //some terms are always 0: derivative of the ODE (excluding the observed variable) against the observed variable, derivative of the dynamic of the observed variable against the observed variables, derivative of the drift eq. They are not stored.
 
     double _r[{{ jac.caches|length }}];
 
@@ -47,62 +47,31 @@ void ssm_eval_jac(const double X[], double t, ssm_par_t *par, ssm_nav_t *nav, ss
     {% for sf in jac.sf %}
     _sf[{{ loop.index0 }}] = {{ sf }};{% endfor %}
 
+    /* common subexpressions */
+    {% for x in jac.cse %}
+    const double {{ x.name }} = {{ x.term }};{% endfor %}
+
     {% for cache in jac.caches %}
     _r[{{ loop.index0 }}] = {{ cache }};{% endfor %}
 
 
-    //first non null part of the jacobian matrix: derivative of the ODE (excluding the observed variable) against the state variable only ( automaticaly generated code )
-    {% for jac_i in jac.jac %}
-    {% set outer_loop = loop %}
-    {% for jac_ii in jac_i %}
-    gsl_matrix_set(Ft,
-                   states_sv->p[{{ outer_loop.index0 }}]->offset,
-                   states_sv->p[{{ loop.index0 }}]->offset,
-                   _r[{{ jac_ii }}]);
-    {% endfor %}
-    {% endfor %}
-
-
-    //second non null part of the jacobian matrix: derivative of the dynamic of the observed variable against the state variable only ( automaticaly generated code )
-    {% for jac_i in jac.jac_obs %}
-    {% set outer_loop = loop %}
-    {% for jac_ii in jac_i %}
-    gsl_matrix_set(Ft,
-                   states_inc->p[{{ outer_loop.index0 }}]->offset,
-                   states_sv->p[{{ loop.index0 }}]->offset,
-                   _r[{{ jac_ii }}]);
-    {% endfor %}
-    {% endfor %}
-
-
-
-    {% if is_diff %}
+    //non null terms of the jacobian matrix (automaticaly generated code): derivative of the ODE and of the dynamic of the observed variable against the state variables and the diff variables. Ft is stored in coordinate format (see ssm_jac_set()).
+    calc->_Ft_nnz = 0;
+    {% for x in jac.Ft %}
+    {% if x.diff %}
     if(is_diff){
-
-        //third non null part of the jacobian matrix: derivative of the ODE (excluding the observed variable) against the diff variable (automaticaly generated code)
-        {% for jac_i in jac.jac_diff %}
-        {% set outer_loop = loop %}
-        {% for jac_ii in jac_i %}
-        gsl_matrix_set(Ft,
-                       states_sv->p[{{ outer_loop.index0 }}]->offset,
-                       states_diff->p[{{ loop.index0 }}]->offset,
-                       ssm_diff_derivative(_r[{{ jac_ii.value }}], X, states_diff->p[{{ loop.index0 }}]));
-        {% endfor %}
-        {% endfor %}
-
-        //fourth non null part of the jacobian matrix: derivative of obs variable against diff (automaticaly generated code)
-        {% for jac_i in jac.jac_obs_diff %}
-        {% set outer_loop = loop %}
-        {% for jac_ii in jac_i %}
-        gsl_matrix_set(Ft,
-                       states_inc->p[{{ outer_loop.index0 }}]->offset,
-                       nav->states_diff->p[{{ loop.index0 }}]->offset,
-                       ssm_diff_derivative(_r[{{ jac_ii.value }}], X, states_diff->p[{{ loop.index0 }}]));
-        {% endfor %}
-        {% endfor %}
-
+        ssm_jac_set(calc,
+                    {{ x.i.it }}->p[{{ x.i.ind }}]->offset,
+                    {{ x.j.it }}->p[{{ x.j.ind }}]->offset,
+                    ssm_diff_derivative(_r[{{ x.value }}], X, states_diff->p[{{ x.j.ind }}]));
     }
+    {% else %}
+    ssm_jac_set(calc,
+                {{ x.i.it }}->p[{{ x.i.ind }}]->offset,
+                {{ x.j.it }}->p[{{ x.j.ind }}]->offset,
+                _r[{{ x.value }}]);
     {% endif %}
+    {% endfor %}
 
 }
 
@@ -0,0 +1,102 @@
+{% extends "ordered.tpl" %}
+
+{% block code %}
+
+/**
+ * Alloc memory for the nrm implementation (see ssm_nrm_t) and set the
+ * reaction dependency graph
+ */
+void ssm_nrm_new(ssm_calc_t *calc)
+{
+    int k;
+    ssm_nrm_t *nrm = malloc(sizeof (ssm_nrm_t));
+    if (nrm == NULL) {
+        ssm_print_err("Allocation impossible for ssm_nrm_t *");
+        exit(EXIT_FAILURE);
+    }
+
+    /*automaticaly generated code: reaction dependency graph*/
+    static const int dep_start[{{ dep_start|length }}] = { {{ dep_start|join(', ') }} };
+    static const int dep[{{ dep|length }}] = { {{ dep|join(', ') }} };
+    static const int refresh[{{ refresh|length or 1 }}] = { {{ (refresh or [0])|join(', ') }} };
+
+    nrm->length = {{ reactions|length }};
+    nrm->refresh_length = {{ refresh|length }};
+
+    nrm->dep_start = ssm_i1_new(nrm->length + 1);
+    nrm->dep = ssm_i1_new(dep_start[nrm->length]);
+    nrm->refresh = ssm_i1_new(nrm->refresh_length);
+
+    for(k=0; k<=nrm->length; k++){
+        nrm->dep_start[k] = dep_start[k];
+    }
+    for(k=0; k<dep_start[nrm->length]; k++){
+        nrm->dep[k] = dep[k];
+    }
+    for(k=0; k<nrm->refresh_length; k++){
+        nrm->refresh[k] = refresh[k];
+    }
+
+    nrm->a = ssm_d1_new(nrm->length);
+    nrm->T = ssm_d1_new(nrm->length);
+    nrm->heap = ssm_i1_new(nrm->length);
+    nrm->pos = ssm_i1_new(nrm->length);
+
+    calc->nrm = nrm;
+    calc->_wn = {% if n_noises %}ssm_d1_new({{ n_noises }}){% else %}NULL{% endif %};
+}
+
+void ssm_nrm_free(ssm_calc_t *calc)
+{
+    ssm_nrm_t *nrm = calc->nrm;
+
+    free(nrm->dep_start);
+    free(nrm->dep);
+    free(nrm->refresh);
+    free(nrm->a);
+    free(nrm->T);
+    free(nrm->heap);
+    free(nrm->pos);
+    free(nrm);
+    free(calc->_wn);
+}
+
+
+/**
+ * propensity of the reaction k (rate not corrected, white noises (if
+ * any) drawn by ssm_psr_white_noises(), same reactions as
+ * ssm_psr_fire())
+ */
+double ssm_nrm_propensity(int k, ssm_X_t *p_X, double t, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc)
+{
+    double *X = p_X->proj;{% if reactions|uses('_cov[') %}
+    const double *_cov = ssm_covariates(calc, t);{% endif %}
+
+    {% if is_diff %}
+    int i;
+    ssm_it_states_t *states_diff = nav->states_diff;
+    double diffed[states_diff->length];
+    int is_diff = ! (nav->noises_off & SSM_NO_DIFF);
+
+    for(i=0; i<states_diff->length; i++){
+        ssm_state_t *p = states_diff->p[i];
+        if(is_diff){
+            diffed[i] = p->f_inv(X[p->offset]);
+        } else {
+            diffed[i] = gsl_vector_get(par, p->ic->offset);
+        }
+    }
+    {% endif %}
+
+    /*automaticaly generated code*/
+    switch(k){
+    {% for r in reactions %}
+    case {{ loop.index0 }}:
+        return {% if r.noise is not none %}({{ r.rate }})*calc->_wn[{{ r.noise }}]{% else %}{{ r.rate }}{% endif %};
+    {% endfor %}
+    }
+
+    return 0.0;
+}
+
+{% endblock %}
@@ -7,7 +7,9 @@
 static double f_likelihood_tpl_{{ x.name }}(double y, ssm_X_t *p_X, ssm_par_t *par, ssm_calc_t *calc, double t)
 {
     double like;
-    double *X = p_X->proj;
+    double *X = p_X->proj;{% if x|uses('_cov[') %}
+    const double *_cov = ssm_covariates(calc, t);{% endif %}{% if x.pre %}
+    const double *_pre = ssm_precomputed(par, calc, SSM_PRE_OBSERVED);{% endif %}
 
     {% if x.distribution == 'discretized_normal' %}
     
@@ -40,22 +42,63 @@ static double f_likelihood_tpl_{{ x.name }}(double y, ssm_X_t *p_X, ssm_par_t *p
 }
 
 
+static double f_log_likelihood_tpl_{{ x.name }}(double y, ssm_X_t *p_X, ssm_par_t *par, ssm_calc_t *calc, double t)
+{
+    double *X = p_X->proj;{% if x|uses('_cov[') %}
+    const double *_cov = ssm_covariates(calc, t);{% endif %}{% if x.pre %}
+    const double *_pre = ssm_precomputed(par, calc, SSM_PRE_OBSERVED);{% endif %}
+
+    {% if x.distribution == 'discretized_normal' %}
+    return ssm_log_dnorm_discretized(y, {{ x.mean }}, {{ x.sd }}, calc);
+    {% elif x.distribution == 'poisson' %}
+    return ssm_log_dpois(rint(y), {{ x.mean }}, calc);
+    {% elif x.distribution == 'binomial' %}
+    return ssm_log_dbinom(rint(y), {{ x.p }}, {{ x.n }}, calc);
+    {% endif %}
+}
+
+static void f_log_likelihood_batch_tpl_{{ x.name }}(double y, ssm_batch_t *b, ssm_par_t *par, ssm_calc_t *calc, double t, double *restrict res)
+{
+    int j;
+    int J = b->J;
+    const double *restrict Xb = b->X;{% if x|uses('_cov[') %}
+    const double *_cov = ssm_covariates(calc, t);{% endif %}{% if x.pre %}
+    const double *_pre = ssm_precomputed(par, calc, SSM_PRE_OBSERVED);{% endif %}
+
+    for(j=0; j<J; j++){
+        {% if x.distribution == 'discretized_normal' %}
+        res[j] += ssm_log_dnorm_discretized(y, {{ x.mean|soa }}, {{ x.sd|soa }}, calc);
+        {% elif x.distribution == 'poisson' %}
+        res[j] += ssm_log_dpois(rint(y), {{ x.mean|soa }}, calc);
+        {% elif x.distribution == 'binomial' %}
+        res[j] += ssm_log_dbinom(rint(y), {{ x.p|soa }}, {{ x.n|soa }}, calc);
+        {% endif %}
+    }
+}
+
+
 static double f_obs_mean_tpl_{{ x.name }}(ssm_X_t *p_X, ssm_par_t *par, ssm_calc_t *calc, double t)
 {
-    double *X = p_X->proj;
+    double *X = p_X->proj;{% if x|uses('_cov[') %}
+    const double *_cov = ssm_covariates(calc, t);{% endif %}{% if x.pre_mean %}
+    const double *_pre = ssm_precomputed(par, calc, SSM_PRE_OBSERVED);{% endif %}
     return {{ x.mean }};
 }
 
 static double f_obs_var_tpl_{{ x.name }}(ssm_X_t *p_X, ssm_par_t *par, ssm_calc_t *calc, double t)
 {
-    double *X = p_X->proj;
+    double *X = p_X->proj;{% if x|uses('_cov[') %}
+    const double *_cov = ssm_covariates(calc, t);{% endif %}{% if x.sd|uses('_pre[') %}
+    const double *_pre = ssm_precomputed(par, calc, SSM_PRE_OBSERVED);{% endif %}
     return pow({{ x.sd }}, 2);
 }
 
 
 static double f_obs_ran_tpl_{{ x.name }}(ssm_X_t *p_X, ssm_par_t *par, ssm_calc_t *calc, double t)
 {
-    double *X = p_X->proj;
+    double *X = p_X->proj;{% if x|uses('_cov[') %}
+    const double *_cov = ssm_covariates(calc, t);{% endif %}{% if x.pre %}
+    const double *_pre = ssm_precomputed(par, calc, SSM_PRE_OBSERVED);{% endif %}
 
     {% if x.distribution == 'discretized_normal' %}
     
@@ -98,7 +141,9 @@ static double f_obs_ran_tpl_{{ x.name }}(ssm_X_t *p_X, ssm_par_t *par, ssm_calc_
  {
     double res = 0;
     int m = nav->states_sv->length + nav->states_inc->length + nav->states_diff->length;
-    gsl_matrix_const_view Ct   = gsl_matrix_const_view_array(&p_X->proj[m], m, m);
+    gsl_matrix_const_view Ct   = gsl_matrix_const_view_array(&p_X->proj[m], m, m);{% if y|uses('_cov[') %}
+    const double *_cov = ssm_covariates(calc, t);{% endif %}{% if y.pre %}
+    const double *_pre = ssm_precomputed(par, calc, SSM_PRE_OBSERVED);{% endif %}
 
     {% for grad_i in y.grads %}
     {% set outer_loop = loop %}
@@ -135,10 +180,12 @@ ssm_observed_t **_ssm_observed_new(int *observed_length)
     observed[{{ loop.index0 }}]->name = strdup("{{ x.name }}");
     observed[{{ loop.index0 }}]->offset = {{ loop.index0 }};
     observed[{{ loop.index0 }}]->f_likelihood = &f_likelihood_tpl_{{ x.name }};
+    observed[{{ loop.index0 }}]->f_log_likelihood = &f_log_likelihood_tpl_{{ x.name }};
     observed[{{ loop.index0 }}]->f_obs_mean = &f_obs_mean_tpl_{{ x.name }};
     observed[{{ loop.index0 }}]->f_obs_var = &f_obs_var_tpl_{{ x.name }};
     observed[{{ loop.index0 }}]->f_obs_ran = &f_obs_ran_tpl_{{ x.name }};
     observed[{{ loop.index0 }}]->f_var_pred = &f_var_pred_tpl_{{ x.name }};
+    observed[{{ loop.index0 }}]->f_log_likelihood_batch = &f_log_likelihood_batch_tpl_{{ x.name }};
     {% endfor %}
 
     return observed;
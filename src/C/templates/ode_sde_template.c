@@ -2,9 +2,10 @@
 
 {% block code %}
 
-//stepping functions for ODE and SDEs
+//stepping functions for ODE and SDEs (the ODE steps are adaptive and specific to each particle: its time only terms are computed inline, see ssm_time_terms())
 
 {% for noises_off, func in step.func.items() %}
+{% set s = (step.inline or step) if noises_off == 'ode' else step %}
 {% if noises_off == 'ode'%}
 int ssm_step_ode(double t, const double X[], double f[], void *params)
 {% else %}
@@ -25,12 +26,15 @@ void ssm_step_sde_{{ noises_off }}(ssm_X_t *p_X, double t, ssm_par_t *par, ssm_n
     {% endif %}
 
     ssm_it_states_t *states_diff = nav->states_diff;
-    ssm_it_states_t *states_inc = nav->states_inc;
+    ssm_it_states_t *states_inc = nav->states_inc;{% if [func, s.caches, s.sf]|uses('_cov[') %}
+    const double *_cov = ssm_covariates(calc, t);{% endif %}{% if [func, s.caches, s.sf]|uses('_pre[') %}
+    const double *_pre = ssm_precomputed(par, calc, SSM_PRE_STEP);{% endif %}{% if tt and noises_off != 'ode' %}
+    const double *_tt = ssm_time_terms(par, calc, t);{% endif %}
 
-    double _r[{{ step.caches|length }}];
+    double _r[{{ s.caches|length }}];
 
-    {% if step.sf %}
-    double _sf[{{ step.sf|length }}];{% endif %}
+    {% if s.sf %}
+    double _sf[{{ s.sf|length }}];{% endif %}
 
     {% for noise in func.proc.noises %}
     double {{ noise }};{% endfor %}
@@ -59,19 +63,23 @@ void ssm_step_sde_{{ noises_off }}(ssm_X_t *p_X, double t, ssm_par_t *par, ssm_n
     {% endif %}
 
     /* caches */
-    {% for sf in step.sf %}
-    _sf[{{ loop.index0 }}] = {{ sf }};{% endfor %}
+    {% filter roll(true) %}{% for sf in s.sf %}
+    _sf[{{ loop.index0 }}] = {{ sf }};{{ roll_unit }}{% endfor %}{% endfilter %}
 
-    {% for cache in step.caches %}
-    _r[{{ loop.index0 }}] = {{ cache }};{% endfor %}
+    {% filter roll(true) %}{% for cache in s.caches %}
+    _r[{{ loop.index0 }}] = {{ cache }};{{ roll_unit }}{% endfor %}{% endfilter %}
 
     /* noises */
     {% for noise in func.proc.noises %}
     {{ noise }} = sqrt(dt)*gsl_ran_ugaussian(calc->randgsl);{% endfor %}
 
+    /* common subexpressions */
+    {% for x in func.cse %}
+    const double {{ x.name }} = {{ x.term }};{% endfor %}
+
     /*ODE system*/
-    {% for eq in func.proc.system %}
-    f[{{eq.index}}] {% if noises_off == 'ode'%}={% else %}= X[{{eq.index}}] + {% endif %} {{ eq.eq }};{% endfor %}
+    {% filter roll(true) %}{% for eq in func.proc.system %}
+    f[{{eq.index}}] {% if noises_off == 'ode'%}={% else %}= X[{{eq.index}}] + {% endif %} {{ eq.eq }};{{ roll_unit }}{% endfor %}{% endfilter %}
 
     //TODO: drift of the diffusion
     //for(i=0; i<states_diff->length; i++){
@@ -80,8 +88,8 @@ void ssm_step_sde_{{ noises_off }}(ssm_X_t *p_X, double t, ssm_par_t *par, ssm_n
 
 
     /*compute incidence:integral between t and t+1*/
-    {% for eq in func.obs %}
-    f[states_inc->p[{{ eq.index }}]->offset] {% if noises_off == 'ode'%}={% else %}= X[states_inc->p[{{ eq.index }}]->offset] + {% endif %} {{ eq.eq }};{% endfor %}
+    {% filter roll(true) %}{% for eq in func.obs %}
+    f[states_inc->p[{{ eq.index }}]->offset] {% if noises_off == 'ode'%}={% else %}= X[states_inc->p[{{ eq.index }}]->offset] + {% endif %} {{ eq.eq }};{{ roll_unit }}{% endfor %}{% endfilter %}
 
     {% if noises_off == 'ode'%}
     return GSL_SUCCESS;
@@ -100,5 +108,101 @@ void ssm_step_sde_{{ noises_off }}(ssm_X_t *p_X, double t, ssm_par_t *par, ssm_n
 }
 {% endfor %}
 
+
+//batched stepping functions (see ssm_batch_t): one loop on the particles per term so that they can be vectorized
+
+{% for noises_off, func in step.func.items() if noises_off != 'ode' %}
+{% set n_noises = func.proc.noises|length %}
+{% set n_diff = orders.diff|length %}
+{% set n_sf = step.sf|length %}
+{% set n_r = step.caches|length %}
+{% set n_cse = func.cse|length %}
+void ssm_step_sde_{{ noises_off }}_batch(ssm_batch_t *b, double t, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc)
+{
+    int i, j;
+    int J = b->J;
+    double dt = b->dt;
+    double *restrict Xb = b->X;
+
+    ssm_it_states_t *states_sv = nav->states_sv;
+    ssm_it_states_t *states_diff = nav->states_diff;
+    ssm_it_states_t *states_inc = nav->states_inc;{% if [func, step.caches, step.sf]|uses('_cov[') %}
+    const double *_cov = ssm_covariates(calc, t);{% endif %}{% if [func, step.caches, step.sf]|uses('_pre[') %}
+    const double *_pre = ssm_precomputed(par, calc, SSM_PRE_STEP);{% endif %}{% if tt %}
+    const double *_tt = ssm_time_terms(par, calc, t);{% endif %}
+
+    {% if n_noises %}
+    double *restrict _nb = b->work;{% endif %}{% if is_diff %}
+    double *restrict diffed = b->work + {{ n_noises }}*J;{% endif %}{% if n_sf %}
+    double *restrict _sfb = b->work + {{ n_noises + n_diff }}*J;{% endif %}
+    double *restrict _rb = b->work + {{ n_noises + n_diff + n_sf }}*J;{% if n_cse %}
+    double *restrict _cb = b->work + {{ n_noises + n_diff + n_sf + n_r }}*J;{% endif %}
+    double *restrict _fb = b->work + {{ n_noises + n_diff + n_sf + n_r + n_cse }}*J;
+
+    {% if is_diff %}
+    int is_diff = ! (nav->noises_off & SSM_NO_DIFF);
+    for(i=0; i<states_diff->length; i++){
+        ssm_state_t *p = states_diff->p[i];
+        for(j=0; j<J; j++){
+            diffed[i*J+j] = (is_diff) ? p->f_inv(Xb[p->offset*J+j]) : gsl_vector_get(par, p->ic->offset);
+        }
+    }
+    {% endif %}
+
+    /* noises (drawn particle by particle) */
+    {% if n_noises %}
+    double sqrt_dt = sqrt(dt);
+    for(j=0; j<J; j++){
+        {% filter soa(func.proc.noises) %}{% for noise in func.proc.noises %}
+        {{ noise }} = sqrt_dt*gsl_ran_ugaussian(calc->randgsl);{% endfor %}{% endfilter %}
+    }
+    {% endif %}
+
+    /* caches */
+    {% filter soa %}{% filter roll(true) %}{% for sf in step.sf %}
+    for(j=0; j<J; j++) _sf[{{ loop.index0 }}] = {{ sf }};{{ roll_unit }}{% endfor %}{% endfilter %}{% endfilter %}
+
+    {% filter soa %}{% filter roll(true) %}{% for cache in step.caches %}
+    for(j=0; j<J; j++) _r[{{ loop.index0 }}] = {{ cache }};{{ roll_unit }}{% endfor %}{% endfilter %}{% endfilter %}
+
+    /* common subexpressions */
+    {% filter soa(func.proc.noises, func.cse) %}{% for x in func.cse %}
+    for(j=0; j<J; j++) {{ x.name }} = {{ x.term }};{% endfor %}{% endfilter %}
+
+    /*ODE system*/
+    {% filter soa(func.proc.noises, func.cse) %}{% filter roll(true) %}{% for eq in func.proc.system %}
+    for(j=0; j<J; j++) f[{{eq.index}}] = X[{{eq.index}}] + {{ eq.eq }};{{ roll_unit }}{% endfor %}{% endfilter %}{% endfilter %}
+
+    /*compute incidence:integral between t and t+1*/
+    {% filter soa(func.proc.noises, func.cse) %}{% filter roll(true) %}{% for eq in func.obs %}
+    for(j=0; j<J; j++) f[states_inc->p[{{ eq.index }}]->offset] = X[states_inc->p[{{ eq.index }}]->offset] + {{ eq.eq }};{{ roll_unit }}{% endfor %}{% endfilter %}{% endfilter %}
+
+    //y_pred (f) -> X (and we ensure that X is > 0.0)
+    for(i=0; i<states_sv->length; i++){
+        double *restrict x = Xb + states_sv->p[i]->offset*J;
+        const double *restrict y = _fb + states_sv->p[i]->offset*J;
+        for(j=0; j<J; j++){
+            x[j] = (y[j] < 0.0) ? 0.0 : y[j];
+        }
+    }
+
+    for(i=0; i<states_inc->length; i++){
+        double *restrict x = Xb + states_inc->p[i]->offset*J;
+        const double *restrict y = _fb + states_inc->p[i]->offset*J;
+        for(j=0; j<J; j++){
+            x[j] = (y[j] < 0.0) ? 0.0 : y[j];
+        }
+    }
+}
+{% endfor %}
+
+/**
+ * size of the scratch space (in number of particles, see ssm_batch_t) used by the batched stepping functions
+ */
+int ssm_ode_sde_batch_width(void)
+{
+    return {{ step.batch_width }};
+}
+
 {% endblock %}
 
@@ -36,6 +36,27 @@
 {% block code %}
 {% endblock %}
 
+{% if pre_block is defined %}
+/**
+ * number of parameter only subexpressions (_pre) of the block
+ * {{ pre_block }} (see ssm_precompute())
+ */
+int ssm_pre_length_{{ pre_block }}(void)
+{
+    return {{ pre_terms|length }};
+}
+
+/**
+ * compute the parameter only subexpressions of the block {{ pre_block }}
+ * for par (_pre points to the first term of the block)
+ */
+void ssm_pre_eval_{{ pre_block }}(ssm_par_t *par, double *_pre)
+{
+    {% filter roll(true) %}{% for x in pre_terms %}
+    _pre[{{ loop.index0 }}] = {{ x }};{{ roll_unit }}{% endfor %}{% endfilter %}
+}
+{% endif %}
+
 {% for x, v in orders.items() %}
 {% for o in v %}
 #undef ORDER_{{ o.name }}{% endfor %}{% endfor %}
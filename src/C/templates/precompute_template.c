@@ -0,0 +1,27 @@
+{% extends "ordered.tpl" %}
+
+{% block code %}
+
+/**
+ * number of time only subexpressions of the stepping functions
+ */
+int ssm_time_terms_length(void)
+{
+    return {{ time_terms|length }};
+}
+
+/**
+ * compute the time only subexpressions of the stepping functions
+ * (_tt) at time t (see ssm_time_terms())
+ */
+void ssm_eval_time_terms(double t, ssm_par_t *par, ssm_calc_t *calc, const double *_pre, double *_tt)
+{
+    {% if time_terms %}{% if time_terms|uses('_cov[') %}
+    const double *_cov = ssm_covariates(calc, t);{% endif %}
+
+    {% filter roll(true) %}{% for x in time_terms %}
+    _tt[{{ loop.index0 }}] = {{ x }};{{ roll_unit }}{% endfor %}{% endfilter %}
+    {% endif %}
+}
+
+{% endblock %}
@@ -17,6 +17,11 @@ void ssm_psr_new(ssm_calc_t *calc)
     calc->prob = ssm_d2_var_new({{ alloc|length }}, tab);
     calc->inc = ssm_u2_var_new({{ alloc|length }}, tab);
 
+    calc->_a_length = {{ step.reactions.reactions|length }};
+    calc->_a = ssm_d1_new(calc->_a_length);
+    calc->_a_grid = {{ 1 if step.reactions.refresh else 0 }};
+    calc->_wn = {% if white_noise %}ssm_d1_new({{ white_noise|length }}){% else %}NULL{% endif %};
+
     free(tab);
 }
 
@@ -24,13 +29,20 @@ void ssm_psr_free(ssm_calc_t *calc)
 {
     ssm_d2_free(calc->prob, {{ alloc|length }});
     ssm_u2_free(calc->inc, {{ alloc|length }});
+    free(calc->_a);
+    free(calc->_wn);
 }
 
 
+{% for name, s, use_tt in [('ssm_step_psr', step, tt), ('ssm_step_psr_leap', step.inline, False)] %}
 /**
- * stepping functions for Poisson System with stochastic rates (psr)
+ * stepping functions for Poisson System with stochastic rates (psr){% if use_tt %}
+ * on the fixed time grid shared by the particles (time only terms
+ * read from _tt, see ssm_time_terms()){% elif name == 'ssm_step_psr_leap' %}
+ * for the steps of size and time specific to a particle (time only
+ * terms computed inline, see ssm_f_prediction_psr_tau()){% endif %}
  */
-void ssm_step_psr(ssm_X_t *p_X, double t, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc)
+void {{ name }}(ssm_X_t *p_X, double t, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc)
 {
 
     double *X = p_X->proj;
@@ -39,15 +51,18 @@ void ssm_step_psr(ssm_X_t *p_X, double t, ssm_par_t *par, ssm_nav_t *nav, ssm_ca
     double sum, one_minus_exp_sum;
 
     ssm_it_states_t *states_diff = nav->states_diff;
-    ssm_it_states_t *states_inc = nav->states_inc;
+    ssm_it_states_t *states_inc = nav->states_inc;{% if [s.caches, s.sf, step.code, step.update_code, step.poisson, step_inc]|uses('_cov[') %}
+    const double *_cov = ssm_covariates(calc, t);{% endif %}{% if [s.caches, s.sf, step.code, step.update_code, step.poisson, step_inc, white_noise]|uses('_pre[') %}
+    const double *_pre = ssm_precomputed(par, calc, SSM_PRE_STEP);{% endif %}{% if use_tt %}
+    const double *_tt = ssm_time_terms(par, calc, t);{% endif %}
 
     /*0-declaration of noise terms (if any)*/
     {% for n in white_noise %}
     double {{ n.name }};{% endfor %}
 
-    double _r[{{ step.caches|length }}];
-    {% if step.sf %}
-    double _sf[{{ step.sf|length }}];{% endif %}
+    double _r[{{ s.caches|length }}];
+    {% if s.sf %}
+    double _sf[{{ s.sf|length }}];{% endif %}
 
     {% if is_diff %}
     int i;
@@ -72,34 +87,241 @@ void ssm_step_psr(ssm_X_t *p_X, double t, ssm_par_t *par, ssm_nav_t *nav, ssm_ca
         {{ n.name }} = 1.0;{% endfor %}
     } else {
         {% for n in white_noise %}
-        {{ n.name }} = gsl_ran_gamma(calc->randgsl, (dt)/ pow(gsl_vector_get(par, ORDER_{{ n.sd }}), 2), pow(gsl_vector_get(par, ORDER_{{ n.sd }}), 2))/dt;{% endfor %}
+        {{ n.name }} = gsl_ran_gamma(calc->randgsl, (dt)/ {{ n.var }}, {{ n.var }})/dt;{% endfor %}
     }
     {% endif %}
 
     /*2-generate process increments (automaticaly generated code)*/
-    {% for sf in step.sf %}
-    _sf[{{ loop.index0 }}] = {{ sf }};{% endfor %}
+    {% filter roll(true) %}{% for sf in s.sf %}
+    _sf[{{ loop.index0 }}] = {{ sf }};{{ roll_unit }}{% endfor %}{% endfilter %}
 
-    {% for cache in step.caches %}
-    _r[{{ loop.index0 }}] = {{ cache }};{% endfor %}
+    {% filter roll(true) %}{% for cache in s.caches %}
+    _r[{{ loop.index0 }}] = {{ cache }};{{ roll_unit }}{% endfor %}{% endfilter %}
 
-    {{ step.code }}
+    {{ step.code|roll }}
 
     /*3-multinomial drawn (automaticaly generated code)*/
-    {% for draw in psr_multinomial %}
-    ssm_ran_multinomial(calc->randgsl, {{ draw.nb_exit }}, (unsigned int) X[ORDER_{{ draw.state }}], calc->prob[ORDER_{{ draw.state }}], calc->inc[ORDER_{{ draw.state }}]);{% endfor %}
+    {% filter roll %}{% for draw in psr_multinomial %}
+    ssm_ran_multinomial(calc->randgsl, {{ draw.nb_exit }}, (unsigned int) X[ORDER_{{ draw.state }}], calc->prob[ORDER_{{ draw.state }}], calc->inc[ORDER_{{ draw.state }}]);{{ roll_unit }}{% endfor %}{% endfilter %}
 
     /*4-update state variables (automaticaly generated code)*/
     //use inc to cache the Poisson draw as thew might be re-used for the incidence computation
-    {% for draw in step.poisson %}
-    {{ draw }};{% endfor %}
+    {% filter roll %}{% for draw in step.poisson %}
+    {{ draw }};{{ roll_unit }}{% endfor %}{% endfilter %}
 
-    {{ step.update_code }}
+    {{ step.update_code|roll }}
 
     /*compute incidence:integral between t and t+1 (automaticaly generated code)*/
 
-    {% for eq in step_inc %}
-    X[states_inc->p[{{ eq.index }}]->offset] += {{ eq.right_hand_side }};{% endfor %}
+    {% filter roll(true) %}{% for eq in step_inc %}
+    X[states_inc->p[{{ eq.index }}]->offset] += {{ eq.right_hand_side }};{{ roll_unit }}{% endfor %}{% endfilter %}
+}
+{% endfor %}
+
+{% set n_noises = white_noise|length %}
+{% set n_diff = orders.diff|length %}
+{% set n_sf = step.sf|length %}
+/**
+ * batched version of ssm_step_psr() (see ssm_batch_t): the rates are
+ * computed with one loop on the particles per term (so that they can
+ * be vectorized), the multinomial draws are made particle by particle
+ */
+void ssm_step_psr_batch(ssm_batch_t *b, double t, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc)
+{
+    int j;
+    int J = b->J;
+    double dt = b->dt;
+    double *restrict Xb = b->X;
+
+    double sum, one_minus_exp_sum;
+
+    ssm_it_states_t *states_diff = nav->states_diff;
+    ssm_it_states_t *states_inc = nav->states_inc;{% if [step.caches, step.sf, step.code, step.update_code, step.poisson, step_inc]|uses('_cov[') %}
+    const double *_cov = ssm_covariates(calc, t);{% endif %}{% if [step.caches, step.sf, step.code, step.update_code, step.poisson, step_inc, white_noise]|uses('_pre[') %}
+    const double *_pre = ssm_precomputed(par, calc, SSM_PRE_STEP);{% endif %}{% if tt %}
+    const double *_tt = ssm_time_terms(par, calc, t);{% endif %}
+
+    {% if n_noises %}
+    double *restrict _nb = b->work;{% endif %}{% if is_diff %}
+    double *restrict diffed = b->work + {{ n_noises }}*J;{% endif %}{% if n_sf %}
+    double *restrict _sfb = b->work + {{ n_noises + n_diff }}*J;{% endif %}
+    double *restrict _rb = b->work + {{ n_noises + n_diff + n_sf }}*J;
+
+    {% if is_diff %}
+    int i;
+    int is_diff = ! (nav->noises_off & SSM_NO_DIFF);
+    for(i=0; i<states_diff->length; i++){
+        ssm_state_t *p = states_diff->p[i];
+        for(j=0; j<J; j++){
+            diffed[i*J+j] = (is_diff) ? p->f_inv(Xb[p->offset*J+j]) : gsl_vector_get(par, p->ic->offset);
+        }
+    }
+    {% endif %}
+
+    /*1-generate noise increments (if any) (automaticaly generated code)*/
+    {% if white_noise %}
+    {% filter soa(white_noise) %}
+    for(j=0; j<J; j++){
+        if(nav->noises_off & SSM_NO_WHITE_NOISE){
+            {% for n in white_noise %}
+            {{ n.name }} = 1.0;{% endfor %}
+        } else {
+            {% for n in white_noise %}
+            {{ n.name }} = gsl_ran_gamma(calc->randgsl, (dt)/ {{ n.var }}, {{ n.var }})/dt;{% endfor %}
+        }
+    }
+    {% endfilter %}
+    {% endif %}
+
+    /*2-generate process increments (automaticaly generated code)*/
+    {% filter soa(white_noise) %}{% filter roll(true) %}{% for sf in step.sf %}
+    for(j=0; j<J; j++) _sf[{{ loop.index0 }}] = {{ sf }};{{ roll_unit }}{% endfor %}{% endfilter %}{% endfilter %}
+
+    {% filter soa(white_noise) %}{% filter roll(true) %}{% for cache in step.caches %}
+    for(j=0; j<J; j++) _r[{{ loop.index0 }}] = {{ cache }};{{ roll_unit }}{% endfor %}{% endfilter %}{% endfilter %}
+
+    for(j=0; j<J; j++){
+        {% filter soa(white_noise) %}
+        {{ step.code|roll }}
+
+        /*3-multinomial drawn (automaticaly generated code)*/
+        {% filter roll %}{% for draw in psr_multinomial %}
+        ssm_ran_multinomial(calc->randgsl, {{ draw.nb_exit }}, (unsigned int) X[ORDER_{{ draw.state }}], calc->prob[ORDER_{{ draw.state }}], calc->inc[ORDER_{{ draw.state }}]);{{ roll_unit }}{% endfor %}{% endfilter %}
+
+        /*4-update state variables (automaticaly generated code)*/
+        {% filter roll %}{% for draw in step.poisson %}
+        {{ draw }};{{ roll_unit }}{% endfor %}{% endfilter %}
+
+        {{ step.update_code|roll }}
+
+        /*compute incidence:integral between t and t+1 (automaticaly generated code)*/
+        {% filter roll(true) %}{% for eq in step_inc %}
+        X[states_inc->p[{{ eq.index }}]->offset] += {{ eq.right_hand_side }};{{ roll_unit }}{% endfor %}{% endfilter %}
+        {% endfilter %}
+    }
+}
+
+/**
+ * size of the scratch space (in number of particles, see ssm_batch_t) used by ssm_step_psr_batch()
+ */
+int ssm_psr_batch_width(void)
+{
+    return {{ n_noises + n_diff + n_sf + step.caches|length }};
+}
+
+
+/**
+ * white noises (if any) of the reactions for a time step of size dt
+ * (in calc->_wn, drawn as in ssm_step_psr()) for the propensities of
+ * the adaptive steps (ssm_f_prediction_psr_tau(),
+ * ssm_f_prediction_nrm()): they are redrawn on the dt0 time grid
+ */
+void ssm_psr_white_noises(double dt, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc)
+{
+    {% if white_noise %}
+    double *_wn = calc->_wn;{% if white_noise|uses('_pre[') %}
+    const double *_pre = ssm_precomputed(par, calc, SSM_PRE_STEP);{% endif %}
+
+    if(nav->noises_off & SSM_NO_WHITE_NOISE){
+        {% for n in white_noise %}
+        _wn[{{ loop.index0 }}] = 1.0;{% endfor %}
+    } else {
+        {% for n in white_noise %}
+        _wn[{{ loop.index0 }}] = gsl_ran_gamma(calc->randgsl, (dt)/ {{ n.var }}, {{ n.var }})/dt;{% endfor %}
+    }
+    {% endif %}
+}
+
+
+/**
+ * propensities of the reactions (in calc->_a) for the adaptive steps
+ * of ssm_f_prediction_psr_tau(): rates not corrected, white noises (if
+ * any) drawn by ssm_psr_white_noises(). Return their sum.
+ */
+double ssm_psr_propensities(ssm_X_t *p_X, double t, ssm_par_t *par, ssm_nav_t *nav, ssm_calc_t *calc)
+{
+    int k;
+    double *X = p_X->proj;
+    double *a = calc->_a;
+    double a0 = 0.0;{% if step.reactions.reactions|uses('_cov[') %}
+    const double *_cov = ssm_covariates(calc, t);{% endif %}
+
+    {% if is_diff %}
+    int i;
+    ssm_it_states_t *states_diff = nav->states_diff;
+    double diffed[states_diff->length];
+    int is_diff = ! (nav->noises_off & SSM_NO_DIFF);
+
+    for(i=0; i<states_diff->length; i++){
+        ssm_state_t *p = states_diff->p[i];
+        if(is_diff){
+            diffed[i] = p->f_inv(X[p->offset]);
+        } else {
+            diffed[i] = gsl_vector_get(par, p->ic->offset);
+        }
+    }
+    {% endif %}
+
+    /*automaticaly generated code*/
+    {% for r in step.reactions.reactions %}
+    a[{{ loop.index0 }}] = {% if r.noise is not none %}({{ r.rate }})*calc->_wn[{{ r.noise }}]{% else %}{{ r.rate }}{% endif %};{% endfor %}
+
+    for(k=0; k<calc->_a_length; k++){
+        a0 += a[k];
+    }
+
+    return a0;
+}
+
+
+/**
+ * largest leap keeping the expected change and the standard deviation
+ * of the change of every state variable below max(eps*X, 1) (Cao,
+ * Gillespie and Petzold, 2006) given the propensities computed by
+ * ssm_psr_propensities()
+ */
+double ssm_psr_tau(ssm_X_t *p_X, double eps, ssm_calc_t *calc)
+{
+    double *X = p_X->proj;
+    double *a = calc->_a;
+    double mu, sigma2, bound;
+    double tau = GSL_POSINF;
+
+    /*automaticaly generated code*/
+    {% for x in step.reactions.tau %}
+    mu = {{ x.mu }};
+    sigma2 = {{ x.sigma2 }};
+    bound = GSL_MAX(eps*X[ORDER_{{ x.state }}], 1.0);
+    if(mu != 0.0){
+        tau = GSL_MIN(tau, bound/fabs(mu));
+    }
+    if(sigma2 > 0.0){
+        tau = GSL_MIN(tau, bound*bound/sigma2);
+    }
+    {% endfor %}
+
+    return tau;
+}
+
+
+/**
+ * fire the reaction k once (exact steps of ssm_f_prediction_psr_tau()
+ * and ssm_f_prediction_nrm())
+ */
+void ssm_psr_fire(ssm_X_t *p_X, int k, ssm_nav_t *nav)
+{
+    double *X = p_X->proj;
+    ssm_it_states_t *states_inc = nav->states_inc;
+
+    /*automaticaly generated code*/
+    switch(k){
+    {% for r in step.reactions.reactions %}
+    case {{ loop.index0 }}:{% for u in r.updates %}
+        {{ u }};{% endfor %}{% for i in r.inc %}
+        X[states_inc->p[{{ i }}]->offset] += 1.0;{% endfor %}
+        break;
+    {% endfor %}
+    }
 }
 
 {% endblock %}
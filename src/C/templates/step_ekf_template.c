@@ -13,13 +13,14 @@ int ssm_step_ekf(double t, const double X[], double f[], void *params)
 
     ssm_calc_t *calc = (ssm_calc_t *) params;
     ssm_nav_t *nav = calc->_nav;
-    ssm_par_t *par = calc->_par;
+    ssm_par_t *par = calc->_par;{% if [step.func.ode, step.caches, step.sf]|uses('_cov[') %}
+    const double *_cov = ssm_covariates(calc, t);{% endif %}{% if [step.func.ode, step.caches, step.sf]|uses('_pre[') %}
+    const double *_pre = ssm_precomputed(par, calc, SSM_PRE_STEP_EKF);{% endif %}
 
     ssm_it_states_t *states_diff = nav->states_diff;
     ssm_it_states_t *states_inc = nav->states_inc;
     int m = nav->states_sv->length + nav->states_inc->length + nav->states_diff->length;
 
-    gsl_matrix *Ft = calc->_Ft;
     gsl_matrix *Q = calc->_Q;
     gsl_matrix *FtCt =calc->_FtCt;
 
@@ -53,17 +54,20 @@ int ssm_step_ekf(double t, const double X[], double f[], void *params)
     {% endif %}
 
     /* caches */
-    {% for sf in step.sf %}
-    _sf[{{ loop.index0 }}] = {{ sf }};{% endfor %}
+    {% filter roll(true) %}{% for sf in step.sf %}
+    _sf[{{ loop.index0 }}] = {{ sf }};{{ roll_unit }}{% endfor %}{% endfilter %}
 
-    {% for cache in step.caches %}
-    _r[{{ loop.index0 }}] = {{ cache }};{% endfor %}
+    {% filter roll(true) %}{% for cache in step.caches %}
+    _r[{{ loop.index0 }}] = {{ cache }};{{ roll_unit }}{% endfor %}{% endfilter %}
 
 
-    /*ODE system*/
+    /* common subexpressions */
+    {% for x in step.func.ode.cse %}
+    const double {{ x.name }} = {{ x.term }};{% endfor %}
 
-    {% for eq in step.func.ode.proc.system %}
-    f[{{eq.index}}] = {{ eq.eq }};{% endfor %}
+    /*ODE system*/
+    {% filter roll(true) %}{% for eq in step.func.ode.proc.system %}
+    f[{{eq.index}}] = {{ eq.eq }};{{ roll_unit }}{% endfor %}{% endfilter %}
 
 
     //TODO: drift of the diffusion
@@ -73,8 +77,8 @@ int ssm_step_ekf(double t, const double X[], double f[], void *params)
 
 
     /*compute incidence:integral between t and t+1*/
-    {% for eq in step.func.ode.obs %}
-    f[states_inc->p[{{ eq.index }}]->offset] = {{ eq.eq }};{% endfor %}
+    {% filter roll(true) %}{% for eq in step.func.ode.obs %}
+    f[states_inc->p[{{ eq.index }}]->offset] = {{ eq.eq }};{{ roll_unit }}{% endfor %}{% endfilter %}
 
     ////////////////
     // covariance //
@@ -87,14 +91,15 @@ int ssm_step_ekf(double t, const double X[], double f[], void *params)
 
     // compute Ft*Ct+Ct*Ft'+Q
     //here Ct is symmetrical and transpose(FtCt) == transpose(Ct)transpose(Ft) == Ct transpose(Ft)
-    gsl_blas_dgemm (CblasNoTrans, CblasNoTrans, 1.0, Ft, &Ct.matrix, 0.0, FtCt);
-    for(i=0; i< ff.matrix.size1; i++){
-        for(c=0; c< ff.matrix.size2; c++){
-            gsl_matrix_set(&ff.matrix,
-                           i,
-                           c,
-                           gsl_matrix_get(FtCt, i, c) + gsl_matrix_get(FtCt, c, i) + gsl_matrix_get(Q, i, c));
+    //Ft is sparse (only its non zero terms are stored by ssm_eval_jac)
+    ssm_jac_mul(calc, &Ct.matrix, FtCt);
 
+    //the result is symmetrical (as Q): we only compute the lower triangle
+    for(i=0; i< ff.matrix.size1; i++){
+        for(c=0; c<= i; c++){
+            double term = gsl_matrix_get(FtCt, i, c) + gsl_matrix_get(FtCt, c, i) + gsl_matrix_get(Q, i, c);
+            gsl_matrix_set(&ff.matrix, i, c, term);
+            gsl_matrix_set(&ff.matrix, c, i, term);
         }
     }
 
@@ -85,7 +85,8 @@ static double f_user2par_tpl_{{ p.name }}(double x, ssm_input_t *par, ssm_calc_t
 {% if 'f_2prior' in p %}
 static double f_2prior_tpl_{{ p.name }}(double x, ssm_hat_t *hat, ssm_par_t *par, ssm_calc_t *calc, double t)
 {
-    double *X = hat->states;
+    double *X = hat->states;{% if p.f_2prior|uses('_cov[') %}
+    const double *_cov = ssm_covariates(calc, t);{% endif %}
     double res = {{ p.f_2prior }};
 
     //sanitize
@@ -107,7 +108,8 @@ static double f_2prior_tpl_{{ p.name }}(double x, ssm_hat_t *hat, ssm_par_t *par
 {% for rem, def in f_remainders.items() %}
 static double f_remainder_tpl_{{ rem }}(ssm_X_t *p_X, ssm_par_t *par, ssm_calc_t *calc, double t)
 {
-    double *X = p_X->proj;
+    double *X = p_X->proj;{% if def|uses('_cov[') %}
+    const double *_cov = ssm_covariates(calc, t);{% endif %}
     return {{ def }};
 }
 {% endfor %}
@@ -115,7 +117,8 @@ static double f_remainder_tpl_{{ rem }}(ssm_X_t *p_X, ssm_par_t *par, ssm_calc_t
 {% for rem, var in f_remainders_var.items() %}
 static double f_remainder_var_tpl_{{ rem }}(ssm_X_t *p_X, ssm_calc_t *calc, ssm_nav_t *nav, double t)
 {
-    double *X = p_X->proj;
+    double *X = p_X->proj;{% if var|uses('_cov[') %}
+    const double *_cov = ssm_covariates(calc, t);{% endif %}
     int m = nav->states_sv_inc->length + nav->states_diff->length;
     gsl_matrix_const_view Ct = gsl_matrix_const_view_array(&X[m], m, m);
     return {{ var }};
@@ -84,7 +84,7 @@ int main(int argc, char *argv[])
 	    ssm_X_reset_inc(X, data->rows[n], nav);
 	    fitness->cum_status[0] |= (*f_pred)(X, t0, t1, par, nav, calc);
 	    if((opts->worker_algo != SSM_SIMUL) && data->rows[n]->ts_nonan_length) {
-		fitness->weights[0] = (fitness->cum_status[0] == SSM_SUCCESS) ?  exp(ssm_log_likelihood(data->rows[n], X, par, calc, nav, fitness)) : 0.0;
+		fitness->weights[0] = (fitness->cum_status[0] == SSM_SUCCESS) ?  ssm_log_likelihood(data->rows[n], X, par, calc, nav, fitness) : GSL_NEGINF;
 		fitness->cum_status[0] = SSM_SUCCESS;
 	    }
 
@@ -17,7 +17,8 @@
 #########################################################################
 
 import copy
-from Cmodel import Cmodel
+import re
+from Cmodel import Cmodel, parse_user_input, reaction_key, index_key
 
 class SsmError(Exception):
     def __init__(self, value):
@@ -25,18 +26,578 @@ class SsmError(Exception):
     def __str__(self):
         return repr(self.value)
 
+##########################################################################
+# C expressions as trees (used by Ccoder.cse)
+#
+# nodes are tuples: ('num', text), ('id', name), ('idx', base, index),
+# ('arrow', base, name), ('call', f, args), ('neg', x), ('pos', x) and
+# ('bin', op, lhs, rhs)
+##########################################################################
+
+C_TOKEN = re.compile(r'\s*(?:(\d+\.?\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?)|([A-Za-z_]\w*)|(->|[-+*/(),\[\]]))')
+
+##calls that are plain accessors (not worth a temporary)
+C_ACCESSORS = set(['gsl_vector_get', 'gsl_matrix_get'])
+
+def C_tokenize(term):
+    tokens = []
+    pos = 0
+    term = term.rstrip()
+    while pos < len(term):
+        m = C_TOKEN.match(term, pos)
+        if not m:
+            raise SsmError('can not tokenize C expression ' + term)
+        tokens.append(m.group(1) or m.group(2) or m.group(3))
+        pos = m.end()
+
+    return tokens
+
+def C_parse(term):
+    """parse a C expression (arithmetic, calls, [] and ->) into a tree"""
+
+    tokens = C_tokenize(term)
+    pos = [0]
+
+    def peek():
+        return tokens[pos[0]] if pos[0] < len(tokens) else None
+
+    def take(expected=None):
+        t = peek()
+        if t is None or (expected and t != expected):
+            raise SsmError('can not parse C expression ' + term)
+        pos[0] += 1
+        return t
+
+    def expr():
+        node = product()
+        while peek() in ('+', '-'):
+            op = take()
+            node = ('bin', op, node, product())
+        return node
+
+    def product():
+        node = unary()
+        while peek() in ('*', '/'):
+            op = take()
+            node = ('bin', op, node, unary())
+        return node
+
+    def unary():
+        if peek() == '-':
+            take()
+            return ('neg', unary())
+        if peek() == '+':
+            take()
+            return ('pos', unary())
+        return postfix()
+
+    def postfix():
+        t = take()
+        if t == '(':
+            node = expr()
+            take(')')
+        elif t[0].isdigit() or t[0] == '.':
+            return ('num', t)
+        elif t[0].isalpha() or t[0] == '_':
+            node = ('id', t)
+        else:
+            raise SsmError('can not parse C expression ' + term)
+
+        while peek() in ('(', '[', '->'):
+            t = take()
+            if t == '(':
+                args = []
+                if peek() != ')':
+                    args.append(expr())
+                    while peek() == ',':
+                        take()
+                        args.append(expr())
+                take(')')
+                node = ('call', node, tuple(args))
+            elif t == '[':
+                node = ('idx', node, expr())
+                take(']')
+            else:
+                node = ('arrow', node, take())
+
+        return node
+
+    node = expr()
+    if peek() is not None:
+        raise SsmError('can not parse C expression ' + term)
+
+    return node
+
+def C_is_atom(node):
+    return node[0] in ('num', 'id', 'idx', 'arrow') or (node[0] == 'call' and node[1] == ('id', node[1][1]) and node[1][1] in C_ACCESSORS)
+
+def C_children(node):
+    if node[0] == 'bin':
+        return [node[2], node[3]]
+    elif node[0] in ('neg', 'pos'):
+        return [node[1]]
+    elif node[0] == 'call':
+        return [node[1]] + list(node[2])
+    elif node[0] == 'idx':
+        return [node[1], node[2]]
+    elif node[0] == 'arrow':
+        return [node[1]]
+    return []
+
+def C_key(node):
+    """key identifying a tree up to the order of the operands of
+    + and * (commutative, also in floating point)"""
+
+    if node[0] == 'bin':
+        lhs, rhs = C_key(node[2]), C_key(node[3])
+        if node[1] in ('+', '*'):
+            lhs, rhs = sorted([lhs, rhs])
+        return ('bin', node[1], lhs, rhs)
+    elif node[0] in ('neg', 'pos'):
+        return (node[0], C_key(node[1]))
+    elif node[0] == 'call':
+        return ('call', node[1], tuple(C_key(x) for x in node[2]))
+    return node
+
+def C_count_ops(node):
+    n = 0 if C_is_atom(node) else 1
+    if node[0] in ('bin', 'neg', 'pos', 'call'):
+        n += sum(C_count_ops(x) for x in C_children(node))
+    return n
+
+def C_print(node):
+    """print a tree back to C, keeping its evaluation order"""
+
+    prec = lambda x: (1 if x[1] in ('+', '-') else 2) if x[0] == 'bin' else (3 if x[0] in ('neg', 'pos') else 4)
+
+    if node[0] in ('num', 'id'):
+        return node[1]
+    elif node[0] == 'idx':
+        return '{0}[{1}]'.format(C_print(node[1]), C_print(node[2]))
+    elif node[0] == 'arrow':
+        return '{0}->{1}'.format(C_print(node[1]), node[2])
+    elif node[0] == 'call':
+        return '{0}({1})'.format(C_print(node[1]), ','.join(C_print(x) for x in node[2]))
+    elif node[0] in ('neg', 'pos'):
+        x = C_print(node[1])
+        return ('-' if node[0] == 'neg' else '+') + ('({0})'.format(x) if prec(node[1]) < 4 else x)
+    else:
+        p = prec(node)
+        lhs = C_print(node[2])
+        rhs = C_print(node[3])
+        if prec(node[2]) < p:
+            lhs = '(' + lhs + ')'
+        if prec(node[3]) <= p or rhs[0] in ('-', '+'):
+            rhs = '(' + rhs + ')'
+        return lhs + node[1] + rhs
+
+
+##what a C expression depends on (see C_depends), in increasing order:
+##constants, parameters only, time (or covariates) and state (anything
+##changing within a time step or from one particle to another)
+C_CONST, C_PAR, C_TIME, C_STATE = range(4)
+
+C_CONSTANTS = set(['E', 'LN2', 'LN10', 'LOG2E', 'LOG10E', 'PI', 'SQRT1_2', 'SQRT2'])
+
+##functions whose value only depends on the value of their arguments
+C_PURE = set(['heaviside', 'ramp', 'slowstep', 'sigmoid', 'sin', 'cos', 'tan', 'sqrt', 'pow', 'exp', 'log', 'fabs'])
+
+def C_depends(node):
+    """dependency class of a tree (C_CONST, C_PAR, C_TIME or C_STATE)"""
+
+    if node[0] == 'num':
+        return C_CONST
+    elif node[0] == 'id':
+        if node[1] == 't':
+            return C_TIME
+        return C_CONST if node[1] in C_CONSTANTS or node[1].startswith('M_') else C_STATE
+    elif node[0] == 'idx':
+        if node[1] in (('id', '_cov'), ('id', '_tt')):
+            return C_TIME
+        return C_PAR if node[1] == ('id', '_pre') else C_STATE
+    elif node[0] == 'call':
+        if node[1] == ('id', 'gsl_vector_get') and node[2] and node[2][0] == ('id', 'par'):
+            return C_PAR
+        if node[1][0] == 'id' and node[1][1] in C_PURE:
+            return max([C_CONST] + [C_depends(x) for x in node[2]])
+        return C_STATE
+    elif node[0] in ('bin', 'neg', 'pos'):
+        return max(C_depends(x) for x in C_children(node))
+
+    return C_STATE
+
+def C_states(node):
+    """names of the state variables (X[ORDER_<name>]) a tree uses"""
+
+    if node[0] == 'idx' and node[1] == ('id', 'X') and node[2][0] == 'id' and node[2][1].startswith('ORDER_'):
+        return set([node[2][1][len('ORDER_'):]])
+
+    return set().union(*[C_states(x) for x in C_children(node)])
+
+def C_is_stationary(node):
+    """True if a tree only changes with the state variables X (and
+    not with the time, the covariates or the diffusions)"""
+
+    if node[0] == 'id':
+        return node[1] != 't'
+    elif node[0] == 'idx':
+        return node[1] in (('id', 'X'), ('id', '_pre'))
+    elif node[0] == 'call':
+        if node[1] == ('id', 'gsl_vector_get') and node[2] and node[2][0] == ('id', 'par'):
+            return True
+        return node[1][0] == 'id' and node[1][1] in C_PURE and all(C_is_stationary(x) for x in node[2])
+    elif node[0] in ('bin', 'neg', 'pos'):
+        return all(C_is_stationary(x) for x in C_children(node))
+
+    return node[0] == 'num'
+
+
+##loop rolling (models with indexed families, see
+##Cmodel.expand_indices): templates mark the end of every unit of
+##code (e.g one equation) with ROLL_UNIT and runs of units that only
+##differ by integer literals and ORDER_ identifiers varying with a
+##constant stride are turned into C loops
+ROLL_UNIT = '\x1e'
+C_UNIT_TOKEN = re.compile(r'([A-Za-z_]\w*)|(\d+\.\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?|\d+[eE][-+]?\d+)|(\d+)')
+
+def C_skeleton(unit, orders):
+    """
+    split unit into its skeleton (the text around its integer
+    literals and ORDER_ identifiers, and their kind) and the values
+    (ORDER_ identifiers are valued with their order) and text of them
+    """
+
+    parts = []
+    kinds = []
+    values = []
+    names = []
+    last = 0
+    for m in C_UNIT_TOKEN.finditer(unit):
+        ident, flt, integer = m.groups()
+        if ident and ident.startswith('ORDER_') and ident[6:] in orders:
+            kinds.append('o')
+            values.append(orders[ident[6:]])
+        elif integer:
+            kinds.append('i')
+            values.append(int(integer))
+        else:
+            continue
+
+        parts.append(unit[last:m.start()])
+        names.append(m.group(0))
+        last = m.end()
+
+    parts.append(unit[last:])
+
+    return (tuple(parts), tuple(kinds)), values, names
+
+def C_roll(units, orders, reorder=False):
+    """
+    roll the runs of units (list of pieces of C code) into C loops (on
+    _k). orders maps the names of the ORDER_ identifiers to their
+    values. If reorder is True, the units are independent and can be
+    grouped by skeleton (keeping their relative order) first.
+    """
+
+    parsed = [C_skeleton(x, orders) for x in units]
+    ind = range(len(units))
+    if reorder:
+        first = {}
+        for i, x in enumerate(parsed):
+            first.setdefault(x[0], i)
+        ind.sort(key=lambda i: first[parsed[i][0]])
+
+    def shifted(v, d, k):
+        return [a + k*b for a, b in zip(v, d)]
+
+    def index(name, d):
+        if d == 1:
+            return '({0}+_k)'.format(name)
+        elif d == -1:
+            return '({0}-_k)'.format(name)
+        return '({0}{1:+d}*_k)'.format(name, d)
+
+    out = []
+    s = 0
+    while s < len(ind):
+        sk, v0, names = parsed[ind[s]]
+        e = s + 1
+        d = []
+        if e < len(ind) and parsed[ind[e]][0] == sk:
+            d = [b - a for a, b in zip(v0, parsed[ind[e]][1])]
+            if any(d):
+                while e < len(ind) and parsed[ind[e]][0] == sk and parsed[ind[e]][1] == shifted(v0, d, e-s):
+                    e += 1
+
+        if e - s >= 2 and any(d):
+            parts = sk[0]
+            body = parts[0]
+            for j, (name, x) in enumerate(zip(names, d)):
+                body += (index(name, x) if x else name) + parts[j+1]
+
+            loop = '{{int _k; for(_k=0; _k<{0}; _k++){{'.format(e-s)
+            if body.startswith('\n'):
+                indent = re.match(r'\n*([ \t]*)', body).group(1)
+                out.append('\n' + indent + loop + body + '\n' + indent + '}}')
+            else:
+                out.append(loop + '\n' + body + '}}\n')
+        else:
+            e = s + 1
+            out.append(units[ind[s]])
+
+        s = e
+
+    return ''.join(out)
+
+
+##batched kernels (see ssm_batch_t): the J particles of a block are
+##stored as structure of arrays, element k of particle j being
+##block[k*J+j]
+C_IDENT = re.compile(r'[A-Za-z_]\w*')
+C_SIMPLE_INDEX = re.compile(r'^(?:\w|->|\[|\])+$')
+
+##per particle arrays of the generated code and their block
+SOA_ARRAYS = {'X': 'Xb', 'f': '_fb', '_r': '_rb', '_sf': '_sfb', 'diffed': 'diffed', '_w': '_wb'}
+
+def C_soa(code, blocks, J='J', j='j'):
+    """
+    rewrite code written for one particle for the batched kernels.
+    blocks maps identifiers to their block: either the name of the
+    block (arrays: name[k] becomes block[k*J+j]) or a tuple (block, k)
+    (scalars, e.g the noises: name becomes block[k*J+j]). Members
+    (p->name, x.name) are left unchanged.
+    """
+
+    def element(block, k):
+        if not C_SIMPLE_INDEX.match(k) and not (k.startswith('(') and k.endswith(')') and C_brackets(k, 0) == len(k) - 1):
+            k = '({0})'.format(k)
+        return '{0}[{1}*{2}+{3}]'.format(block, k, J, j)
+
+    out = []
+    i = 0
+    while i < len(code):
+        m = C_IDENT.match(code, i)
+        if m is None or (i and (code[i-1].isalnum() or code[i-1] in '_.')):
+            out.append(code[i])
+            i += 1
+            continue
+
+        name = m.group(0)
+        i = m.end()
+        if name not in blocks or code[max(0, m.start()-2):m.start()] == '->':
+            out.append(name)
+        elif isinstance(blocks[name], tuple):
+            out.append(element(blocks[name][0], str(blocks[name][1])))
+        elif code[i:i+1] == '[':
+            end = C_brackets(code, i)
+            out.append(element(blocks[name], C_soa(code[i+1:end], blocks, J, j)))
+            i = end + 1
+        else:
+            out.append(name)
+
+    return ''.join(out)
+
+def C_brackets(code, start):
+    """index of the bracket closing the one opened at code[start]"""
+
+    depth = 0
+    for i in range(start, len(code)):
+        if code[i] in '([':
+            depth += 1
+        elif code[i] in ')]':
+            depth -= 1
+            if depth == 0:
+                return i
+
+    raise SsmError('unbalanced brackets in {0}'.format(code))
+
+
+class Polynomial(dict):
+    """
+    Sum of products of symbolic factors (user expressions such as
+    reaction rates) with numeric coefficients, stored as
+    {sorted tuple of factors: coefficient}. Sums and products work on
+    these records so that equal products are collected and cancelling
+    ones dropped before anything is converted to C.
+    """
+
+    @classmethod
+    def cast(cls, x):
+        if isinstance(x, cls):
+            return x
+        elif isinstance(x, (int, long, float)):
+            return cls({(): x} if x else {})
+        else:
+            return cls({(x,): 1})
+
+    def add(self, monomial, coef):
+        coef += self.get(monomial, 0)
+        if coef:
+            self[monomial] = coef
+        else:
+            self.pop(monomial, None)
+
+    def __add__(self, other):
+        res = Polynomial(self)
+        for m, c in Polynomial.cast(other).iteritems():
+            res.add(m, c)
+        return res
+
+    __radd__ = __add__
+
+    def __neg__(self):
+        return Polynomial((m, -c) for m, c in self.iteritems())
+
+    def __sub__(self, other):
+        return self + -Polynomial.cast(other)
+
+    def __rsub__(self, other):
+        return -self + other
+
+    def __mul__(self, other):
+        res = Polynomial()
+        for m, c in self.iteritems():
+            for n, d in Polynomial.cast(other).iteritems():
+                res.add(tuple(sorted(m + n)), c * d)
+        return res
+
+    __rmul__ = __mul__
+
+    def factors(self):
+        return set(f for m in self for f in m)
+
+    def format(self, factor=lambda x: '({0})'.format(x)):
+        """print the sum, each factor being printed by factor"""
+
+        res = ''
+        for m in sorted(self):
+            c = self[m]
+            term = [factor(x) for x in m]
+            if abs(c) != 1 or not term:
+                term.insert(0, str(abs(c)))
+            if res:
+                res += ' - ' if c < 0 else ' + '
+            elif c < 0:
+                res = '-'
+            res += '*'.join(term)
+
+        return res or '0'
+
+    def __str__(self):
+        return self.format()
+
+
+class SparseMatrix:
+    """
+    Sparse matrix of symbolic terms (see Polynomial). Only the
+    structurally non zero terms are stored (one dict per row) so that
+    products only visit pairs of non zero terms: building a product
+    costs O(nnz) instead of O(n**3).
+
+    symmetric is set for products known to be symmetrical
+    (e.g. L Q L') so that only their lower triangle needs to be
+    converted to C.
+    """
+
+    def __init__(self, n_rows, n_cols, symmetric=False):
+        self.n_rows = n_rows
+        self.n_cols = n_cols
+        self.symmetric = symmetric
+        self.rows = [{} for i in range(n_rows)]
+
+    @classmethod
+    def from_list(cls, A):
+        res = cls(len(A), len(A[0]) if A else 0)
+        for i, row in enumerate(A):
+            for j, x in enumerate(row):
+                res[i, j] = x
+        return res
+
+    def __getitem__(self, ij):
+        return self.rows[ij[0]].get(ij[1], 0)
+
+    def __setitem__(self, ij, term):
+        i, j = ij
+        term = Polynomial.cast(term)
+        if term:
+            self.rows[i][j] = term
+        else:
+            self.rows[i].pop(j, None)
+
+    def nnz(self):
+        return sum(len(row) for row in self.rows)
+
+    def items(self, lower=False):
+        """non zero terms (i, j, term) in row major order"""
+
+        for i, row in enumerate(self.rows):
+            for j in sorted(row):
+                if lower and j > i:
+                    break
+                yield i, j, row[j]
+
+    def transpose(self):
+        res = SparseMatrix(self.n_cols, self.n_rows, self.symmetric)
+        for i, j, x in self.items():
+            res.rows[j][i] = x
+        return res
+
+    def block(self, i0, i1, j0, j1):
+        """sub matrix [i0:i1, j0:j1]"""
+
+        res = SparseMatrix(i1 - i0, j1 - j0)
+        for i in range(i0, i1):
+            for j, x in self.rows[i].iteritems():
+                if j0 <= j < j1:
+                    res.rows[i - i0][j - j0] = x
+        return res
+
+    def dot(self, B, symmetric=False):
+        """
+        symbolic product: term (i,j) is the sum over the non zero
+        (i,k) (k,j) pairs of A[i,k]*B[k,j]. Terms cancelling out are
+        not stored.
+        """
+
+        if not self.n_rows or not B.n_rows:
+            return SparseMatrix(0, 0)
+
+        res = SparseMatrix(self.n_rows, B.n_cols, symmetric)
+        for i, row in enumerate(self.rows):
+            terms = {}
+            for k, a in row.iteritems():
+                if k < B.n_rows:
+                    for j, b in B.rows[k].iteritems():
+                        terms[j] = terms.get(j, 0) + a * b
+
+            res.rows[i] = {j: x for j, x in terms.iteritems() if x}
+
+        return res
+
+    def to_list(self):
+        return [[str(row[j]) if j in row else 0 for j in range(self.n_cols)] for row in self.rows]
+
+
 class Ccoder(Cmodel):
     """write the C code from the user input coming from the web interface..."""
 
     def __init__(self, dpkgRoot, dpkg,  **kwargs):
         Cmodel.__init__(self, dpkgRoot, dpkg,  **kwargs)
 
+        ##parameter (and time) only subexpressions hoisted out of the generated functions (see precompute and time_cache)
+        self.precomputed = []
+        self._precomputed = {}
+        self.pre_blocks = {}
+        self.time_terms = []
+        self._time_terms = {}
+
     def get_inc_reset(self, observation):
+        par_inc = set(self.par_inc)
         inc = set()
         for x in observation:
             if x != "distribution" and x!= 'name' and x !='start':
-                for e in self.change_user_input(observation[x]):
-                    if e in self.par_inc:
+                for e in parse_user_input(observation[x]):
+                    if e in par_inc:
                         inc.add(e)
 
         return inc
@@ -211,7 +772,7 @@ class Ccoder(Cmodel):
             sf = []
             for term in caches_C:
                 if any([x in term for x in self.special_functions]):
-                    terms = self.change_user_input(term)
+                    terms = parse_user_input(term)
                     ind = 0
                     while (ind < len(terms)):
                         if terms[ind] in self.special_functions:
@@ -231,17 +792,305 @@ class Ccoder(Cmodel):
                         else:
                             ind += 1
 
-            sf = list(set(sf))
+            sf = sorted(set(sf), key=index_key) if self.indices else list(set(sf))
 
         for i, term in enumerate(caches_C):
             if any([x in term for x in self.special_functions]):
-                for s in sf:
-                    caches_C[i] = caches_C[i].replace(s, prefix + '[{0}]'.format(sf.index(s)))
+                for j, s in enumerate(sf):
+                    caches_C[i] = caches_C[i].replace(s, prefix + '[{0}]'.format(j))
 
         return sf
 
 
 
+    def cse(self, terms, prefix='_cse'):
+        """common subexpression elimination across the C expressions
+        terms (typically all the expressions of a generated C function).
+
+        Every non trivial subexpression used more than once is
+        replaced by a temporary (prefix + index). Temporaries used only
+        once are inlined back. Returns a dict with:
+         - terms: the rewritten terms (unchanged if no temporary is used)
+         - cse: the temporaries [{'name', 'term'}] in dependency order
+         - n_removed: the number of operations removed
+
+        If one of the terms can't be parsed, or while the Builder
+        collects the symbolic work (self.pending), terms are returned
+        unchanged.
+        """
+
+        if self.pending is not None:
+            return {'terms': list(terms), 'cse': [], 'n_removed': 0}
+
+        try:
+            trees = [C_parse(x) for x in terms]
+        except SsmError:
+            return {'terms': list(terms), 'cse': [], 'n_removed': 0}
+
+        count = {}
+        def visit(node):
+            if not C_is_atom(node):
+                k = C_key(node)
+                count[k] = count.get(k, 0) + 1
+            for x in C_children(node):
+                visit(x)
+
+        for x in trees:
+            visit(x)
+
+        temps = {} #key -> index in defs
+        defs = []  #[name, tree]
+
+        def rebuild(node):
+            if C_is_atom(node):
+                return node
+
+            if node[0] == 'bin':
+                new = ('bin', node[1], rebuild(node[2]), rebuild(node[3]))
+            elif node[0] in ('neg', 'pos'):
+                new = (node[0], rebuild(node[1]))
+            else:
+                new = ('call', node[1], tuple(rebuild(x) for x in node[2]))
+
+            k = C_key(node)
+            if count[k] < 2:
+                return new
+            if k not in temps:
+                temps[k] = len(defs)
+                defs.append([prefix + str(len(defs)), new])
+
+            return ('id', defs[temps[k]][0])
+
+        new_trees = [rebuild(x) for x in trees]
+
+        ##inline the temporaries used only once
+        names = dict((d[0], d) for d in defs)
+        def uses(node, acc):
+            if node[0] == 'id' and node[1] in names:
+                acc[node[1]] = acc.get(node[1], 0) + 1
+            for x in C_children(node):
+                uses(x, acc)
+            return acc
+
+        def inline(node, once):
+            if node[0] == 'id' and node[1] in once:
+                return inline(names[node[1]][1], once)
+            if node[0] == 'bin':
+                return ('bin', node[1], inline(node[2], once), inline(node[3], once))
+            elif node[0] in ('neg', 'pos'):
+                return (node[0], inline(node[1], once))
+            elif node[0] == 'call':
+                return ('call', node[1], tuple(inline(x, once) for x in node[2]))
+            return node
+
+        acc = {}
+        for x in new_trees + [d[1] for d in defs]:
+            uses(x, acc)
+        once = set(x for x in names if acc.get(x, 0) < 2)
+
+        defs = [[d[0], inline(d[1], once)] for d in defs if d[0] not in once]
+        new_trees = [inline(x, once) for x in new_trees]
+
+        ##rename (contiguous indexes)
+        rename = dict((d[0], prefix + str(i)) for i, d in enumerate(defs))
+        def do_rename(node):
+            if node[0] == 'id':
+                return ('id', rename.get(node[1], node[1]))
+            if node[0] == 'bin':
+                return ('bin', node[1], do_rename(node[2]), do_rename(node[3]))
+            elif node[0] in ('neg', 'pos'):
+                return (node[0], do_rename(node[1]))
+            elif node[0] == 'call':
+                return ('call', node[1], tuple(do_rename(x) for x in node[2]))
+            return node
+
+        n_before = sum(C_count_ops(x) for x in trees)
+        n_after = sum(C_count_ops(x) for x in new_trees) + sum(C_count_ops(d[1]) for d in defs)
+
+        return {
+            'terms': [C_print(do_rename(new)) if uses(new, {}) else x for x, new in zip(terms, new_trees)],
+            'cse': [{'name': rename[d[0]], 'term': C_print(do_rename(d[1]))} for d in defs],
+            'n_removed': n_before - n_after
+        }
+
+
+    def precompute(self, terms, block=None):
+        """hoist the subexpressions of the C expressions terms that
+        only depend on the parameters (see C_depends).
+
+        Every maximal non trivial parameter only subexpression is
+        replaced by _pre[k] where k is its index in self.precomputed,
+        or, if block is given, in self.pre_blocks[block] (one list of
+        terms per generated file so that the indexes of a file don't
+        depend on the others, see ssm_precompute()). Within a chain of products (or sums)
+        the parameter only operands are grouped together first so
+        that e.g. X[ORDER_S]*r0*v/N gives _pre[0]*X[ORDER_S]/N.
+        Returns a dict with:
+         - terms: the rewritten terms (terms that can't be parsed are unchanged)
+         - n_hoisted: the number of subexpressions replaced
+        """
+
+        return self.hoist(terms, C_PAR, block)
+
+    def time_cache(self, terms):
+        """same as precompute for the subexpressions that only depend
+        on time (t, covariates and parameters): they are replaced by
+        _tt[k] where k is their index in self.time_terms (computed
+        once per time point and shared by all the particles, see
+        ssm_time_terms())"""
+
+        return self.hoist(terms, C_TIME)
+
+    def time_cache_step(self, caches, sf, prefix='_sf'):
+        """time_cache for the caches (and their special functions sf,
+        see cache_special_function_C) of a stepping function.
+
+        The special functions that only depend on time are moved to
+        _tt (and the parameter only ones inlined) so that the caches
+        using them can be time only too. Returns a dict with the new
+        caches, sf and n_hoisted.
+        """
+
+        if self.pending is not None:
+            return {'caches': list(caches), 'sf': list(sf), 'n_hoisted': 0}
+
+        inlined = {}
+        kept = []
+        n_hoisted = 0
+        for i, term in enumerate(sf):
+            try:
+                dep = C_depends(C_parse(term))
+            except SsmError:
+                dep = C_STATE
+
+            if dep == C_TIME:
+                res = self.time_cache([term])
+                inlined[i] = res['terms'][0]
+                n_hoisted += res['n_hoisted']
+            elif dep < C_TIME:
+                inlined[i] = term if C_is_atom(C_parse(term)) else '({0})'.format(term)
+            else:
+                kept.append(i)
+
+        renumber = dict((i, k) for k, i in enumerate(kept))
+        def sub(m):
+            i = int(m.group(1))
+            return inlined[i] if i in inlined else '{0}[{1}]'.format(prefix, renumber[i])
+
+        res = self.time_cache([re.sub(re.escape(prefix) + r'\[(\d+)\]', sub, x) for x in caches])
+
+        return {'caches': res['terms'], 'sf': [sf[i] for i in kept], 'n_hoisted': n_hoisted + res['n_hoisted']}
+
+    def hoist(self, terms, level, block=None):
+        """see precompute (level C_PAR) and time_cache (level C_TIME).
+        Nothing is hoisted while the Builder collects the symbolic
+        work (self.pending)"""
+
+        if self.pending is not None:
+            return {'terms': list(terms), 'n_hoisted': 0}
+
+        n_hoisted = [0]
+        trivial = lambda x: C_is_atom(x) or (x[0] in ('neg', 'pos') and C_is_atom(x[1]))
+
+        if level == C_PAR:
+            name = '_pre'
+            registry, index = (self.precomputed, self._precomputed) if block is None else self.pre_blocks.setdefault(block, ([], {}))
+        else:
+            name, registry, index = ('_tt', self.time_terms, self._time_terms)
+
+        def pre(node):
+            n_hoisted[0] += 1
+            k = C_key(node)
+            if k not in index:
+                index[k] = len(registry)
+                registry.append(C_print(node))
+
+            return ('idx', ('id', name), ('num', str(index[k])))
+
+        def chain(items, ops):
+            node = items[0][1]
+            for op, x in items[1:]:
+                node = ('bin', op, node, x)
+            return node
+
+        def hoist(node):
+            if C_is_atom(node):
+                return node
+
+            dep = C_depends(node)
+            if dep == level:
+                return node if trivial(node) else pre(node)
+            elif dep < level:
+                return node
+
+            if node[0] in ('neg', 'pos'):
+                return (node[0], hoist(node[1]))
+            elif node[0] == 'call':
+                return ('call', node[1], tuple(hoist(x) for x in node[2]))
+
+            ##flatten the (left associative) chain of operators of the same precedence
+            ops = ('+', '-') if node[1] in ('+', '-') else ('*', '/')
+            items = []
+            while node[0] == 'bin' and node[1] in ops:
+                items.append((node[1], node[3]))
+                node = node[2]
+            items.append((ops[0], node))
+            items.reverse()
+
+            grouped = [x for x in items if C_depends(x[1]) <= level]
+            if not any(C_depends(x[1]) == level for x in grouped) or (len(grouped) == 1 and trivial(grouped[0][1])):
+                return chain([(op, hoist(x)) for op, x in items], ops)
+
+            rest = [(op, hoist(x)) for op, x in items if C_depends(x) > level]
+            direct = [x for x in grouped if x[0] == ops[0]]
+            inverse = [x for x in grouped if x[0] == ops[1]]
+            if direct:
+                return chain([(ops[0], pre(chain(direct + inverse, ops)))] + rest, ops)
+            else:
+                ##x - a - b -> x - (a + b) and x/a/b -> x/(a*b)
+                return chain(rest + [(ops[1], pre(chain([(ops[0], x) for op, x in inverse], ops)))], ops)
+
+        res = []
+        for term in terms:
+            try:
+                tree = C_parse(term)
+            except SsmError:
+                res.append(term)
+                continue
+
+            n = n_hoisted[0]
+            new = hoist(tree)
+            res.append(C_print(new) if n_hoisted[0] > n else term)
+
+        return {'terms': res, 'n_hoisted': n_hoisted[0]}
+
+
+    def roll(self, code, reorder=False):
+        """roll the units of code (delimited by ROLL_UNIT, see
+        C_roll) into C loops (models with indices only)"""
+
+        units = code.split(ROLL_UNIT)
+        if not self.indices or len(units) < 3:
+            return ''.join(units)
+
+        orders = dict((x['name'], x['order']) for v in self.orders().values() for x in v)
+        return C_roll(units[:-1], orders, reorder) + units[-1]
+
+    def soa(self, code, noises=(), cse=()):
+        """rewrite code written for one particle for the batched
+        kernels (see C_soa): the per particle arrays (SOA_ARRAYS), the
+        noises (block _nb) and the common subexpressions (block _cb)
+        are read from structure of arrays blocks. noises and cse are
+        lists of names (or of dict with a name)"""
+
+        blocks = dict(SOA_ARRAYS)
+        for block, names in [('_nb', noises), ('_cb', cse)]:
+            for k, x in enumerate(names):
+                blocks[x['name'] if isinstance(x, dict) else x] = (block, k)
+
+        return C_soa(code, blocks)
+
+
     def alloc_psr(self):
         Clist = []
         univ = ['U']
@@ -249,7 +1098,7 @@ class Ccoder(Cmodel):
             univ += self.remainder
 
         for s in self.par_sv + univ:
-            nbreac = len([r for r in self.proc_model if r['from']==s]) +1 ##+1 to stay in the same compartment or to declare smtg in case of no reaction (not super clean but makes C code easier...)
+            nbreac = len(self.reactions_from.get(s, [])) +1 ##+1 to stay in the same compartment or to declare smtg in case of no reaction (not super clean but makes C code easier...)
             Clist.append({'state':s, 'nb_reaction': nbreac})
 
         return Clist
@@ -290,22 +1139,23 @@ class Ccoder(Cmodel):
 
                 rates.add(myrate)
 
-        rates = list(rates)
+        rates = sorted(rates, key=index_key) if self.indices else list(rates)
         caches = map(lambda x: self.make_C_term(x, False), rates)
         sf = self.cache_special_function_C(caches)
 
+        ind_rates = dict((x, i) for i, x in enumerate(rates))
         for r in proc_model:
             if r['from'] not in (['U'] + self.remainder):
                 myrate = r['rate']
                 if 'white_noise' in r:
                     myrate = '({0})*{1}'.format(myrate, r['white_noise']['name'])
 
-                r['ind_cache'] = rates.index(myrate)
+                r['ind_cache'] = ind_rates[myrate]
 
         Ccode=''
 
         for s in self.par_sv:
-            myexit = [r for r in proc_model if r['from'] == s]
+            myexit = [proc_model[i] for i in self.reactions_from.get(s, [])]
             exitlist=[]
 
             if len(myexit)>0:
@@ -331,7 +1181,7 @@ class Ccoder(Cmodel):
 
                 Celse += 'calc->prob[ORDER_{0}][{1}] = 1.0;\n'.format(s,len(exitlist))+'}\n\n'
 
-                Ccode += Celse
+                Ccode += Celse + ROLL_UNIT
 
         ############
         ## update ##
@@ -340,14 +1190,14 @@ class Ccoder(Cmodel):
         incDict = dict([(x,'') for x in self.par_sv])
 
         for s in self.par_sv: ##stay in the same compartment
-            myexit = [r for r in self.proc_model if r['from'] == s]
+            myexit = self.reactions_from.get(s, [])
             if len(myexit)>0: ##only if you can exit from this compartment in this case the remaining has a sense
                 incDict[s] += 'calc->inc[ORDER_{0}][{1}]'.format(s, len(myexit))
             else:
                 incDict[s] += 'X[ORDER_{0}]'.format(s)
 
         for s in self.par_sv: #come in from other compartments
-            myinput = [r for r in self.proc_model if r['from'] == s]
+            myinput = [self.proc_model[i] for i in self.reactions_from.get(s, [])]
             for nbreac in range(len(myinput)):
                 if myinput[nbreac]['to'] not in (['U'] + self.remainder): ##we exclude deaths or transitions to remainder in the update
                     incDict[myinput[nbreac]['to']] += ' + calc->inc[ORDER_{0}][{1}]'.format(myinput[nbreac]['from'], nbreac)
@@ -356,7 +1206,7 @@ class Ccoder(Cmodel):
         ##we add flow from (['U'] + self.remainder) (Poisson term). We want to cache those flow so that the incidences can be computed
         poisson = []
         for s in (['U'] + self.remainder):
-            reac_from_univ = [r for r in self.proc_model if (r['from'] == s and (r['to'] not in (['U'] + self.remainder)) )]
+            reac_from_univ = [self.proc_model[i] for i in self.reactions_from.get(s, []) if self.proc_model[i]['to'] not in (['U'] + self.remainder)]
             for nbreac in range(len(reac_from_univ)):
                 myrate = self.make_C_term(reac_from_univ[nbreac]['rate'], False)
                 if 'white_noise' in reac_from_univ[nbreac]:
@@ -367,10 +1217,103 @@ class Ccoder(Cmodel):
 
         Cstring=''
         for s in self.par_sv:
-            Cstring += 'X[ORDER_{0}] = {1};\n'.format(s, incDict[s])
+            Cstring += 'X[ORDER_{0}] = {1};\n'.format(s, incDict[s]) + ROLL_UNIT
+
+
+        return {'code': Ccode, 'caches': caches, 'sf': sf, 'poisson': poisson, 'update_code': Cstring, 'reactions': self.step_psr_reactions()}
+
+
+    def step_psr_reactions(self):
+        """
+        reactions of the psr implementation taken one by one (exact
+        steps and leap size of the adaptive tau-leaping):
+
+        {'reactions': [{'rate': propensity, 'noise': index of the white noise or None, 'updates': [], 'inc': [index of the incidences]}],
+         'tau': [{'state':, 'mu': expected change, 'sigma2': variance of the change}],
+         'refresh': [reactions whose propensities have to be re-evaluated on a time grid],
+         'n_noises': number of white noises}
+
+        The propensities (rate times the size of the compartment
+        left) are not corrected (correct_rate) and not multiplied by
+        their white noise (drawn once per time step, see
+        ssm_psr_white_noises()). The reactions with a white noise or
+        depending on the time, the covariates or the diffusions are
+        refreshed.
+        """
+
+        univ = ['U'] + self.remainder
+
+        noise = {}
+        for i, x in enumerate(self.white_noise):
+            for o in self.reactions_noise[x['name']]:
+                noise[o] = i
+
+        reactions = []
+        refresh = []
+        index = {} ##index in reactions of the reactions of proc_model
+        for o, r in enumerate(self.proc_model):
+            if r['from'] in univ and r['to'] in univ:
+                continue
+
+            rate = self.make_C_term(r['rate'], True)
+            updates = []
+            if r['from'] not in univ:
+                rate = '({0})*X[ORDER_{1}]'.format(rate, r['from'])
+                updates.append('X[ORDER_{0}] -= 1.0'.format(r['from']))
+            if r['to'] not in univ:
+                updates.append('X[ORDER_{0}] += 1.0'.format(r['to']))
+
+            inc = [i for i, inc_def in enumerate(self.par_inc_def) if any(o in self.reactions_key[reaction_key(x)] for x in inc_def)]
+
+            if o in noise or not C_is_stationary(C_parse(rate)):
+                refresh.append(len(reactions))
+
+            index[o] = len(reactions)
+            reactions.append({'from': r['from'], 'to': r['to'], 'rate': rate, 'noise': noise.get(o), 'updates': updates, 'inc': inc})
+
+        tau = []
+        for s in self.par_sv:
+            k_in = ['a[{0}]'.format(index[o]) for o in self.reactions_to.get(s, []) if o in index]
+            k_out = ['a[{0}]'.format(index[o]) for o in self.reactions_from.get(s, []) if o in index]
+            if k_in or k_out:
+                tau.append({
+                    'state': s,
+                    'mu': ' - '.join(['(' + ' + '.join(k_in or ['0.0']) + ')'] + k_out),
+                    'sigma2': ' + '.join(k_in + k_out)
+                })
+
+        return {'reactions': reactions, 'tau': tau, 'refresh': refresh, 'n_noises': len(self.white_noise)}
 
 
-        return {'code': Ccode, 'caches': caches, 'sf': sf, 'poisson': poisson, 'update_code': Cstring}
+    def step_nrm(self):
+        """
+        reactions of step_psr_reactions for the next reaction method
+        with the reaction dependency graph: the propensities to update
+        when the reaction k fires are dep[dep_start[k]:dep_start[k+1]]
+        (the ones using a state variable changed by k, k included).
+        The propensities with a white noise or depending on the time,
+        the covariates or the diffusions (refresh) are updated on a
+        time grid.
+        """
+
+        psr = self.step_psr_reactions()
+        reactions = psr['reactions']
+        uses = [C_states(C_parse(r['rate'])) for r in reactions]
+
+        dep_start = [0]
+        dep = []
+        for k, r in enumerate(reactions):
+            changed = set(x for x in [r['from'], r['to']] if x in self.par_sv)
+            dep += [d for d in range(len(reactions)) if d == k or (uses[d] & changed)]
+            dep_start.append(len(dep))
+
+        return {
+            'reactions': reactions,
+            'dep_start': dep_start,
+            'dep': dep,
+            'refresh': psr['refresh'],
+            'n_noises': psr['n_noises']
+        }
 
 
     def step_psr_inc(self):
@@ -387,10 +1330,8 @@ class Ccoder(Cmodel):
             right_hand_side=''
 
             for j in range(len(self.par_inc_def[i])):
-                id_out = [self.proc_model.index(r) for r in self.proc_model if ((r['from'] == self.par_inc_def[i][j]['from']) and (r['to'] == self.par_inc_def[i][j]['to']) and (r['rate'] == self.par_inc_def[i][j]['rate']))]
-                for o in id_out:
-                    myexit = [r for r in self.proc_model if r['from']==self.proc_model[o]['from']]
-                    right_hand_side += ' + calc->inc[ORDER_{0}][{1}]'.format(self.par_inc_def[i][j]['from'], myexit.index(self.proc_model[o]))
+                for o in self.reactions_key[reaction_key(self.par_inc_def[i][j])]:
+                    right_hand_side += ' + calc->inc[ORDER_{0}][{1}]'.format(self.par_inc_def[i][j]['from'], self.ind_exit[o])
 
             Clist.append({'index': i, 'right_hand_side':right_hand_side})
 
@@ -400,7 +1341,7 @@ class Ccoder(Cmodel):
     def step_psr_multinomial(self):
         draw = []
         for s in self.par_sv:
-            nbexit = len([r for r in self.proc_model if r['from']==s])
+            nbexit = len(self.reactions_from.get(s, []))
             if nbexit>0:
                 draw.append({'state': s, 'nb_exit': nbexit+1}) ##+1 to stay in the compartment
 
@@ -419,12 +1360,15 @@ class Ccoder(Cmodel):
         odeDict = dict([(x, []) for x in self.par_sv])
 
         rates = list(set(r['rate'] for r in proc_model))
+        if self.indices:
+            rates.sort(key=index_key)
 
         caches = map(lambda x: self.make_C_term(x, True), rates)
         sf = self.cache_special_function_C(caches, prefix='_sf')
 
+        ind_rates = dict((x, i) for i, x in enumerate(rates))
         for i, r in enumerate(proc_model):
-            r['ind_cache'] = rates.index(r['rate'])
+            r['ind_cache'] = ind_rates[r['rate']]
             r['ind_dem_sto'] = i
 
 
@@ -471,8 +1415,7 @@ class Ccoder(Cmodel):
 
             if isinstance(self.par_inc_def[i][0], dict): ##incidence
                 for j in range(len(self.par_inc_def[i])):
-                    id_out = [proc_model.index(r) for r in proc_model if ((r['from'] == self.par_inc_def[i][j]['from']) and (r['to'] == self.par_inc_def[i][j]['to']) and (r['rate'] == self.par_inc_def[i][j]['rate'])) ]
-                    for o in id_out:
+                    for o in self.reactions_key[reaction_key(self.par_inc_def[i][j])]:
                         reaction = proc_model[o]
                         if self.par_inc_def[i][j]['from'] in (['U'] + self.remainder):
                             cached = '_r[{0}]'.format(reaction['ind_cache'])
@@ -687,23 +1630,39 @@ class Ccoder(Cmodel):
         caches_jac_only = list(set(caches_jac_only))
 
         ##replace with index of caches (will be _r[index] in C)
+        ind_caches = dict((x, i) for i, x in enumerate(caches))
+        ind_caches_jac_only = dict((x, i) for i, x in enumerate(caches_jac_only))
         for s in range(len(self.par_sv)):
             for i in range(len(self.par_sv)):
                 Cterm = jac[s][i]
-                jac[s][i] = caches.index(Cterm)
-                jac_only[s][i] = caches_jac_only.index(Cterm)
+                jac[s][i] = ind_caches[Cterm]
+                jac_only[s][i] = ind_caches_jac_only[Cterm]
 
             for i in range(len(self.par_diff)):
-                jac_diff[s][i]['value'] = caches.index(jac_diff[s][i]['value'])
+                jac_diff[s][i]['value'] = ind_caches[jac_diff[s][i]['value']]
 
 
         for o in range(len(obsList)):
             for i in range(len(self.par_sv)):
-                jac_obs[o][i] = caches.index(jac_obs[o][i])
+                jac_obs[o][i] = ind_caches[jac_obs[o][i]]
 
             for i in range(len(self.par_diff)):
-                jac_obs_diff[o][i]['value'] = caches.index(jac_obs_diff[o][i]['value'])
-
+                jac_obs_diff[o][i]['value'] = ind_caches[jac_obs_diff[o][i]['value']]
+
+
+        ##sparse version of the jacobian (structural zeros are
+        ##skipped): list of the non zero terms (row by row) with
+        ##their row and column (iterator and index in it)
+        Ft = []
+        rows = [('states_sv', jac, jac_diff), ('states_inc', jac_obs, jac_obs_diff)]
+        for it, jac_it, jac_it_diff in rows:
+            for s in range(len(jac_it)):
+                for i in range(len(self.par_sv)):
+                    if caches[jac_it[s][i]] != '0':
+                        Ft.append({'i': {'it': it, 'ind': s}, 'j': {'it': 'states_sv', 'ind': i}, 'value': jac_it[s][i], 'diff': False})
+                for i in range(len(self.par_diff)):
+                    if caches[jac_it_diff[s][i]['value']] != '0':
+                        Ft.append({'i': {'it': it, 'ind': s}, 'j': {'it': 'states_diff', 'ind': i}, 'value': jac_it_diff[s][i]['value'], 'diff': True})
 
         ##special function that have to be cached (caches is transformed by self.cache_special_function_)
         sf = self.cache_special_function_C(caches, prefix='_sf')
@@ -715,6 +1674,7 @@ class Ccoder(Cmodel):
                 'jac_obs': jac_obs,
                 'jac_diff': jac_diff,
                 'jac_obs_diff': jac_obs_diff,
+                'Ft': Ft,
                 'caches': caches,
                 'sf': sf,
                 'caches_jac_only': caches_jac_only}
@@ -812,14 +1772,14 @@ class Ccoder(Cmodel):
         N_PAR_INC = len(self.par_inc)
         N_DIFF = len(self.par_diff)
 
-        unique_noises_names = [x['name'] for x in self.white_noise]
+        unique_noises_names = dict((x['name'], i) for i, x in enumerate(self.white_noise))
         N_ENV_STO_UNIQUE = len(unique_noises_names)
 
         ##add sd and order properties to noisy reactions
         N_ENV_STO = 0
         for reaction in proc_model:
             if 'white_noise' in reaction:
-                reaction['order_env_sto_unique'] = unique_noises_names.index(reaction['white_noise']['name'])
+                reaction['order_env_sto_unique'] = unique_noises_names[reaction['white_noise']['name']]
                 reaction['order_env_sto'] = N_ENV_STO
                 N_ENV_STO += 1
 
@@ -827,13 +1787,14 @@ class Ccoder(Cmodel):
         s = N_REAC + N_ENV_STO ## number of noise terms (potentially non-independent)
         ##for demographic stochasticity, one independent noise term per reaction
 
-        Ls = [[0]*s for x in range(N_PAR_SV + N_PAR_INC)]  
-        Qs = [[0]*(N_PAR_SV + N_PAR_INC) for x in range(N_PAR_SV + N_PAR_INC)]
-        Qr = [[0]*s for x in range(s)]
-        Qr_dem = [[0]*s for x in range(N_REAC)]
-        Qr_sto = [[0]*s for x in range(N_ENV_STO)]
-        Lr = [[0]*N_ENV_STO_UNIQUE for x in range(N_ENV_STO)]
-        Qn = [[0]*N_ENV_STO_UNIQUE for x in range(N_ENV_STO_UNIQUE)]
+        N_S = N_PAR_SV + N_PAR_INC
+
+        #only the structurally non zero terms are stored (see SparseMatrix)
+        Ls = SparseMatrix(N_S, s)
+        Qr = SparseMatrix(s, s, symmetric=True)
+        Qr_dem = SparseMatrix(N_REAC, N_REAC, symmetric=True)
+        Lr = SparseMatrix(N_ENV_STO, N_ENV_STO_UNIQUE)
+        Qn = SparseMatrix(N_ENV_STO_UNIQUE, N_ENV_STO_UNIQUE, symmetric=True)
 
 
         ###########################################
@@ -847,34 +1808,34 @@ class Ccoder(Cmodel):
                 B_sto_ind = N_REAC + r['order_env_sto']
 
             if r['from'] not in (['U'] + self.remainder):
-                i = self.par_sv.index(r['from'])
-                Ls[i][B_dem_ind] -= 1 ##demographic stochasticity
+                i = self.order_states[r['from']]
+                Ls[i, B_dem_ind] -= 1 ##demographic stochasticity
                 if is_noise:
-                    Ls[i][B_sto_ind] -= 1 ##env stochasticity
+                    Ls[i, B_sto_ind] -= 1 ##env stochasticity
 
                 Qc_term = '({0})*{1}'.format(r['rate'], r['from'])
             else:
                 Qc_term = r['rate']
 
             if r['to'] not in (['U'] + self.remainder):
-                i = self.par_sv.index(r['to'])
-                Ls[i][B_dem_ind] += 1
+                i = self.order_states[r['to']]
+                Ls[i, B_dem_ind] += 1
                 if is_noise:
-                    Ls[i][B_sto_ind] += 1
+                    Ls[i, B_sto_ind] += 1
 
-            Qr_dem[B_dem_ind][B_dem_ind] =  Qc_term
+            Qr_dem[B_dem_ind, B_dem_ind] =  Qc_term
 
         # incidence variables
         for i in range(len(self.par_inc_def)): #(for every incidence variable)
-            for B_dem_ind, r in enumerate(proc_model):
-                # for every incidence
-                for inc in self.par_inc_def[i]:
-                    # if it involves incidence
-                    if (r['from'] == inc['from']) and (r['to'] == inc['to']) and (r['rate'] == inc['rate']):
-                        Ls[N_PAR_SV + i][B_dem_ind] += 1
-                        if 'white_noise' in r:
-                            B_sto_ind = N_REAC + r['order_env_sto']
-                            Ls[N_PAR_SV + i][B_sto_ind] += 1
+            # for every incidence
+            for inc in self.par_inc_def[i]:
+                # reactions involved in the incidence
+                for B_dem_ind in self.reactions_key[reaction_key(inc)]:
+                    r = proc_model[B_dem_ind]
+                    Ls[N_PAR_SV + i, B_dem_ind] += 1
+                    if 'white_noise' in r:
+                        B_sto_ind = N_REAC + r['order_env_sto']
+                        Ls[N_PAR_SV + i, B_sto_ind] += 1
 
 
 
@@ -888,81 +1849,45 @@ class Ccoder(Cmodel):
                 else:
                     Qn_term = r['rate']
 
-                Lr[r['order_env_sto']][r['order_env_sto_unique']] = Qn_term
-                Qn[r['order_env_sto_unique']][r['order_env_sto_unique']] = '({0})**2'.format(r['white_noise']['sd'])
-
+                Lr[r['order_env_sto'], r['order_env_sto_unique']] = Qn_term
+                Qn[r['order_env_sto_unique'], r['order_env_sto_unique']] = '({0})**2'.format(r['white_noise']['sd'])
 
 
-        def matrix_product(A, B):
-            if not A or not B:
-                return []
-
-            res = [[0]*len(B[0]) for x in range(len(A))]
-
-            for i in range(len(A)):
-                for j in range(len(B[0])):
-                    for k in range(len(B)):
-                        if (A[i][k] and B[k][j]):
-                            term = ('({0})*({1})').format(A[i][k], B[k][j])
-
-                            if res[i][j]:
-                               res[i][j] = res[i][j] + ' + {0}'.format(term)
-                            else:
-                               res[i][j] = term
-
-
-            return res
-
-
-        Qr_env = matrix_product(Lr, Qn)
-        Qr_env = matrix_product(Qr_env, zip(*Lr))
-
-        for i in range(N_ENV_STO):
-            for j in range(N_ENV_STO):
-                Qr[N_REAC+i][N_REAC+j] = Qr_env[i][j]
+        Qr_env = Lr.dot(Qn).dot(Lr.transpose(), symmetric=True)
 
         #we fill Qr with Qc_dem and Qc_env
-        for i in range(N_REAC):
-            for j in range(N_REAC):
-                Qr[i][j] = Qr_dem[i][j]
+        for i, j, x in Qr_env.items():
+            Qr[N_REAC+i, N_REAC+j] = x
 
+        for i, j, x in Qr_dem.items():
+            Qr[i, j] = x
 
-        #we split Ls into Ls_dem and Ls_env
-        Ls_dem = [[0]*N_REAC for x in range(N_PAR_SV + N_PAR_INC)]
-        for i in range(N_PAR_SV + N_PAR_INC):
-            for j in range(N_REAC):
-                Ls_dem[i][j] = Ls[i][j]
 
-        Ls_env = [[0]*N_ENV_STO for x in range(N_PAR_SV + N_PAR_INC)]
-        for i in range(N_PAR_SV + N_PAR_INC):
-            for j in range(N_ENV_STO):
-                Ls_env[i][j] = Ls[i][N_REAC + j]
+        #we split Ls into Ls_dem and Ls_env
+        Ls_dem = Ls.block(0, N_S, 0, N_REAC)
+        Ls_env = Ls.block(0, N_S, N_REAC, s)
 
 
         ############################
         ## Create Q_sde
         ############################
 
+        Q_sde = None
         sde = self.model.get('sde', {})
         if 'dispersion' in sde:
             sde = self.model['sde']
-            dispersion = sde['dispersion']
+            dispersion = SparseMatrix.from_list(sde['dispersion'])
             # Q_sde = dispersion * dispersion'
-            Q_sde = matrix_product(dispersion, zip(*dispersion))
+            Q_sde = dispersion.dot(dispersion.transpose(), symmetric=True)
 
 
         #####################################################################################
         ##we create 4 versions of Q (no_dem_sto, no_env_sto, no_dem_sto_no_env_sto and full)
         #####################################################################################
 
-        Qs = matrix_product(Ls, Qr)
-        Qs = matrix_product(Qs, zip(*Ls))
-
-        Qs_dem = matrix_product(Ls_dem, Qr_dem)
-        Qs_dem = matrix_product(Qs_dem, zip(*Ls_dem))
-
-        Qs_env = matrix_product(Ls_env, Qr_env)
-        Qs_env = matrix_product(Qs_env, zip(*Ls_env))
+        Qs = Ls.dot(Qr).dot(Ls.transpose(), symmetric=True)
+        Qs_dem = Ls_dem.dot(Qr_dem).dot(Ls_dem.transpose(), symmetric=True)
+        Qs_env = Ls_env.dot(Qr_env).dot(Ls_env.transpose(), symmetric=True)
 
         # calc_Q contains different components of Q depending on the absence / presence
         # of demographic and environmental noise.
@@ -981,15 +1906,15 @@ class Ccoder(Cmodel):
         
         calc_Q = {'no_dem_sto': {'Q_proc':[],
                                  'Q_inc':[],
-                                 'Q_cm': Qs_env,
+                                 'Q_cm': Qs_env.to_list(),
                                  'Q_sde': []},
                   'no_env_sto': {'Q_proc':[],
                                  'Q_inc':[],
-                                 'Q_cm': Qs_dem,
+                                 'Q_cm': Qs_dem.to_list(),
                                  'Q_sde': []},
                   'full': {'Q_proc':[],
                            'Q_inc':[],
-                           'Q_cm': Qs,
+                           'Q_cm': Qs.to_list(),
                            'Q_sde': []},
                   'no_dem_sto_no_env_sto':{'Q_proc':[],
                                            'Q_inc':[],
@@ -1021,22 +1946,27 @@ class Ccoder(Cmodel):
 
         #convert in a version easy to template in C
         #Note that we only template the lower triangle (Q is symmetrical)
+        #Each factor (rate, squared amplitude...) goes through make_C_term once,
+        #the sums of products are then printed from their C factors.
+        C_factors = {}
+        def Q_term(x):
+            for f in x.factors():
+                if f not in C_factors:
+                    C_factors[f] = self.make_C_term(f, True)
+            return C_print(C_parse(x.format(lambda f: '({0})'.format(C_factors[f]))))
+
+        sparse_Q = {'no_dem_sto': Qs_env, 'no_env_sto': Qs_dem, 'full': Qs, 'no_dem_sto_no_env_sto': SparseMatrix(0, 0)}
         for k, tpl in calc_Q.iteritems():
-            if tpl['Q_cm']:
-                for i  in range(len(tpl['Q_cm'])):
-                    for j in range(i+1):
-                        if tpl['Q_cm'][i][j]:
-                            if i< N_PAR_SV and j < N_PAR_SV:
-                                tpl['Q_proc'].append({'i': i, 'j': j, 'term': self.make_C_term(tpl['Q_cm'][i][j], True)})
-                            else:
-                                tpl['Q_inc'].append({'i': {'is_inc': False, 'ind': i} if i < N_PAR_SV else {'is_inc': True, 'ind': i - N_PAR_SV},
-                                                     'j': {'is_inc': False, 'ind': j} if j < N_PAR_SV else {'is_inc': True, 'ind': j - N_PAR_SV},
-                                                     'term': self.make_C_term(tpl['Q_cm'][i][j], True)})
-            if sde:
-                for i in range(len(Q_sde)):
-                    for j in range(i+1):
-                        if Q_sde[i][j]:
-                            tpl['Q_sde'].append({'i': i, 'j': j, 'term': self.make_C_term(Q_sde[i][j], True)})
+            for i, j, x in sparse_Q[k].items(lower=sparse_Q[k].symmetric):
+                if i< N_PAR_SV and j < N_PAR_SV:
+                    tpl['Q_proc'].append({'i': i, 'j': j, 'term': Q_term(x)})
+                else:
+                    tpl['Q_inc'].append({'i': {'is_inc': False, 'ind': i} if i < N_PAR_SV else {'is_inc': True, 'ind': i - N_PAR_SV},
+                                         'j': {'is_inc': False, 'ind': j} if j < N_PAR_SV else {'is_inc': True, 'ind': j - N_PAR_SV},
+                                         'term': Q_term(x)})
+            if Q_sde is not None:
+                for i, j, x in Q_sde.items(lower=True):
+                    tpl['Q_sde'].append({'i': i, 'j': j, 'term': Q_term(x)})
 
 
         ##cache special functions
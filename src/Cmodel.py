@@ -17,14 +17,160 @@
 #########################################################################
 
 import copy
+import itertools
 import sys
 import os
 import os.path
+import re
 import json
+import hashlib
+import tempfile
+import time
+import sympy
 from sympy import diff, Symbol, sympify, simplify
 from sympy.solvers import solve
 from sympy.printing import ccode
 
+OP = frozenset(['+', '-', '*', '/', ',', '(', ')']) ##!!!CAN'T contain square bracket '[' ']'
+USER_TOKEN = re.compile(r'([-+*/,()])')
+
+##SymPy calls counted by sym_ccode (see Builder profile mode)
+SYMBOLIC_OPS = ('sympify', 'diff', 'solve', 'ccode')
+
+##placeholder returned by sym_ccode while the Builder collects the
+##symbolic work (Cmodel.pending). It is a token of its own (user
+##tokens are never prefixed by ssm___) so that the terms built on a
+##pending result are recognized by token, not by substring.
+PENDING = 'ssm___pending'
+
+##parsed user expressions and interned tokens (shared by all the
+##models of the process)
+_parsed = {}
+_tokens = {}
+
+INDEXED = re.compile(r'([A-Za-z_]\w*)((?:@[A-Za-z_]\w*)+)')
+INDEX_SUFFIX = re.compile(r'__(\d+(?:_\d+)*)\b')
+
+def expand_indices(model):
+    """
+    expand the indexed families of compartments, reactions, inputs...
+
+    model['indices'] (e.g [{'name': 'p', 'n': 3}]) declares the
+    indices. A name suffixed by @p (e.g S@p) denotes a family (S__0,
+    S__1, S__2, zero padded so that the alphabetical order of the
+    members is the index order). Every element of populations,
+    reactions, observations, data, inputs and sde.drift using such
+    names is repeated for every value of the indices it uses, e.g
+    {"from": "S@p", "to": "I@p", "rate": "r0@p*v*I@p/N@p"}. Several
+    indices can be combined (C@p@q).
+
+    model['couplings'] (e.g [{'name': 'C', 'value': [[1, 0.1], [0.1,
+    1]]}]) declares coupling matrices: C@p@q is replaced by its value
+    and the elements where it is 0 are dropped (structural zeros).
+
+    Returns a new model (model is returned as is if it has no indices)
+    """
+
+    if not model.get('indices'):
+        return model
+
+    n = dict((x['name'], x['n']) for x in model['indices'])
+    width = dict((k, len(str(v-1))) for k, v in n.iteritems())
+    order = [x['name'] for x in model['indices']]
+    couplings = dict((x['name'], x['value']) for x in model.get('couplings', []))
+
+    def used(x, found):
+        if isinstance(x, basestring):
+            for m in INDEXED.finditer(x):
+                for i in m.group(2).split('@')[1:]:
+                    if i not in n:
+                        raise ModelError('undefined index {0} in {1}'.format(i, x))
+                    found.add(i)
+        elif isinstance(x, dict):
+            for v in x.values():
+                used(v, found)
+        elif isinstance(x, list):
+            for v in x:
+                used(v, found)
+        return found
+
+    class Zero(Exception):
+        pass
+
+    def subst(x, env):
+        if isinstance(x, basestring):
+            def repl(m):
+                ind = m.group(2).split('@')[1:]
+                if m.group(1) in couplings:
+                    value = couplings[m.group(1)]
+                    for i in ind:
+                        value = value[env[i]]
+                    if not value:
+                        raise Zero
+                    return repr(value)
+
+                return m.group(1) + '__' + '_'.join('{0:0{1}d}'.format(env[i], width[i]) for i in ind)
+
+            return INDEXED.sub(repl, x)
+        elif isinstance(x, dict):
+            return dict((k, subst(v, env)) for k, v in x.iteritems())
+        elif isinstance(x, list):
+            return [subst(v, env) for v in x]
+        else:
+            return x
+
+    def expand(elements):
+        res = []
+        for x in elements:
+            ind = [i for i in order if i in used(x, set())]
+            for values in itertools.product(*[range(n[i]) for i in ind]):
+                try:
+                    res.append(subst(x, dict(zip(ind, values))))
+                except Zero:
+                    pass
+        return res
+
+    model = copy.deepcopy(model)
+    for k in ['populations', 'reactions', 'observations', 'data', 'inputs']:
+        if k in model:
+            model[k] = expand(model[k])
+    if 'drift' in model.get('sde', {}):
+        model['sde']['drift'] = expand(model['sde']['drift'])
+
+    return model
+
+
+def index_key(term):
+    """sort key grouping the members of the families used in term
+    (in index order)"""
+    return (INDEX_SUFFIX.sub('__', term), tuple(int(x) for m in INDEX_SUFFIX.findall(term) for x in m.split('_')))
+
+
+def reaction_key(r):
+    """signature used to match a reaction (e.g. against the reactions of par_inc_def)"""
+    return (r['from'], r['to'], r['rate'])
+
+
+def parse_user_input(term):
+    """tokenize term (whitespaces are removed) into an immutable tuple.
+    example: parse_user_input('r0*2*correct_rate(v)') -> ('r0', '*', '2', '*', 'correct_rate', '(', 'v', ')')
+
+    An expression is only tokenized once per process: the tuple (and
+    its tokens) are interned so callers must not rely on getting a
+    mutable copy (see Cmodel.change_user_input)
+    """
+
+    try:
+        return _parsed[term]
+    except KeyError:
+        pass
+
+    tokens = tuple(_tokens.setdefault(x, x) for x in USER_TOKEN.split(term.replace(' ', '')) if x)
+    _parsed[term] = tokens
+
+    return tokens
+
+
 class ModelError(Exception):
     def __init__(self, value):
         self.value = value
@@ -39,9 +185,23 @@ class Cmodel:
 
     def __init__(self, dpkgRoot, dpkg, **kwargs):
         self.dpkgRoot = os.path.abspath(unicode(dpkgRoot, 'utf8'))
-        self.model = copy.deepcopy(dpkg)
-
-        self.op = set(['+', '-', '*', '/', ',', '(', ')']) ##!!!CAN'T contain square bracket '[' ']'
+        self.model = expand_indices(copy.deepcopy(dpkg))
+        self.indices = self.model.get('indices', [])
+
+        ##symbolic cache for make_C_term: in process (sympified
+        ##trees and their ccode) and optionally on disk
+        ##(content-addressed so that it can be shared across models
+        ##and builds)
+        self.cache_dir = kwargs.get('cache_dir', None)
+        self._sympified = {}
+        self._ccoded = {}
+        self.cache_stats = {'hits': 0, 'disk_hits': 0, 'misses': 0}
+        self.pending = None
+
+        ##optional profiler notified of the symbolic work (see Builder.Profile)
+        self.profile = None
+
+        self.op = OP
         self.reserved = set(['U', 'x', 't', 'E', 'LN2', 'LN10','LOG2E', 'LOG10E', 'PI', 'SQRT1_2', 'SQRT2']) #JS Math Global Object
         self.special_functions = set(['terms_forcing', 'heaviside', 'ramp', 'slowstep', 'sigmoid', 'sin', 'cos', 'correct_rate', 'ssm_correct_rate', 'sqrt', 'pow', 'exp', 'log'])
 
@@ -104,8 +264,9 @@ class Cmodel:
         par_proc = set()
         par_noise = set()
         self.white_noise = []
+        white_noise_names = set()
         for r in reactions:
-            el =  self.change_user_input(r['rate'])
+            el =  parse_user_input(r['rate'])
             for e in el:
                 if e not in self.op and e not in self.reserved and e not in self.special_functions and e not in self.par_sv and e not in self.par_forced:
                     try:
@@ -115,7 +276,8 @@ class Cmodel:
 
             if 'white_noise' in r:
                 par_noise.add(r['white_noise']['sd'])
-                if r['white_noise']['name'] not in [y['name'] for y in self.white_noise]:
+                if r['white_noise']['name'] not in white_noise_names:
+                    white_noise_names.add(r['white_noise']['name'])
                     self.white_noise.append(r['white_noise'])
 
         self.par_noise = sorted(list(par_noise))
@@ -136,7 +298,7 @@ class Cmodel:
                 pars = [o['n'], o['p'],o['mean'], o['sd']]
 
             for p in pars:
-                el =  self.change_user_input(p)
+                el =  parse_user_input(p)
                 for e in el:
                     if e not in self.op and e not in self.reserved and e not in self.special_functions and e not in self.par_sv and e not in self.par_noise and e not in self.par_proc and e not in self.par_forced and e not in self.par_inc:
                         try:
@@ -150,7 +312,7 @@ class Cmodel:
         disp = [x for subl in sde['dispersion'] for x in subl if x != 0] if 'dispersion' in sde else []
         par_disp = set()
         for x in disp:
-            el =  self.change_user_input(x)
+            el =  parse_user_input(x)
             for e in el:
                 if e not in self.op and e not in self.reserved and e not in self.special_functions and e not in self.par_sv and e not in self.par_proc and e not in self.par_obs and e not in self.par_noise and e not in self.par_forced:
                     try:
@@ -176,6 +338,13 @@ class Cmodel:
         ##all parameters
         self.all_par = par_ssm + self.par_other + ['t']
 
+        ##set versions for the lookups of toC and make_C_term
+        self._all_par = set(self.all_par)
+        self._par_states = set(self.par_sv + self.par_inc)
+        self._par_forced = set(self.par_forced)
+        self._par_vector = set(self.par_proc + self.par_noise + self.par_disp + self.par_obs + self.par_other)
+        self._par_diff = set(self.par_diff)
+
         ##orders in nav->states and nav->parameters
         ## !!par_sv must be first in both order_states and order_parameters, remainder must be last in order_states
         self.order_states = {x:i for i,x in enumerate(self.par_sv + self.par_inc + self.par_diff + self.remainder)}
@@ -217,84 +386,91 @@ class Cmodel:
             if self.proc_model[i]['from'] in self.remainder:
                 self.proc_model[i]['rate'] = '({0})*{1}'.format(self.proc_model[i]['rate'], self.proc_model[i]['from'])
 
-            self.proc_model[i]['rate'] = ''.join(map(resolve_remainder, self.change_user_input(m['rate'])))
+            self.proc_model[i]['rate'] = ''.join(map(resolve_remainder, parse_user_input(m['rate'])))
 
 
         for i, m in enumerate(self.obs_model):
             for x in m:
                 if x != "distribution" and x!= 'name' and x !='start':
                     self.obs_model[i][x] = self.pow2star(self.obs_model[i][x])
-                    self.obs_model[i][x] = ''.join(map(resolve_remainder, self.change_user_input(self.obs_model[i][x])))
+                    self.obs_model[i][x] = ''.join(map(resolve_remainder, parse_user_input(self.obs_model[i][x])))
 
         ## incidence def
-        self.par_inc_def = []
-        for inc in self.par_inc:
-            self.par_inc_def.append([x for x in self.proc_model if "accumulators" in x and inc in x['accumulators'] ])
+        inc_def = dict((inc, []) for inc in self.par_inc)
+        for x in self.proc_model:
+            for inc in sorted(set(x.get('accumulators', []))):
+                inc_def[inc].append(x)
+        self.par_inc_def = [inc_def[inc] for inc in self.par_inc]
+
+        ## reaction graph: indices (in proc_model) of the reactions
+        ## leaving (reactions_from) and entering (reactions_to) every
+        ## compartment, position of every reaction among the
+        ## reactions leaving its compartment (ind_exit), reactions
+        ## sharing a reaction_key (reactions_key) and reactions
+        ## affected by every white noise (reactions_noise). Built once
+        ## so that the generators of Ccoder are linear in the size of
+        ## the model.
+        self.reactions_from = {}
+        self.reactions_to = {}
+        self.reactions_key = {}
+        self.reactions_noise = {}
+        self.ind_exit = []
+        for i, r in enumerate(self.proc_model):
+            exits = self.reactions_from.setdefault(r['from'], [])
+            self.ind_exit.append(len(exits))
+            exits.append(i)
+            self.reactions_to.setdefault(r['to'], []).append(i)
+            self.reactions_key.setdefault(reaction_key(r), []).append(i)
+            if 'white_noise' in r:
+                self.reactions_noise.setdefault(r['white_noise']['name'], []).append(i)
 
 
     def change_user_input(self, term):
         """transform the term in smtg that we can parse in a programming language:
-        example: change_user_input('r0*2*correct_rate(v)') -> ['r0', '*', '2', '*', 'correct_rate', '(', 'v', ')']"""
-
-        myterm=term.replace(' ','') ##get rid of whitespaces
-        mylist=[]
-        mystring=''
-
-        for i in range(len(myterm)):
-
-            if myterm[i] in self.op :
-                if len(mystring)>0:
-                    mylist.append(mystring)
-                    mystring=''
-                mylist.append(myterm[i])
-            else:
-                mystring += myterm[i]
+        example: change_user_input('r0*2*correct_rate(v)') -> ['r0', '*', '2', '*', 'correct_rate', '(', 'v', ')']
 
-        if len(mystring)>0: ##the string doesn't end with an operator
-            mylist.append(mystring)
+        Returns a (mutable) copy of parse_user_input(term)"""
 
-        return mylist
+        return list(parse_user_input(term))
 
 
     def pow2star(self, term):
-        """replace pow(a,b) by (a)**(b) so that Sympy works"""
-
+        """replace pow(a,b) by (a)**(b) so that Sympy works. Nested
+        pow are rewritten in a single pass on the tokens"""
 
-        terms = self.change_user_input(term)
+        terms = parse_user_input(term)
 
-        start = 0
-        for i, x in enumerate(terms):
-            if x == 'pow':
-                start = i
-                break
-
-        if not start and not terms[0] == 'pow':
+        if 'pow' not in terms:
             return term
 
-        pos = 1 #counter for open parenthesis
-        ind = start+2 #skip first parenthesis
-        lhs = ''
-        rhs = ''
-        left = True
-        while (ind < len(terms)):
-            if terms[ind] == '(':
-                pos += 1
-            if terms[ind] == ')':
-                pos -= 1
-
-            if pos == 1 and terms[ind] == ',':
-                left = False
-            else:
-                if left:
-                    lhs += terms[ind]
+        def rewrite(ind, stop):
+            """rewrite terms[ind:] up to the first token of stop
+            found outside of parenthesis, returns the rewritten string
+            and the index of the stop token"""
+
+            out = []
+            pos = 0 #counter for open parenthesis
+            while ind < len(terms):
+                x = terms[ind]
+                if pos == 0 and x in stop:
+                    break
+
+                if x == 'pow' and ind+1 < len(terms) and terms[ind+1] == '(':
+                    lhs, ind = rewrite(ind+2, (',',)) #skip first parenthesis
+                    rhs, ind = rewrite(ind+1, (')',))
+                    out.append('({0})**({1})'.format(lhs, rhs))
                 else:
-                    if not (pos == 0 and terms[ind] == ')'):
-                        rhs += terms[ind]
-                    else:
-                        break;
-            ind += 1
+                    if x == '(':
+                        pos += 1
+                    elif x == ')':
+                        pos -= 1
+                    out.append(x)
+
+                ind += 1
 
-        return self.pow2star(''.join(terms).replace('pow({0},{1})'.format(lhs, rhs), '({0})**({1})'.format(lhs, rhs)))
+            return ''.join(out), ind
+
+        return rewrite(0, ())[0]
 
 
 
@@ -313,17 +489,21 @@ class Cmodel:
         if human:
             return term
 
-        if term in self.par_sv or term in self.par_inc:
+        if term in self._par_states:
             if force_par:
                 return 'gsl_vector_get(par,ORDER_{0})'.format(term)
             else:
                 return 'X[ORDER_{0}]'.format(term)
 
-        elif term in self.par_forced:
-            return 'gsl_spline_eval(calc->spline[ORDER_{0}],{1},calc->acc[ORDER_{0}])'.format(term, '0.0' if set_t0 else 't')
+        elif term in self._par_forced:
+            ##covariates at t are interpolated once per time point (see ssm_covariates())
+            if set_t0:
+                return 'gsl_spline_eval(calc->spline[ORDER_{0}],0.0,calc->acc[ORDER_{0}])'.format(term)
+            else:
+                return '_cov[ORDER_{0}]'.format(term)
 
-        elif term in self.par_proc or term in self.par_noise or term in self.par_disp or term in self.par_obs or term in self.par_other:
-            if ('diff__' + term) in self.par_diff:
+        elif term in self._par_vector:
+            if ('diff__' + term) in self._par_diff:
                 return 'diffed[ORDER_diff__{0}]'.format(term)
             else:
                 return 'gsl_vector_get(par,ORDER_{0})'.format(term)
@@ -335,7 +515,7 @@ class Cmodel:
     def generator_C(self, term, no_correct_rate, force_par=False, xify=None, human=False, set_t0=False):
         """add extra terms (for C code) at the end of special functions (support nested special functions)"""
 
-        terms = self.change_user_input(term)
+        terms = parse_user_input(term)
 
         ind = 0
         Cterm = ''
@@ -391,44 +571,144 @@ class Cmodel:
         #avoid namespace collision with Sympy as QCOSINE letters are
         #used by SymPy
 
-        myterm = self.change_user_input(term)
+        myterm = parse_user_input(term)
         safe = ''
 
         for r in myterm:
-            if r in self.all_par:
+            if r in self._all_par:
                 safe += 'ssm___' + r
             elif inverse and r == inverse:
                 safe += 'ssm___' + r
             else:
                 safe += r
 
-        if derivate:
-	    sy = Symbol(str('ssm___' + derivate)) if derivate != 'x' else Symbol(derivate)
-	    pterm = diff(sympify(safe), sy)
-        elif inverse:
-            if inverse in myterm:
-                sy = Symbol(str('ssm___' + inverse))
-                pterm = solve(sympify(safe), sy)
-                if not pterm:
-                    raise SsmError("can't find a solution to " + term + "=0 solving for " + inverse)
-                elif len(pterm)!=1:
-                    raise SsmError("no unique solution for " + term + "=0 solving for " + inverse)
-                else:
-                    pterm = pterm[0]
-            else:
-                pterm = sympify(safe)
-
+        if derivate and derivate not in myterm:
+            ##structural zero: no need to go through SymPy
+            term = '0'
         else:
-            pterm = sympify(safe)
-
-        #remove the ssm___ prefix
-        #term = ccode(simplify(pterm)).replace('ssm___', '') ##NOTE simplify is just too slow to be used...
-        term = ccode(pterm).replace('ssm___', '')
+            term = self.sym_ccode(term, safe, myterm, derivate, inverse)
 
         #make the ssm C expression
         return self.generator_C(term, no_correct_rate, force_par=force_par, xify=xify, human=human, set_t0=set_t0)
 
 
+    def sym_ccode(self, term, safe, myterm, derivate, inverse):
+        """ccode (with the ssm___ prefix removed) of the sanitized
+        term safe, or of its derivate or its inverse.
+
+        Results are memoized in process (keyed on the sanitized
+        expression and the derivate/inverse target) and, if
+        self.cache_dir is set, on disk (see cached_sym_ccode). The C
+        flags of make_C_term are applied afterwards by generator_C so
+        they are not part of the key.
+
+        If self.pending is a list, nothing is computed: the key is
+        appended to it and PENDING is returned (used by the Builder to
+        collect all the symbolic work before computing it in
+        parallel). The keys of terms built on a PENDING result are not
+        collected: they are only known once their operands are.
+        """
+
+        key = (safe, derivate, inverse if (inverse and inverse in myterm) else None)
+
+        if self.profile is not None:
+            self.profile.request(key)
+
+        if key in self._ccoded:
+            self.cache_stats['hits'] += 1
+            return self._ccoded[key]
+
+        if self.pending is not None:
+            if PENDING not in myterm:
+                self.pending.append(key)
+            return PENDING
+
+        if self.profile is None:
+            self._ccoded[key], status = cached_sym_ccode(key, self.cache_dir, self._sympified)
+        else:
+            counts = dict.fromkeys(SYMBOLIC_OPS, 0)
+            t = time.time()
+            self._ccoded[key], status = cached_sym_ccode(key, self.cache_dir, self._sympified, counts)
+            self.profile.computed(key, counts, time.time() - t)
+
+        self.cache_stats[status] += 1
+
+        return self._ccoded[key]
+
+
+def sym_ccode(key, sympified=None, counts=None):
+    """ccode (with the ssm___ prefix removed) of a (safe, derivate,
+    inverse) key (see Cmodel.sym_ccode). sympified is an optional
+    dict used to memoize the sympified trees. If counts is a dict,
+    the SymPy calls made (see SYMBOLIC_OPS) are added to it."""
+
+    safe, derivate, inverse = key
+
+    if counts is None:
+        counts = dict.fromkeys(SYMBOLIC_OPS, 0)
+
+    if sympified is None:
+        sympified = {}
+    if safe not in sympified:
+        sympified[safe] = sympify(safe)
+        counts['sympify'] += 1
+    tree = sympified[safe]
+
+    if derivate:
+        sy = Symbol(str('ssm___' + derivate)) if derivate != 'x' else Symbol(derivate)
+        pterm = diff(tree, sy)
+        counts['diff'] += 1
+    elif inverse:
+        term = safe.replace('ssm___', '')
+        sy = Symbol(str('ssm___' + inverse))
+        pterm = solve(tree, sy)
+        counts['solve'] += 1
+        if not pterm:
+            raise ModelError("can't find a solution to " + term + "=0 solving for " + inverse)
+        elif len(pterm)!=1:
+            raise ModelError("no unique solution for " + term + "=0 solving for " + inverse)
+        else:
+            pterm = pterm[0]
+    else:
+        pterm = tree
+
+    #remove the ssm___ prefix
+    #ccode(simplify(pterm)) ##NOTE simplify is just too slow to be used...
+    counts['ccode'] += 1
+    return ccode(pterm).replace('ssm___', '')
+
+
+def cached_sym_ccode(key, cache_dir, sympified=None, counts=None):
+    """sym_ccode going through the on disk cache of cache_dir (if
+    not None). Entries are stored under the sha1 of the key and of
+    the SymPy version. Returns (ccode, 'disk_hits' or 'misses')
+    """
+
+    path = None
+    if cache_dir:
+        h = hashlib.sha1(json.dumps([sympy.__version__] + list(key))).hexdigest()
+        path = os.path.join(cache_dir, h[:2], h[2:])
+        if os.path.exists(path):
+            with open(path) as f:
+                return (f.read(), 'disk_hits')
+
+    Cterm = sym_ccode(key, sympified, counts)
+
+    if path:
+        ##write then rename so that concurrent builds never read a partial entry
+        if not os.path.exists(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'w') as f:
+            f.write(Cterm)
+        os.rename(tmp, path)
+
+    return (Cterm, 'misses')
+
+
 if __name__=="__main__":
 
     dpkgRoot = os.path.join('..' ,'examples', 'foo')
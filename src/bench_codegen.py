@@ -0,0 +1,304 @@
+##########################################################################
+#    This file is part of ssm.
+#
+#    ssm is free software: you can redistribute it and/or modify it
+#    under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    ssm is distributed in the hope that it will be useful, but
+#    WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#    General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public
+#    License along with ssm.  If not, see
+#    <http://www.gnu.org/licenses/>.
+#########################################################################
+
+"""
+codegen scaling benchmark.
+
+Generate synthetic models of increasing size and time every phase
+of the build (parsing, symbolic generators, rendering and compilation
+of the rendered templates). Results are written as JSON.
+
+    python bench_codegen.py --scale 1 2 4 8 -o bench.json
+"""
+
+import os
+import sys
+import copy
+import json
+import time
+import shutil
+import tempfile
+import platform
+import argparse
+import datetime
+import subprocess
+from distutils.spawn import find_executable
+
+import sympy
+
+from Ccoder import Ccoder
+from Builder import Builder
+
+
+SIZES = ['compartments', 'reactions', 'white_noises', 'drifts', 'covariates', 'observations']
+
+PRIORS = {
+    'ic': {'name': 'dirac', 'distributionParameter': [{'value': 100}]},
+    'N': {'name': 'dirac', 'distributionParameter': [{'value': 1000}]},
+    'k': {'name': 'uniform', 'distributionParameter': [{'name': 'lower', 'value': 0.1}, {'name': 'upper', 'value': 1.0}]},
+    'rep': {'name': 'uniform', 'distributionParameter': [{'name': 'lower', 'value': 0.1}, {'name': 'upper', 'value': 0.9}]},
+    'sto': {'name': 'dirac', 'distributionParameter': [{'value': 0.1}]},
+    'vol': {'name': 'dirac', 'distributionParameter': [{'value': 0.1}]}
+}
+
+
+def synthetic_model(compartments=3, reactions=3, white_noises=0, drifts=0, covariates=0, observations=1, n_data=10):
+    """
+    return (ssm.json, {path: content}) for a synthetic model.
+
+    The compartments X_0, ..., X_{c-1} form a single population of
+    size N. Reaction j moves X_{j%c} to X_{(j+1)%c} at rate
+    k_j*X_{(j+1)%c}/N (times the covariate cov_{j%covariates} if
+    any). The first white_noises reactions have their own white
+    noise, the first drifts k_j follow a diffusion and observation i
+    is the incidence of reaction i%reactions.
+    """
+
+    if compartments < 2 or reactions < 1 or observations < 1:
+        raise ValueError('a synthetic model needs at least 2 compartments, 1 reaction and 1 observation')
+    if white_noises > reactions or drifts > reactions:
+        raise ValueError('at most one white noise and one drift per reaction')
+
+    X = ['X_{0}'.format(i) for i in range(compartments)]
+    dates = [(datetime.date(2012, 7, 26) + datetime.timedelta(days=7*i)).isoformat() for i in range(n_data)]
+
+    files = dict(('data/{0}.json'.format(k), v) for k, v in PRIORS.items())
+
+    inputs = [{'name': x, 'require': {'name': x, 'path': 'data/ic.json'}} for x in X]
+    inputs += [{'name': 'N', 'require': {'name': 'N', 'path': 'data/N.json'}}]
+    inputs += [{'name': 'k_{0}'.format(j), 'require': {'name': 'k_{0}'.format(j), 'path': 'data/k.json'}} for j in range(reactions)]
+    inputs += [{'name': 'rep', 'require': {'name': 'rep', 'path': 'data/rep.json'}}]
+    if white_noises:
+        inputs += [{'name': 'sto', 'require': {'name': 'sto', 'path': 'data/sto.json'}}]
+    if drifts:
+        inputs += [{'name': 'vol', 'require': {'name': 'vol', 'path': 'data/vol.json'}}]
+
+    cov = ['cov_{0}'.format(m) for m in range(covariates)]
+    inputs += [{'name': x, 'require': {'path': 'data/covariates.csv', 'fields': ['date', x]}} for x in cov]
+    if cov:
+        files['data/covariates.csv'] = '\n'.join([','.join(['"date"'] + ['"{0}"'.format(x) for x in cov])] +
+                                                 [','.join(['"{0}"'.format(d)] + ['1.0'] * len(cov)) for d in dates]) + '\n'
+
+    rxns = []
+    for j in range(reactions):
+        rate = 'k_{0}*{1}/N'.format(j, X[(j+1) % compartments])
+        if cov:
+            rate = '{0}*{1}'.format(cov[j % covariates], rate)
+        r = {'from': X[j % compartments], 'to': X[(j+1) % compartments], 'rate': rate, 'accumulators': []}
+        if j < white_noises:
+            r['white_noise'] = {'name': 'noise_{0}'.format(j), 'sd': 'sto'}
+        rxns.append(r)
+
+    obs = []
+    for i in range(observations):
+        inc = 'Inc_{0}'.format(i)
+        rxns[i % reactions]['accumulators'].append(inc)
+        obs.append({
+            'name': 'obs_{0}'.format(i),
+            'start': dates[0],
+            'distribution': 'discretized_normal',
+            'mean': 'rep*{0}'.format(inc),
+            'sd': 'sqrt(rep*(1.0-rep)*{0})'.format(inc)
+        })
+
+    for r in rxns:
+        if not r['accumulators']:
+            del r['accumulators']
+
+    names = [x['name'] for x in obs]
+    files['data/data.csv'] = '\n'.join([','.join(['"date"'] + ['"{0}"'.format(x) for x in names])] +
+                                       [','.join(['"{0}"'.format(d)] + ['10'] * len(names)) for d in dates]) + '\n'
+
+    dpkg = {
+        'data': [{'name': x, 'require': {'path': 'data/data.csv', 'fields': ['date', x]}} for x in names],
+        'inputs': inputs,
+        'populations': [{'name': 'pop', 'composition': X}],
+        'reactions': rxns,
+        'observations': obs
+    }
+
+    if drifts:
+        dpkg['sde'] = {
+            'drift': [{'name': 'k_{0}'.format(j), 'f': 0.0, 'transformation': 'log(k_{0})'.format(j)} for j in range(drifts)],
+            'dispersion': [['vol' if i == j else 0 for j in range(drifts)] for i in range(drifts)]
+        }
+
+    return dpkg, files
+
+
+def write_model(dpkgRoot, dpkg, files):
+    """write ssm.json and its resources in dpkgRoot"""
+
+    for path, content in files.items():
+        path = os.path.join(dpkgRoot, path)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            if isinstance(content, basestring):
+                f.write(content)
+            else:
+                json.dump(content, f)
+
+    with open(os.path.join(dpkgRoot, 'ssm.json'), 'w') as f:
+        json.dump(dpkg, f, indent=2)
+
+
+def timed(f):
+    t = time.time()
+    f()
+    return time.time() - t
+
+
+def compile_rendered(path_rendered, jobs=1):
+    """compile the rendered templates (make all: libssmtpl.a, not linked)"""
+
+    if not find_executable('gcc') or not find_executable('make'):
+        return {'status': 'skipped', 'time': None}
+
+    t = time.time()
+    p = subprocess.Popen(['make', '-j', str(jobs)], cwd=os.path.join(path_rendered, 'C', 'templates'), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    out, err = p.communicate()
+    elapsed = time.time() - t
+
+    if p.returncode != 0:
+        return {'status': 'failed', 'time': elapsed, 'returncode': p.returncode, 'stderr': err.strip().splitlines()[-10:]}
+
+    return {'status': 'ok', 'time': elapsed}
+
+
+def bench(dpkgRoot, dpkg, compile=True, jobs=1):
+    """
+    time every phase of the build of the model dpkg.
+
+    Each symbolic phase runs on a fresh Ccoder without on disk cache
+    so that the timings do not depend on the order of the phases
+    (jac is given the special functions of step_ode_sde, computed
+    outside of the timing).
+    """
+
+    fresh = lambda: Ccoder(dpkgRoot, copy.deepcopy(dpkg), cache_dir=None)
+
+    m = fresh()
+    sizes = {
+        'states': len(m.par_sv) + len(m.par_inc),
+        'reactions': len(m.proc_model),
+        'white_noises': len(m.white_noise),
+        'drifts': len(m.par_diff),
+        'covariates': len(m.par_forced),
+        'observations': len(m.obs_model)
+    }
+
+    phases = {}
+    phases['parse'] = timed(fresh)
+    for name in ['step_ode_sde', 'Ht', 'h_grads', 'eval_Q']:
+        m = fresh()
+        phases[name] = timed(getattr(m, name))
+
+    m = fresh()
+    sf = m.step_ode_sde()['sf']
+    phases['jac'] = timed(lambda: m.jac(sf))
+
+    ##Builder.code does not use the data (only write_data does)
+    path_rendered = os.path.join(dpkgRoot, 'bin')
+    if not os.path.exists(path_rendered):
+        os.makedirs(path_rendered)
+    with open(os.path.join(path_rendered, '.data.json'), 'w') as f:
+        f.write('[]')
+
+    b = Builder(path_rendered, dpkgRoot, copy.deepcopy(dpkg), cache_dir=None)
+    b.prepare(replace=True)
+    ##code() reports its cache statistics on stdout, keep stdout for the results
+    stdout, sys.stdout = sys.stdout, sys.stderr
+    try:
+        phases['render'] = timed(lambda: b.code(jobs=jobs))
+    finally:
+        sys.stdout = stdout
+
+    path_templates = os.path.join(path_rendered, 'C', 'templates')
+    rendered = [os.path.join(path_templates, x) for x in os.listdir(path_templates) if x.endswith('.c')]
+    lines = sum(len(open(x).readlines()) for x in rendered)
+
+    res = {'sizes': sizes, 'phases': phases, 'rendered_lines': lines}
+    if compile:
+        res['compile'] = compile_rendered(path_rendered, jobs)
+        phases['compile'] = res['compile']['time'] if res['compile']['status'] == 'ok' else None
+
+    return res
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='time the code generation of synthetic models of increasing size')
+    parser.add_argument('--compartments', type=int, default=3)
+    parser.add_argument('--reactions', type=int, default=3)
+    parser.add_argument('--white-noises', type=int, default=1)
+    parser.add_argument('--drifts', type=int, default=1)
+    parser.add_argument('--covariates', type=int, default=1)
+    parser.add_argument('--observations', type=int, default=1)
+    parser.add_argument('--scale', type=int, nargs='+', default=[1, 2, 4], help='every size is multiplied by each scale in turn')
+    parser.add_argument('--repeat', type=int, default=1, help='keep the fastest of REPEAT runs for each phase')
+    parser.add_argument('--jobs', type=int, default=1, help='passed to Builder.code and make')
+    parser.add_argument('--no-compile', action='store_true')
+    parser.add_argument('--keep', help='generate the models in KEEP (kept after the run) instead of a temporary directory')
+    parser.add_argument('-o', '--output', help='JSON results (default: stdout)')
+    args = parser.parse_args(argv)
+
+    root = args.keep or tempfile.mkdtemp(prefix='ssm_bench_')
+    runs = []
+    try:
+        for scale in args.scale:
+            params = dict((k, getattr(args, k) * scale) for k in SIZES)
+            dpkgRoot = os.path.join(root, 'scale_{0}'.format(scale))
+            dpkg, files = synthetic_model(**params)
+            write_model(dpkgRoot, dpkg, files)
+
+            best = None
+            for _ in range(args.repeat):
+                res = bench(dpkgRoot, dpkg, compile=not args.no_compile, jobs=args.jobs)
+                if best is None:
+                    best = res
+                else:
+                    for k, v in res['phases'].items():
+                        if v is not None and (best['phases'][k] is None or v < best['phases'][k]):
+                            best['phases'][k] = v
+
+            best['scale'] = scale
+            best['params'] = params
+            runs.append(best)
+            sys.stderr.write('scale {0}: {1}\n'.format(scale, ', '.join('{0} {1:.3f}s'.format(k, v) for k, v in sorted(best['phases'].items()) if v is not None)))
+    finally:
+        if not args.keep:
+            shutil.rmtree(root)
+
+    out = {
+        'date': datetime.datetime.now().isoformat(),
+        'python': platform.python_version(),
+        'sympy': sympy.__version__,
+        'jobs': args.jobs,
+        'repeat': args.repeat,
+        'runs': runs
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(out, f, indent=2)
+    else:
+        print json.dumps(out, indent=2)
+
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,82 @@
+from Builder import Builder
+import unittest
+import copy
+import json
+import os
+import shutil
+import tempfile
+
+class TestBuilder(unittest.TestCase):
+
+    def setUp(self):
+        self.dpkgRoot = os.path.join('..' ,'examples', 'noise')
+        self.dpkg = json.load(open(os.path.join(self.dpkgRoot, 'ssm.json')))
+
+        self.path_rendered = tempfile.mkdtemp()
+        with open(os.path.join(self.path_rendered, '.data.json'), 'w') as f:
+            f.write('[]')
+
+    def tearDown(self):
+        shutil.rmtree(self.path_rendered)
+
+    def build(self, dpkg, **kwargs):
+        b = Builder(self.path_rendered, self.dpkgRoot, copy.deepcopy(dpkg), cache_dir=None, **kwargs)
+        b.prepare()
+        b.code()
+        return b
+
+    def test_code_incremental(self):
+        self.build(self.dpkg)
+
+        ##set the mtimes in the past so that a rewrite is visible
+        path_templates = os.path.join(self.path_rendered, 'C', 'templates')
+        rendered = [x for x in os.listdir(path_templates) if x.endswith('.c')]
+        for x in rendered:
+            os.utime(os.path.join(path_templates, x), (0, 0))
+
+        self.assertTrue(os.path.exists(os.path.join(path_templates, '.build.json')))
+
+        ##one observation formula changed: only observed.c is rewritten
+        dpkg = copy.deepcopy(self.dpkg)
+        dpkg['observations'][0]['sd'] = 'sqrt(rep_all_CDC_inc * prop_all_CDC_inc * all_inc_out + pow(rep_all_CDC_inc * phi * all_inc_out, 2))'
+        self.build(dpkg)
+
+        changed = [x for x in rendered if os.stat(os.path.join(path_templates, x)).st_mtime != 0]
+        self.assertEqual(changed, ['observed.c'])
+
+        ##nothing changed: nothing is rewritten
+        os.utime(os.path.join(path_templates, 'observed.c'), (0, 0))
+        self.build(dpkg)
+        changed = [x for x in rendered if os.stat(os.path.join(path_templates, x)).st_mtime != 0]
+        self.assertEqual(changed, [])
+
+    def test_code_jobs(self):
+        path_templates = os.path.join(self.path_rendered, 'C', 'templates')
+        def rendered():
+            return dict((x, open(os.path.join(path_templates, x)).read()) for x in os.listdir(path_templates) if x.endswith('.c'))
+
+        misses = self.build(self.dpkg).cache_stats['misses']
+        serial = rendered()
+
+        shutil.rmtree(os.path.join(self.path_rendered, 'C'))
+        b = Builder(self.path_rendered, self.dpkgRoot, copy.deepcopy(self.dpkg), cache_dir=None)
+        b.prepare()
+        b.code(jobs=2)
+        self.assertEqual(rendered(), serial)
+        ##every term is computed once, in the pool or (built on other terms) afterwards
+        self.assertEqual(b.cache_stats['misses'], misses)
+
+    def test_code_profile(self):
+        self.build(self.dpkg)
+        self.assertFalse(os.path.exists(os.path.join(self.path_rendered, '.profile.json')))
+
+        shutil.rmtree(os.path.join(self.path_rendered, 'C'))
+        self.build(self.dpkg, profile=True)
+        stats = json.load(open(os.path.join(self.path_rendered, '.profile.json')))['stats']
+        self.assertEqual(sorted(stats.keys()), ['cse', 'precompute', 'symbolic_cache', 'time_cache'])
+        self.assertTrue(stats['precompute']['length'] > 0)
+        self.assertTrue(stats['precompute']['templates']['observed'] > 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
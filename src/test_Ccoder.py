@@ -1,9 +1,11 @@
-from Ccoder import Ccoder
+from Ccoder import Ccoder, SparseMatrix, C_roll, C_soa, SOA_ARRAYS, ROLL_UNIT, C_parse, C_depends, C_states, C_is_stationary, C_CONST, C_PAR, C_TIME, C_STATE
 import unittest
 import copy
 import json
 import os
 import shutil
+import re
+from sympy import Symbol, Function, sympify, expand
 
 class TestCcoder(unittest.TestCase):
 
@@ -72,6 +74,15 @@ class TestCcoder(unittest.TestCase):
         self.m_diff2 = Ccoder(dpkgRoot, m_diff2)
     
 
+    def assertTermEqual(self, term, expected):
+        """terms of Q are compared as sums of products, not as strings"""
+        if not expected:
+            return self.assertEqual(term, expected)
+
+        ns = dict((x, Symbol(x)) for x in re.findall(r'[A-Za-z_]\w*', term + expected))
+        ns['correct_rate'] = Function('correct_rate')
+        self.assertEqual(expand(sympify(term, locals=ns) - sympify(expected, locals=ns)), 0)
+
     def test_eval_Q(self):
         calc_Q = self.m_noise.eval_Q()
 
@@ -80,42 +91,42 @@ class TestCcoder(unittest.TestCase):
         term_paris = '((((r0_paris/N_paris*v*I_paris)*S_paris)*((sto)**2))*((r0_paris/N_paris*v*I_paris)*S_paris)))'
         term_nyc = '((((r0_nyc/N_nyc*v*I_nyc)*S_nyc)*((sto)**2))*((r0_nyc/N_nyc*v*I_nyc)*S_nyc)))'
         Q_cm = calc_Q["no_dem_sto"]["Q_cm"]
-        self.assertEqual(Q_cm[0][0], '((1)*'+term_nyc+'*(1)')
-        self.assertEqual(Q_cm[0][1], 0)
-        self.assertEqual(Q_cm[0][2], '((1)*'+term_nyc+'*(-1)')
-        self.assertEqual(Q_cm[0][3], 0)
-        self.assertEqual(Q_cm[0][4], 0)
-        self.assertEqual(Q_cm[0][5], '((1)*'+term_nyc+'*(1)')
-        self.assertEqual(Q_cm[1][0], 0)
-        self.assertEqual(Q_cm[1][1], '((1)*'+term_paris+'*(1)')
-        self.assertEqual(Q_cm[1][2], 0)
-        self.assertEqual(Q_cm[1][3], '((1)*'+term_paris+'*(-1)')
-        self.assertEqual(Q_cm[1][4], 0)
-        self.assertEqual(Q_cm[1][5], 0)
-        self.assertEqual(Q_cm[2][0], '((-1)*'+term_nyc+'*(1)')
-        self.assertEqual(Q_cm[2][1], 0)
-        self.assertEqual(Q_cm[2][2], '((-1)*'+term_nyc+'*(-1)')
-        self.assertEqual(Q_cm[2][3], 0)
-        self.assertEqual(Q_cm[2][4], 0)
-        self.assertEqual(Q_cm[2][5], '((-1)*'+term_nyc+'*(1)')
-        self.assertEqual(Q_cm[3][0], 0)
-        self.assertEqual(Q_cm[3][1], '((-1)*'+term_paris+'*(1)')
-        self.assertEqual(Q_cm[3][2], 0)
-        self.assertEqual(Q_cm[3][3], '((-1)*'+term_paris+'*(-1)')
-        self.assertEqual(Q_cm[3][4], 0)
-        self.assertEqual(Q_cm[3][5], 0)
-        self.assertEqual(Q_cm[4][0], 0)
-        self.assertEqual(Q_cm[4][1], 0)
-        self.assertEqual(Q_cm[4][2], 0)
-        self.assertEqual(Q_cm[4][3], 0)
-        self.assertEqual(Q_cm[4][4], 0)
-        self.assertEqual(Q_cm[4][5], 0)
-        self.assertEqual(Q_cm[5][0], '((1)*'+term_nyc+'*(1)')
-        self.assertEqual(Q_cm[5][1], 0)
-        self.assertEqual(Q_cm[5][2], '((1)*'+term_nyc+'*(-1)')
-        self.assertEqual(Q_cm[5][3], 0)
-        self.assertEqual(Q_cm[5][4], 0)
-        self.assertEqual(Q_cm[5][5], '((1)*'+term_nyc+'*(1)')
+        self.assertTermEqual(Q_cm[0][0], '((1)*'+term_nyc+'*(1)')
+        self.assertTermEqual(Q_cm[0][1], 0)
+        self.assertTermEqual(Q_cm[0][2], '((1)*'+term_nyc+'*(-1)')
+        self.assertTermEqual(Q_cm[0][3], 0)
+        self.assertTermEqual(Q_cm[0][4], 0)
+        self.assertTermEqual(Q_cm[0][5], '((1)*'+term_nyc+'*(1)')
+        self.assertTermEqual(Q_cm[1][0], 0)
+        self.assertTermEqual(Q_cm[1][1], '((1)*'+term_paris+'*(1)')
+        self.assertTermEqual(Q_cm[1][2], 0)
+        self.assertTermEqual(Q_cm[1][3], '((1)*'+term_paris+'*(-1)')
+        self.assertTermEqual(Q_cm[1][4], 0)
+        self.assertTermEqual(Q_cm[1][5], 0)
+        self.assertTermEqual(Q_cm[2][0], '((-1)*'+term_nyc+'*(1)')
+        self.assertTermEqual(Q_cm[2][1], 0)
+        self.assertTermEqual(Q_cm[2][2], '((-1)*'+term_nyc+'*(-1)')
+        self.assertTermEqual(Q_cm[2][3], 0)
+        self.assertTermEqual(Q_cm[2][4], 0)
+        self.assertTermEqual(Q_cm[2][5], '((-1)*'+term_nyc+'*(1)')
+        self.assertTermEqual(Q_cm[3][0], 0)
+        self.assertTermEqual(Q_cm[3][1], '((-1)*'+term_paris+'*(1)')
+        self.assertTermEqual(Q_cm[3][2], 0)
+        self.assertTermEqual(Q_cm[3][3], '((-1)*'+term_paris+'*(-1)')
+        self.assertTermEqual(Q_cm[3][4], 0)
+        self.assertTermEqual(Q_cm[3][5], 0)
+        self.assertTermEqual(Q_cm[4][0], 0)
+        self.assertTermEqual(Q_cm[4][1], 0)
+        self.assertTermEqual(Q_cm[4][2], 0)
+        self.assertTermEqual(Q_cm[4][3], 0)
+        self.assertTermEqual(Q_cm[4][4], 0)
+        self.assertTermEqual(Q_cm[4][5], 0)
+        self.assertTermEqual(Q_cm[5][0], '((1)*'+term_nyc+'*(1)')
+        self.assertTermEqual(Q_cm[5][1], 0)
+        self.assertTermEqual(Q_cm[5][2], '((1)*'+term_nyc+'*(-1)')
+        self.assertTermEqual(Q_cm[5][3], 0)
+        self.assertTermEqual(Q_cm[5][4], 0)
+        self.assertTermEqual(Q_cm[5][5], '((1)*'+term_nyc+'*(1)')
 
         # testing dem sto only
         term1_p = '(mu_b_paris*N_paris))'
@@ -130,42 +141,42 @@ class TestCcoder(unittest.TestCase):
         term5_n = '((mu_d_nyc)*I_nyc))'
         # order: I_nyc, I_paris, S_nyc, S_paris, inc_all , inc_nyc
         Q_cm = calc_Q["no_env_sto"]["Q_cm"]
-        self.assertEqual(Q_cm[0][0], '((1)*'+term2_n+'*(1) + ((-1)*'+term3_n+'*(-1) + ((-1)*'+term5_n+'*(-1)')
-        self.assertEqual(Q_cm[0][1], 0)
-        self.assertEqual(Q_cm[0][2], '((1)*'+term2_n+'*(-1)')
-        self.assertEqual(Q_cm[0][3], 0)
-        self.assertEqual(Q_cm[0][4], '((-1)*'+term3_n+'*(1) + ((-1)*'+term5_n+'*(1)')
-        self.assertEqual(Q_cm[0][5], '((1)*'+term2_n+'*(1)')
-        self.assertEqual(Q_cm[1][0], 0)
-        self.assertEqual(Q_cm[1][1], '((1)*'+term2_p+'*(1) + ((-1)*'+term3_p+'*(-1) + ((-1)*'+term5_p+'*(-1)')
-        self.assertEqual(Q_cm[1][2], 0)
-        self.assertEqual(Q_cm[1][3], '((1)*'+term2_p+'*(-1)')
-        self.assertEqual(Q_cm[1][4], '((-1)*'+term3_p+'*(1) + ((-1)*'+term5_p+'*(1)')
-        self.assertEqual(Q_cm[1][5], 0)
-        self.assertEqual(Q_cm[2][0], '((-1)*'+term2_n+'*(1)')
-        self.assertEqual(Q_cm[2][1], 0)
-        self.assertEqual(Q_cm[2][2], '((1)*'+term1_n+'*(1) + ((-1)*'+term2_n+'*(-1) + ((-1)*'+term4_n+'*(-1)')
-        self.assertEqual(Q_cm[2][3], 0)
-        self.assertEqual(Q_cm[2][4], 0)
-        self.assertEqual(Q_cm[2][5], '((-1)*'+term2_n+'*(1)')
-        self.assertEqual(Q_cm[3][0], 0)
-        self.assertEqual(Q_cm[3][1], '((-1)*'+term2_p+'*(1)')
-        self.assertEqual(Q_cm[3][2], 0)
-        self.assertEqual(Q_cm[3][3], '((1)*'+term1_p+'*(1) + ((-1)*'+term2_p+'*(-1) + ((-1)*'+term4_p+'*(-1)')
-        self.assertEqual(Q_cm[3][4], 0)
-        self.assertEqual(Q_cm[3][5], 0)
-        self.assertEqual(Q_cm[4][0], '((1)*'+term3_n+'*(-1) + ((1)*'+term5_n+'*(-1)')
-        self.assertEqual(Q_cm[4][1], '((1)*'+term3_p+'*(-1) + ((1)*'+term5_p+'*(-1)')
-        self.assertEqual(Q_cm[4][2], 0)
-        self.assertEqual(Q_cm[4][3], 0)
-        self.assertEqual(Q_cm[4][4], '((1)*'+term3_p+'*(1) + ((1)*'+term3_n+'*(1) + ((1)*'+term5_p+'*(1) + ((1)*'+term5_n+'*(1)')
-        self.assertEqual(Q_cm[4][5], 0)
-        self.assertEqual(Q_cm[5][0], '((1)*'+term2_n+'*(1)')
-        self.assertEqual(Q_cm[5][1], 0)
-        self.assertEqual(Q_cm[5][2], '((1)*'+term2_n+'*(-1)')
-        self.assertEqual(Q_cm[5][3], 0)
-        self.assertEqual(Q_cm[5][4], 0)
-        self.assertEqual(Q_cm[5][5], '((1)*'+term2_n+'*(1)')
+        self.assertTermEqual(Q_cm[0][0], '((1)*'+term2_n+'*(1) + ((-1)*'+term3_n+'*(-1) + ((-1)*'+term5_n+'*(-1)')
+        self.assertTermEqual(Q_cm[0][1], 0)
+        self.assertTermEqual(Q_cm[0][2], '((1)*'+term2_n+'*(-1)')
+        self.assertTermEqual(Q_cm[0][3], 0)
+        self.assertTermEqual(Q_cm[0][4], '((-1)*'+term3_n+'*(1) + ((-1)*'+term5_n+'*(1)')
+        self.assertTermEqual(Q_cm[0][5], '((1)*'+term2_n+'*(1)')
+        self.assertTermEqual(Q_cm[1][0], 0)
+        self.assertTermEqual(Q_cm[1][1], '((1)*'+term2_p+'*(1) + ((-1)*'+term3_p+'*(-1) + ((-1)*'+term5_p+'*(-1)')
+        self.assertTermEqual(Q_cm[1][2], 0)
+        self.assertTermEqual(Q_cm[1][3], '((1)*'+term2_p+'*(-1)')
+        self.assertTermEqual(Q_cm[1][4], '((-1)*'+term3_p+'*(1) + ((-1)*'+term5_p+'*(1)')
+        self.assertTermEqual(Q_cm[1][5], 0)
+        self.assertTermEqual(Q_cm[2][0], '((-1)*'+term2_n+'*(1)')
+        self.assertTermEqual(Q_cm[2][1], 0)
+        self.assertTermEqual(Q_cm[2][2], '((1)*'+term1_n+'*(1) + ((-1)*'+term2_n+'*(-1) + ((-1)*'+term4_n+'*(-1)')
+        self.assertTermEqual(Q_cm[2][3], 0)
+        self.assertTermEqual(Q_cm[2][4], 0)
+        self.assertTermEqual(Q_cm[2][5], '((-1)*'+term2_n+'*(1)')
+        self.assertTermEqual(Q_cm[3][0], 0)
+        self.assertTermEqual(Q_cm[3][1], '((-1)*'+term2_p+'*(1)')
+        self.assertTermEqual(Q_cm[3][2], 0)
+        self.assertTermEqual(Q_cm[3][3], '((1)*'+term1_p+'*(1) + ((-1)*'+term2_p+'*(-1) + ((-1)*'+term4_p+'*(-1)')
+        self.assertTermEqual(Q_cm[3][4], 0)
+        self.assertTermEqual(Q_cm[3][5], 0)
+        self.assertTermEqual(Q_cm[4][0], '((1)*'+term3_n+'*(-1) + ((1)*'+term5_n+'*(-1)')
+        self.assertTermEqual(Q_cm[4][1], '((1)*'+term3_p+'*(-1) + ((1)*'+term5_p+'*(-1)')
+        self.assertTermEqual(Q_cm[4][2], 0)
+        self.assertTermEqual(Q_cm[4][3], 0)
+        self.assertTermEqual(Q_cm[4][4], '((1)*'+term3_p+'*(1) + ((1)*'+term3_n+'*(1) + ((1)*'+term5_p+'*(1) + ((1)*'+term5_n+'*(1)')
+        self.assertTermEqual(Q_cm[4][5], 0)
+        self.assertTermEqual(Q_cm[5][0], '((1)*'+term2_n+'*(1)')
+        self.assertTermEqual(Q_cm[5][1], 0)
+        self.assertTermEqual(Q_cm[5][2], '((1)*'+term2_n+'*(-1)')
+        self.assertTermEqual(Q_cm[5][3], 0)
+        self.assertTermEqual(Q_cm[5][4], 0)
+        self.assertTermEqual(Q_cm[5][5], '((1)*'+term2_n+'*(1)')
         
 
     def test_eval_Q_tricky_cases(self):
@@ -177,11 +188,11 @@ class TestCcoder(unittest.TestCase):
         for i in range(5):
             for j in range(5):
                 if i==2 and j == 2:
-                    self.assertEqual(calc_Q["no_dem_sto"]["Q_cm"][i][j],'((1)*'+term_n+'*(1)')
+                    self.assertTermEqual(calc_Q["no_dem_sto"]["Q_cm"][i][j],'((1)*'+term_n+'*(1)')
                 elif i==3 and j == 3:
-                    self.assertEqual(calc_Q["no_dem_sto"]["Q_cm"][i][j],'((1)*'+term_p+'*(1)')
+                    self.assertTermEqual(calc_Q["no_dem_sto"]["Q_cm"][i][j],'((1)*'+term_p+'*(1)')
                 else:
-                    self.assertEqual(calc_Q["no_dem_sto"]["Q_cm"][i][j],0)
+                    self.assertTermEqual(calc_Q["no_dem_sto"]["Q_cm"][i][j],0)
 
 
         calc_Q = self.m_noise3.eval_Q()
@@ -192,21 +203,21 @@ class TestCcoder(unittest.TestCase):
         for i in range(5):
             for j in range(5):
                 if i==0 and j == 0:
-                    self.assertEqual(Q_cm[i][j], '((-1)*'+term_n+'*(-1)')
+                    self.assertTermEqual(Q_cm[i][j], '((-1)*'+term_n+'*(-1)')
                 elif i==1 and j == 1:
-                    self.assertEqual(Q_cm[i][j], '((-1)*'+term_p+'*(-1)')
+                    self.assertTermEqual(Q_cm[i][j], '((-1)*'+term_p+'*(-1)')
                 elif i==0  and j == 4:
-                    self.assertEqual(Q_cm[i][j], '((-1)*'+term_n+'*(1)')
+                    self.assertTermEqual(Q_cm[i][j], '((-1)*'+term_n+'*(1)')
                 elif i==4  and j == 0:
-                    self.assertEqual(Q_cm[i][j], '((1)*'+term_n+'*(-1)')
+                    self.assertTermEqual(Q_cm[i][j], '((1)*'+term_n+'*(-1)')
                 elif i==1  and j == 4:
-                    self.assertEqual(Q_cm[i][j], '((-1)*'+term_p+'*(1)')
+                    self.assertTermEqual(Q_cm[i][j], '((-1)*'+term_p+'*(1)')
                 elif i==4  and j == 1:
-                    self.assertEqual(Q_cm[i][j], '((1)*'+term_p+'*(-1)')
+                    self.assertTermEqual(Q_cm[i][j], '((1)*'+term_p+'*(-1)')
                 elif i==4  and j == 4:
-                    self.assertEqual(Q_cm[i][j], '((1)*'+term_p+'*(1) + ((1)*'+term_n+'*(1)')
+                    self.assertTermEqual(Q_cm[i][j], '((1)*'+term_p+'*(1) + ((1)*'+term_n+'*(1)')
                 else:
-                    self.assertEqual(Q_cm[i][j], 0)
+                    self.assertTermEqual(Q_cm[i][j], 0)
         
 
         calc_Q = self.m_noise4.eval_Q()
@@ -217,21 +228,21 @@ class TestCcoder(unittest.TestCase):
         for i in range(5):
             for j in range(5):
                 if i==0 and j == 0:
-                    self.assertEqual(Q_cm[i][j], '((-1)*'+term_n+'*(-1)')
+                    self.assertTermEqual(Q_cm[i][j], '((-1)*'+term_n+'*(-1)')
                 elif i==1 and j == 1:
-                    self.assertEqual(Q_cm[i][j], '((-1)*'+term_p+'*(-1)')
+                    self.assertTermEqual(Q_cm[i][j], '((-1)*'+term_p+'*(-1)')
                 elif i==1  and j == 4:
-                    self.assertEqual(Q_cm[i][j], '((-1)*'+term_p+'*(1)')
+                    self.assertTermEqual(Q_cm[i][j], '((-1)*'+term_p+'*(1)')
                 elif i==4  and j == 1:
-                    self.assertEqual(Q_cm[i][j], '((1)*'+term_p+'*(-1)')
+                    self.assertTermEqual(Q_cm[i][j], '((1)*'+term_p+'*(-1)')
                 elif i==0  and j == 4:
-                    self.assertEqual(Q_cm[i][j], '((-1)*'+term_n+'*(1)')
+                    self.assertTermEqual(Q_cm[i][j], '((-1)*'+term_n+'*(1)')
                 elif i==4  and j == 0:
-                    self.assertEqual(Q_cm[i][j], '((1)*'+term_n+'*(-1)')
+                    self.assertTermEqual(Q_cm[i][j], '((1)*'+term_n+'*(-1)')
                 elif i==4  and j == 4:
-                    self.assertEqual(Q_cm[i][j], '((1)*'+term_p+'*(1) + ((1)*'+term_n+'*(1)')
+                    self.assertTermEqual(Q_cm[i][j], '((1)*'+term_p+'*(1) + ((1)*'+term_n+'*(1)')
                 else:
-                    self.assertEqual(Q_cm[i][j], 0)
+                    self.assertTermEqual(Q_cm[i][j], 0)
 
                     
 
@@ -239,7 +250,7 @@ class TestCcoder(unittest.TestCase):
         # testing env sto only for m_noise5 : WN on R->U
         for i in range(5):
             for j in range(5):
-                self.assertEqual(calc_Q["no_dem_sto"]["Q_cm"][i][j],0)
+                self.assertTermEqual(calc_Q["no_dem_sto"]["Q_cm"][i][j],0)
 
         calc_Q = self.m_noise6.eval_Q()
         # testing env sto only for m_noise6 : correlated WN on I->R and S->I
@@ -248,43 +259,43 @@ class TestCcoder(unittest.TestCase):
         term1_n = '((r0_nyc/N_nyc*v*I_nyc)*S_nyc)'
         term2_n = '((correct_rate(v))*I_nyc)'
         Q_cm = calc_Q["no_dem_sto"]["Q_cm"]
-        self.assertEqual(Q_cm[0][0], '((1)*(('+term1_n+'*((sto)**2))*'+term1_n+') + (-1)*(('+term2_n+'*((sto)**2))*'+term1_n+'))*(1) + ((1)*(('+term1_n+'*((sto)**2))*'+term2_n+') + (-1)*(('+term2_n+'*((sto)**2))*'+term2_n+'))*(-1)')
-        self.assertEqual(Q_cm[0][1], 0)
-        self.assertEqual(Q_cm[0][2], '((1)*(('+term1_n+'*((sto)**2))*'+term1_n+') + (-1)*(('+term2_n+'*((sto)**2))*'+term1_n+'))*(-1)')
-        self.assertEqual(Q_cm[0][3], 0)
-        self.assertEqual(Q_cm[0][4], '((1)*(('+term1_n+'*((sto)**2))*'+term2_n+') + (-1)*(('+term2_n+'*((sto)**2))*'+term2_n+'))*(1)')
-        self.assertEqual(Q_cm[0][5], '((1)*(('+term1_n+'*((sto)**2))*'+term1_n+') + (-1)*(('+term2_n+'*((sto)**2))*'+term1_n+'))*(1)')
-        self.assertEqual(Q_cm[1][0], 0)
-        self.assertEqual(Q_cm[1][1], '((1)*(('+term1_p+'*((sto)**2))*'+term1_p+') + (-1)*(('+term2_p+'*((sto)**2))*'+term1_p+'))*(1) + ((1)*(('+term1_p+'*((sto)**2))*'+term2_p+') + (-1)*(('+term2_p+'*((sto)**2))*'+term2_p+'))*(-1)')
-        self.assertEqual(Q_cm[1][2], 0)
-        self.assertEqual(Q_cm[1][3], '((1)*(('+term1_p+'*((sto)**2))*'+term1_p+') + (-1)*(('+term2_p+'*((sto)**2))*'+term1_p+'))*(-1)')
-        self.assertEqual(Q_cm[1][4], '((1)*(('+term1_p+'*((sto)**2))*'+term2_p+') + (-1)*(('+term2_p+'*((sto)**2))*'+term2_p+'))*(1)')
-        self.assertEqual(Q_cm[1][5], 0)
-        self.assertEqual(Q_cm[2][0], '((-1)*(('+term1_n+'*((sto)**2))*'+term1_n+'))*(1) + ((-1)*(('+term1_n+'*((sto)**2))*'+term2_n+'))*(-1)')
-        self.assertEqual(Q_cm[2][1], 0)
-        self.assertEqual(Q_cm[2][2], '((-1)*(('+term1_n+'*((sto)**2))*'+term1_n+'))*(-1)')
-        self.assertEqual(Q_cm[2][3], 0)
-        self.assertEqual(Q_cm[2][4], '((-1)*(('+term1_n+'*((sto)**2))*'+term2_n+'))*(1)')
-        self.assertEqual(Q_cm[2][5], '((-1)*(('+term1_n+'*((sto)**2))*'+term1_n+'))*(1)')
-        self.assertEqual(Q_cm[3][0], 0)
-        self.assertEqual(Q_cm[3][1], '((-1)*(('+term1_p+'*((sto)**2))*'+term1_p+'))*(1) + ((-1)*(('+term1_p+'*((sto)**2))*'+term2_p+'))*(-1)')
-        self.assertEqual(Q_cm[3][2], 0)
-        self.assertEqual(Q_cm[3][3], '((-1)*(('+term1_p+'*((sto)**2))*'+term1_p+'))*(-1)')
+        self.assertTermEqual(Q_cm[0][0], '((1)*(('+term1_n+'*((sto)**2))*'+term1_n+') + (-1)*(('+term2_n+'*((sto)**2))*'+term1_n+'))*(1) + ((1)*(('+term1_n+'*((sto)**2))*'+term2_n+') + (-1)*(('+term2_n+'*((sto)**2))*'+term2_n+'))*(-1)')
+        self.assertTermEqual(Q_cm[0][1], 0)
+        self.assertTermEqual(Q_cm[0][2], '((1)*(('+term1_n+'*((sto)**2))*'+term1_n+') + (-1)*(('+term2_n+'*((sto)**2))*'+term1_n+'))*(-1)')
+        self.assertTermEqual(Q_cm[0][3], 0)
+        self.assertTermEqual(Q_cm[0][4], '((1)*(('+term1_n+'*((sto)**2))*'+term2_n+') + (-1)*(('+term2_n+'*((sto)**2))*'+term2_n+'))*(1)')
+        self.assertTermEqual(Q_cm[0][5], '((1)*(('+term1_n+'*((sto)**2))*'+term1_n+') + (-1)*(('+term2_n+'*((sto)**2))*'+term1_n+'))*(1)')
+        self.assertTermEqual(Q_cm[1][0], 0)
+        self.assertTermEqual(Q_cm[1][1], '((1)*(('+term1_p+'*((sto)**2))*'+term1_p+') + (-1)*(('+term2_p+'*((sto)**2))*'+term1_p+'))*(1) + ((1)*(('+term1_p+'*((sto)**2))*'+term2_p+') + (-1)*(('+term2_p+'*((sto)**2))*'+term2_p+'))*(-1)')
+        self.assertTermEqual(Q_cm[1][2], 0)
+        self.assertTermEqual(Q_cm[1][3], '((1)*(('+term1_p+'*((sto)**2))*'+term1_p+') + (-1)*(('+term2_p+'*((sto)**2))*'+term1_p+'))*(-1)')
+        self.assertTermEqual(Q_cm[1][4], '((1)*(('+term1_p+'*((sto)**2))*'+term2_p+') + (-1)*(('+term2_p+'*((sto)**2))*'+term2_p+'))*(1)')
+        self.assertTermEqual(Q_cm[1][5], 0)
+        self.assertTermEqual(Q_cm[2][0], '((-1)*(('+term1_n+'*((sto)**2))*'+term1_n+'))*(1) + ((-1)*(('+term1_n+'*((sto)**2))*'+term2_n+'))*(-1)')
+        self.assertTermEqual(Q_cm[2][1], 0)
+        self.assertTermEqual(Q_cm[2][2], '((-1)*(('+term1_n+'*((sto)**2))*'+term1_n+'))*(-1)')
+        self.assertTermEqual(Q_cm[2][3], 0)
+        self.assertTermEqual(Q_cm[2][4], '((-1)*(('+term1_n+'*((sto)**2))*'+term2_n+'))*(1)')
+        self.assertTermEqual(Q_cm[2][5], '((-1)*(('+term1_n+'*((sto)**2))*'+term1_n+'))*(1)')
+        self.assertTermEqual(Q_cm[3][0], 0)
+        self.assertTermEqual(Q_cm[3][1], '((-1)*(('+term1_p+'*((sto)**2))*'+term1_p+'))*(1) + ((-1)*(('+term1_p+'*((sto)**2))*'+term2_p+'))*(-1)')
+        self.assertTermEqual(Q_cm[3][2], 0)
+        self.assertTermEqual(Q_cm[3][3], '((-1)*(('+term1_p+'*((sto)**2))*'+term1_p+'))*(-1)')
         
-        self.assertEqual(Q_cm[3][4], '((-1)*(('+term1_p+'*((sto)**2))*'+term2_p+'))*(1)')
-        self.assertEqual(Q_cm[3][5], 0)
-        self.assertEqual(Q_cm[4][0], '((1)*(('+term2_n+'*((sto)**2))*'+term1_n+'))*(1) + ((1)*(('+term2_n+'*((sto)**2))*'+term2_n+'))*(-1)')
-        self.assertEqual(Q_cm[4][1], '((1)*(('+term2_p+'*((sto)**2))*'+term1_p+'))*(1) + ((1)*(('+term2_p+'*((sto)**2))*'+term2_p+'))*(-1)')
-        self.assertEqual(Q_cm[4][2], '((1)*(('+term2_n+'*((sto)**2))*'+term1_n+'))*(-1)')
-        self.assertEqual(Q_cm[4][3], '((1)*(('+term2_p+'*((sto)**2))*'+term1_p+'))*(-1)')
-        self.assertEqual(Q_cm[4][4], '((1)*(('+term2_p+'*((sto)**2))*'+term2_p+'))*(1) + ((1)*(('+term2_n+'*((sto)**2))*'+term2_n+'))*(1)')
-        self.assertEqual(Q_cm[4][5], '((1)*(('+term2_n+'*((sto)**2))*'+term1_n+'))*(1)')
-        self.assertEqual(Q_cm[5][0], '((1)*(('+term1_n+'*((sto)**2))*'+term1_n+'))*(1) + ((1)*(('+term1_n+'*((sto)**2))*'+term2_n+'))*(-1)')
-        self.assertEqual(Q_cm[5][1], 0)
-        self.assertEqual(Q_cm[5][2], '((1)*(('+term1_n+'*((sto)**2))*'+term1_n+'))*(-1)')
-        self.assertEqual(Q_cm[5][3], 0)
-        self.assertEqual(Q_cm[5][4], '((1)*(('+term1_n+'*((sto)**2))*'+term2_n+'))*(1)')
-        self.assertEqual(Q_cm[5][5], '((1)*(('+term1_n+'*((sto)**2))*'+term1_n+'))*(1)')
+        self.assertTermEqual(Q_cm[3][4], '((-1)*(('+term1_p+'*((sto)**2))*'+term2_p+'))*(1)')
+        self.assertTermEqual(Q_cm[3][5], 0)
+        self.assertTermEqual(Q_cm[4][0], '((1)*(('+term2_n+'*((sto)**2))*'+term1_n+'))*(1) + ((1)*(('+term2_n+'*((sto)**2))*'+term2_n+'))*(-1)')
+        self.assertTermEqual(Q_cm[4][1], '((1)*(('+term2_p+'*((sto)**2))*'+term1_p+'))*(1) + ((1)*(('+term2_p+'*((sto)**2))*'+term2_p+'))*(-1)')
+        self.assertTermEqual(Q_cm[4][2], '((1)*(('+term2_n+'*((sto)**2))*'+term1_n+'))*(-1)')
+        self.assertTermEqual(Q_cm[4][3], '((1)*(('+term2_p+'*((sto)**2))*'+term1_p+'))*(-1)')
+        self.assertTermEqual(Q_cm[4][4], '((1)*(('+term2_p+'*((sto)**2))*'+term2_p+'))*(1) + ((1)*(('+term2_n+'*((sto)**2))*'+term2_n+'))*(1)')
+        self.assertTermEqual(Q_cm[4][5], '((1)*(('+term2_n+'*((sto)**2))*'+term1_n+'))*(1)')
+        self.assertTermEqual(Q_cm[5][0], '((1)*(('+term1_n+'*((sto)**2))*'+term1_n+'))*(1) + ((1)*(('+term1_n+'*((sto)**2))*'+term2_n+'))*(-1)')
+        self.assertTermEqual(Q_cm[5][1], 0)
+        self.assertTermEqual(Q_cm[5][2], '((1)*(('+term1_n+'*((sto)**2))*'+term1_n+'))*(-1)')
+        self.assertTermEqual(Q_cm[5][3], 0)
+        self.assertTermEqual(Q_cm[5][4], '((1)*(('+term1_n+'*((sto)**2))*'+term2_n+'))*(1)')
+        self.assertTermEqual(Q_cm[5][5], '((1)*(('+term1_n+'*((sto)**2))*'+term1_n+'))*(1)')
         
         calc_Q = self.m_noise7.eval_Q()
         # testing env sto only for m_noise7 : uncorrelated WN on I->R and S->I
@@ -293,43 +304,43 @@ class TestCcoder(unittest.TestCase):
         term1_n = '((r0_nyc/N_nyc*v*I_nyc)*S_nyc)'
         term2_n = '((correct_rate(v))*I_nyc)'
         Q_cm = calc_Q["no_dem_sto"]["Q_cm"]
-        self.assertEqual(Q_cm[0][0], '((1)*(('+term1_n+'*((sto)**2))*'+term1_n+'))*(1) + ((-1)*(('+term2_n+'*((sto)**2))*'+term2_n+'))*(-1)')
-        self.assertEqual(Q_cm[0][1], 0)
-        self.assertEqual(Q_cm[0][2], '((1)*(('+term1_n+'*((sto)**2))*'+term1_n+'))*(-1)')
-        self.assertEqual(Q_cm[0][3], 0)
-        self.assertEqual(Q_cm[0][4], '((-1)*(('+term2_n+'*((sto)**2))*'+term2_n+'))*(1)')
-        self.assertEqual(Q_cm[0][5], '((1)*(('+term1_n+'*((sto)**2))*'+term1_n+'))*(1)')
-        self.assertEqual(Q_cm[1][0], 0)
-        self.assertEqual(Q_cm[1][1], '((1)*(('+term1_p+'*((sto)**2))*'+term1_p+'))*(1) + ((-1)*(('+term2_p+'*((sto)**2))*'+term2_p+'))*(-1)')
-        self.assertEqual(Q_cm[1][2], 0)
-        self.assertEqual(Q_cm[1][3], '((1)*(('+term1_p+'*((sto)**2))*'+term1_p+'))*(-1)')
-        self.assertEqual(Q_cm[1][4], '((-1)*(('+term2_p+'*((sto)**2))*'+term2_p+'))*(1)')
-        self.assertEqual(Q_cm[1][5], 0)
-        self.assertEqual(Q_cm[2][0], '((-1)*(('+term1_n+'*((sto)**2))*'+term1_n+'))*(1)')
-        self.assertEqual(Q_cm[2][1], 0)
-        self.assertEqual(Q_cm[2][2], '((-1)*(('+term1_n+'*((sto)**2))*'+term1_n+'))*(-1)')
-        self.assertEqual(Q_cm[2][3], 0)
-        self.assertEqual(Q_cm[2][4], 0)
-        self.assertEqual(Q_cm[2][5], '((-1)*(('+term1_n+'*((sto)**2))*'+term1_n+'))*(1)')
-        self.assertEqual(Q_cm[3][0], 0)
-        self.assertEqual(Q_cm[3][1], '((-1)*(('+term1_p+'*((sto)**2))*'+term1_p+'))*(1)')
-        self.assertEqual(Q_cm[3][2], 0)
-        self.assertEqual(Q_cm[3][3], '((-1)*(('+term1_p+'*((sto)**2))*'+term1_p+'))*(-1)')
+        self.assertTermEqual(Q_cm[0][0], '((1)*(('+term1_n+'*((sto)**2))*'+term1_n+'))*(1) + ((-1)*(('+term2_n+'*((sto)**2))*'+term2_n+'))*(-1)')
+        self.assertTermEqual(Q_cm[0][1], 0)
+        self.assertTermEqual(Q_cm[0][2], '((1)*(('+term1_n+'*((sto)**2))*'+term1_n+'))*(-1)')
+        self.assertTermEqual(Q_cm[0][3], 0)
+        self.assertTermEqual(Q_cm[0][4], '((-1)*(('+term2_n+'*((sto)**2))*'+term2_n+'))*(1)')
+        self.assertTermEqual(Q_cm[0][5], '((1)*(('+term1_n+'*((sto)**2))*'+term1_n+'))*(1)')
+        self.assertTermEqual(Q_cm[1][0], 0)
+        self.assertTermEqual(Q_cm[1][1], '((1)*(('+term1_p+'*((sto)**2))*'+term1_p+'))*(1) + ((-1)*(('+term2_p+'*((sto)**2))*'+term2_p+'))*(-1)')
+        self.assertTermEqual(Q_cm[1][2], 0)
+        self.assertTermEqual(Q_cm[1][3], '((1)*(('+term1_p+'*((sto)**2))*'+term1_p+'))*(-1)')
+        self.assertTermEqual(Q_cm[1][4], '((-1)*(('+term2_p+'*((sto)**2))*'+term2_p+'))*(1)')
+        self.assertTermEqual(Q_cm[1][5], 0)
+        self.assertTermEqual(Q_cm[2][0], '((-1)*(('+term1_n+'*((sto)**2))*'+term1_n+'))*(1)')
+        self.assertTermEqual(Q_cm[2][1], 0)
+        self.assertTermEqual(Q_cm[2][2], '((-1)*(('+term1_n+'*((sto)**2))*'+term1_n+'))*(-1)')
+        self.assertTermEqual(Q_cm[2][3], 0)
+        self.assertTermEqual(Q_cm[2][4], 0)
+        self.assertTermEqual(Q_cm[2][5], '((-1)*(('+term1_n+'*((sto)**2))*'+term1_n+'))*(1)')
+        self.assertTermEqual(Q_cm[3][0], 0)
+        self.assertTermEqual(Q_cm[3][1], '((-1)*(('+term1_p+'*((sto)**2))*'+term1_p+'))*(1)')
+        self.assertTermEqual(Q_cm[3][2], 0)
+        self.assertTermEqual(Q_cm[3][3], '((-1)*(('+term1_p+'*((sto)**2))*'+term1_p+'))*(-1)')
         
-        self.assertEqual(Q_cm[3][4], 0)
-        self.assertEqual(Q_cm[3][5], 0)
-        self.assertEqual(Q_cm[4][0], '((1)*(('+term2_n+'*((sto)**2))*'+term2_n+'))*(-1)')
-        self.assertEqual(Q_cm[4][1], '((1)*(('+term2_p+'*((sto)**2))*'+term2_p+'))*(-1)')
-        self.assertEqual(Q_cm[4][2], 0)
-        self.assertEqual(Q_cm[4][3], 0)
-        self.assertEqual(Q_cm[4][4], '((1)*(('+term2_p+'*((sto)**2))*'+term2_p+'))*(1) + ((1)*(('+term2_n+'*((sto)**2))*'+term2_n+'))*(1)')
-        self.assertEqual(Q_cm[4][5], 0)
-        self.assertEqual(Q_cm[5][0], '((1)*(('+term1_n+'*((sto)**2))*'+term1_n+'))*(1)')
-        self.assertEqual(Q_cm[5][1], 0)
-        self.assertEqual(Q_cm[5][2], '((1)*(('+term1_n+'*((sto)**2))*'+term1_n+'))*(-1)')
-        self.assertEqual(Q_cm[5][3], 0)
-        self.assertEqual(Q_cm[5][4], 0)
-        self.assertEqual(Q_cm[5][5], '((1)*(('+term1_n+'*((sto)**2))*'+term1_n+'))*(1)')
+        self.assertTermEqual(Q_cm[3][4], 0)
+        self.assertTermEqual(Q_cm[3][5], 0)
+        self.assertTermEqual(Q_cm[4][0], '((1)*(('+term2_n+'*((sto)**2))*'+term2_n+'))*(-1)')
+        self.assertTermEqual(Q_cm[4][1], '((1)*(('+term2_p+'*((sto)**2))*'+term2_p+'))*(-1)')
+        self.assertTermEqual(Q_cm[4][2], 0)
+        self.assertTermEqual(Q_cm[4][3], 0)
+        self.assertTermEqual(Q_cm[4][4], '((1)*(('+term2_p+'*((sto)**2))*'+term2_p+'))*(1) + ((1)*(('+term2_n+'*((sto)**2))*'+term2_n+'))*(1)')
+        self.assertTermEqual(Q_cm[4][5], 0)
+        self.assertTermEqual(Q_cm[5][0], '((1)*(('+term1_n+'*((sto)**2))*'+term1_n+'))*(1)')
+        self.assertTermEqual(Q_cm[5][1], 0)
+        self.assertTermEqual(Q_cm[5][2], '((1)*(('+term1_n+'*((sto)**2))*'+term1_n+'))*(-1)')
+        self.assertTermEqual(Q_cm[5][3], 0)
+        self.assertTermEqual(Q_cm[5][4], 0)
+        self.assertTermEqual(Q_cm[5][5], '((1)*(('+term1_n+'*((sto)**2))*'+term1_n+'))*(1)')
 
     def test_jac(self):
         step_ode_sde = self.m_noise.step_ode_sde()
@@ -337,31 +348,142 @@ class TestCcoder(unittest.TestCase):
 
         # testing jac
         # I ode - ((v)*I) - ((mu_d)*I) + ((r0/N*v*I)*S)
-        self.assertEqual(jac['caches'][jac['jac'][0][0]], '-gsl_spline_eval(calc->spline[ORDER_mu_d_nyc],t,calc->acc[ORDER_mu_d_nyc])-(gsl_vector_get(par,ORDER_v))+X[ORDER_S_nyc]*diffed[ORDER_diff__r0_nyc]*gsl_vector_get(par,ORDER_v)/gsl_spline_eval(calc->spline[ORDER_N_nyc],t,calc->acc[ORDER_N_nyc])')
-        self.assertEqual(jac['caches'][jac['jac'][1][1]], '-gsl_spline_eval(calc->spline[ORDER_mu_d_paris],t,calc->acc[ORDER_mu_d_paris])-(gsl_vector_get(par,ORDER_v))+X[ORDER_S_paris]*diffed[ORDER_diff__r0_paris]*gsl_vector_get(par,ORDER_v)/gsl_spline_eval(calc->spline[ORDER_N_paris],t,calc->acc[ORDER_N_paris])')
+        self.assertEqual(jac['caches'][jac['jac'][0][0]], '-_cov[ORDER_mu_d_nyc]-(gsl_vector_get(par,ORDER_v))+X[ORDER_S_nyc]*diffed[ORDER_diff__r0_nyc]*gsl_vector_get(par,ORDER_v)/_cov[ORDER_N_nyc]')
+        self.assertEqual(jac['caches'][jac['jac'][1][1]], '-_cov[ORDER_mu_d_paris]-(gsl_vector_get(par,ORDER_v))+X[ORDER_S_paris]*diffed[ORDER_diff__r0_paris]*gsl_vector_get(par,ORDER_v)/_cov[ORDER_N_paris]')
         self.assertEqual(jac['caches'][jac['jac_diff'][1][0]['value']], '0')
         self.assertEqual(jac['caches'][jac['jac_diff'][0][1]['value']], '0')
         
         # S ode - ((r0/N*v*I)*S) - ((mu_d)*S) + (mu_b*N)
-        self.assertEqual(jac['caches'][jac['jac'][2][2]], '-X[ORDER_I_nyc]*diffed[ORDER_diff__r0_nyc]*gsl_vector_get(par,ORDER_v)/gsl_spline_eval(calc->spline[ORDER_N_nyc],t,calc->acc[ORDER_N_nyc])-gsl_spline_eval(calc->spline[ORDER_mu_d_nyc],t,calc->acc[ORDER_mu_d_nyc])')
-        self.assertEqual(jac['caches'][jac['jac'][3][3]], '-X[ORDER_I_paris]*diffed[ORDER_diff__r0_paris]*gsl_vector_get(par,ORDER_v)/gsl_spline_eval(calc->spline[ORDER_N_paris],t,calc->acc[ORDER_N_paris])-gsl_spline_eval(calc->spline[ORDER_mu_d_paris],t,calc->acc[ORDER_mu_d_paris])')
-        self.assertEqual(jac['caches'][jac['jac'][2][0]], '-X[ORDER_S_nyc]*diffed[ORDER_diff__r0_nyc]*gsl_vector_get(par,ORDER_v)/gsl_spline_eval(calc->spline[ORDER_N_nyc],t,calc->acc[ORDER_N_nyc])')
-        self.assertEqual(jac['caches'][jac['jac'][3][1]], '-X[ORDER_S_paris]*diffed[ORDER_diff__r0_paris]*gsl_vector_get(par,ORDER_v)/gsl_spline_eval(calc->spline[ORDER_N_paris],t,calc->acc[ORDER_N_paris])')
+        self.assertEqual(jac['caches'][jac['jac'][2][2]], '-X[ORDER_I_nyc]*diffed[ORDER_diff__r0_nyc]*gsl_vector_get(par,ORDER_v)/_cov[ORDER_N_nyc]-_cov[ORDER_mu_d_nyc]')
+        self.assertEqual(jac['caches'][jac['jac'][3][3]], '-X[ORDER_I_paris]*diffed[ORDER_diff__r0_paris]*gsl_vector_get(par,ORDER_v)/_cov[ORDER_N_paris]-_cov[ORDER_mu_d_paris]')
+        self.assertEqual(jac['caches'][jac['jac'][2][0]], '-X[ORDER_S_nyc]*diffed[ORDER_diff__r0_nyc]*gsl_vector_get(par,ORDER_v)/_cov[ORDER_N_nyc]')
+        self.assertEqual(jac['caches'][jac['jac'][3][1]], '-X[ORDER_S_paris]*diffed[ORDER_diff__r0_paris]*gsl_vector_get(par,ORDER_v)/_cov[ORDER_N_paris]')
         
         
         # testing jac_obs
         # all_inc
-        self.assertEqual(jac['caches'][jac['jac_obs'][0][0]], 'gsl_spline_eval(calc->spline[ORDER_mu_d_nyc],t,calc->acc[ORDER_mu_d_nyc])+(gsl_vector_get(par,ORDER_v))')
-        self.assertEqual(jac['caches'][jac['jac_obs'][0][1]], 'gsl_spline_eval(calc->spline[ORDER_mu_d_paris],t,calc->acc[ORDER_mu_d_paris])+(gsl_vector_get(par,ORDER_v))')
+        self.assertEqual(jac['caches'][jac['jac_obs'][0][0]], '_cov[ORDER_mu_d_nyc]+(gsl_vector_get(par,ORDER_v))')
+        self.assertEqual(jac['caches'][jac['jac_obs'][0][1]], '_cov[ORDER_mu_d_paris]+(gsl_vector_get(par,ORDER_v))')
         self.assertEqual(jac['caches'][jac['jac_obs_diff'][0][0]['value']], '0')
         self.assertEqual(jac['caches'][jac['jac_obs_diff'][0][1]['value']], '0')
         # nyc_inc
-        self.assertEqual(jac['caches'][jac['jac_obs'][1][0]], 'X[ORDER_S_nyc]*diffed[ORDER_diff__r0_nyc]*gsl_vector_get(par,ORDER_v)/gsl_spline_eval(calc->spline[ORDER_N_nyc],t,calc->acc[ORDER_N_nyc])')
+        self.assertEqual(jac['caches'][jac['jac_obs'][1][0]], 'X[ORDER_S_nyc]*diffed[ORDER_diff__r0_nyc]*gsl_vector_get(par,ORDER_v)/_cov[ORDER_N_nyc]')
         self.assertEqual(jac['caches'][jac['jac_obs'][1][1]], '0')
-        self.assertEqual(jac['caches'][jac['jac_obs_diff'][1][0]['value']], 'X[ORDER_I_nyc]*X[ORDER_S_nyc]*gsl_vector_get(par,ORDER_v)/gsl_spline_eval(calc->spline[ORDER_N_nyc],t,calc->acc[ORDER_N_nyc])')
+        self.assertEqual(jac['caches'][jac['jac_obs_diff'][1][0]['value']], 'X[ORDER_I_nyc]*X[ORDER_S_nyc]*gsl_vector_get(par,ORDER_v)/_cov[ORDER_N_nyc]')
         self.assertEqual(jac['caches'][jac['jac_obs_diff'][1][1]['value']], '0')
         
 
+    def test_jac_sparse(self):
+        step_ode_sde = self.m_diff.step_ode_sde()
+        jac = self.m_diff.jac(step_ode_sde['sf'])
+
+        nnz = len([1 for row in jac['jac'] + jac['jac_obs'] for x in row if jac['caches'][x] != '0'])
+        nnz += len([1 for row in jac['jac_diff'] + jac['jac_obs_diff'] for x in row if jac['caches'][x['value']] != '0'])
+
+        self.assertEqual(len(jac['Ft']), nnz)
+        self.assertTrue(all(jac['caches'][x['value']] != '0' for x in jac['Ft']))
+
+        # derivative of the S_nyc ode against I_paris is a structural zero
+        self.assertFalse([x for x in jac['Ft'] if x['i'] == {'it': 'states_sv', 'ind': 2} and x['j'] == {'it': 'states_sv', 'ind': 1}])
+        self.assertEqual([x['value'] for x in jac['Ft'] if x['i'] == {'it': 'states_sv', 'ind': 2} and x['j'] == {'it': 'states_sv', 'ind': 2}], [jac['jac'][2][2]])
+
+    def test_step_psr_reactions(self):
+        x = self.m_noise.step_psr_reactions()
+
+        # births (from U) are Poisson flows, flows between universes are dropped
+        self.assertEqual(len(x['reactions']), 10)
+        self.assertEqual(x['reactions'][0]['rate'], '_cov[ORDER_N_paris]*_cov[ORDER_mu_b_paris]')
+        self.assertEqual(x['reactions'][0]['updates'], ['X[ORDER_S_paris] += 1.0'])
+
+        # rates are per capita and not corrected, the white noises are not applied
+        self.assertEqual(x['reactions'][4]['rate'], '((gsl_vector_get(par,ORDER_v)))*X[ORDER_I_paris]')
+        self.assertEqual(x['reactions'][2]['updates'], ['X[ORDER_S_paris] -= 1.0', 'X[ORDER_I_paris] += 1.0'])
+
+        # the remainder is not updated, the incidences are
+        self.assertEqual(x['reactions'][4]['updates'], ['X[ORDER_I_paris] -= 1.0'])
+        self.assertEqual(x['reactions'][4]['inc'], [self.m_noise.par_inc.index('all_inc_out')])
+        self.assertEqual(x['reactions'][3]['inc'], [self.m_noise.par_inc.index('nyc_inc')])
+
+        tau = dict((t['state'], t) for t in x['tau'])
+        self.assertEqual(tau['S_paris']['mu'], '(a[0]) - a[2] - a[6]')
+        self.assertEqual(tau['S_paris']['sigma2'], 'a[0] + a[2] + a[6]')
+
+        # white noises drawn per time step, refreshed with the time dependent propensities
+        self.assertEqual(x['n_noises'], 2)
+        self.assertEqual([r['noise'] for r in x['reactions'][:5]], [None, None, 0, 1, None])
+        self.assertEqual(x['refresh'], [0, 1, 2, 3, 6, 7, 8, 9])
+        self.assertEqual(self.m_diff.step_psr_reactions()['n_noises'], 0)
+
+    def test_step_nrm(self):
+        x = self.m_noise.step_nrm()
+        n = len(x['reactions'])
+        dep = [x['dep'][x['dep_start'][k]:x['dep_start'][k+1]] for k in range(n)]
+
+        self.assertEqual(len(x['dep_start']), n + 1)
+
+        # birth in S_paris: itself, infection and death of S_paris
+        self.assertEqual(dep[0], [0, 2, 6])
+        # infection in paris changes S_paris and I_paris
+        self.assertEqual(dep[2], [2, 4, 6, 8])
+        # death of I_paris: itself, the recovery and the infection (through I_paris)
+        self.assertEqual(dep[8], [2, 4, 8])
+
+        # the recoveries only depend on parameters and states
+        self.assertEqual(x['refresh'], [0, 1, 2, 3, 6, 7, 8, 9])
+        # the infections have a white noise
+        self.assertEqual(x['n_noises'], 2)
+
+    def test_sparse_matrix(self):
+        L = SparseMatrix.from_list([[-1, 0, 0], [1, -1, 0], [0, 1, 0]])
+        Q = SparseMatrix.from_list([['a', 0, 0], [0, 'b', 0], [0, 0, 'c']])
+        self.assertEqual(L.nnz(), 4)
+
+        Qs = L.dot(Q).dot(L.transpose(), symmetric=True)
+        self.assertEqual(Qs.to_list(), [['(a)', '-(a)', 0],
+                                        ['-(a)', '(a) + (b)', '-(b)'],
+                                        [0, '-(b)', '(b)']])
+        self.assertEqual([(i, j) for i, j, x in Qs.items(lower=True)], [(0, 0), (1, 0), (1, 1), (2, 1), (2, 2)])
+        self.assertEqual(SparseMatrix(0, 2).dot(Q).to_list(), [])
+
+        # equal products are collected and cancelling ones dropped
+        A = SparseMatrix.from_list([[1, -1], [2, 1]])
+        B = SparseMatrix.from_list([['a', 'b'], ['a', 'b']])
+        self.assertEqual(A.dot(B).nnz(), 2)
+        self.assertEqual(A.dot(B).to_list(), [[0, 0], ['3*(a)', '3*(b)']])
+        self.assertEqual(str(A.dot(B)[1, 0] * B[0, 1] - 'c'), '3*(a)*(b) - (c)')
+
+    def test_roll(self):
+        orders = {'S__0': 4, 'S__1': 5, 'S__2': 6, 'I__0': 0, 'I__2': 2}
+        units = ['\n    f[4] = _r[1]*X[ORDER_S__0];', '\n    f[5] = _r[2]*X[ORDER_S__1];', '\n    f[6] = _r[3]*X[ORDER_S__2];', '\n    f[0] = 1.0;']
+        self.assertEqual(C_roll(units, orders),
+                         '\n    {int _k; for(_k=0; _k<3; _k++){\n    f[(4+_k)] = _r[(1+_k)]*X[(ORDER_S__0+_k)];\n    }}\n    f[0] = 1.0;')
+
+        #any constant stride
+        units = ['\n    f[0] = X[ORDER_I__0];', '\n    f[1] = X[ORDER_I__2];']
+        self.assertEqual(C_roll(units, orders), '\n    {int _k; for(_k=0; _k<2; _k++){\n    f[(0+_k)] = X[(ORDER_I__0+2*_k)];\n    }}')
+
+        #different skeletons or not affine: left as is
+        units = ['\n    f[0] = X[ORDER_I__0];', '\n    f[1] = 2.0*X[ORDER_I__2];', '\n    f[2] = X[ORDER_S__0];', '\n    f[2] = X[ORDER_S__0];']
+        self.assertEqual(C_roll(units, orders), ''.join(units))
+
+        #independent units can be grouped first
+        units = ['\n    a[0] = 1;', '\n    b = 2;', '\n    a[1] = 1;']
+        self.assertEqual(C_roll(units, orders, reorder=True), '\n    {int _k; for(_k=0; _k<2; _k++){\n    a[(0+_k)] = 1;\n    }}\n    b = 2;')
+
+        #models without indices are left as is
+        self.assertEqual(self.m_noise.roll('a[0] = 1;' + ROLL_UNIT + 'a[1] = 1;' + ROLL_UNIT), 'a[0] = 1;a[1] = 1;')
+
+    def test_soa(self):
+        self.assertEqual(C_soa('f[0] = X[ORDER_S]*_r[1];', SOA_ARRAYS), '_fb[0*J+j] = Xb[ORDER_S*J+j]*_rb[1*J+j];')
+
+        #non trivial indices are parenthesized, members are left as is
+        self.assertEqual(C_soa('f[(4+_k)] = X[ORDER_S__0+_k]*nav->X[0];', SOA_ARRAYS),
+                         '_fb[(4+_k)*J+j] = Xb[(ORDER_S__0+_k)*J+j]*nav->X[0];')
+
+        #noises and common subexpressions are read from their own blocks
+        self.assertEqual(self.m_noise.soa('_c1*X[ORDER_I] + sqrt(_r[0])*dem_sto__0', noises=[{'name': 'dem_sto__0'}], cse=['_c0', '_c1']),
+                         '_cb[1*J+j]*Xb[ORDER_I*J+j] + sqrt(_rb[0*J+j])*_nb[0*J+j]')
+
     def test_cache_special_function_C(self):
 
         caches = map(lambda x: self.m_diff.make_C_term(x, False), ['sin(2*PI*(t +r0))', 'sin(2*PI*(t +r0))', 'sin(2*PI*(t +r0)) + correct_rate(v)'])
@@ -379,6 +501,86 @@ class TestCcoder(unittest.TestCase):
         self.assertEqual(sf, ['pow(ssm_correct_rate(ssm_correct_rate(gsl_vector_get(par,ORDER_v),dt),dt),pow(2,4))'])
         self.assertEqual(caches, ['_sf[0]'])
 
+    def test_cse(self):
+        terms = ['(_r[0]*X[ORDER_S])*dt + sqrt(X[ORDER_S]*_r[0])*dem_sto__0',
+                 ' - (_r[0]*X[ORDER_S])*dt',
+                 'sin(a*b*c)+a*b',
+                 '2*sin(a*b*c)',
+                 'x+y']
+
+        res = self.m_noise.cse(terms)
+        self.assertEqual(res['cse'], [{'name': '_cse0', 'term': '_r[0]*X[ORDER_S]'},
+                                      {'name': '_cse1', 'term': 'a*b'},
+                                      {'name': '_cse2', 'term': 'sin(_cse1*c)'}])
+        self.assertEqual(res['terms'], ['_cse0*dt+sqrt(_cse0)*dem_sto__0',
+                                        '-_cse0*dt',
+                                        '_cse2+_cse1',
+                                        '2*_cse2',
+                                        'x+y'])
+        self.assertEqual(res['n_removed'], 6)
+
+    def test_cse_keep_evaluation_order(self):
+        res = self.m_noise.cse(['a-(b-c)', 'a - -(b-c)', 'a/(b*c)'])
+        self.assertEqual(res['terms'], ['a-_cse0', 'a-(-_cse0)', 'a/(b*c)'])
+
+    def test_depends(self):
+        self.assertEqual(C_depends(C_parse('2*M_PI')), C_CONST)
+        self.assertEqual(C_depends(C_parse('pow(gsl_vector_get(par,ORDER_sd),2)')), C_PAR)
+        self.assertEqual(C_depends(C_parse('sin(2*PI*t)*gsl_vector_get(par,ORDER_v)')), C_TIME)
+        self.assertEqual(C_depends(C_parse('_cov[ORDER_N]/_pre[0]')), C_TIME)
+        self.assertEqual(C_depends(C_parse('gsl_vector_get(par,ORDER_v)*X[ORDER_I]')), C_STATE)
+        self.assertEqual(C_depends(C_parse('ssm_correct_rate(gsl_vector_get(par,ORDER_v),dt)')), C_STATE)
+
+    def test_states(self):
+        self.assertEqual(C_states(C_parse('gsl_vector_get(par,ORDER_v)*X[ORDER_I]*(X[ORDER_S]+X[ORDER_I])')), set(['S', 'I']))
+        self.assertEqual(C_states(C_parse('_cov[ORDER_N]*diffed[0]')), set())
+
+        self.assertTrue(C_is_stationary(C_parse('pow(gsl_vector_get(par,ORDER_v),2)*X[ORDER_I]/_pre[0]')))
+        self.assertFalse(C_is_stationary(C_parse('gsl_vector_get(par,ORDER_v)*X[ORDER_I]/_cov[ORDER_N]')))
+        self.assertFalse(C_is_stationary(C_parse('sin(2*PI*t)*X[ORDER_I]')))
+        self.assertFalse(C_is_stationary(C_parse('diffed[0]*X[ORDER_I]')))
+
+    def test_precompute(self):
+        m = copy.deepcopy(self.m_noise)
+        terms = ['X[ORDER_S]*gsl_vector_get(par,ORDER_r0)*gsl_vector_get(par,ORDER_v)/_cov[ORDER_N]',
+                 'pow(gsl_vector_get(par,ORDER_sd),2)',
+                 'X[ORDER_I]-gsl_vector_get(par,ORDER_r0)-gsl_vector_get(par,ORDER_v)',
+                 'sin(2*M_PI*t/gsl_vector_get(par,ORDER_v))*gsl_vector_get(par,ORDER_v)*gsl_vector_get(par,ORDER_r0)',
+                 'gsl_vector_get(par,ORDER_v)*X[ORDER_I]',
+                 'calc->prob[ORDER_S][0] = X[ORDER_S]']
+
+        res = m.precompute(terms)
+        self.assertEqual(res['terms'], ['_pre[0]*X[ORDER_S]/_cov[ORDER_N]',
+                                        '_pre[1]',
+                                        'X[ORDER_I]-_pre[2]',
+                                        '_pre[0]*sin(_pre[3]*t)',
+                                        'gsl_vector_get(par,ORDER_v)*X[ORDER_I]',
+                                        'calc->prob[ORDER_S][0] = X[ORDER_S]'])
+        self.assertEqual(m.precomputed, ['gsl_vector_get(par,ORDER_r0)*gsl_vector_get(par,ORDER_v)',
+                                         'pow(gsl_vector_get(par,ORDER_sd),2)',
+                                         'gsl_vector_get(par,ORDER_r0)+gsl_vector_get(par,ORDER_v)',
+                                         '2*M_PI/gsl_vector_get(par,ORDER_v)'])
+        self.assertEqual(res['n_hoisted'], 5)
+
+        ##one block per generated file: the indexes of a block don't depend on the others
+        res = m.precompute(['X[ORDER_S]*gsl_vector_get(par,ORDER_sd)*gsl_vector_get(par,ORDER_v)'], 'observed')
+        self.assertEqual(res['terms'], ['_pre[0]*X[ORDER_S]'])
+        self.assertEqual(m.pre_blocks['observed'][0], ['gsl_vector_get(par,ORDER_sd)*gsl_vector_get(par,ORDER_v)'])
+        self.assertEqual(len(m.precomputed), 4)
+
+    def test_time_cache_step(self):
+        m = copy.deepcopy(self.m_noise)
+        sf = ['sin(2*M_PI*t/_pre[0])', 'pow(X[ORDER_I],2)', '_pre[1]']
+        caches = ['_sf[0]*X[ORDER_S]*_pre[2]/_cov[ORDER_N]',
+                  '_sf[1]*_sf[2]',
+                  '_cov[ORDER_mu_b]*_cov[ORDER_N]']
+
+        res = m.time_cache_step(caches, sf)
+        self.assertEqual(res['sf'], ['pow(X[ORDER_I],2)'])
+        self.assertEqual(res['caches'], ['_tt[1]*X[ORDER_S]', '_sf[0]*_pre[1]', '_tt[2]'])
+        self.assertEqual(m.time_terms, ['sin(2*M_PI*t/_pre[0])', '_tt[0]*_pre[2]/_cov[ORDER_N]', '_cov[ORDER_mu_b]*_cov[ORDER_N]'])
+        self.assertEqual(res['n_hoisted'], 3)
+
 
 if __name__ == '__main__':
     unittest.main()
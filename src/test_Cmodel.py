@@ -1,8 +1,11 @@
-from Cmodel import Cmodel
+from Cmodel import Cmodel, parse_user_input, expand_indices, sym_ccode, SYMBOLIC_OPS, PENDING
+from bench_codegen import synthetic_model, write_model
 import unittest
 import copy
 import os
 import json
+import shutil
+import tempfile
 
 class TestCmodel(unittest.TestCase):
 
@@ -15,6 +18,12 @@ class TestCmodel(unittest.TestCase):
         x = self.m.change_user_input('r0*2*correct_rate(v)')
         self.assertEqual(x, ['r0', '*', '2', '*', 'correct_rate', '(', 'v', ')'])
 
+    def test_parse_user_input(self):
+        x = parse_user_input('r0 * 2*correct_rate(v)')
+        self.assertEqual(x, ('r0', '*', '2', '*', 'correct_rate', '(', 'v', ')'))
+        self.assertTrue(parse_user_input('r0 * 2*correct_rate(v)') is x)
+        self.assertTrue(parse_user_input('v*r0')[2] is x[0])
+
     def test_par_sv(self):
         self.assertEqual(self.m.par_sv, ['I_nyc', 'I_paris', 'S_nyc', 'S_paris'])
 
@@ -45,24 +54,55 @@ class TestCmodel(unittest.TestCase):
     def test_par_other(self):
         self.assertEqual(self.m.par_other, [])
 
+    def test_reaction_graph(self):
+        self.assertEqual(self.m.reactions_from['S_nyc'], [2, 6])
+        self.assertEqual(self.m.reactions_to['I_nyc'], [2])
+        self.assertEqual(self.m.ind_exit, [0, 1, 0, 0, 0, 0, 1, 1, 1, 1])
+        self.assertEqual(self.m.reactions_noise, {'noise_SI': [2]})
+        self.assertEqual([[self.m.proc_model.index(r) for r in x] for x in self.m.par_inc_def], [[2], [4, 5, 8, 9]])
+
+    def test_expand_indices(self):
+        model = {
+            'indices': [{'name': 'p', 'n': 2}, {'name': 'q', 'n': 2}],
+            'couplings': [{'name': 'C', 'value': [[1.0, 0.5], [0, 1.0]]}],
+            'populations': [{'name': 'city@p', 'composition': ['S@p', 'I@p']}],
+            'reactions': [{'from': 'S@p', 'to': 'I@p', 'rate': 'r0@p*C@p@q*I@q', 'accumulators': ['Inc@p']},
+                          {'from': 'I@p', 'to': 'U', 'rate': 'v'}]
+        }
+
+        x = expand_indices(model)
+        self.assertEqual(x['populations'], [{'name': 'city__0', 'composition': ['S__0', 'I__0']},
+                                            {'name': 'city__1', 'composition': ['S__1', 'I__1']}])
+        self.assertEqual([(r['from'], r['rate'], r['accumulators']) for r in x['reactions'][:3]],
+                         [('S__0', 'r0__0*1.0*I__0', ['Inc__0']), ('S__0', 'r0__0*0.5*I__1', ['Inc__0']), ('S__1', 'r0__1*1.0*I__1', ['Inc__1'])])
+        self.assertEqual([r['from'] for r in x['reactions'][3:]], ['I__0', 'I__1'])
+        self.assertEqual(model['reactions'][0]['from'], 'S@p')
+
+        model['indices'][0]['n'] = 12
+        model['couplings'] = []
+        self.assertEqual(expand_indices(model)['populations'][10]['composition'], ['S__10', 'I__10'])
+        self.assertEqual(expand_indices(model)['populations'][1]['composition'], ['S__01', 'I__01'])
+
     def test_pow2star(self):
         self.assertEqual(self.m.pow2star('pow(x, 2)'), '(x)**(2)')
         self.assertEqual(self.m.pow2star('pow(pow(x,2), pow(2, 3))'), '((x)**(2))**((2)**(3))')
         self.assertEqual(self.m.pow2star('a+ sin((x))+pow(pow(x,2), pow(2, 3))+cos(x)'), 'a+sin((x))+((x)**(2))**((2)**(3))+cos(x)')
+        self.assertEqual(self.m.pow2star('pow(sin(x),2)*pow(y, pow(x,2)) + 1'), '(sin(x))**(2)*(y)**((x)**(2))+1')
+        self.assertEqual(self.m.pow2star('a + b'), 'a + b')
 
     def test_make_C_term(self):
         terms = [
             {'x': 'mu_b_paris*(1.0+v*sin((v/N_paris+(mu_b_paris)))) + r0_paris', #input
              'h': 'mu_b_paris*(v*sin(mu_b_paris+v/N_paris)+1.0)+r0_paris', #expected human output
-             'c': 'gsl_spline_eval(calc->spline[ORDER_mu_b_paris],t,calc->acc[ORDER_mu_b_paris])*(gsl_vector_get(par,ORDER_v)*sin(gsl_spline_eval(calc->spline[ORDER_mu_b_paris],t,calc->acc[ORDER_mu_b_paris])+gsl_vector_get(par,ORDER_v)/gsl_spline_eval(calc->spline[ORDER_N_paris],t,calc->acc[ORDER_N_paris]))+1.0)+diffed[ORDER_diff__r0_paris]'}, #expected C output
+             'c': '_cov[ORDER_mu_b_paris]*(gsl_vector_get(par,ORDER_v)*sin(_cov[ORDER_mu_b_paris]+gsl_vector_get(par,ORDER_v)/_cov[ORDER_N_paris])+1.0)+diffed[ORDER_diff__r0_paris]'}, #expected C output
 
             {'x': 'N_paris-S_paris-I_paris+S_paris+I_paris',
              'h': 'N_paris',
-             'c': 'gsl_spline_eval(calc->spline[ORDER_N_paris],t,calc->acc[ORDER_N_paris])'},
+             'c': '_cov[ORDER_N_paris]'},
 
             {'x': 'rep_all_CDC_inc*(1.0-rep_all_CDC_inc)*prop_all_CDC_inc*x + (rep_all_CDC_inc*phi*prop_all_CDC_inc*x)**2',
              'h': 'pow(phi,2)*pow(prop_all_CDC_inc,2)*pow(rep_all_CDC_inc,2)*pow(x,2)+prop_all_CDC_inc*rep_all_CDC_inc*x*(-rep_all_CDC_inc+1.0)',
-             'c': 'pow(gsl_vector_get(par,ORDER_phi),2)*pow(gsl_spline_eval(calc->spline[ORDER_prop_all_CDC_inc],t,calc->acc[ORDER_prop_all_CDC_inc]),2)*pow(gsl_vector_get(par,ORDER_rep_all_CDC_inc),2)*pow(x,2)+gsl_spline_eval(calc->spline[ORDER_prop_all_CDC_inc],t,calc->acc[ORDER_prop_all_CDC_inc])*gsl_vector_get(par,ORDER_rep_all_CDC_inc)*x*(-gsl_vector_get(par,ORDER_rep_all_CDC_inc)+1.0)'},
+             'c': 'pow(gsl_vector_get(par,ORDER_phi),2)*pow(_cov[ORDER_prop_all_CDC_inc],2)*pow(gsl_vector_get(par,ORDER_rep_all_CDC_inc),2)*pow(x,2)+_cov[ORDER_prop_all_CDC_inc]*gsl_vector_get(par,ORDER_rep_all_CDC_inc)*x*(-gsl_vector_get(par,ORDER_rep_all_CDC_inc)+1.0)'},
         ]
 
         for t in terms:
@@ -90,7 +130,7 @@ class TestCmodel(unittest.TestCase):
         #correct_rate is only skipped for C code
 
         x = 'mu_b_paris*(1.0+correct_rate(v)*sin((correct_rate(v)/N_paris+(mu_b_paris)))) + r0_paris'
-        c = 'gsl_spline_eval(calc->spline[ORDER_mu_b_paris],t,calc->acc[ORDER_mu_b_paris])*((gsl_vector_get(par,ORDER_v))*sin(gsl_spline_eval(calc->spline[ORDER_mu_b_paris],t,calc->acc[ORDER_mu_b_paris])+(gsl_vector_get(par,ORDER_v))/gsl_spline_eval(calc->spline[ORDER_N_paris],t,calc->acc[ORDER_N_paris]))+1.0)+diffed[ORDER_diff__r0_paris]'
+        c = '_cov[ORDER_mu_b_paris]*((gsl_vector_get(par,ORDER_v))*sin(_cov[ORDER_mu_b_paris]+(gsl_vector_get(par,ORDER_v))/_cov[ORDER_N_paris])+1.0)+diffed[ORDER_diff__r0_paris]'
 
         self.assertEqual(self.m.make_C_term(x, True, human=False), c)
 
@@ -112,6 +152,71 @@ class TestCmodel(unittest.TestCase):
         for t in terms:
             self.assertEqual(self.m.make_C_term(t['x'], False, human=False), t['c'])
 
+    def test_make_C_term_cache(self):
+        x = 'sin(2*PI*(t +r0_paris))'
+        c = self.m.make_C_term(x, False, human=False, derivate='r0_paris')
+        misses = self.m.cache_stats['misses']
+
+        self.assertEqual(self.m.make_C_term(x, False, human=False, derivate='r0_paris'), c)
+        self.assertEqual(self.m.make_C_term(x, False, human=True, derivate='r0_paris'), '2*PI*cos(2*PI*(r0_paris+t))')
+        self.assertEqual(self.m.cache_stats['misses'], misses)
+        self.assertEqual(self.m.cache_stats['hits'], 2)
+
+    def test_make_C_term_disk_cache(self):
+        cache_dir = tempfile.mkdtemp()
+        try:
+            dpkgRoot = os.path.join('..' ,'examples', 'foo')
+            dpkg = json.load(open(os.path.join(dpkgRoot, 'ssm.json')))
+            x = 'mu_b_paris*(1.0+v*sin((v/N_paris+(mu_b_paris)))) + r0_paris'
+
+            m = Cmodel(dpkgRoot, dpkg, cache_dir=cache_dir)
+            c = m.make_C_term(x, False, derivate='v')
+            self.assertEqual(m.cache_stats['misses'], 1)
+
+            m = Cmodel(dpkgRoot, dpkg, cache_dir=cache_dir)
+            self.assertEqual(m.make_C_term(x, False, derivate='v'), c)
+            self.assertEqual(m.cache_stats['disk_hits'], 1)
+            self.assertEqual(m.cache_stats['misses'], 0)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_make_C_term_pending(self):
+        self.m.pending = []
+        x = self.m.make_C_term('r0_paris*v', True)
+        self.assertTrue(PENDING in parse_user_input(x))
+
+        ##a term built on a pending result is not collected, a name containing pending is
+        self.m.make_C_term(x + '*2', True)
+        self.m.make_C_term('pending_cases*2', True)
+        self.assertEqual([k[0] for k in self.m.pending], ['ssm___r0_paris*ssm___v', 'pending_cases*2'])
+        self.m.pending = None
+
+        self.assertEqual(self.m.make_C_term('r0_paris*v', True, human=True), 'r0_paris*v')
+
+    def test_sym_ccode_counts(self):
+        counts = dict.fromkeys(SYMBOLIC_OPS, 0)
+        sympified = {}
+        self.assertEqual(sym_ccode(('ssm___v*ssm___r0_paris', 'v', None), sympified, counts), 'r0_paris')
+        self.assertEqual(sym_ccode(('ssm___v*ssm___r0_paris', None, None), sympified, counts), 'r0_paris*v')
+        self.assertEqual(sym_ccode(('log(ssm___v)-x', None, 'v'), sympified, counts), 'exp(x)')
+        self.assertEqual(counts, {'sympify': 2, 'diff': 1, 'solve': 1, 'ccode': 3})
+
+    def test_synthetic_model(self):
+        dpkgRoot = tempfile.mkdtemp()
+        try:
+            dpkg, files = synthetic_model(compartments=4, reactions=5, white_noises=2, drifts=3, covariates=2, observations=3)
+            write_model(dpkgRoot, dpkg, files)
+            m = Cmodel(dpkgRoot, json.load(open(os.path.join(dpkgRoot, 'ssm.json'))))
+
+            self.assertEqual(m.par_sv, ['X_0', 'X_1', 'X_2', 'X_3'])
+            self.assertEqual(m.par_inc, ['Inc_0', 'Inc_1', 'Inc_2'])
+            self.assertEqual(len(m.proc_model), 5)
+            self.assertEqual(sorted(x['name'] for x in m.white_noise), ['noise_0', 'noise_1'])
+            self.assertEqual(m.par_diff, ['diff__k_0', 'diff__k_1', 'diff__k_2'])
+            self.assertEqual(m.par_forced, ['cov_0', 'cov_1'])
+            self.assertEqual(len(m.obs_model), 3)
+        finally:
+            shutil.rmtree(dpkgRoot)
 
 
 if __name__ == '__main__':
@@ -68,3 +68,646 @@ void test_calc__covariates(void)
         cl_check(gsl_spline_eval(calc->spline[9], data->rows[3]->time, calc->acc[9]) == 1.0);
     }
 }
+
+void test_calc__covariates_cache(void)
+{
+    int i, k;
+    const double *cov;
+
+    //same values as the splines, whatever the order of the requests
+    for(k=0; k<2; k++){
+        for(i=0; i<data->length; i++){
+            cov = ssm_covariates(calc, data->rows[i]->time);
+            cl_check(cov[0] == gsl_spline_eval(calc->spline[0], data->rows[i]->time, calc->acc[0]));
+            cl_check(cov[9] == gsl_spline_eval(calc->spline[9], data->rows[i]->time, calc->acc[9]));
+        }
+    }
+    cl_check(calc->cov->length == data->length);
+
+    cov = ssm_covariates(calc, data->rows[0]->time + 0.5);
+    cl_check(cov[2] == gsl_spline_eval(calc->spline[2], data->rows[0]->time + 0.5, calc->acc[2]));
+    cl_check(calc->cov->length == 1);
+}
+
+void test_calc__precomputed(void)
+{
+    int i;
+    ssm_input_t *input = ssm_input_new(jparameters, nav);
+    ssm_par_t *par = ssm_par_new(input, calc, nav);
+    ssm_par_t *par2 = gsl_vector_alloc(par->size);
+    double *pre = ssm_d1_new(calc->pre_length);
+    const double *res;
+
+    //computed by ssm_input2par
+    cl_check(calc->pre_length > 0);
+    cl_check(calc->pre_par == par);
+    memcpy(pre, ssm_precomputed(par, calc, SSM_PRE_STEP), calc->pre_length * sizeof (double));
+
+    //recomputed when calc is used with other parameters
+    gsl_vector_memcpy(par2, par);
+    gsl_vector_scale(par2, 2.0);
+    ssm_precomputed(par2, calc, SSM_PRE_STEP);
+    cl_check(calc->pre_par == par2);
+
+    res = ssm_precomputed(par, calc, SSM_PRE_STEP);
+    cl_check(calc->pre_par == par);
+    for(i=0; i<calc->pre_length; i++){
+        cl_check(res[i] == pre[i]);
+    }
+
+    //modified in place: kept until ssm_par_changed() is called
+    gsl_vector_scale(par, 2.0);
+    res = ssm_precomputed(par, calc, SSM_PRE_STEP);
+    for(i=0; i<calc->pre_length; i++){
+        cl_check(res[i] == pre[i]);
+    }
+    ssm_par_changed();
+    res = ssm_precomputed(par, calc, SSM_PRE_STEP);
+    memcpy(pre, res, calc->pre_length * sizeof (double));
+    ssm_precompute(par2, calc); //par has now the content of par2
+    for(i=0; i<calc->pre_length; i++){
+        cl_check(res[i] == pre[i]);
+    }
+
+    //one block per generated file, laid out one after the other
+    cl_check(calc->pre_offset[SSM_PRE_STEP] == 0);
+    for(i=1; i<SSM_PRE_BLOCKS; i++){
+        cl_check(calc->pre_offset[i] >= calc->pre_offset[i-1]);
+        cl_check(calc->pre_offset[i] <= calc->pre_length);
+    }
+    cl_check(ssm_precomputed(par, calc, SSM_PRE_OBSERVED) == calc->pre + calc->pre_offset[SSM_PRE_OBSERVED]);
+
+    free(pre);
+    gsl_vector_free(par2);
+    ssm_par_free(par);
+    ssm_input_free(input);
+}
+
+void test_calc__tcache(void)
+{
+    int is_new;
+    ssm_tcache_t *tcache = ssm_tcache_new(2);
+    double *row;
+
+    row = ssm_tcache_get(tcache, 1.0, &is_new);
+    cl_check(is_new);
+    row[0] = 1.0; row[1] = 10.0;
+    row = ssm_tcache_get(tcache, 2.0, &is_new);
+    cl_check(is_new);
+    row[0] = 2.0; row[1] = 20.0;
+
+    //a second particle stepping through the same time points
+    row = ssm_tcache_get(tcache, 1.0, &is_new);
+    cl_check(!is_new && row[1] == 10.0);
+    row = ssm_tcache_get(tcache, 2.0, &is_new);
+    cl_check(!is_new && row[1] == 20.0);
+
+    //a time point in between resets the cache
+    row = ssm_tcache_get(tcache, 1.5, &is_new);
+    cl_check(is_new);
+    cl_check(tcache->length == 1);
+
+    ssm_tcache_free(tcache);
+}
+
+void test_calc__time_terms(void)
+{
+    int i;
+    ssm_input_t *input = ssm_input_new(jparameters, nav);
+    ssm_par_t *par = ssm_par_new(input, calc, nav);
+    double t = data->rows[0]->time;
+    const double *tt;
+    double *expected = ssm_d1_new(calc->tt->width);
+
+    cl_check(calc->tt->width > 0);
+
+    tt = ssm_time_terms(par, calc, t);
+    ssm_eval_time_terms(t, par, calc, ssm_precomputed(par, calc, SSM_PRE_STEP), expected);
+    for(i=0; i<calc->tt->width; i++){
+        cl_check(tt[i] == expected[i]);
+    }
+    cl_check(ssm_time_terms(par, calc, t) == tt);
+
+    //new parameters: recomputed
+    gsl_vector_scale(par, 2.0);
+    ssm_time_terms(par, calc, t);
+    cl_check(calc->tt->length == 1);
+
+    free(expected);
+    ssm_par_free(par);
+    ssm_input_free(input);
+}
+
+void test_calc__batch(void)
+{
+    int i, j;
+    ssm_X_t *J_X[3];
+    ssm_batch_t *b = ssm_batch_new(4, nav);
+
+    cl_check(calc->batch == NULL); //opts->flag_batch is off by default
+    cl_check(b->size == 4);
+    cl_check(b->length == nav->states_sv_inc->length + nav->states_diff->length);
+
+    for(j=0; j<3; j++){
+        J_X[j] = ssm_X_new(nav, opts);
+        J_X[j]->dt = 0.25;
+        for(i=0; i<J_X[j]->length; i++){
+            J_X[j]->proj[i] = 10.0*j + i;
+        }
+    }
+
+    //particles 1 and 2, state k of particle j at X[k*J+j]
+    ssm_batch_gather(b, J_X, 1, 3);
+    cl_check(b->J == 2);
+    cl_check(b->dt == 0.25);
+    for(j=0; j<b->J; j++){
+        for(i=0; i<b->length; i++){
+            cl_check(b->X[i*b->J+j] == J_X[1+j]->proj[i]);
+        }
+    }
+
+    for(i=0; i<b->length*b->J; i++){
+        b->X[i] += 1.0;
+    }
+    ssm_batch_scatter(b, J_X, 1);
+    for(i=0; i<b->length; i++){
+        cl_check(J_X[0]->proj[i] == i);
+        cl_check(J_X[1]->proj[i] == 10.0 + i + 1.0);
+        cl_check(J_X[2]->proj[i] == 20.0 + i + 1.0);
+    }
+
+    for(j=0; j<3; j++){
+        ssm_X_free(J_X[j]);
+    }
+    ssm_batch_free(b);
+}
+
+void test_calc__batch_prediction(void)
+{
+    int i, j;
+    ssm_implementations_t implementation = opts->implementation;
+    ssm_nav_t *nav_sde;
+    ssm_calc_t *calc_b;
+    ssm_input_t *input;
+    ssm_par_t *par;
+    ssm_X_t *J_X[5], *J_X_serial[5];
+    ssm_err_code_t cum_status[5];
+    double log_like[5];
+    ssm_row_t *row = data->rows[0];
+    double t1 = row->time;
+
+    opts->implementation = SSM_SDE;
+    opts->flag_batch = 1;
+    nav_sde = ssm_nav_new(jparameters, opts);
+    calc_b = ssm_calc_new(jdata, nav_sde, data, fitness, opts, 0);
+    input = ssm_input_new(jparameters, nav_sde);
+    par = ssm_par_new(input, calc_b, nav_sde);
+
+    //deterministic: no demographic stochasticity, no white noise and no dispersion of the diffusions
+    nav_sde->noises_off = SSM_NO_DEM_STO | SSM_NO_WHITE_NOISE;
+    for(i=0; i<nav_sde->par_all->length; i++){
+        if(!strcmp(nav_sde->par_all->p[i]->name, "vol")){
+            gsl_vector_set(par, nav_sde->par_all->p[i]->offset, 0.0);
+        }
+    }
+    ssm_par_changed();
+
+    cl_check(calc_b->batch != NULL);
+    cl_check(ssm_get_f_pred_batch(nav_sde, calc_b) == &ssm_f_prediction_batch_sde_no_dem_sto_no_white_noise);
+    cl_check(row->ts_nonan_length > 0);
+
+    for(j=0; j<5; j++){
+        J_X[j] = ssm_X_new(nav_sde, opts);
+        J_X_serial[j] = ssm_X_new(nav_sde, opts);
+        ssm_par2X(J_X[j], par, calc_b, nav_sde);
+        for(i=0; i<nav_sde->states_sv->length; i++){
+            J_X[j]->proj[nav_sde->states_sv->p[i]->offset] *= 1.0 + 0.01*j;
+        }
+        ssm_X_copy(J_X_serial[j], J_X[j]);
+        cum_status[j] = SSM_SUCCESS;
+    }
+
+    ssm_f_prediction_batch_sde_no_dem_sto_no_white_noise(J_X, 0, 5, 0.0, t1, par, nav_sde, calc_b, cum_status);
+    ssm_log_likelihood_batch(row, J_X, 0, 5, par, calc_b, nav_sde, fitness, log_like);
+
+    for(j=0; j<5; j++){
+        cl_check(cum_status[j] == ssm_f_prediction_sde_no_dem_sto_no_white_noise(J_X_serial[j], 0.0, t1, par, nav_sde, calc_b));
+        for(i=0; i<J_X[j]->length; i++){
+            cl_check(fabs(J_X[j]->proj[i] - J_X_serial[j]->proj[i]) <= 1e-10 * GSL_MAX(1.0, fabs(J_X_serial[j]->proj[i])));
+        }
+        cl_check(fabs(log_like[j] - ssm_log_likelihood(row, J_X_serial[j], par, calc_b, nav_sde, fitness)) <= 1e-10 * GSL_MAX(1.0, fabs(log_like[j])));
+    }
+
+    opts->implementation = implementation;
+    opts->flag_batch = 0;
+    for(j=0; j<5; j++){
+        ssm_X_free(J_X[j]);
+        ssm_X_free(J_X_serial[j]);
+    }
+    ssm_par_free(par);
+    ssm_input_free(input);
+    ssm_calc_free(calc_b, nav_sde);
+    ssm_nav_free(nav_sde);
+}
+
+void test_calc__jac_ode(void)
+{
+    int i, j;
+    ssm_input_t *input = ssm_input_new(jparameters, nav);
+    ssm_par_t *par = ssm_par_new(input, calc, nav);
+    ssm_X_t *X = ssm_X_new(nav, opts);
+    ssm_calc_t *calc_imp;
+    ssm_noises_off_t noises_off = nav->noises_off;
+    int dim = X->length;
+    double *dfdy = ssm_d1_new(dim*dim);
+    double *dfdt = ssm_d1_new(dim);
+    double *y = ssm_d1_new(dim);
+    double *f_plus = ssm_d1_new(dim);
+    double *f_minus = ssm_d1_new(dim);
+    double h, der;
+
+    //rkf45 by default: no jacobian
+    cl_check(calc->T == gsl_odeiv2_step_rkf45);
+    cl_check((calc->sys).jacobian == NULL);
+
+    strncpy(opts->integrator, "bsimp", SSM_STR_BUFFSIZE);
+    calc_imp = ssm_calc_new(jdata, nav, data, fitness, opts, 0);
+    cl_check(calc_imp->T == gsl_odeiv2_step_bsimp);
+    cl_check((calc_imp->sys).jacobian == &ssm_jac_ode);
+
+    //ode implementation: the diffusions are not integrated
+    nav->noises_off |= SSM_NO_DEM_STO | SSM_NO_WHITE_NOISE | SSM_NO_DIFF;
+    ssm_par2X(X, par, calc_imp, nav);
+    calc_imp->_par = par;
+
+    ssm_jac_ode(10.0, X->proj, dfdy, dfdt, calc_imp);
+
+    //against central differences of the ODE
+    for(j=0; j<dim; j++){
+        memcpy(y, X->proj, dim * sizeof (double));
+        h = 1e-6 * GSL_MAX(1.0, fabs(y[j]));
+        y[j] = X->proj[j] + h;
+        ssm_step_ode(10.0, y, f_plus, calc_imp);
+        y[j] = X->proj[j] - h;
+        ssm_step_ode(10.0, y, f_minus, calc_imp);
+
+        for(i=0; i<dim; i++){
+            der = (f_plus[i] - f_minus[i])/(2*h);
+            cl_check(fabs(dfdy[i*dim+j] - der) <= 1e-5 * GSL_MAX(1.0, fabs(der)));
+        }
+    }
+
+    nav->noises_off = noises_off;
+    free(dfdy);
+    free(dfdt);
+    free(y);
+    free(f_plus);
+    free(f_minus);
+    ssm_X_free(X);
+    ssm_calc_free(calc_imp, nav);
+    ssm_par_free(par);
+    ssm_input_free(input);
+}
+
+void test_calc__ode_warm_start(void)
+{
+    ssm_input_t *input = ssm_input_new(jparameters, nav);
+    ssm_par_t *par = ssm_par_new(input, calc, nav);
+    ssm_X_t *X = ssm_X_new(nav, opts);
+    ssm_noises_off_t noises_off = nav->noises_off;
+
+    nav->noises_off |= SSM_NO_DEM_STO | SSM_NO_WHITE_NOISE | SSM_NO_DIFF;
+    ssm_par2X(X, par, calc, nav);
+
+    //a short interval truncates the step: the step size is kept for the next interval
+    X->dt = 0.25;
+    cl_check(ssm_f_prediction_ode(X, 0.0, 1e-3, par, nav, calc) == SSM_SUCCESS);
+    cl_check(X->dt >= 0.25);
+
+    //first particle that did not fail
+    fitness->cum_status[0] = SSM_SUCCESS;
+    fitness->weights[0] = 1.0;
+    cl_check(ssm_dt_warm(&X, fitness) == X->dt);
+    fitness->weights[0] = GSL_NEGINF;
+    cl_check(ssm_dt_warm(&X, fitness) == X->dt0);
+
+    nav->noises_off = noises_off;
+    ssm_X_free(X);
+    ssm_par_free(par);
+    ssm_input_free(input);
+}
+
+void test_calc__psr_tau(void)
+{
+    int i;
+    double a0;
+    ssm_implementations_t implementation = opts->implementation;
+    ssm_nav_t *nav_psr;
+    ssm_calc_t *calc_psr;
+    ssm_input_t *input;
+    ssm_par_t *par;
+    ssm_X_t *X;
+
+    opts->implementation = SSM_PSR;
+    strncpy(opts->psr_step, "tau", SSM_STR_BUFFSIZE);
+    nav_psr = ssm_nav_new(jparameters, opts);
+    calc_psr = ssm_calc_new(jdata, nav_psr, data, fitness, opts, 0);
+    input = ssm_input_new(jparameters, nav_psr);
+    par = ssm_par_new(input, calc_psr, nav_psr);
+    X = ssm_X_new(nav_psr, opts);
+
+    cl_check(ssm_get_f_pred(nav_psr) == &ssm_f_prediction_psr_tau);
+
+    ssm_par2X(X, par, calc_psr, nav_psr);
+    a0 = ssm_psr_propensities(X, 0.0, par, nav_psr, calc_psr);
+    cl_check(a0 > 0.0);
+    cl_check(ssm_psr_tau(X, SSM_TAU_EPS, calc_psr) > 0.0);
+
+    ssm_f_prediction_psr_tau(X, 0.0, 7.0, par, nav_psr, calc_psr);
+
+    //the time step of the particle is left untouched
+    cl_check(X->dt == X->dt0);
+    for(i=0; i<nav_psr->states_sv->length; i++){
+        cl_check(X->proj[nav_psr->states_sv->p[i]->offset] >= 0.0);
+    }
+
+    opts->implementation = implementation;
+    strncpy(opts->psr_step, "euler", SSM_STR_BUFFSIZE);
+    ssm_X_free(X);
+    ssm_par_free(par);
+    ssm_input_free(input);
+    ssm_calc_free(calc_psr, nav_psr);
+    ssm_nav_free(nav_psr);
+}
+
+void test_calc__nrm(void)
+{
+    int i, k;
+    ssm_implementations_t implementation = opts->implementation;
+    ssm_nav_t *nav_nrm;
+    ssm_calc_t *calc_nrm;
+    ssm_input_t *input;
+    ssm_par_t *par;
+    ssm_X_t *X;
+    ssm_nrm_t *nrm;
+
+    opts->implementation = SSM_NRM;
+    nav_nrm = ssm_nav_new(jparameters, opts);
+    calc_nrm = ssm_calc_new(jdata, nav_nrm, data, fitness, opts, 0);
+    input = ssm_input_new(jparameters, nav_nrm);
+    par = ssm_par_new(input, calc_nrm, nav_nrm);
+    X = ssm_X_new(nav_nrm, opts);
+    nrm = calc_nrm->nrm;
+
+    cl_check(ssm_get_f_pred(nav_nrm) == &ssm_f_prediction_nrm);
+
+    //every reaction has to update its own propensity
+    for(k=0; k<nrm->length; k++){
+        int has_k = 0;
+        for(i=nrm->dep_start[k]; i<nrm->dep_start[k+1]; i++){
+            has_k |= (nrm->dep[i] == k);
+        }
+        cl_check(has_k);
+    }
+
+    ssm_par2X(X, par, calc_nrm, nav_nrm);
+    ssm_f_prediction_nrm(X, 0.0, 7.0, par, nav_nrm, calc_nrm);
+
+    //integer states, the time step of the particle is left untouched
+    cl_check(X->dt == X->dt0);
+    for(i=0; i<nav_nrm->states_sv->length; i++){
+        double x = X->proj[nav_nrm->states_sv->p[i]->offset];
+        cl_check(x >= 0.0 && x == round(x));
+    }
+
+    //the queue is a min heap on the putative times
+    for(i=1; i<nrm->length; i++){
+        cl_check(nrm->T[nrm->heap[(i-1)/2]] <= nrm->T[nrm->heap[i]]);
+        cl_check(nrm->pos[nrm->heap[i]] == i);
+    }
+
+    opts->implementation = implementation;
+    ssm_X_free(X);
+    ssm_par_free(par);
+    ssm_input_free(input);
+    ssm_calc_free(calc_nrm, nav_nrm);
+    ssm_nav_free(nav_nrm);
+}
+
+static int test_calc_offset(ssm_nav_t *nav_x, const char *name)
+{
+    int i;
+    for(i=0; i<nav_x->states_sv->length; i++){
+        if(!strcmp(nav_x->states_sv->p[i]->name, name)){
+            return nav_x->states_sv->p[i]->offset;
+        }
+    }
+    return -1;
+}
+
+/**
+ * initial conditions of par in X (without infectious when
+ * no_infection)
+ */
+static void test_calc_ic(ssm_X_t *X, int no_infection, ssm_par_t *par, ssm_nav_t *nav_x, ssm_calc_t *calc_x)
+{
+    int i;
+    ssm_par2X(X, par, calc_x, nav_x);
+    if(no_infection){
+        for(i=0; i<nav_x->states_sv->length; i++){
+            if(nav_x->states_sv->p[i]->name[0] == 'I'){
+                X->proj[nav_x->states_sv->p[i]->offset] = 0.0;
+            }
+        }
+    }
+}
+
+/**
+ * sample mean and variance over n replicates of the state variable
+ * name after a prediction by f_pred from 0 to t1 with a time step dt
+ */
+static void test_calc_moments(ssm_f_pred_t f_pred, const char *name, int no_infection, double dt, double t1, int n, ssm_par_t *par, ssm_nav_t *nav_x, ssm_calc_t *calc_x, double *mean, double *var)
+{
+    int r;
+    double x, sum = 0.0, sum_sq = 0.0;
+    ssm_X_t *X = ssm_X_new(nav_x, opts);
+    int offset = test_calc_offset(nav_x, name);
+
+    cl_assert(offset >= 0);
+
+    for(r=0; r<n; r++){
+        test_calc_ic(X, no_infection, par, nav_x, calc_x);
+        X->dt = X->dt0 = dt;
+        cl_check(f_pred(X, 0.0, t1, par, nav_x, calc_x) == SSM_SUCCESS);
+        x = X->proj[offset];
+        sum += x;
+        sum_sq += x*x;
+    }
+
+    *mean = sum/n;
+    *var = (sum_sq - n*(*mean)*(*mean))/(n-1);
+    ssm_X_free(X);
+}
+
+/**
+ * without infectious, S_nyc is an immigration-death process (constant
+ * birth mu_b*N and death mu_d rates of the fixture):
+ * S_nyc(t) ~ Binomial(S0, p) + Poisson(mu_b*N*(1-p)/mu_d) with p = exp(-mu_d*t).
+ * Check the sample mean (4 standard errors) and variance (25%) of the
+ * implementation against it.
+ */
+static void test_calc_birth_death(ssm_f_pred_t f_pred, ssm_nav_t *nav_x, ssm_calc_t *calc_x, ssm_par_t *par)
+{
+    int n = 500;
+    double t1 = 7.0, mu_b = 0.00027, mu_d = 0.00027, N = 1e6;
+    double S0, p, mean, var, mean_hat, var_hat;
+    ssm_X_t *X = ssm_X_new(nav_x, opts);
+
+    test_calc_ic(X, 1, par, nav_x, calc_x);
+    S0 = X->proj[test_calc_offset(nav_x, "S_nyc")];
+    ssm_X_free(X);
+
+    p = exp(-mu_d*t1);
+    mean = S0*p + mu_b*N*(1.0-p)/mu_d;
+    var = S0*p*(1.0-p) + mu_b*N*(1.0-p)/mu_d;
+
+    test_calc_moments(f_pred, "S_nyc", 1, 0.25, t1, n, par, nav_x, calc_x, &mean_hat, &var_hat);
+
+    cl_check(fabs(mean_hat - mean) <= 4.0*sqrt(var/n));
+    cl_check(fabs(var_hat - var) <= 0.25*var);
+}
+
+void test_calc__nrm_birth_death(void)
+{
+    ssm_implementations_t implementation = opts->implementation;
+    ssm_nav_t *nav_nrm;
+    ssm_calc_t *calc_nrm;
+    ssm_input_t *input;
+    ssm_par_t *par;
+
+    opts->implementation = SSM_NRM;
+    nav_nrm = ssm_nav_new(jparameters, opts);
+    calc_nrm = ssm_calc_new(jdata, nav_nrm, data, fitness, opts, 0);
+    input = ssm_input_new(jparameters, nav_nrm);
+    par = ssm_par_new(input, calc_nrm, nav_nrm);
+
+    test_calc_birth_death(&ssm_f_prediction_nrm_no_diff, nav_nrm, calc_nrm, par);
+
+    opts->implementation = implementation;
+    ssm_par_free(par);
+    ssm_input_free(input);
+    ssm_calc_free(calc_nrm, nav_nrm);
+    ssm_nav_free(nav_nrm);
+}
+
+void test_calc__psr_tau_birth_death(void)
+{
+    ssm_implementations_t implementation = opts->implementation;
+    ssm_nav_t *nav_psr;
+    ssm_calc_t *calc_psr;
+    ssm_input_t *input;
+    ssm_par_t *par;
+
+    opts->implementation = SSM_PSR;
+    strncpy(opts->psr_step, "tau", SSM_STR_BUFFSIZE);
+    nav_psr = ssm_nav_new(jparameters, opts);
+    calc_psr = ssm_calc_new(jdata, nav_psr, data, fitness, opts, 0);
+    input = ssm_input_new(jparameters, nav_psr);
+    par = ssm_par_new(input, calc_psr, nav_psr);
+
+    test_calc_birth_death(&ssm_f_prediction_psr_tau_no_diff, nav_psr, calc_psr, par);
+
+    opts->implementation = implementation;
+    strncpy(opts->psr_step, "euler", SSM_STR_BUFFSIZE);
+    ssm_par_free(par);
+    ssm_input_free(input);
+    ssm_calc_free(calc_psr, nav_psr);
+    ssm_nav_free(nav_psr);
+}
+
+/**
+ * with a small dt the euler multinomial steps and the tau-leaping
+ * (white noises included) have the same means (4 standard errors of
+ * the difference)
+ */
+void test_calc__psr_tau_euler(void)
+{
+    int i, n = 500;
+    double dt = 0.01, t1 = 7.0;
+    const char *names[] = {"S_nyc", "I_nyc", "I_paris"};
+    double mean_tau, var_tau, mean_euler, var_euler;
+    ssm_implementations_t implementation = opts->implementation;
+    ssm_nav_t *nav_tau, *nav_euler;
+    ssm_calc_t *calc_tau, *calc_euler;
+    ssm_input_t *input;
+    ssm_par_t *par;
+
+    opts->implementation = SSM_PSR;
+    nav_euler = ssm_nav_new(jparameters, opts);
+    calc_euler = ssm_calc_new(jdata, nav_euler, data, fitness, opts, 0);
+    strncpy(opts->psr_step, "tau", SSM_STR_BUFFSIZE);
+    nav_tau = ssm_nav_new(jparameters, opts);
+    calc_tau = ssm_calc_new(jdata, nav_tau, data, fitness, opts, 0);
+    input = ssm_input_new(jparameters, nav_tau);
+    par = ssm_par_new(input, calc_tau, nav_tau);
+
+    for(i=0; i<3; i++){
+        test_calc_moments(&ssm_f_prediction_psr_tau_no_diff, names[i], 0, dt, t1, n, par, nav_tau, calc_tau, &mean_tau, &var_tau);
+        test_calc_moments(&ssm_f_prediction_psr_no_diff, names[i], 0, dt, t1, n, par, nav_euler, calc_euler, &mean_euler, &var_euler);
+        cl_check(fabs(mean_tau - mean_euler) <= 4.0*sqrt((var_tau + var_euler)/n));
+    }
+
+    opts->implementation = implementation;
+    strncpy(opts->psr_step, "euler", SSM_STR_BUFFSIZE);
+    ssm_par_free(par);
+    ssm_input_free(input);
+    ssm_calc_free(calc_tau, nav_tau);
+    ssm_calc_free(calc_euler, nav_euler);
+    ssm_nav_free(nav_tau);
+    ssm_nav_free(nav_euler);
+}
+
+void test_calc__log_fact(void)
+{
+    int n;
+    cl_check(calc->accuracy == SSM_ACC_FAST);
+
+    for(n=0; n<3*SSM_LOG_FACT_LENGTH; n+=7){
+        cl_check(fabs(ssm_log_fact(n, calc) - gsl_sf_lnfact(n)) <= 1e-12*GSL_MAX(1.0, gsl_sf_lnfact(n)));
+    }
+}
+
+/**
+ * the log densities agree with GSL within 1e-10 (exact and fast) or
+ * 1e-4 (approx, sd >= SSM_APPROX_SD_MIN and y within 6 sd of the
+ * mean)
+ */
+void test_calc__log_densities(void)
+{
+    int i;
+    double y, mu = 200.0, sd = 10.0;
+    ssm_accuracy_t levels[] = {SSM_ACC_EXACT, SSM_ACC_FAST, SSM_ACC_APPROX};
+    double tol[] = {1e-10, 1e-10, 1e-4};
+
+    for(i=0; i<3; i++){
+        calc->accuracy = levels[i];
+        for(y=0.0; y<=mu + 6*sd; y+=1.0){
+            double like = (y > 0.0) ? gsl_cdf_gaussian_P(y + 0.5 - mu, sd) - gsl_cdf_gaussian_P(y - 0.5 - mu, sd) : gsl_cdf_gaussian_P(y + 0.5 - mu, sd);
+            if(y >= mu - 6*sd){
+                cl_check(fabs(ssm_log_dnorm_discretized(y, mu, sd, calc) - log(like)) < tol[i]);
+            }
+            cl_check(fabs(ssm_log_dpois(y, mu, calc) - log(gsl_ran_poisson_pdf(y, mu))) < 1e-10);
+            cl_check(fabs(ssm_log_dbinom(y, 0.3, 500.0, calc) - log(gsl_ran_binomial_pdf(y, 0.3, 500))) < 1e-10);
+        }
+
+        //far in the tails the likelihood underflows but not the log likelihood
+        cl_check(isfinite(ssm_log_dnorm_discretized(1e4, mu, sd, calc)));
+        cl_check(isfinite(ssm_log_dnorm_discretized(0.0, 1e4, sd, calc)));
+        cl_check(ssm_log_dnorm_discretized(1e4, mu, sd, calc) < ssm_log_dnorm_discretized(5e3, mu, sd, calc));
+
+        cl_check(ssm_log_dpois(0.0, 0.0, calc) == 0.0);
+        cl_check(ssm_log_dbinom(51.0, 0.3, 50.0, calc) == GSL_NEGINF);
+    }
+
+    calc->accuracy = SSM_ACC_FAST;
+}
@@ -59,3 +59,283 @@ void test_fitness__fitness_new(void)
     }
 
 }
+
+void test_fitness__weight(void)
+{
+    ssm_row_t *row = data->rows[0];
+    double log_like = -800.0 * row->ts_nonan_length;
+
+    //the likelihood underflows in linear space
+    cl_check(exp(log_like) == 0.0);
+
+    fitness->log_like_min = -1000.0;
+    fitness->weights[0] = log_like;
+    cl_check(ssm_weight(fitness, row, nav, 0));
+    cl_check(fitness->weights[0] == 1.0);
+    cl_check(fitness->log_like_n == log_like);
+
+    //below like_min: lost
+    fitness->weights[0] = -1001.0 * row->ts_nonan_length;
+    cl_check(!ssm_weight(fitness, row, nav, 0));
+    cl_check(fitness->log_like_n == -1000.0 * row->ts_nonan_length);
+    cl_check(fitness->n_all_fail == 1);
+}
+
+void test_fitness__sanitize_log_likelihood(void)
+{
+    ssm_row_t *row = data->rows[0];
+    int print = nav->print;
+
+    nav->print = 0;
+    fitness->log_like_min = -1000.0;
+
+    //below like_min the log likelihood is kept (ssm_weight discards it)
+    cl_check(ssm_sanitize_log_likelihood(-2000.0 * row->ts_nonan_length, row, fitness, nav) == -2000.0 * row->ts_nonan_length);
+    cl_check(ssm_sanitize_log_likelihood(GSL_NEGINF, row, fitness, nav) == GSL_NEGINF);
+
+    //numerical errors
+    cl_check(ssm_sanitize_log_likelihood(GSL_NAN, row, fitness, nav) == -1000.0 * row->ts_nonan_length);
+    cl_check(ssm_sanitize_log_likelihood(GSL_POSINF, row, fitness, nav) == -1000.0 * row->ts_nonan_length);
+
+    nav->print = print;
+}
+
+void test_fitness__adaptive_resampling(void)
+{
+    int j;
+    ssm_row_t *row = data->rows[0];
+    ssm_X_t **J_X, **J_X_tmp, *X[4];
+    ssm_fitness_t *f;
+    unsigned int permutation[] = {1, 0, 3, 2};
+    unsigned int duplicates[] = {2, 2, 2, 0};
+    double weights[4];
+
+    opts->J = 4;
+    opts->ess_threshold = 0.5;
+    f = ssm_fitness_new(data, opts);
+    J_X = ssm_J_X_new(f, nav, opts);
+    J_X_tmp = ssm_J_X_new(f, nav, opts);
+    for(j=0; j<f->J; j++){
+        J_X[j]->proj[0] = j;
+        X[j] = J_X[j];
+    }
+
+    //nearly uniform weights: no resampling, the weights are carried over
+    for(j=0; j<f->J; j++){
+        f->weights[j] = log(1.0 + 0.1*j);
+    }
+    cl_check(ssm_weight(f, row, nav, 0));
+    cl_check(f->ess_n > 0.5*f->J);
+    cl_check(!ssm_adaptive_sampling(f, NULL, 0));
+    ssm_resample_X(f, &J_X, &J_X_tmp, 0);
+    for(j=0; j<f->J; j++){
+        cl_check(f->select[0][j] == j);
+        cl_check(J_X[j] == X[j]);
+        cl_check(f->weights_prev[j] == f->weights[j]);
+        weights[j] = f->weights[j];
+    }
+
+    //same likelihood for all the particles: the weights do not change
+    for(j=0; j<f->J; j++){
+        f->weights[j] = -1.0;
+    }
+    cl_check(ssm_weight(f, row, nav, 1));
+    cl_check(fabs(f->log_like_n + 1.0) < 1e-12);
+    for(j=0; j<f->J; j++){
+        cl_check(fabs(f->weights[j] - weights[j]) < 1e-12);
+    }
+
+    //a permutation of the ancestors only moves pointers
+    memcpy(f->select[1], permutation, sizeof(permutation));
+    ssm_resample_X(f, &J_X, &J_X_tmp, 1);
+    for(j=0; j<f->J; j++){
+        cl_check(J_X[j] == X[permutation[j]]);
+    }
+
+    //duplicated ancestors are copied
+    for(j=0; j<f->J; j++){
+        X[j] = J_X[j];
+    }
+    memcpy(f->select[1], duplicates, sizeof(duplicates));
+    ssm_resample_X(f, &J_X, &J_X_tmp, 1);
+    for(j=0; j<f->J; j++){
+        cl_check(J_X[j]->proj[0] == X[duplicates[j]]->proj[0]);
+    }
+    cl_check(J_X[0] == X[2] && J_X[3] == X[0]);
+
+    ssm_J_X_free(J_X, f);
+    ssm_J_X_free(J_X_tmp, f);
+    ssm_fitness_free(f);
+}
+
+void test_fitness__tree(void)
+{
+    int j, n, length;
+    ssm_X_t **J_X;
+    ssm_fitness_t *f;
+    ssm_tree_t *tree;
+    ssm_calc_t calc;
+    unsigned int coalesce[] = {0, 0, 0, 0};
+    unsigned int ones[] = {1, 1, 1, 1};
+    unsigned int *select[] = {coalesce, NULL, ones};
+    double weights[] = {0.0, 0.0, 1.0, 0.0};
+
+    opts->J = 4;
+    f = ssm_fitness_new(data, opts);
+    J_X = ssm_J_X_new(f, nav, opts);
+    tree = ssm_tree_new(f, nav, opts);
+    calc.randgsl = gsl_rng_alloc(gsl_rng_mt19937);
+
+    for(j=0; j<f->J; j++){
+        J_X[j]->proj[0] = j;
+    }
+    ssm_tree_init(tree, J_X);
+    cl_check(tree->size - tree->n_free == 4);
+
+    for(n=0; n<3; n++){
+        for(j=0; j<f->J; j++){
+            J_X[j]->proj[0] = 10*(n+1) + j;
+        }
+        ssm_tree_insert(tree, J_X, select[n], n);
+    }
+
+    //only the lineages of the leaves are left: 1 root, 1 node at n=0 and n=1 and the 4 leaves
+    cl_check(tree->size - tree->n_free == 7);
+    cl_check(tree->size == 16);
+
+    ssm_tree_set_weights(tree, weights);
+    length = ssm_tree_sample_path(tree, &calc);
+    cl_check(length == 3);
+    cl_check(tree->X[tree->path[0]]->proj[0] == 11);
+    cl_check(tree->X[tree->path[1]]->proj[0] == 21);
+    cl_check(tree->X[tree->path[2]]->proj[0] == 32);
+    for(n=0; n<3; n++){
+        cl_check(tree->row[tree->path[n]] == n);
+    }
+
+    //a new tree reuses the nodes
+    ssm_tree_init(tree, J_X);
+    cl_check(tree->size - tree->n_free == 4);
+
+    gsl_rng_free(calc.randgsl);
+    ssm_tree_free(tree);
+    ssm_J_X_free(J_X, f);
+    ssm_fitness_free(f);
+}
+
+void test_fitness__resampling_schemes(void)
+{
+    int j, c, j0, j1, scheme, chunks_length;
+    ssm_fitness_t *f;
+    ssm_calc_t calc;
+    unsigned int select[10];
+    int counts[10];
+    double weights[] = {0.3, 0.0, 0.05, 0.15, 0.0, 0.2, 0.01, 0.09, 0.1, 0.1};
+    ssm_resampling_t schemes[] = {SSM_RESAMPLING_SYSTEMATIC, SSM_RESAMPLING_STRATIFIED, SSM_RESAMPLING_RESIDUAL};
+
+    opts->J = 10;
+    opts->n_thread = 3;
+    f = ssm_fitness_new(data, opts);
+    cl_check(f->chunks_length == 3);
+    cl_check(f->J_chunk == 3);
+    calc.randgsl = gsl_rng_alloc(gsl_rng_mt19937);
+
+    for(scheme=0; scheme<3; scheme++){
+        f->resampling = schemes[scheme];
+
+        //the chunks run in any order give the same ancestors as a single chunk
+        for(chunks_length=1; chunks_length<=3; chunks_length+=2){
+            f->chunks_length = chunks_length;
+            f->J_chunk = f->J / chunks_length;
+            memcpy(f->weights, weights, sizeof(weights));
+            gsl_rng_set(calc.randgsl, 1);
+
+            for(c=chunks_length-1; c>=0; c--){
+                ssm_cumsum_chunk(f, c);
+            }
+            ssm_cumsum_chunks(f, &calc);
+            for(c=chunks_length-1; c>=0; c--){
+                j0 = c*f->J_chunk;
+                j1 = (c+1 == chunks_length) ? f->J : (c+1)*f->J_chunk;
+                ssm_sampling_chunk(f, &calc, 0, j0, j1);
+            }
+
+            for(j=0; j<f->J; j++){
+                counts[j] = 0;
+            }
+            for(j=0; j<f->J; j++){
+                counts[f->select[0][j]]++;
+                if(chunks_length == 1){
+                    select[j] = f->select[0][j];
+                } else if(f->resampling != SSM_RESAMPLING_STRATIFIED){
+                    cl_check(f->select[0][j] == select[j]);
+                }
+            }
+
+            for(j=0; j<f->J; j++){
+                if(weights[j] == 0.0){
+                    cl_check(counts[j] == 0);
+                }
+                if(f->resampling == SSM_RESAMPLING_SYSTEMATIC){
+                    cl_check(counts[j] >= floor(f->J*weights[j] - 1e-12) && counts[j] <= ceil(f->J*weights[j] + 1e-12));
+                } else if(f->resampling == SSM_RESAMPLING_RESIDUAL){
+                    cl_check(counts[j] >= floor(f->J*weights[j] + 1e-12));
+                }
+            }
+        }
+    }
+
+    gsl_rng_free(calc.randgsl);
+    ssm_fitness_free(f);
+}
+
+void test_fitness__collapse(void)
+{
+    int j;
+    ssm_X_t **J_X;
+    ssm_fitness_t *f;
+    unsigned int select[] = {3, 0, 0, 4, 3, 5};
+    int rep[] = {0, 1, 1, 3, 3, 3};
+
+    opts->J = 6;
+    opts->n_thread = 2;
+    f = ssm_fitness_new(data, opts);
+    J_X = ssm_J_X_new(f, nav, opts);
+
+    //stochastic dynamics: every particle is predicted
+    ssm_fitness_collapse(f, &ssm_f_prediction_psr);
+    cl_check(!f->flag_collapse);
+    for(j=0; j<f->J; j++){
+        cl_check(f->rep[j] == j);
+    }
+
+    //deterministic dynamics: one particle predicted per chunk
+    ssm_fitness_collapse(f, &ssm_f_prediction_ode);
+    cl_check(f->flag_collapse);
+    for(j=0; j<f->J; j++){
+        cl_check(f->rep[j] == ((j<3) ? 0 : 3));
+    }
+
+    //the offspring of the same group are copies of the first of them in their chunk
+    ssm_collapse_resample(f, select);
+    for(j=0; j<f->J; j++){
+        cl_check(f->rep[j] == rep[j]);
+        cl_check(f->_rep_map[j] == -1);
+    }
+
+    for(j=0; j<f->J; j++){
+        J_X[j]->proj[0] = (f->rep[j] == j) ? j : -1.0;
+        f->weights[j] = (f->rep[j] == j) ? j : -1.0;
+        f->cum_status[j] = SSM_SUCCESS;
+    }
+    f->cum_status[1] = SSM_ERR_PRED;
+    ssm_expand_X(f, J_X, 0, f->J);
+    for(j=0; j<f->J; j++){
+        cl_check(J_X[j]->proj[0] == rep[j]);
+        cl_check(f->weights[j] == rep[j]);
+    }
+    cl_check(f->cum_status[2] == SSM_ERR_PRED);
+
+    ssm_J_X_free(J_X, f);
+    ssm_fitness_free(f);
+}